@@ -1008,6 +1008,7 @@ def clean():
                    "xpra/server/cystats.c",
                    "xpra/rectangle.c",
                    "xpra/server/window/motion.c",
+                   "xpra/server/window/content_classifier.c",
                    "xpra/server/pam.c",
                    "etc/xpra/xpra.conf",
                    #special case for the generated xpra conf files in build (see #891):
@@ -2073,6 +2074,9 @@ if server_ENABLED or shadow_ENABLED:
     cython_add(Extension("xpra.server.window.motion",
                 ["xpra/server/window/motion.pyx"],
                 **O3_pkgconfig))
+    cython_add(Extension("xpra.server.window.content_classifier",
+                ["xpra/server/window/content_classifier.pyx"],
+                **O3_pkgconfig))
 
 if sd_listen_ENABLED:
     sdp = pkgconfig("libsystemd")
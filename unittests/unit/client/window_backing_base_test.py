@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+from threading import Lock
+
+from xpra.client.window_backing_base import WindowBackingBase
+
+
+class FakeDecoder(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def __repr__(self):
+        return self.name
+
+    def clean(self):
+        self.closed = True
+
+
+def make_backing():
+    #skip the codec loading done by the constructor:
+    backing = WindowBackingBase.__new__(WindowBackingBase)
+    backing._video_decoder = None
+    backing._csc_decoder = None
+    backing._video_streams = {}
+    backing._decoder_lock = Lock()
+    return backing
+
+
+class TestWindowBackingBase(unittest.TestCase):
+
+    def test_stream_decoders(self):
+        backing = make_backing()
+        assert backing.get_stream_decoders()==(None, None)
+        assert backing.get_stream_decoders(1)==(None, None)
+        vd0, cd0 = FakeDecoder("vd0"), FakeDecoder("cd0")
+        vd1, cd1 = FakeDecoder("vd1"), FakeDecoder("cd1")
+        backing.set_stream_decoders(0, vd0, cd0)
+        backing.set_stream_decoders(1, vd1, cd1)
+        #stream 0 uses the main decoders:
+        assert backing._video_decoder is vd0 and backing._csc_decoder is cd0
+        assert backing.get_stream_decoders(0)==(vd0, cd0)
+        assert backing.get_stream_decoders(1)==(vd1, cd1)
+        #clearing both decoders removes the stream:
+        backing.set_stream_decoders(1, None, None)
+        assert 1 not in backing._video_streams
+        assert backing.get_stream_decoders(0)==(vd0, cd0)
+
+    def test_eos(self):
+        backing = make_backing()
+        decoders = {}
+        for stream in (0, 1, 2):
+            vd, cd = FakeDecoder("vd%i" % stream), FakeDecoder("cd%i" % stream)
+            decoders[stream] = vd, cd
+            backing.set_stream_decoders(stream, vd, cd)
+        #only the stream given is cleaned:
+        backing.eos(1)
+        assert all(x.closed for x in decoders[1])
+        assert backing.get_stream_decoders(1)==(None, None)
+        assert 1 not in backing._video_streams
+        for stream in (0, 2):
+            assert not any(x.closed for x in decoders[stream])
+            assert backing.get_stream_decoders(stream)==decoders[stream]
+        backing.eos()
+        assert all(x.closed for x in decoders[0])
+        assert backing.get_stream_decoders(0)==(None, None)
+        assert backing.get_stream_decoders(2)==decoders[2]
+        #closing cleans all the streams:
+        assert backing.close_decoder(True)
+        assert all(x.closed for x in decoders[2])
+        assert not backing._video_streams
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from xpra.codecs.codec_constants import video_spec, csc_spec
+from xpra.codecs.video_helper import VideoHelper, get_specs_generation
+from xpra.codecs.codec_benchmark import (
+    get_speed, get_spec_key, get_host_id, make_benchmark_image,
+    save_benchmark, load_benchmark, apply_benchmark,
+    ENCODER_REFERENCE, CSC_REFERENCE,
+    )
+
+
+class TestCodecBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.espec = video_spec("h264", "YUV420P", ["YUV420P"], False, object, "test-encoder", speed=60, setup_cost=20)
+        self.cspec = csc_spec("BGRX", "YUV420P", object, "test-csc", speed=60, setup_cost=20)
+        self.vh = VideoHelper({"h264" : {"YUV420P" : [self.espec]}}, {"BGRX" : {"YUV420P" : [self.cspec]}}, {}, True)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_speed(self):
+        assert get_speed(ENCODER_REFERENCE, ENCODER_REFERENCE)==100
+        assert get_speed(ENCODER_REFERENCE*10, ENCODER_REFERENCE)==100
+        assert get_speed(ENCODER_REFERENCE/2.0, ENCODER_REFERENCE)==80
+        assert get_speed(0, ENCODER_REFERENCE)==0
+
+    def test_apply(self):
+        results = {
+            "host"      : get_host_id(),
+            "encoders"  : {
+                get_spec_key(self.espec) : {
+                    "version"   : "",
+                    "results"   : [[1000*1000, 50, ENCODER_REFERENCE], [100*1000, 10, ENCODER_REFERENCE/4.0]],
+                    },
+                },
+            "csc"       : {
+                get_spec_key(self.cspec) : {
+                    "version"   : "other",
+                    "results"   : [[1000*1000, 1, CSC_REFERENCE]],
+                    },
+                },
+            }
+        filename = os.path.join(self.tmpdir, "benchmark.json")
+        save_benchmark(results, filename)
+        loaded = load_benchmark(filename)
+        assert loaded
+        generation = get_specs_generation()
+        #the csc results are for another version:
+        assert apply_benchmark(self.vh, loaded)==1
+        assert get_specs_generation()>generation
+        assert self.cspec.get_speed(1000*1000)==60 and self.cspec.get_setup_cost()==20
+        #interpolated between the measurements:
+        assert self.espec.get_speed(100*1000)==60
+        assert self.espec.get_speed(1000*1000)==100
+        assert self.espec.get_speed(550*1000)==80
+        assert self.espec.get_speed(10*1000*1000)==100
+        assert self.espec.get_setup_cost(10)==10
+        assert self.espec.get_setup_cost(1000*1000)==50
+        #results from another host are ignored:
+        results["host"] = "some other host"
+        save_benchmark(results, filename)
+        assert load_benchmark(filename) is None
+        assert load_benchmark(os.path.join(self.tmpdir, "missing.json")) is None
+
+    def test_image(self):
+        for fmt in ("BGRX", "YUV420P"):
+            image = make_benchmark_image(fmt, 64, 32, 1)
+            assert image.get_width()==64 and image.get_pixel_format()==fmt
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.codecs.tile_cache import TileCache
+
+
+class TestTileCache(unittest.TestCase):
+
+    def test_lru(self):
+        tc = TileCache(3, 1000)
+        for i in range(3):
+            tc.add(i, 100, i)
+        #touch the oldest entry:
+        assert tc.get(0)==0
+        tc.add(3, 100, 3)
+        #so the next oldest one got evicted:
+        assert tc.get(1) is None
+        assert len(tc)==3
+        assert tc.get(0)==0 and tc.get(2)==2 and tc.get(3)==3
+
+    def test_pixel_limit(self):
+        tc = TileCache(10, 1000)
+        assert not tc.can_store(1001)
+        tc.add(1, 600, None)
+        tc.add(2, 600, None)
+        assert tc.pixels==600
+        assert tc.get(1) is None
+        #replacing an entry does not count it twice:
+        tc.add(2, 500, None)
+        assert tc.pixels==500
+
+    def test_mirror(self):
+        #the client and server instances must end up with the same keys:
+        client = TileCache(4, 10000)
+        server = TileCache(4, 10000)
+        ops = [("add", 1, 1000), ("add", 2, 3000), ("get", 1, 0), ("add", 3, 5000),
+               ("add", 4, 2000), ("get", 2, 0), ("add", 5, 100), ("add", 1, 100)]
+        for op, key, pixels in ops:
+            for tc, value in ((client, b"pixels"), (server, True)):
+                if op=="add":
+                    tc.add(key, pixels, value)
+                else:
+                    tc.get(key)
+        assert tuple(client.tiles.keys())==tuple(server.tiles.keys())
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import socket
+import unittest
+from threading import Timer, Event
+
+from xpra.os_util import PYTHON3, bytestostr
+from xpra.net.bytestreams import SocketConnection, SSLSocketConnection
+from xpra.net.compression import Compressed
+
+
+class ThreadScheduler(object):
+    """ runs the callbacks from timer threads, good enough for these tests """
+
+    def idle_add(self, fn, *args):
+        return self.timeout_add(0, fn, *args)
+
+    def timeout_add(self, delay, fn, *args):
+        t = Timer(delay/1000.0, fn, args)
+        t.daemon = True
+        t.start()
+        return t
+
+    def source_remove(self, timer):
+        timer.cancel()
+
+
+class TestAsyncioProtocol(unittest.TestCase):
+
+    def make_protocols(self, server_packet_cb, get_packet_cb):
+        from xpra.net.asyncio_protocol import AsyncioProtocol
+        s1, s2 = socket.socketpair()
+        c1 = SocketConnection(s1, "local", "remote", "target", "unix-domain")
+        c2 = SocketConnection(s2, "remote", "local", "target", "unix-domain")
+        scheduler = ThreadScheduler()
+        def noop(*_args):
+            pass
+        server = AsyncioProtocol(scheduler, c1, server_packet_cb)
+        client = AsyncioProtocol(scheduler, c2, noop, get_packet_cb)
+        for p in (server, client):
+            p.enable_encoder("bencode")
+            p.enable_compressor("none")
+            p.start()
+        return server, client
+
+    def test_is_supported(self):
+        from xpra.net.asyncio_protocol import is_supported
+        s1, s2 = socket.socketpair()
+        try:
+            assert is_supported(SocketConnection(s1, "local", "remote", "target", "unix-domain"))
+            assert not is_supported(SSLSocketConnection(s2, "local", "remote", "target", "ssl"))
+        finally:
+            s1.close()
+            s2.close()
+
+    def test_packets(self):
+        N = 20
+        large = b"x"*(1024*1024)
+        received = []
+        done = Event()
+        def process_packet(_proto, packet):
+            if bytestostr(packet[0])=="test":
+                received.append(packet)
+                if len(received)==N:
+                    done.set()
+        packets = [("test", i, Compressed("data", large)) for i in range(N)]
+        def get_packet():
+            packet = packets.pop(0)
+            return packet, None, None, None, True, bool(packets)
+        server, client = self.make_protocols(process_packet, get_packet)
+        try:
+            client.source_has_more()
+            assert done.wait(20), "only received %i packets" % len(received)
+            assert [p[1] for p in received]==list(range(N))
+            assert all(bytes(p[2])==large for p in received)
+            assert server.input_packetcount>=N and client.output_packetcount>=N
+            assert not server._read_thread and not server._read_parser_thread and not server._write_thread
+        finally:
+            server.close()
+            client.close()
+        assert server.wait_for_io_threads_exit(5) and client.wait_for_io_threads_exit(5)
+
+
+def main():
+    if PYTHON3:
+        unittest.main()
+
+if __name__ == '__main__':
+    main()
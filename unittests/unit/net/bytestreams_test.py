@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import socket
+import unittest
+
+from xpra.net.bytestreams import Connection, SocketConnection, SOCKET_WRITEV, FD_PASSING
+
+
+class TestSocketConnection(unittest.TestCase):
+
+    def make_connections(self):
+        s1, s2 = socket.socketpair()
+        c1 = SocketConnection(s1, "local", "remote", "target", "unix-domain")
+        c2 = SocketConnection(s2, "remote", "local", "target", "unix-domain")
+        return c1, c2
+
+    def test_write(self):
+        c1, c2 = self.make_connections()
+        try:
+            assert c1.write(b"hello")==5
+            assert c2.read(1024)==b"hello"
+            assert c1.output_bytecount==5 and c1.output_writecount==1
+        finally:
+            c1._socket.close()
+            c2._socket.close()
+
+    def test_writev(self):
+        c1, c2 = self.make_connections()
+        try:
+            assert c1.can_writev()==SOCKET_WRITEV
+            if not SOCKET_WRITEV:
+                return
+            buffers = [memoryview(b"header"), memoryview(b"payload"*100)[7:], memoryview(bytearray(b"end"))]
+            size = sum(buf.nbytes for buf in buffers)
+            assert c1.writev(buffers)==size
+            data = b""
+            while len(data)<size:
+                data += c2.read(size)
+            assert data==b"header"+b"payload"*99+b"end"
+            assert c1.output_bytecount==size and c1.output_writecount==1
+        finally:
+            c1._socket.close()
+            c2._socket.close()
+
+    def test_writev_fallback(self):
+        written = []
+        class WriteConnection(Connection):
+            def write(self, buf):
+                written.append(buf)
+                return len(buf)
+        c = WriteConnection(("local", ), "test")
+        assert not c.can_writev()
+        buffers = [memoryview(b"header"), b"payload", memoryview(bytearray(b"end"))]
+        assert c.writev(buffers)==len("headerpayloadend")
+        assert written==[b"headerpayloadend"]
+
+    @unittest.skipUnless(FD_PASSING, "file descriptor passing is not available")
+    def test_fd_passing(self):
+        c1, c2 = self.make_connections()
+        r, w = os.pipe()
+        try:
+            assert c1.can_pass_fds()
+            c2.enable_fd_passing()
+            c1.send_fds([w])
+            assert c1.write(b"hello")==5
+            #the connection owns the file descriptor and closes it once sent:
+            assert not c1.pending_fds
+            self.assertRaises(OSError, os.fstat, w)
+            assert c2.read(1024)==b"hello"
+            fd = c2.pop_received_fd()
+            assert fd>=0 and c2.pop_received_fd()==-1
+            os.write(fd, b"via fd")
+            os.close(fd)
+            assert os.read(r, 1024)==b"via fd"
+        finally:
+            os.close(r)
+            c1._socket.close()
+            c2._socket.close()
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
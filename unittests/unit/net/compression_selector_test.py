@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.net.compression_selector import CompressionSelector, NONE, PROBE_COUNT, REPROBE_INTERVAL, MAX_LEVEL
+
+
+class TestCompressionSelector(unittest.TestCase):
+
+    def run_packets(self, selector, packet_type, size, results, n):
+        """ results maps each option to its compressed size and the time it takes """
+        selected = []
+        for _ in range(n):
+            option = selector.select(packet_type, size)
+            selected.append(option)
+            if option!=NONE:
+                out_size, elapsed = results[option]
+                selector.record(packet_type, option, size, out_size, elapsed)
+        return selected
+
+    def test_options(self):
+        cs = CompressionSelector()
+        cs.set_options(("lz4", "zlib"), 1)
+        assert cs.options==(NONE, ("lz4", 1), ("zlib", 1), ("lz4", MAX_LEVEL))
+        cs.set_options(("lz4", ), 0)
+        assert cs.options==(NONE, )
+        assert cs.select("ping", 1000)==NONE
+
+    def test_incompressible(self):
+        #compressing does not save anything, so we stop doing it:
+        cs = CompressionSelector(bandwidth=100*1000*1000)
+        cs.set_options(("lz4", ), 1)
+        results = {
+            ("lz4", 1)          : (1000, 0.0001),
+            ("lz4", MAX_LEVEL)  : (990, 0.001),
+            }
+        selected = self.run_packets(cs, "cursor", 1000, results, 50)
+        assert selected[:PROBE_COUNT*2]==[("lz4", 1)]*PROBE_COUNT+[("lz4", MAX_LEVEL)]*PROBE_COUNT
+        assert set(selected[PROBE_COUNT*2:])==set([NONE])
+
+    def test_compressible(self):
+        #on a slow link, the stronger level is worth it:
+        cs = CompressionSelector(bandwidth=1000*1000)
+        cs.set_options(("lz4", "zlib"), 1)
+        results = {
+            ("lz4", 1)          : (50000, 0.001),
+            ("zlib", 1)         : (30000, 0.005),
+            ("lz4", MAX_LEVEL)  : (20000, 0.01),
+            }
+        selected = self.run_packets(cs, "window-metadata", 100000, results, REPROBE_INTERVAL*2)
+        best = [o for o in selected[PROBE_COUNT*3:] if o!=("lz4", MAX_LEVEL)]
+        #the other options are only probed again occasionally:
+        assert len(best)<=2, "unexpected selection: %s" % (best,)
+        #on a faster link, use the fastest:
+        cs.bandwidth = 100*1000*1000
+        selected = self.run_packets(cs, "window-metadata", 100000, results, 10)
+        assert selected[-1]==("lz4", 1)
+        #and on a very fast link, don't compress at all:
+        cs.bandwidth = 1000*1000*1000
+        selected = self.run_packets(cs, "window-metadata", 100000, results, 10)
+        assert selected[-1]==NONE
+        info = cs.get_info()
+        assert info["packets"]["window-metadata"]["lz4:1"]["ratio"]==50
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from xpra.net import compression
+from xpra.net.header import ZSTD_FLAG, CHUNKED_FLAG
+
+
+@unittest.skipUnless(compression.has_zstd, "zstd is not available")
+class TestZstd(unittest.TestCase):
+
+    def test_levels(self):
+        data = b"hello world, "*1000
+        for level in range(11):
+            cl, cdata = compression.zstd_compress(data, level)
+            assert cl & ZSTD_FLAG and cl & 0xf==level
+            assert compression.get_compression_type(cl)=="zstd"
+            assert len(cdata)<len(data)
+            assert compression.decompress(cdata, cl)==data
+
+    def test_wrapper(self):
+        data = b"0123456789"*100
+        cw = compression.compressed_wrapper("test", data, zstd=True)
+        assert cw.algorithm=="zstd"
+        assert compression.decompress_by_name(cw.data, "zstd")==data
+
+    def test_max_size(self):
+        data = b"0"*2000
+        _, cdata = compression.zstd_compress(data, 1)
+        saved = compression.MAX_SIZE
+        try:
+            compression.MAX_SIZE = 1000
+            #the size declared in the frame header is checked before decompressing:
+            with self.assertRaises(compression.InvalidCompressionException):
+                compression.zstd_decompress(cdata)
+            compression.MAX_SIZE = 4000
+            assert compression.zstd_decompress(cdata)==data
+        finally:
+            compression.MAX_SIZE = saved
+
+    def test_dictionaries(self):
+        samples = [b"['window-metadata', %i, {'title': 'window %i', 'class-instance': ('xterm', 'XTerm')}]" % (i, i) for i in range(1000)]
+        zdict = compression.train_zstd_dictionary(samples, 4096)
+        tmpdir = tempfile.mkdtemp()
+        saved = compression.ZSTD_DICTIONARY_DIRS, compression.zstd_dictionaries, compression.zstd_dictionary_types
+        try:
+            with open(os.path.join(tmpdir, "metadata.zdict"), "wb") as f:
+                f.write(zdict)
+            compression.ZSTD_DICTIONARY_DIRS = [tmpdir]
+            compression.zstd_dictionaries = None
+            compression.zstd_dictionary_types = {}
+            dict_ids = tuple(compression.get_zstd_dictionaries().keys())
+            assert len(dict_ids)==1
+            dict_id = dict_ids[0]
+            assert compression.get_zstd_dictionary_id("window-metadata", dict_ids)==dict_id
+            assert compression.get_zstd_dictionary_id(b"window-metadata", dict_ids)==dict_id
+            #the peer does not have it:
+            assert compression.get_zstd_dictionary_id("window-metadata", ())==0
+            #no "control" dictionary:
+            assert compression.get_zstd_dictionary_id("ping", dict_ids)==0
+            packet = samples[0]
+            cl, with_dict = compression.zstd_compress(packet, 5, dict_id)
+            _, without_dict = compression.zstd_compress(packet, 5)
+            assert len(with_dict)<len(without_dict)
+            assert compression.decompress(with_dict, cl)==packet
+        finally:
+            compression.ZSTD_DICTIONARY_DIRS, compression.zstd_dictionaries, compression.zstd_dictionary_types = saved
+            shutil.rmtree(tmpdir)
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_compressors(self):
+        enabled = compression.get_enabled_compressors()
+        assert ("zstd" in enabled)==compression.use_zstd
+        for c in enabled:
+            compressor = compression.get_compressor(c)
+            assert compression.get_compressor_name(compressor)==c
+
+    def test_chunked(self):
+        data = os.urandom(1024)*300
+        cl, cdata = compression.chunked_compress(compression.zcompress, data, 3, chunk_size=64*1024)
+        assert cl & CHUNKED_FLAG and cl & 0xf==3
+        assert compression.get_compression_type(cl & ~CHUNKED_FLAG)=="zlib"
+        assert len(cdata)<len(data)
+        assert compression.decompress(cdata, cl)==data
+        assert compression.decompress(memoryview(cdata), cl)==data
+        #corrupted chunk sizes:
+        for bad in (cdata[:-1], b"\0"*4+cdata[4:], b"\xff"*4+cdata[4:]):
+            try:
+                compression.decompress(bad, cl)
+            except compression.InvalidCompressionException:
+                pass
+            else:
+                raise Exception("corrupted data should have been rejected")
+
+    def test_chunked_wrapper(self):
+        data = b"0123456789"*1000
+        saved = compression.CHUNKED_COMPRESSION_SIZE
+        try:
+            compression.CHUNKED_COMPRESSION_SIZE = 1024
+            cw = compression.compressed_wrapper("test", data, zlib=True, chunked=True)
+            assert cw.level & CHUNKED_FLAG
+            assert compression.decompress(cw.data, cw.level)==data
+            cw = compression.compressed_wrapper("test", data, zlib=True)
+            assert not cw.level & CHUNKED_FLAG
+        finally:
+            compression.CHUNKED_COMPRESSION_SIZE = saved
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
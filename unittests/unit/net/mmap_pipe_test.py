@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import mmap
+import unittest
+
+from xpra.net.mmap_pipe import MmapAreas, MmapAllocator, mmap_read, mmap_write, MMAP_ALLOC_UNIT
+
+
+UNIT = MMAP_ALLOC_UNIT
+
+
+class TestMmapAllocator(unittest.TestCase):
+
+    def test_allocate_free(self):
+        a = MmapAllocator()
+        a.add_area(mmap.mmap(-1, 64*UNIT), 64*UNIT, 0, UNIT)
+        assert a.free_size==63*UNIT
+        o1 = a.allocate(1)
+        o2 = a.allocate(UNIT+1)
+        o3 = a.allocate(4*UNIT)
+        assert o1==UNIT and o2==2*UNIT and o3==4*UNIT, "got %s" % ((o1, o2, o3),)
+        assert a.free_size==(63-7)*UNIT
+        #too big:
+        assert a.allocate(64*UNIT)==-1
+        #the hole left by a free block is re-used:
+        a.free(o2)
+        assert len(a.free_blocks)==2
+        assert a.allocate(2*UNIT)==o2
+        #free out of order, the free blocks are merged back together:
+        a.free(o3)
+        assert len(a.free_blocks)==1
+        a.free(o1)
+        assert len(a.free_blocks)==2
+        a.free(o2)
+        assert a.free_blocks=={UNIT : 63*UNIT}, "got %s" % (a.free_blocks,)
+        assert a.free_size==63*UNIT
+
+    def test_areas(self):
+        full = []
+        a = MmapAllocator(full.append)
+        a.add_area(mmap.mmap(-1, 16*UNIT), 16*UNIT, 0, UNIT)
+        o1 = a.allocate(10*UNIT)
+        assert o1>0
+        data = b"x"*(10*UNIT)
+        chunks, _ = mmap_write(a, 0, data)
+        assert chunks is None and full==[len(data)]
+        #add another area, using the same offsets on both ends:
+        client = MmapAreas()
+        client.add_area(a.areas[0][0], 16*UNIT, 0)
+        area = mmap.mmap(-1, 32*UNIT)
+        base = client.add_area(area, 32*UNIT)
+        assert base>=17*UNIT
+        a.add_area(area, 32*UNIT, base)
+        chunks, free_size = mmap_write(a, 0, data)
+        assert chunks==[(base, len(data))], "got %s" % (chunks,)
+        assert free_size==(15-10+32-10)*UNIT
+        assert memoryview(mmap_read(client, *chunks)).tobytes()==data
+        #areas cannot overlap:
+        try:
+            a.add_area(mmap.mmap(-1, 16*UNIT), 16*UNIT, base)
+        except ValueError:
+            pass
+        else:
+            raise Exception("overlapping areas should not be allowed")
+        #blocks do not get merged across areas:
+        a.free(base)
+        a.free(o1)
+        assert len(a.free_blocks)==2
+        assert a.get_info()["free"]==(15+32)*UNIT
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,7 @@ from xpra.os_util import monotonic_time
 from xpra.net.protocol import Protocol
 from xpra.net.bytestreams import Connection
 from xpra.net.compression import Compressed
+from xpra.net.header import pack_header
 from xpra.gtk_common.gobject_compat import import_glib
 from xpra.log import Logger
 
@@ -53,6 +54,21 @@ class FastMemoryConnection(Connection):
         return "FastMemoryConnection"
 
 
+class SlowWritevConnection(FastMemoryConnection):
+    """ only ever writes part of the buffers it is given """
+    def __init__(self, max_write):
+        FastMemoryConnection.__init__(self, [])
+        self.max_write = max_write
+
+    def can_writev(self):
+        return True
+
+    def writev(self, buffers):
+        data = b"".join(bytes(buf) for buf in buffers)[:self.max_write]
+        self.write_data.append(data)
+        return len(data)
+
+
 def noop(*_args):
     pass
 
@@ -128,6 +144,55 @@ class ProtocolTest(unittest.TestCase):
                 items = p.encode(packet)
                 assert items
 
+    def test_writev_buffers(self):
+        buf_data = [b"header", b"", b"A"*1000, bytearray(b"B"*10), memoryview(b"C"*3000)]
+        expected = b"".join(bytes(buf) for buf in buf_data)
+        for max_write in (1, 7, 1000, 1016, 10000):
+            p = self.make_memory_protocol()
+            p._conn = conn = SlowWritevConnection(max_write)
+            p.write_buffers(buf_data, None, False)
+            assert b"".join(conn.write_data)==expected
+            assert p.output_raw_packetcount==len(conn.write_data)==(len(expected)+max_write-1)//max_write
+
+    def test_large_payload_allocation(self):
+        p = self.make_memory_protocol()
+        p.max_packet_size = 1024*1024
+        parser = p.packet_parser()
+        next(parser)
+        #not validated yet, so we don't allocate a buffer for it:
+        parser.send(pack_header(0, 0, 0, 128*1024*1024))
+        assert parser.gi_frame.f_locals.get("payload") is None
+        p = self.make_memory_protocol()
+        p.max_packet_size = 1024*1024
+        parser = p.packet_parser()
+        next(parser)
+        parser.send(pack_header(0, 0, 0, 512*1024))
+        assert len(parser.gi_frame.f_locals.get("payload"))==512*1024
+
+    def test_raw_packets(self):
+        #use the plain xpra protocol to generate the data we feed to the packet parser:
+        p = Protocol(glib, FastMemoryConnection([]), noop)
+        p.enable_encoder("rencode")
+        p.enable_compressor("lz4")
+        data = []
+        def raw_write(items, *_args):
+            data.extend(items)
+        p.raw_write = raw_write
+        pixel_data = os.urandom(2**18)
+        p._add_packet_to_queue(("draw", 100, 100, 640, 480, Compressed("pixel-data", pixel_data), {}))
+        packets = []
+        def process_packet_cb(_proto, packet):
+            packets.append(packet)
+        protocol = self.make_memory_protocol(process_packet_cb=process_packet_cb)
+        parser = protocol.packet_parser()
+        next(parser)
+        for item in data:
+            parser.send(item)
+        assert len(packets)==1
+        #the raw packets are delivered as bytes:
+        assert isinstance(packets[0][5], bytes)
+        assert packets[0][5]==pixel_data
+
     def test_read_speed(self):
         total_size = 0
         total_elapsed = 0
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.net.read_buffer import ReadBuffer
+
+
+class TestReadBuffer(unittest.TestCase):
+
+    def test_append_take(self):
+        rb = ReadBuffer(16)
+        assert not rb and len(rb)==0
+        rb.append(b"hello")
+        rb.append(memoryview(b"world"))
+        rb.append(bytearray(b"!"))
+        rb.append(b"")
+        assert len(rb)==11
+        assert rb.peek(5).tobytes()==b"hello"
+        assert rb.peek(100).tobytes()==b"helloworld!"
+        assert rb.take(5)==b"hello"
+        assert rb.take(6)==b"world!"
+        assert not rb
+        with self.assertRaises(AssertionError):
+            rb.take(1)
+
+    def test_compact_and_grow(self):
+        rb = ReadBuffer(16)
+        rb.append(b"0123456789")
+        assert rb.take(8)==b"01234567"
+        #no room at the end, the unread bytes are moved back to the start:
+        rb.append(b"abcdefghij")
+        assert len(rb.buffer)==16
+        assert rb.take(12)==b"89abcdefghij"
+        #too big, grow:
+        rb.append(b"x"*100)
+        assert len(rb.buffer)>=100
+        assert rb.take(100)==b"x"*100
+        #emptied, so we go back to the initial size:
+        assert len(rb.buffer)==16
+
+    def test_take_into(self):
+        rb = ReadBuffer(16)
+        rb.append(b"abcdef")
+        target = bytearray(4)
+        assert rb.take_into(target, 1)==3
+        assert target==bytearray(b"\0abc")
+        assert rb.take(3)==b"def"
+        assert rb.take_into(target)==0
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import unittest
+import tempfile
+
+from xpra.server.window import batch_delay_calculator
+from xpra.server.window.batch_config import DamageBatchConfig
+from xpra.server.window.batch_tuner import (
+    get_tuning_profile, apply_tuning_profile,
+    load_tuning_profile, save_tuning_profile,
+    BatchTuner,
+    )
+
+
+class TestBatchTuner(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = get_tuning_profile()
+
+    def tearDown(self):
+        apply_tuning_profile(self.saved)
+
+    def test_round_trip(self):
+        profile = get_tuning_profile()
+        profile["batch.min-delay"] = 12
+        profile["speed.backlog-frames"] = 8
+        profile["quality.latency-ratio"] = 1.5
+        fd, filename = tempfile.mkstemp(suffix=".conf")
+        os.close(fd)
+        try:
+            save_tuning_profile(filename, profile, ("test profile", ))
+            loaded = load_tuning_profile(filename)
+        finally:
+            os.unlink(filename)
+        assert loaded==profile, "expected %s but got %s" % (profile, loaded)
+        assert DamageBatchConfig.MIN_DELAY==12
+        assert DamageBatchConfig().min_delay==12
+        assert batch_delay_calculator.TUNING["speed.backlog-frames"]==8
+        assert batch_delay_calculator.TUNING["quality.latency-ratio"]==1.5
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            apply_tuning_profile({"foo" : 1})
+        fd, filename = tempfile.mkstemp(suffix=".conf")
+        try:
+            os.write(fd, b"speed.backlog-frames = 1000\n")
+            os.close(fd)
+            with self.assertRaises(ValueError):
+                load_tuning_profile(filename)
+        finally:
+            os.unlink(filename)
+        with self.assertRaises(ValueError):
+            load_tuning_profile("/this-file-does-not-exist")
+
+    def test_candidates(self):
+        tuner = BatchTuner([], {})
+        profile = get_tuning_profile()
+        profile["speed.backlog-frames"] = 1
+        #the value can only go up from the minimum:
+        assert tuner.get_candidates(profile, "speed.backlog-frames")==[2]
+        profile["batch.actual-delay-weight"] = 0.8
+        candidates = tuner.get_candidates(profile, "batch.actual-delay-weight")
+        assert 1.0 in candidates and 0.4 in candidates and len(candidates)==3
+
+    def test_cost(self):
+        tuner = BatchTuner([], {}, latency_weight=1, bytes_weight=10, quality_weight=2)
+        results = {
+            "latency"   : {"90p" : 50},
+            "bytes"     : 2*1024*1024,
+            "quality"   : 90,
+            }
+        assert tuner.get_cost(results)==50+20+20
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
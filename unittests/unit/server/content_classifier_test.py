@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.server.window.content_classifier import (  #@UnresolvedImport
+    get_pixel_stats, classify_stats, classify_image,
+    )
+
+W = 256
+H = 128
+
+
+def make_pixels(fn, width=W, height=H):
+    pixels = bytearray(width*height*4)
+    for y in range(height):
+        for x in range(width):
+            r, g, b = fn(x, y)
+            i = (y*width+x)*4
+            pixels[i:i+4] = bytearray((b, g, r, 0))
+    return bytes(pixels)
+
+def text(x, y):
+    #glyph like strokes on a white background:
+    if (x%7 in (1, 2) and y%12<9) or (y%12==4 and x%7<5):
+        return 0, 0, 0
+    return 255, 255, 255
+
+def ui(x, y):
+    #a few flat panels with borders:
+    if x in (10, 200) or y==50:
+        return 0, 0, 0
+    if y<50:
+        return 230, 230, 230
+    return 250, 250, 250
+
+def picture(x, y):
+    #smooth gradients with lots of colors:
+    return (x+y)%256, (x*2)%256, (y*3+(x*y)%5)%256
+
+
+class TestContentClassifier(unittest.TestCase):
+
+    def classify(self, fn):
+        return classify_stats(*get_pixel_stats(make_pixels(fn), W, H, W*4))
+
+    def test_classify(self):
+        assert self.classify(text)=="text"
+        assert self.classify(ui)=="ui"
+        assert self.classify(picture)=="picture"
+        assert self.classify(lambda x,y : (200, 200, 200))=="ui"
+
+    def test_stats(self):
+        samples, ncolors, flat, edges, gradients = get_pixel_stats(make_pixels(text), W, H, W*4, max_samples=256)
+        assert 0<samples<=256
+        assert ncolors==2
+        assert flat+edges==samples and gradients==0
+        #the padding byte is ignored:
+        pixels = bytes(bytearray(v for i in range(64*64) for v in (10, 20, 30, i%256)))
+        samples, ncolors, flat, edges, gradients = get_pixel_stats(pixels, 64, 64, 64*4)
+        assert ncolors==1 and flat==samples
+        #too small to tell:
+        assert get_pixel_stats(b"\0"*4, 1, 1, 4)[0]==0
+        assert classify_stats(*get_pixel_stats(b"\0"*16, 2, 2, 8))==""
+
+    def test_invalid(self):
+        with self.assertRaises(AssertionError):
+            get_pixel_stats(b"\0"*100, 64, 64, 64*4)
+        with self.assertRaises(AssertionError):
+            get_pixel_stats(b"\0"*64*64*4, 64, 64, 10)
+
+    def test_image(self):
+        pixels = make_pixels(text)
+        image = ImageWrapper(0, 0, W, H, pixels, "BGRX", 24, W*4, 4)
+        assert classify_image(image)=="text"
+        image = ImageWrapper(0, 0, W, H, pixels, "RGB", 24, W*3, 3)
+        assert classify_image(image)==""
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import unittest
+import tempfile
+
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.buffers.membuf import get_xxh64   #@UnresolvedImport
+from xpra.server.window.damage_trace import (
+    DamageTraceRecorder, read_damage_trace,
+    WINDOW, DAMAGE, FLAG_OR,
+    )
+
+
+class FakeWindow(object):
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def get_dimensions(self):
+        return self.width, self.height
+
+    def is_OR(self):
+        return True
+
+    def has_alpha(self):
+        return False
+
+    def is_tray(self):
+        return False
+
+    def get(self, prop, default_value=None):
+        if prop=="content-type":
+            return "text"
+        return default_value
+
+    def get_image(self, x, y, w, h):
+        pixels = bytes(bytearray((x+y+i)%256 for i in range(w*h*4)))
+        return ImageWrapper(x, y, w, h, pixels, "BGRX", 24, w*4, 4)
+
+
+class TestDamageTrace(unittest.TestCase):
+
+    def record(self, pixels):
+        fd, filename = tempfile.mkstemp(suffix=".trace")
+        os.close(fd)
+        try:
+            recorder = DamageTraceRecorder(filename, pixels, hash_interval=0)
+            recorder.start()
+            window = FakeWindow(100, 50)
+            recorder.record(1, window, 0, 0, 100, 50)
+            recorder.record(1, window, 10, 20, 8, 4)
+            #zero sized damage is ignored:
+            recorder.record(1, window, 10, 20, 0, 4)
+            window.width = 200
+            recorder.record(1, window, 5, 5, 2, 2)
+            recorder.stop()
+            info = recorder.get_info()
+            assert info["records"]==5, "expected 5 records but got %s" % (info,)
+            return list(read_damage_trace(filename))
+        finally:
+            os.unlink(filename)
+
+    def check_records(self, records):
+        assert len(records)==5
+        assert [r[0] for r in records]==[WINDOW, DAMAGE, DAMAGE, WINDOW, DAMAGE]
+        assert records[0][2:]==(1, 100, 50, FLAG_OR, "text")
+        assert records[3][2:]==(1, 200, 50, FLAG_OR, "text")
+        assert records[2][2:7]==(1, 10, 20, 8, 4)
+        times = [r[1] for r in records]
+        assert times==sorted(times)
+
+    def test_no_pixels(self):
+        records = self.record("none")
+        self.check_records(records)
+        assert all(r[7] is None for r in records if r[0]==DAMAGE)
+
+    def test_hash(self):
+        records = self.record("hash")
+        self.check_records(records)
+        image = FakeWindow(8, 4).get_image(10, 20, 8, 4)
+        assert records[2][7]==get_xxh64(image.get_pixels())
+
+    def test_raw(self):
+        records = self.record("raw")
+        self.check_records(records)
+        image = FakeWindow(8, 4).get_image(10, 20, 8, 4)
+        assert records[2][7]==(32, "BGRX", image.get_pixels())
+
+    def test_hash_interval(self):
+        recorder = DamageTraceRecorder("/dev/null", "hash", hash_interval=60*1000)
+        recorder.start()
+        window = FakeWindow(100, 50)
+        captures = []
+        get_image = window.get_image
+        def counting_get_image(*args):
+            captures.append(args)
+            return get_image(*args)
+        window.get_image = counting_get_image
+        for _ in range(3):
+            recorder.record(1, window, 0, 0, 10, 10)
+        #other windows are sampled separately:
+        recorder.record(2, window, 0, 0, 10, 10)
+        recorder.stop()
+        assert len(captures)==2, "expected 2 captures, got %s" % (captures,)
+
+    def test_record_error(self):
+        from xpra.server.mixins.window_server import WindowServer
+        class BrokenWindow(FakeWindow):
+            def get_image(self, *_args):
+                raise IOError("window is gone")
+        damaged = []
+        class FakeSource(object):
+            def damage(self, *args):
+                damaged.append(args)
+        server = WindowServer.__new__(WindowServer)
+        window = BrokenWindow(100, 50)
+        server._window_to_id = {window : 1}
+        server._server_sources = {None : FakeSource()}
+        server.damage_trace = DamageTraceRecorder("/dev/null", "hash", hash_interval=0)
+        server.damage_trace.start()
+        server.refresh_window_area(window, 0, 0, 10, 10)
+        #the damage is still sent, the recorder is disabled:
+        assert len(damaged)==1
+        assert server.damage_trace is None
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            DamageTraceRecorder("/dev/null", "foo")
+        fd, filename = tempfile.mkstemp()
+        try:
+            os.write(fd, b"not a trace file")
+            os.close(fd)
+            with self.assertRaises(ValueError):
+                list(read_damage_trace(filename))
+        finally:
+            os.unlink(filename)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.server.window.delta_store import DeltaStore
+
+
+G1 = (100, 10, "BGRX", "png")
+G2 = (10, 100, "BGRX", "png")
+
+
+class TestDeltaStore(unittest.TestCase):
+
+    def test_lookup(self):
+        ds = DeltaStore(4, 10000)
+        assert ds.get(G1, 1) is None
+        b1 = ds.add(G1, 1, 10, b"1"*1000)
+        b2 = ds.add(G1, 2, 11, b"2"*1000)
+        b3 = ds.add(G2, 3, 12, b"3"*1000)
+        assert len(set((b1, b2, b3)))==3
+        #exact match:
+        assert ds.get(G1, 1)[0]==b1
+        #most recently used with the same geometry:
+        assert ds.get(G1, 99)[0]==b1
+        assert ds.get(G2, 99)[0]==b3
+        assert ds.get((1, 1, "BGRX", "png"), 1) is None
+        assert ds.size==3000
+
+    def test_replace(self):
+        ds = DeltaStore(4, 10000)
+        b = ds.add(G1, 1, 10, b"1"*1000)
+        #client stores the new pixels in the reference bucket:
+        assert ds.add(G1, 2, 11, b"2"*1000, 1, b)==b
+        assert len(ds)==1
+        entry = ds.get(G1, 1)
+        assert entry[2]==2 and entry[3]==11
+        #same contents are only stored once:
+        ds.add(G1, 2, 12, b"2"*1000)
+        assert len(ds)==1
+
+    def test_eviction(self):
+        ds = DeltaStore(3, 2500)
+        b1 = ds.add(G1, 1, 1, b"1"*1000)
+        b2 = ds.add(G2, 2, 2, b"2"*1000)
+        ds.get(G1, 1)
+        #byte budget exceeded, the least recently used entry goes:
+        b3 = ds.add(G2, 3, 3, b"3"*1000)
+        assert b3==b2
+        assert ds.size==2000 and ds.evictions==1
+        assert ds.get(G1, 0)[0]==b1
+        ds.remove(b1)
+        assert ds.get(G1, 0) is None
+        info = ds.get_info()
+        assert info["entries"]==1 and info["size"]==1000
+        ds.clear()
+        assert len(ds)==0 and ds.size==0
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.net.compression import Compressed
+from xpra.server.metrics import Histogram, MetricsWriter, get_server_metrics
+from xpra.server.window.window_source import WindowSource
+from xpra.server.window.window_stats import WindowPerformanceStatistics
+from xpra.server.source.source_stats import GlobalPerformanceStatistics
+
+
+class FakeBatchConfig(object):
+    delay = 15
+
+class FakeWindowSource(object):
+
+    def __init__(self, global_statistics=None):
+        self.wid = 1
+        self.global_statistics = global_statistics
+        self.statistics = WindowPerformanceStatistics()
+        self._damage_packet_sequence = 1
+        self.batch_config = FakeBatchConfig()
+        self._current_speed = 50
+        self._current_quality = 80
+
+class FakeSource(object):
+
+    def __init__(self):
+        self.uuid = 'some"uuid'
+        self.statistics = GlobalPerformanceStatistics()
+        self.packet_queue = [1, 2]
+        self.window_sources = {1 : FakeWindowSource(self.statistics)}
+
+    def encode_queue_size(self):
+        return 3
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        h = Histogram((1, 10))
+        for v in (0.5, 1, 5, 20):
+            h.observe(v)
+        cumulative, total = h.get_cumulative_counts()
+        assert cumulative==[(1, 2), (10, 3), ("+Inf", 4)], "got %s" % (cumulative,)
+        assert total==26.5
+        assert h.get_count()==4
+
+    def test_writer(self):
+        w = MetricsWriter("test_")
+        w.gauge("foo", "a gauge", 1.5, (("a", "1"), ))
+        w.counter("bar", "a counter", 10)
+        w.gauge("foo", "a gauge", 2.0, (("a", "2"), ))
+        h = Histogram((1, ))
+        h.observe(0.5)
+        w.histogram("baz", "a histogram", h, (("wid", 1), ))
+        lines = w.get_text().splitlines()
+        assert lines==[
+            "# HELP test_foo a gauge",
+            "# TYPE test_foo gauge",
+            'test_foo{a="1"} 1.5',
+            'test_foo{a="2"} 2',
+            "# HELP test_bar a counter",
+            "# TYPE test_bar counter",
+            "test_bar 10",
+            "# HELP test_baz a histogram",
+            "# TYPE test_baz histogram",
+            'test_baz_bucket{wid="1",le="1"} 1',
+            'test_baz_bucket{wid="1",le="+Inf"} 1',
+            'test_baz_sum{wid="1"} 0.5',
+            'test_baz_count{wid="1"} 1',
+            ], "got %s" % (lines,)
+
+    def test_server_metrics(self):
+        source = FakeSource()
+        ws = source.window_sources[1]
+        wstats = ws.statistics
+        #the encoding paths don't all use the same type for the coding,
+        #they must still be recorded under the same label:
+        WindowSource.make_draw_packet(ws, 0, 0, 10, 10, b"png", b"x"*400, 0)
+        WindowSource.make_draw_packet(ws, 0, 0, 10, 10, "png", Compressed("png", b"x"*600), 0)
+        WindowSource.make_draw_packet(ws, 0, 0, 64, 64, "tile", b"", 0)
+        wstats.encode_time_histogram.observe(0.002)
+        text = get_server_metrics((source, ))
+        assert "xpra_clients 1" in text
+        assert 'xpra_packet_queue_size{client="some\\"uuid"} 2' in text
+        assert 'xpra_encoding_bytes_total{client="some\\"uuid",wid="1",encoding="png"} 1000' in text
+        assert 'xpra_encoding_frames_total{client="some\\"uuid",wid="1",encoding="png"} 2' in text
+        assert 'xpra_encoding_pixels_total{client="some\\"uuid",wid="1",encoding="png"} 200' in text
+        assert 'xpra_encoding_frames_total{client="some\\"uuid",wid="1",encoding="tile"} 1' in text
+        assert 'xpra_encoding_bytes_total{client="some\\"uuid",wid="1",encoding="tile"} 0' in text
+        assert text.count('encoding="png"')==3, "duplicate series in:\n%s" % text
+        assert 'xpra_encode_time_seconds_count{client="some\\"uuid",wid="1"} 1' in text
+        assert 'xpra_batch_delay_milliseconds{client="some\\"uuid",wid="1"} 15' in text
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import mmap
+import unittest
+
+from xpra.os_util import monotonic_time
+from xpra.net.mmap_pipe import MmapAllocator, MMAP_ALLOC_UNIT
+from xpra.server.window.damage_replay import DamageReplay, ReplayWindow
+
+AREA_SIZE = 1024*MMAP_ALLOC_UNIT
+
+
+class TestMmapAllocations(unittest.TestCase):
+
+    def make_window_source(self):
+        replay = DamageReplay("", encoding="rgb")
+        replay.init_encodings()
+        window = ReplayWindow(1, 128, 128, 0, "")
+        window.update(0, 0, 128, 128, None)
+        ws = replay.make_window_source(window)
+        allocator = MmapAllocator()
+        allocator.add_area(mmap.mmap(-1, AREA_SIZE), AREA_SIZE, 0, MMAP_ALLOC_UNIT)
+        ws._mmap = allocator
+        ws._mmap_size = AREA_SIZE
+        ws._mmap_allocator = allocator
+        ws._encoders["mmap"] = ws.mmap_encode
+        #keep the packets in the queue, unsent:
+        ws.packets = []
+        ws.queue_packet = lambda packet, *_args: ws.packets.append(packet)
+        return window, ws, allocator
+
+    def test_cancelled_encode(self):
+        window, ws, allocator = self.make_window_source()
+        try:
+            free_size = allocator.free_size
+            now = monotonic_time()
+            image = window.get_image(0, 0, 128, 128)
+            #cancel the damage request while the pixels are being written:
+            get_pixels = image.get_pixels
+            def cancel_and_get_pixels():
+                ws._damage_cancelled = 1
+                return get_pixels()
+            image.get_pixels = cancel_and_get_pixels
+            assert ws.make_data_packet(now, now, image, "mmap", 1, {}, 0) is None
+            assert allocator.free_size==free_size and not allocator.allocated
+        finally:
+            ws.cleanup()
+
+    def test_cancel_unsent(self):
+        window, ws, allocator = self.make_window_source()
+        try:
+            free_size = allocator.free_size
+            now = monotonic_time()
+            packet = ws.make_data_packet(now, now, window.get_image(0, 0, 128, 128), "mmap", 1, {}, 0)
+            assert packet[6]==b"mmap"
+            ws.queue_damage_packet(packet, now, now, {})
+            assert ws.packets and allocator.allocated
+            #the packet was never sent, so it will never be acked:
+            ws.cancel_damage()
+            assert allocator.free_size==free_size and not allocator.allocated
+            assert not ws._mmap_allocations
+        finally:
+            ws.cleanup()
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
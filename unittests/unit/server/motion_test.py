@@ -224,6 +224,68 @@ class TestMotion(unittest.TestCase):
 				assert y+line+scroll<=wh, "cannot scroll rectangle %i high by %i lines from %i+%i (window height is %i)" % (count, scroll, y, line, wh)
 				scrolls.append((x, y+line, w, count, 0, scroll))
 
+	def test_motion_2d(self):
+		import os
+		W, H = 320, 240
+		def frame(src, sw, x0, y0):
+			return b"".join(src[((y0+y)*sw+x0)*4:((y0+y)*sw+x0+W)*4] for y in range(H))
+		def apply(old, new, copies, repaint):
+			#what the client would do:
+			pixels = bytearray(old)
+			for sx, sy, w, h, dx, dy in copies:
+				for i in range(h):
+					src = ((sy+i)*W+sx)*4
+					dst = ((sy+dy+i)*W+sx+dx)*4
+					pixels[dst:dst+w*4] = old[src:src+w*4]
+			for x, y, w, h in repaint:
+				for i in range(h):
+					pos = ((y+i)*W+x)*4
+					pixels[pos:pos+w*4] = new[pos:pos+w*4]
+			return bytes(pixels)==new
+		src = os.urandom((W+100)*(H+100)*4)
+		for dx, dy in ((37, 0), (0, 20), (64, 33), (3, 91)):
+			sd = motion.ScrollData()
+			f1 = frame(src, W+100, 0, 0)
+			f2 = frame(src, W+100, dx, dy)
+			sd.update(f1, 0, 0, W, H, W*4, 4)
+			assert sd.calculate_motion() is None
+			sd.update(f2, 0, 0, W, H, W*4, 4)
+			assert sd.get_changed_lines()==H
+			copies, repaint = sd.calculate_motion()
+			assert len(copies)==1 and copies[0][4:]==(-dx, -dy), "expected a single copy by %s but got %s" % ((-dx, -dy), copies)
+			assert apply(f1, f2, copies, repaint)
+			#no motion:
+			sd.update(f2, 0, 0, W, H, W*4, 4)
+			assert sd.calculate_motion() is None
+			sd.free()
+
+	def test_incremental_update(self):
+		import os
+		W, H = 128, 64
+		f1 = os.urandom(W*H*4)
+		f2 = bytearray(f1)
+		f2[10*W*4:20*W*4] = os.urandom(10*W*4)
+		f2 = bytes(f2)
+		full = motion.ScrollData()
+		inc = motion.ScrollData()
+		for sd in (full, inc):
+			sd.update(f1, 0, 0, W, H, W*4, 4)
+		full.update(f2, 0, 0, W, H, W*4, 4)
+		#only the damaged rows are checksummed again:
+		inc.update(f2, 0, 0, W, H, W*4, 4, ((0, 10, 16, 10), ))
+		assert full.get_changed_lines()==inc.get_changed_lines()==10
+		#damage outside the area is ignored, so nothing has changed:
+		inc.update(f1, 0, 0, W, H, W*4, 4, ((W, 0, 16, H), ))
+		assert inc.get_changed_lines()==0
+		#large images are checksummed by multiple threads:
+		saved = motion.HASH_THREADS, motion.HASH_MIN_SIZE
+		motion.HASH_THREADS, motion.HASH_MIN_SIZE = 4, W*4*8
+		try:
+			full.update(f1, 0, 0, W, H, W*4, 4)
+			assert full.get_changed_lines()==10
+		finally:
+			motion.HASH_THREADS, motion.HASH_MIN_SIZE = saved
+
 
 def main():
 	if motion:
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.rectangle import rectangle   #@UnresolvedImport
+from xpra.server.window.refresh_tiles import RefreshTiles
+from xpra.server.window.window_source import WindowSource
+
+
+def rects(l):
+    return [(r.x, r.y, r.width, r.height) for r in l]
+
+
+class TestRefreshTiles(unittest.TestCase):
+
+    def test_add_remove(self):
+        rt = RefreshTiles(250, 100, 64)
+        assert not rt and len(rt)==0
+        #a small lossy update marks the whole tile:
+        assert rt.add(rectangle(10, 10, 5, 5))==5*5
+        assert len(rt)==1
+        #already marked, but the pixels are still counted
+        #so the refresh gets postponed:
+        assert rt.add(rectangle(0, 0, 64, 64))==64*64
+        assert len(rt)==1
+        #partial lossless updates don't clear it:
+        rt.remove(rectangle(0, 0, 32, 64))
+        assert len(rt)==1
+        rt.remove(rectangle(0, 0, 64, 64))
+        assert len(rt)==0
+        #the tiles on the edges are smaller:
+        assert rt.add(rectangle(200, 50, 100, 100))==(250-200)*(100-50)
+        assert len(rt)==2
+        rt.remove(rectangle(192, 0, 58, 100))
+        assert not rt
+        #outside the window:
+        assert rt.add(rectangle(300, 300, 10, 10))==0
+        assert rt.add(rectangle(-10, -10, 5, 5))==0
+
+    def test_rectangles(self):
+        rt = RefreshTiles(256, 256, 64)
+        rt.add(rectangle(0, 0, 128, 10))
+        rt.add(rectangle(192, 0, 10, 10))
+        rt.add(rectangle(64, 64, 10, 10))
+        assert rects(rt)==[(0, 0, 128, 64), (192, 0, 64, 64), (64, 64, 64, 64)], "got %s" % (rects(rt),)
+
+    def test_take(self):
+        rt = RefreshTiles(256, 128, 64)
+        rt.add(rectangle(0, 0, 256, 128))
+        assert len(rt)==8
+        #budget for 3 tiles:
+        taken = rects(rt.take(3*64*64))
+        assert taken==[(0, 0, 192, 64)], "got %s" % (taken,)
+        assert len(rt)==5
+        #always at least one tile:
+        taken = rects(rt.take(0))
+        assert taken==[(192, 0, 64, 64)]
+        #the next call continues from where we stopped,
+        #so re-marked tiles do not starve the others:
+        rt.add(rectangle(0, 0, 10, 10))
+        taken = rects(rt.take(4*64*64))
+        assert taken==[(0, 64, 256, 64)], "got %s" % (taken,)
+        taken = rects(rt.take(100000))
+        assert taken==[(0, 0, 64, 64)]
+        assert not rt and rt.take(100000)==[]
+
+    def test_resize(self):
+        rt = RefreshTiles(100, 100, 64)
+        rt.add(rectangle(0, 0, 100, 100))
+        assert len(rt)==4
+        rt.resize(200, 100)
+        assert len(rt)==0
+        assert rt.get_info()["grid"]==(4, 2)
+
+    def test_refresh_bytes_per_pixel(self):
+        class FakeStatistics(object):
+            encoding_stats = []
+        source = WindowSource.__new__(WindowSource)
+        source.auto_refresh_encodings = ["webp", "png"]
+        source.statistics = FakeStatistics()
+        bpp = source.get_refresh_bytes_per_pixel
+        assert bpp()==1.0
+        #make_data_packet records the codings as bytes:
+        source.statistics.encoding_stats = [
+            (0, b"png", 100*100, 32, 5000, 0.01),
+            (0, b"jpeg", 100*100, 24, 100000, 0.01),
+            ]
+        assert bpp()==0.5
+        source.statistics.encoding_stats.append((0, "png", 100*100, 32, 15000, 0.01))
+        assert bpp()==1.0
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
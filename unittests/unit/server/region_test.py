@@ -8,7 +8,7 @@
 import unittest
 
 try:
-    from xpra.server.region import rectangle        #@UnresolvedImport
+    from xpra.rectangle import rectangle, region    #@UnresolvedImport
 
     R1 = rectangle(0, 0, 20, 20)
     R2 = rectangle(0, 0, 20, 20)
@@ -16,7 +16,7 @@ try:
     R4 = rectangle(10, 10, 50, 50)
     R5 = rectangle(100, 100, 100, 100)
 except:
-    rectangle, R1, R2, R3, R4, R5 = None, None, None, None, None, None
+    rectangle, region, R1, R2, R3, R4, R5 = None, None, None, None, None, None, None
 
 
 class TestRegion(unittest.TestCase):
@@ -93,6 +93,57 @@ class TestRegion(unittest.TestCase):
         assert rectangle(200, 200, 0, 0) not in l
 
 
+    def test_banded_region(self):
+        r = region()
+        assert not r and r.get_extents() is None
+        r.union(0, 0, 10, 10)
+        r.union(5, 5, 10, 10)
+        #overlapping rectangles are split into bands:
+        assert r.get_rectangles()==[rectangle(0, 0, 10, 5), rectangle(0, 5, 15, 5), rectangle(5, 10, 10, 5)]
+        assert r.get_area()==175
+        assert r.get_extents()==rectangle(0, 0, 15, 15)
+        assert r.contains(0, 0, 10, 10)
+        assert not r.contains(0, 0, 15, 15)
+        #adjacent bands with identical spans are coalesced:
+        r = region([rectangle(0, 0, 10, 10), rectangle(0, 10, 10, 10)])
+        assert r.get_rectangles()==[rectangle(0, 0, 10, 20)]
+        r.substract(2, 2, 6, 6)
+        assert len(r)==4 and r.get_area()==200-36
+        c = r.copy()
+        c.intersect(0, 0, 10, 10)
+        assert c.get_area()==100-36
+        assert r.get_area()==200-36
+        c.union_region(r)
+        assert c.get_rectangles()==r.get_rectangles()
+        c.substract_region(r)
+        assert not c
+        r.intersect_rect(rectangle(100, 100, 10, 10))
+        assert len(r)==0
+
+    def test_banded_region_pixels(self):
+        #compare with a set of pixels:
+        def pixels(rects):
+            return set((x, y) for r in rects for x in range(r.x, r.x+r.width) for y in range(r.y, r.y+r.height))
+        import random
+        for _ in range(100):
+            r = region()
+            p = set()
+            for _ in range(8):
+                rect = rectangle(random.randint(0, 20), random.randint(0, 20), random.randint(0, 10), random.randint(0, 10))
+                op = random.choice(("union", "union", "substract", "intersect"))
+                getattr(r, op+"_rect")(rect)
+                rp = pixels((rect,))
+                if op=="union":
+                    p |= rp
+                elif op=="substract":
+                    p -= rp
+                else:
+                    p &= rp
+                rects = r.get_rectangles()
+                assert pixels(rects)==p
+                assert sum(x.width*x.height for x in rects)==len(p), "overlapping rectangles in %s" % rects
+
+
 def main():
     #skip test if import failed (ie: not a server build)
     if rectangle is not None:
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import time
+import unittest
+from threading import Thread, Lock
+
+from xpra.server.window.shared_encode import SharedEncodeCache
+
+
+def make_ret(size=100):
+    return "png", b"0"*size, {"quality" : 100}, 10, 10, 0, 24
+
+
+class TestSharedEncodeCache(unittest.TestCase):
+
+    def test_sharing(self):
+        sec = SharedEncodeCache()
+        sec.add_window_source(1)
+        assert not sec.is_shared(1)
+        sec.add_window_source(1)
+        assert sec.is_shared(1)
+        sec.remove_window_source(1)
+        assert not sec.is_shared(1)
+        sec.remove_window_source(1)
+        assert not sec.window_sources
+
+    def test_get_put(self):
+        sec = SharedEncodeCache()
+        key = (1, 0, 0, 10, 10)
+        assert sec.get(key) is None
+        sec.put(key, make_ret())
+        ret = sec.get(key)
+        assert ret is not None
+        #the client options must be a copy:
+        ret[2]["flush"] = 1
+        assert "flush" not in sec.get(key)[2]
+        assert sec.hits==2 and sec.misses==1
+        #entries are removed with the last window source:
+        sec.add_window_source(1)
+        sec.remove_window_source(1)
+        assert sec.get(key) is None
+        assert sec.size==0
+
+    def test_expiry(self):
+        sec = SharedEncodeCache(expiry=0)
+        sec.put((1, ), make_ret())
+        assert sec.get((1, )) is None
+
+    def test_size_limit(self):
+        sec = SharedEncodeCache(max_size=1000)
+        for i in range(10):
+            sec.put((1, i), make_ret(200))
+        assert sec.size<=1000
+        #oldest entries are evicted first:
+        assert sec.get((1, 0)) is None
+        assert sec.get((1, 9)) is not None
+        #too big to be cached:
+        sec.put((2, ), make_ret(500))
+        assert sec.get((2, )) is None
+
+    def encode_threads(self, sec, key, encode, count=2):
+        results = []
+        def encode_thread():
+            ret = sec.get(key)
+            if ret is None:
+                ret = encode()
+                if ret is None:
+                    sec.release(key)
+                else:
+                    sec.put(key, ret)
+            results.append(ret)
+        threads = [Thread(target=encode_thread) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        return results
+
+    def test_concurrent(self):
+        sec = SharedEncodeCache()
+        encodes = []
+        lock = Lock()
+        def encode():
+            with lock:
+                encodes.append(True)
+            #slow enough for the other thread to find the pending entry:
+            time.sleep(0.2)
+            return make_ret()
+        results = self.encode_threads(sec, (1, 2, 3), encode)
+        assert len(encodes)==1, "expected a single encode, got %i" % len(encodes)
+        assert len(results)==2 and all(r is not None for r in results)
+        assert sec.waits==1 and sec.hits==1 and not sec.pending
+
+    def test_concurrent_failure(self):
+        sec = SharedEncodeCache()
+        encodes = []
+        def encode():
+            encodes.append(True)
+            time.sleep(0.2)
+            return None
+        #if the first encoder fails, the other one must encode it:
+        results = self.encode_threads(sec, (1, 2, 3), encode)
+        assert len(encodes)==2 and results==[None, None]
+        assert not sec.pending
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
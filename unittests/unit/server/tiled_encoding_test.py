@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.os_util import monotonic_time
+from xpra.server.window.window_source import split_tiles, TILED_ENCODING_SIZE
+from xpra.server.window.damage_replay import DamageReplay, ReplayWindow
+
+
+class TestTiledEncoding(unittest.TestCase):
+
+    def test_split_tiles(self):
+        assert split_tiles(0, 300, 128)==[(0, 128), (128, 128), (256, 44)]
+        assert split_tiles(100, 200, 128)==[(0, 28), (28, 128), (156, 44)]
+        assert split_tiles(128, 128, 128)==[(0, 128)]
+        assert split_tiles(10, 5, 128)==[(0, 5)]
+        assert split_tiles(0, 0, 128)==[]
+
+    def test_tile_packets(self):
+        replay = DamageReplay("", encoding="rgb")
+        replay.init_encodings()
+        ts = TILED_ENCODING_SIZE
+        window = ReplayWindow(1, ts*3, ts*2, 0, "")
+        #flat pixels at the top, noise at the bottom:
+        window.update(0, ts, ts*3, ts, None)
+        ws = replay.make_window_source(window)
+        try:
+            x, y = ts//2, ts//2
+            w, h = ts*2, ts
+            image = window.get_image(x, y, w, h)
+            now = monotonic_time()
+            packets = ws.make_tile_packets(now, now, image, "rgb24", 1, {}, 0)
+            #the region overlaps 3 tiles horizontally and 2 vertically:
+            assert len(packets)==6, "expected 6 tiles but got %i" % len(packets)
+            geometries = [tuple(p[2:6]) for p, _ in packets]
+            assert geometries[0]==(x, y, ts//2, ts//2)
+            assert geometries[1]==(ts, y, ts, ts//2)
+            assert geometries[-1]==(ts*2, ts, ts//2, ts//2)
+            assert sum(gw*gh for _, _, gw, gh in geometries)==w*h
+            #only the last tile ends the batch:
+            flushes = [p[10].get("flush", 0) for p, _ in packets]
+            assert flushes==[5, 4, 3, 2, 1, 0], "unexpected flush values: %s" % (flushes,)
+            #the quality map records each tile we have sent:
+            assert sorted(ws.tile_quality_map.keys())==[(0, 0), (0, 1), (1, 0), (1, 1), (2, 0), (2, 1)]
+            assert all(q==100 for _, q in ws.tile_quality_map.values())
+            assert ws.tile_quality_map[(1, 0)][0]=="ui"
+        finally:
+            ws.cleanup()
+
+    def test_tile_cache_cancelled(self):
+        replay = DamageReplay("", encoding="rgb")
+        replay.init_encodings()
+        window = ReplayWindow(1, 128, 128, 0, "")
+        window.update(0, 0, 128, 128, None)
+        ws = replay.make_window_source(window)
+        try:
+            assert ws.tile_cache is not None
+            now = monotonic_time()
+            packet = ws.make_data_packet(now, now, window.get_image(0, 0, 128, 128), "rgb24", 1, {}, 0)
+            tile_key = packet[10].get("tile")
+            assert tile_key, "the tile was not stored"
+            #the same pixels are now sent as a cache hit:
+            packet = ws.make_data_packet(now, now, window.get_image(0, 0, 128, 128), "rgb24", 2, {}, 0)
+            assert packet[6]==b"tile" and packet[10].get("tile")==tile_key
+            #unless the damage is cancelled while we hash the pixels:
+            image = window.get_image(0, 0, 128, 128)
+            def cancel():
+                ws._damage_cancelled = 3
+            image.may_restride = cancel
+            assert ws.make_data_packet(now, now, image, "rgb24", 3, {}, 0) is None
+        finally:
+            ws.cleanup()
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.server.window.video_pool import VideoPool, get_csc_key, get_encoder_key, get_instance_size
+
+
+class FakeInstance(object):
+
+    def __init__(self, codec_type="swscale"):
+        self.codec_type = codec_type
+        self.closed = False
+
+    def get_type(self):
+        return self.codec_type
+
+    def clean(self):
+        self.closed = True
+
+
+def csc_key(width=640, height=480):
+    return get_csc_key("swscale", width, height, "BGRX", width, height, "YUV420P", 50.5)
+
+
+class TestVideoPool(unittest.TestCase):
+
+    def test_get_put(self):
+        pool = VideoPool(4, 64*1024*1024, 60)
+        key = csc_key()
+        assert pool.get(key) is None
+        csce = FakeInstance()
+        assert pool.put(key, csce)
+        #the parameters must match:
+        assert pool.get(csc_key(800, 600)) is None
+        assert pool.get(key) is csce
+        assert pool.get(key) is None
+        assert not csce.closed
+        info = pool.get_info()
+        assert info["hits"]==1 and info["misses"]==3 and info["size"]==0
+        #codecs which cannot be pooled:
+        assert not pool.put(key, FakeInstance("nvenc"))
+        ekey = get_encoder_key("x264", "h264", 640, 480, "YUV420P", ["YUV420P"], (1, 1), {"content-type" : "video"})
+        assert ekey!=get_encoder_key("x264", "h264", 640, 480, "YUV420P", ["YUV420P"], (1, 1), {})
+        assert get_instance_size(ekey)>get_instance_size(key)
+
+    def test_encoder_options(self):
+        def ekey(options):
+            return get_encoder_key("x264", "h264", 640, 480, "YUV420P", ["YUV420P"], (1, 1), options)
+        base = {"h264.cabac" : True, "h264.YUV420P.profile" : "main", "bandwidth-limit" : 0}
+        #the client's options are part of the key:
+        assert ekey(base)!=ekey(dict(base, **{"h264.cabac" : False}))
+        assert ekey(base)!=ekey(dict(base, **{"h264.YUV420P.profile" : "high"}))
+        assert ekey(base)!=ekey(dict(base, **{"bandwidth-limit" : 1000*1000}))
+        #the client's encoding options use bytes keys:
+        assert ekey(base)==ekey({b"h264.cabac" : True, b"h264.YUV420P.profile" : "main", "bandwidth-limit" : 0})
+        #but not the options for other encodings:
+        assert ekey(base)==ekey(dict(base, **{"vp8.quality" : 10, "rgb_lz4" : True}))
+
+    def test_limits(self):
+        key = csc_key()
+        size = get_instance_size(key)
+        pool = VideoPool(2, size*10, 60)
+        instances = [FakeInstance() for _ in range(3)]
+        for i in instances:
+            assert pool.put(key, i)
+        #the oldest one was evicted:
+        assert instances[0].closed and not instances[1].closed
+        #the most recent one is re-used first:
+        assert pool.get(key) is instances[2]
+        #too big:
+        assert not VideoPool(2, size-1, 60).put(key, FakeInstance())
+        pool = VideoPool(10, size*2, 60)
+        for i in instances:
+            pool.put(key, i)
+        assert len(pool.entries)==2
+        pool.cleanup()
+        assert all(i.closed for i in instances)
+        assert pool.size==0
+
+    def test_expiry(self):
+        pool = VideoPool(4, 64*1024*1024, -1)
+        csce = FakeInstance()
+        pool.put(csc_key(), csce)
+        assert pool.get(csc_key()) is None
+        assert csce.closed
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
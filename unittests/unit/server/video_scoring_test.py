@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.codecs.codec_constants import video_spec, csc_spec
+from xpra.codecs.video_helper import specs_generation
+from xpra.server.window import video_scoring
+from xpra.server.window.video_scoring import get_pipeline_score, get_score_cache, SCORE_BUCKET
+
+
+def score(enc_in_format, cspec, espec, width=640, height=480, quality=50, speed=50):
+    return get_pipeline_score(enc_in_format, cspec, espec, width, height, (1, 1),
+                              quality, 0, speed, 0, None, None, 0, 25)
+
+
+class TestVideoScoring(unittest.TestCase):
+
+    def setUp(self):
+        self.espec = video_spec("h264", "YUV420P", ["YUV420P"], False, object, "test-encoder",
+                                width_mask=0xFFFE, height_mask=0xFFFE)
+        self.cspec = csc_spec("BGRX", "YUV420P", object, "test-csc")
+
+    def test_cached(self):
+        cache = get_score_cache()
+        specs_generation.increase()
+        s1 = score("YUV420P", self.cspec, self.espec, 641, 481)
+        assert s1 and s1[3:5]==(640, 480), "got %s" % (s1,)
+        hits = cache.hits
+        assert score("YUV420P", self.cspec, self.espec, 641, 481)==s1
+        assert cache.hits==hits+1
+        #the targets are rounded to the same bucket:
+        score("YUV420P", self.cspec, self.espec, 641, 481, 50+SCORE_BUCKET-1)
+        assert cache.hits==hits+2
+        #unsuitable options are cached too:
+        assert score("YUV420P", None, self.espec, 4*1024+2, 480) is None
+        assert score("YUV420P", None, self.espec, 4*1024+2, 480) is None
+        assert cache.hits==hits+3
+
+    def test_invalidation(self):
+        cache = get_score_cache()
+        score("YUV420P", None, self.espec)
+        assert len(cache.entries)>0
+        specs_generation.increase()
+        misses = cache.misses
+        score("YUV420P", None, self.espec)
+        assert cache.misses==misses+1
+        assert len(cache.entries)==1
+
+    def test_uncached(self):
+        v = video_scoring.SCORE_CACHE
+        try:
+            s = score("YUV420P", self.cspec, self.espec)
+            video_scoring.SCORE_CACHE = False
+            assert score("YUV420P", self.cspec, self.espec)==s
+        finally:
+            video_scoring.SCORE_CACHE = v
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
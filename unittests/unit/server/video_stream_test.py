@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.os_util import monotonic_time
+from xpra.rectangle import rectangle          #@UnresolvedImport
+from xpra.server.window.video_stream import (
+    VideoStream, identify_video_streams,
+    MIN_STREAM_EVENTS, KEEP_STREAM_EVENTS,
+    )
+
+
+def damage(now, rects, count):
+    return [(now, r.x, r.y, r.width, r.height) for r in rects for _ in range(count)]
+
+
+class FakeEncoder(object):
+
+    def __init__(self, width, height, src_format="YUV420P", encoding="h264"):
+        self.width = width
+        self.height = height
+        self.src_format = src_format
+        self.encoding = encoding
+        self.closed = False
+
+    def get_type(self):
+        return "fake"
+
+    def get_info(self):
+        return {"width" : self.width, "height" : self.height}
+
+    def is_closed(self):
+        return self.closed
+
+    def get_src_format(self):
+        return self.src_format
+
+    def get_encoding(self):
+        return self.encoding
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+    def clean(self):
+        self.closed = True
+
+
+class TestVideoStream(unittest.TestCase):
+
+    def test_identify(self):
+        now = monotonic_time()
+        chart1 = rectangle(0, 0, 320, 240)
+        chart2 = rectangle(400, 0, 321, 241)
+        small = rectangle(0, 300, 64, 64)
+        video = rectangle(0, 500, 640, 400)
+        lde = damage(now, (chart1, chart2, small, video), MIN_STREAM_EVENTS)
+        lde += damage(now, (rectangle(400, 300, 320, 240), ), MIN_STREAM_EVENTS-1)
+        lde += damage(now-10, (rectangle(400, 600, 320, 240), ), MIN_STREAM_EVENTS)
+        rects = identify_video_streams(1024, 1024, lde, now-5, exclude=[video])
+        #rounded down to even dimensions:
+        assert rects==[chart1, rectangle(400, 0, 320, 240)], "got %s" % (rects,)
+        assert identify_video_streams(1024, 1024, lde, now-5, exclude=[video], max_count=1)==[chart1]
+        assert identify_video_streams(1024, 1024, lde, now-5, max_count=0)==[]
+        #must fit in the window:
+        assert identify_video_streams(700, 1024, lde, now-5, exclude=[video])==[chart1]
+        #overlapping rectangles: the most damaged one wins
+        lde = damage(now, (chart1, ), MIN_STREAM_EVENTS+1)+damage(now, (rectangle(100, 100, 320, 240), ), MIN_STREAM_EVENTS)
+        assert identify_video_streams(1024, 1024, lde, now-5)==[chart1]
+
+    def test_keep(self):
+        now = monotonic_time()
+        chart = rectangle(0, 0, 320, 240)
+        lde = damage(now, (chart, ), KEEP_STREAM_EVENTS)
+        if KEEP_STREAM_EVENTS<MIN_STREAM_EVENTS:
+            assert identify_video_streams(1024, 1024, lde, now-5)==[]
+        assert identify_video_streams(1024, 1024, lde, now-5, current=[chart])==[chart]
+
+    def test_pipeline(self):
+        timers = []
+        def timeout_add(delay, fn, *args):
+            timers.append(fn)
+            return len(timers)
+        def source_remove(_timer):
+            pass
+        refreshed = []
+        def refresh_cb(regions):
+            refreshed.append(regions)
+            return True
+        rect = rectangle(10, 20, 320, 240)
+        stream = VideoStream(1, rect, timeout_add, source_remove, refresh_cb, 500)
+        assert stream.rectangle==rect
+        assert not stream.check_pipeline(["h264"], 320, 240, "YUV420P")
+        ve = FakeEncoder(320, 240)
+        stream.ve = ve
+        assert stream.check_pipeline(["h264"], 320, 240, "YUV420P")
+        assert not stream.check_pipeline(["vp8"], 320, 240, "YUV420P")
+        assert not stream.check_pipeline(["h264"], 640, 240, "YUV420P")
+        assert not stream.check_pipeline(["h264"], 320, 240, "BGRX")
+        assert stream.get_info()["encoder"][""]=="fake"
+        #no restart() method, so the encoder cannot be pooled:
+        assert stream.clean()
+        assert ve.closed and stream.ve is None
+        assert not stream.clean()
+        #refresh tracking:
+        stream.subregion.add_video_refresh(rectangle(10, 20, 100, 100))
+        assert timers
+        timers[-1]()
+        assert refreshed==[[rectangle(10, 20, 100, 100)]]
+        stream.close()
+        assert stream.closed
+
+    def test_idle_timer(self):
+        timers = {}
+        counter = [0]
+        def timeout_add(delay, fn, *args):
+            counter[0] += 1
+            timers[counter[0]] = (delay, fn, args)
+            return counter[0]
+        def source_remove(tid):
+            timers.pop(tid)
+        idle = []
+        stream = VideoStream(1, rectangle(0, 0, 320, 240), timeout_add, source_remove, None, 500)
+        stream.schedule_idle_timer(1000, idle.append)
+        tid = stream.idle_timer
+        assert timers[tid][0]==1000
+        #rescheduling replaces the previous timer:
+        stream.schedule_idle_timer(1000, idle.append)
+        assert tid not in timers and stream.idle_timer in timers
+        _, fn, args = timers.pop(stream.idle_timer)
+        fn(*args)
+        assert idle==[stream] and stream.idle_timer is None
+        #closing the stream cancels it:
+        stream.schedule_idle_timer(1000, idle.append)
+        stream.close()
+        assert stream.idle_timer is None and not timers
+        stream.schedule_idle_timer(1000, idle.append)
+        assert stream.idle_timer is None
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
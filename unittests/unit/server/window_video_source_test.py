@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.rectangle import rectangle          #@UnresolvedImport
+from xpra.server.window.refresh_tiles import RefreshTiles
+from xpra.server.window.video_subregion import VideoSubregion
+from xpra.server.window.window_video_source import WindowVideoSource
+
+
+class FakeEncoder(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def is_closed(self):
+        return self.closed
+
+    def clean(self):
+        self.closed = True
+
+
+class FakeWindow(object):
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+    def get_dimensions(self):
+        return self.width, self.height
+
+
+def make_source(ww=1024, wh=768, video_region=None):
+    """ a window video source with just enough state for the video region code paths """
+    timers = []
+    def timeout_add(_delay, fn, *args):
+        timers.append((fn, args))
+        return len(timers)
+    def source_remove(_timer):
+        pass
+    source = WindowVideoSource.__new__(WindowVideoSource)
+    source.wid = 1
+    source.window = FakeWindow(ww, wh)
+    source.is_tray = False
+    source.full_frames_only = False
+    source.video_encodings = ["h264"]
+    source.timeout_add = timeout_add
+    source.source_remove = source_remove
+    source.base_auto_refresh_delay = 500
+    source.refresh_tiles = RefreshTiles(ww, wh)
+    source.video_subregion = VideoSubregion(timeout_add, source_remove, source.refresh_subregion, 500, True)
+    if video_region:
+        source.video_subregion.set_region(*video_region)
+    source.video_streams = {}
+    source.video_stream_counter = 0
+    source.supports_eos = True
+    source.packets = []
+    source.queue_packet = lambda packet, *_args: source.packets.append(packet)
+    source.call_in_encode_thread = lambda _optional, fn, *args: fn(*args)
+    source.damage_regions = []
+    source.process_damage_region = lambda _damage_time, x, y, w, h, coding, options, _flush=0: \
+        source.damage_regions.append((x, y, w, h, coding, options))
+    return source
+
+
+class TestWindowVideoSource(unittest.TestCase):
+
+    def test_add_refresh_region(self):
+        source = make_source(video_region=(0, 0, 200, 200))
+        source.set_video_streams([rectangle(400, 0, 200, 200)])
+        stream = source.video_streams[1]
+        #each video region takes the part it contains,
+        #and only the rest goes to the regular refresh:
+        assert source.add_refresh_region(rectangle(100, 0, 400, 100))==200*100
+        assert source.video_subregion.refresh_regions==[rectangle(100, 0, 100, 100)]
+        assert stream.subregion.refresh_regions==[rectangle(400, 0, 100, 100)]
+        assert source.refresh_tiles.get_pixel_count()>0
+        #entirely within a stream:
+        source.refresh_tiles.clear()
+        assert source.add_refresh_region(rectangle(450, 50, 50, 50))==0
+        assert not source.refresh_tiles
+        #removing a region clears it from the stream too:
+        source.remove_refresh_region(rectangle(400, 0, 200, 200))
+        assert stream.subregion.refresh_regions==[]
+
+    def test_send_streams(self):
+        vr = (0, 0, 200, 200)
+        source = make_source(video_region=vr)
+        sr = rectangle(400, 0, 200, 200)
+        source.set_video_streams([sr])
+        source.do_send_delayed_regions(0, [rectangle(*vr), sr], "h264", {})
+        assert len(source.damage_regions)==2, "got %s" % (source.damage_regions,)
+        x, y, w, h, coding, options = source.damage_regions[1]
+        assert (x, y, w, h)==(400, 0, 200, 200) and coding=="h264"
+        assert options.get("stream")==1 and options.get("av-sync")
+        assert "stream" not in source.damage_regions[0][5]
+
+    def test_find_video_region(self):
+        source = make_source()
+        vr = rectangle(400, 0, 200, 200)
+        #same dimensions, different position:
+        moved = rectangle(500, 300, 200, 200)
+        assert source.find_video_region(vr, [moved])==moved
+        assert source.find_video_region(vr, [moved], False) is None
+        #enough of the region is damaged:
+        regions = [rectangle(400, 0, 200, 100)]
+        assert source.find_video_region(vr, regions, False)==vr
+        assert source.find_video_region(vr, [rectangle(400, 0, 20, 20)], False) is None
+
+    def test_remove_stream(self):
+        source = make_source(video_region=(0, 0, 200, 200))
+        r1 = rectangle(400, 0, 200, 200)
+        r2 = rectangle(400, 300, 200, 200)
+        source.set_video_streams([r1])
+        stream = source.video_streams[1]
+        ve = FakeEncoder()
+        stream.ve = ve
+        #unchanged, the same stream is kept:
+        source.set_video_streams([r1])
+        assert source.video_streams[1] is stream
+        assert not source.packets
+        source.set_video_streams([r2])
+        assert list(source.video_streams.keys())==[2]
+        assert stream.closed and ve.closed
+        assert source.packets==[("eos", 1, 1)]
+        #the old stream area will be refreshed:
+        assert source.refresh_tiles.get_pixel_count()>=r1.width*r1.height
+        source.clear_video_streams()
+        assert not source.video_streams
+        #no pipeline, so no eos:
+        assert len(source.packets)==1
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
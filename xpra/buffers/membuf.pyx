@@ -107,3 +107,13 @@ cdef MemBuf MemBuf_init(const void *p, size_t l,
 
 cdef unsigned long long xxh64(const void* input, size_t length, unsigned long long seed) nogil:
     return XXH64(input, length, seed)
+
+def get_xxh64(data, unsigned long long seed=0):
+    """ returns the 64-bit xxhash of the buffer as an integer (computed without holding the GIL) """
+    cdef const void *buf = NULL
+    cdef Py_ssize_t buf_len = 0
+    assert _object_as_buffer(data, &buf, &buf_len)==0, "cannot get buffer from %s" % type(data)
+    cdef unsigned long long v
+    with nogil:
+        v = XXH64(buf, buf_len, seed)
+    return v
@@ -120,6 +120,7 @@ class XpraClientBase(ServerInfoMixin, FilePrintMixin):
         self.server_padding_options = [DEFAULT_PADDING]
         self.server_client_shutdown = True
         self.server_compressors = []
+        self.server_chunked_compression = False
         #protocol stuff:
         self._protocol = None
         self._priority_packets = []
@@ -265,7 +266,7 @@ class XpraClientBase(ServerInfoMixin, FilePrintMixin):
             self.set_packet_handlers(self._packet_handlers, {
                 "udp-control"   : self._process_udp_control,
                 })
-        protocol_class = get_client_protocol_class(conn.socktype)
+        protocol_class = get_client_protocol_class(conn.socktype, conn)
         self._protocol = protocol_class(self.get_scheduler(), conn, self.process_packet, self.next_packet)
         for x in (b"keymap-changed", b"server-settings", b"logging", b"input-devices"):
             self._protocol.large_packets.append(x)
@@ -445,8 +446,10 @@ class XpraClientBase(ServerInfoMixin, FilePrintMixin):
         zlib = "zlib" in self.server_compressors and compression.use_zlib
         lz4 = "lz4" in self.server_compressors and compression.use_lz4
         lzo = "lzo" in self.server_compressors and compression.use_lzo
-        if level>0 and len(data)>=256 and (zlib or lz4 or lzo):
-            cw = compression.compressed_wrapper(datatype, data, level=level, zlib=zlib, lz4=lz4, lzo=lzo, can_inline=False)
+        zstd = "zstd" in self.server_compressors and compression.use_zstd
+        if level>0 and len(data)>=256 and (zlib or lz4 or lzo or zstd):
+            cw = compression.compressed_wrapper(datatype, data, level=level, zlib=zlib, lz4=lz4, lzo=lzo, zstd=zstd, can_inline=False,
+                                                 chunked=self.server_chunked_compression)
             if len(cw)<len(data):
                 #the compressed version is smaller, use it:
                 return cw
@@ -994,6 +997,7 @@ class XpraClientBase(ServerInfoMixin, FilePrintMixin):
                 return False
         self.server_client_shutdown = self.server_capabilities.boolget("client-shutdown", True)
         self.server_compressors = self.server_capabilities.strlistget("compressors", ["zlib"])
+        self.server_chunked_compression = self.server_capabilities.boolget("chunked-compression")
         return True
 
     def parse_network_capabilities(self):
@@ -47,7 +47,7 @@ class ClientWidgetBase(object):
                 (backing_class, ww, wh, ww, wh), bc, self._has_alpha, self._window_alpha)
             backing = bc(self._id, self._window_alpha, self.pixel_depth)
             if self._client.mmap_enabled:
-                backing.enable_mmap(self._client.mmap)
+                backing.enable_mmap(self._client.get_mmap_area())
         backing.init(ww, wh, bw, bh)
         return backing
 
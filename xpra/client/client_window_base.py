@@ -678,11 +678,11 @@ class ClientWindowBase(ClientWidgetBase):
             callbacks.append(after_draw_refresh)
         backing.draw_region(x, y, width, height, coding, img_data, rowstride, options, callbacks)
 
-    def eos(self):
+    def eos(self, stream=0):
         """ Note: this runs from the draw thread (not UI thread) """
         backing = self._backing
         if backing:
-            backing.eos()
+            backing.eos(stream)
 
     def spinner(self, _ok):
         if not self.can_have_spinner():
@@ -314,6 +314,8 @@ class GLWindowBackingBase(WindowBackingBase):
         props = WindowBackingBase.get_encoding_properties(self)
         if SCROLL_ENCODING:
             props["encoding.scrolling"] = True
+            #we can copy rectangles in any direction:
+            props["encoding.scrolling.motion"] = True
         props["encoding.bit-depth"] = self.bit_depth
         return props
 
@@ -940,6 +942,7 @@ class GLWindowBackingBase(WindowBackingBase):
     def do_paint_rgb(self, rgb_format, img_data, x, y, width, height, rowstride, options, callbacks):
         log("%s.do_paint_rgb(%s, %s bytes, x=%d, y=%d, width=%d, height=%d, rowstride=%d, options=%s)",
             self, rgb_format, len(img_data), x, y, width, height, rowstride, options)
+        self.may_store_tile(rgb_format, img_data, width, height, rowstride, options)
         context = self.gl_context()
         if not context:
             log("%s._do_paint_rgb(..) no context!", self)
@@ -68,9 +68,8 @@ class GTK2WindowBacking(WindowBackingBase):
         rowstride = pixbuf.get_rowstride()
         img_data = self.process_delta(raw_data, width, height, rowstride, options)
         n = pixbuf.get_n_channels()
-        if n==3:
-            self.do_paint_rgb24(img_data, x, y, width, height, rowstride, options, callbacks)
-        else:
-            assert n==4, "invalid number of channels: %s" % n
-            self.do_paint_rgb32(img_data, x, y, width, height, rowstride, options, callbacks)
+        assert n in (3, 4), "invalid number of channels: %s" % n
+        rgb_format = ("RGB", "RGBA")[n==4]
+        #this also stores the pixels in the tile cache if the server asked for it:
+        self.do_paint_rgb(rgb_format, img_data, x, y, width, height, rowstride, options, callbacks)
         return False
@@ -749,8 +749,12 @@ class GTKXpraClient(GObjectXpraClient, UIXpraClient):
             #lossy protocol means we can't use delta regions:
             log("no delta buckets with udp, since we can drop paint packets")
             window_backing_base.DELTA_BUCKETS = 0
+            #same for the tile cache:
+            window_backing_base.TILE_CACHE = 0
         updict(capabilities, "encoding", {
                     "delta_buckets"     : window_backing_base.DELTA_BUCKETS,
+                    "tile_cache"        : window_backing_base.TILE_CACHE,
+                    "tile_cache.pixels" : window_backing_base.TILE_CACHE_PIXELS,
                     })
         return capabilities
 
@@ -21,6 +21,8 @@ B_FRAMES = envbool("XPRA_B_FRAMES", True)
 PAINT_FLUSH = envbool("XPRA_PAINT_FLUSH", True)
 MAX_SOFT_EXPIRED = envint("XPRA_MAX_SOFT_EXPIRED", 5)
 SEND_TIMESTAMPS = envbool("XPRA_SEND_TIMESTAMPS", False)
+#the number of video streams each window can decode concurrently:
+VIDEO_STREAMS = envint("XPRA_VIDEO_STREAMS", 4)
 VIDEO_MAX_SIZE = tuple(int(x) for x in os.environ.get("XPRA_VIDEO_MAX_SIZE", "4096,4096").replace("x", ",").split(","))
 
 
@@ -139,6 +141,7 @@ class Encodings(StubClientMixin):
             "video_scaling"             : True,
             "video_b_frames"            : video_b_frames,
             "video_max_size"            : self.video_max_size,
+            "video_streams"             : VIDEO_STREAMS,
             "webp_leaks"                : False,
             "transparency"              : self.has_transparency(),
             "rgb24zlib"                 : True,
@@ -16,6 +16,8 @@ from xpra.log import Logger
 log = Logger("mmap")
 
 KEEP_MMAP_FILE = envbool("XPRA_KEEP_MMAP_FILE", False)
+MMAP_ALLOCATOR = envbool("XPRA_MMAP_ALLOCATOR", True)
+MEMFD = envbool("XPRA_MEMFD", True)
 
 
 """
@@ -36,6 +38,13 @@ class MmapClient(StubClientMixin):
         self.mmap_tempfile = None
         self.mmap_delete = False
         self.supports_mmap = MMAP_SUPPORTED
+        self.mmap_socket_filename = None
+        #when the server uses the allocator, all the mmap areas we share with it:
+        self.mmap_areas = None
+        #base -> (delete flag, temp file, filename) of the areas added during the session:
+        self.mmap_extra_files = {}
+        #can the server pass us memfd areas:
+        self.mmap_memfd = False
 
 
     def init(self, opts, _extra_args=[]):
@@ -50,11 +59,26 @@ class MmapClient(StubClientMixin):
 
     def cleanup(self):
         self.clean_mmap()
+        areas = self.mmap_areas
+        self.mmap_areas = None
+        if areas:
+            for mmap_area, _ in areas.areas:
+                if mmap_area is not self.mmap:
+                    mmap_area.close()
+        for base in tuple(self.mmap_extra_files.keys()):
+            self.clean_mmap_area_file(base)
 
 
     def setup_connection(self, conn):
         if self.supports_mmap:
+            self.mmap_socket_filename = conn.filename
             self.init_mmap(self.mmap_filename, self.mmap_group, conn.filename)
+            from xpra.net.mmap_pipe import MEMFD_SUPPORTED
+            can_pass_fds = getattr(conn, "can_pass_fds", None)
+            if MEMFD and MEMFD_SUPPORTED and can_pass_fds and can_pass_fds():
+                #we have to be ready to receive file descriptors before the server sends any:
+                conn.enable_fd_passing()
+                self.mmap_memfd = True
 
 
     def get_root_size(self):
@@ -63,8 +87,16 @@ class MmapClient(StubClientMixin):
 
     def parse_server_capabilities(self):
         c = self.server_capabilities
-        self.mmap_enabled = self.supports_mmap and self.mmap_enabled and c.boolget("mmap_enabled")
-        if self.mmap_enabled:
+        if self.mmap_memfd and c.boolget("mmap.memfd"):
+            #the server could not use our mmap file,
+            #it will send us the areas it creates instead:
+            from xpra.net.mmap_pipe import MmapAreas
+            self.mmap_enabled = True
+            self.mmap_areas = MmapAreas()
+            log.info("enabled fast memfd transfers")
+        else:
+            self.mmap_enabled = self.supports_mmap and self.mmap_enabled and c.boolget("mmap_enabled")
+        if self.mmap_enabled and not self.mmap_areas:
             from xpra.net.mmap_pipe import read_mmap_token, DEFAULT_TOKEN_INDEX, DEFAULT_TOKEN_BYTES
             def iget(attrname, default_value=0):
                 return c.intget("mmap_%s" % attrname) or c.intget("mmap.%s" % attrname) or default_value
@@ -80,6 +112,10 @@ class MmapClient(StubClientMixin):
                 self.quit(EXIT_MMAP_TOKEN_FAILURE)
                 return
             log.info("enabled fast mmap transfers using %sB shared memory area", std_unit(self.mmap_size, unit=1024))
+            if c.boolget("mmap.allocator"):
+                from xpra.net.mmap_pipe import MmapAreas
+                self.mmap_areas = MmapAreas()
+                self.mmap_areas.add_area(self.mmap, self.mmap_size, 0)
         #the server will have a handle on the mmap file by now, safe to delete:
         if not KEEP_MMAP_FILE:
             self.clean_mmap()
@@ -88,6 +124,8 @@ class MmapClient(StubClientMixin):
 
     def get_caps(self):
         if not self.mmap_enabled:
+            if self.mmap_memfd:
+                return {"mmap" : {"namespace" : True, "memfd" : True}}
             return {}
         raw_caps = {
             "file"          : self.mmap_filename,
@@ -96,6 +134,8 @@ class MmapClient(StubClientMixin):
             "token_index"   : self.mmap_token_index,
             "token_bytes"   : self.mmap_token_bytes,
             "namespace"     : True, #this client understands "mmap.ATTRIBUTE" format
+            "allocator"     : MMAP_ALLOCATOR,
+            "memfd"         : self.mmap_memfd,
             }
         caps = {
             "mmap" : raw_caps,
@@ -105,6 +145,72 @@ class MmapClient(StubClientMixin):
             caps["mmap_%s" % k] = v
         return caps
 
+    def get_mmap_area(self):
+        """ what the window backings should read the pixel data from """
+        return self.mmap_areas or self.mmap
+
+
+    def init_authenticated_packet_handlers(self):
+        self.set_packet_handlers(self._packet_handlers, {
+            "mmap-area-request":    self._process_mmap_area_request,
+            "mmap-area-ack":        self._process_mmap_area_ack,
+            "memfd-area":           self._process_memfd_area,
+            })
+
+    def _process_memfd_area(self, packet):
+        base, size = packet[1:3]
+        fd = self._protocol._conn.pop_received_fd()
+        log("memfd area %i of %i bytes at %#x", fd, size, base)
+        areas = self.mmap_areas
+        if fd<0 or not areas:
+            log.error("Error: cannot use the memfd area at %#x", base)
+            log.error(" file descriptor=%i, areas=%s", fd, areas)
+            return
+        from xpra.net.mmap_pipe import map_memfd_area
+        areas.add_area(map_memfd_area(fd, size), size, base)
+
+    def _process_mmap_area_request(self, packet):
+        """ the server has run out of space, create another area for it """
+        size = packet[1]
+        areas = self.mmap_areas
+        if not areas:
+            log.warn("Warning: cannot add mmap areas without the allocator")
+            return
+        from xpra.os_util import get_int_uuid
+        from xpra.net.mmap_pipe import init_client_mmap, write_mmap_token, DEFAULT_TOKEN_INDEX, DEFAULT_TOKEN_BYTES
+        mmap_size = min(1024*1024*1024, max(self.mmap_size, size*2))
+        ok, delete, mmap_area, mmap_size, tempfile, filename = init_client_mmap(self.mmap_group, self.mmap_socket_filename, mmap_size)
+        if not ok:
+            log.warn("Warning: failed to create another mmap area of %sB", std_unit(mmap_size, unit=1024))
+            return
+        token = get_int_uuid()
+        write_mmap_token(mmap_area, token, DEFAULT_TOKEN_INDEX, DEFAULT_TOKEN_BYTES)
+        #we must be ready to read from it before the server starts using it:
+        base = areas.add_area(mmap_area, mmap_size)
+        self.mmap_extra_files[base] = (delete, tempfile, filename)
+        log("new mmap area %s of %i bytes at %#x", filename, mmap_size, base)
+        self.send("mmap-area", filename, mmap_size, base, token, DEFAULT_TOKEN_INDEX, DEFAULT_TOKEN_BYTES)
+
+    def _process_mmap_area_ack(self, packet):
+        base, ok = packet[1:3]
+        log("mmap area at %#x added: %s", base, ok)
+        areas = self.mmap_areas
+        if not ok and areas and base in areas.bases:
+            areas.remove_area(base).close()
+        if not ok or not KEEP_MMAP_FILE:
+            self.clean_mmap_area_file(base)
+
+    def clean_mmap_area_file(self, base):
+        delete, tempfile, filename = self.mmap_extra_files.pop(base, (False, None, None))
+        if tempfile:
+            try:
+                tempfile.close()
+            except Exception as e:
+                log("error closing mmap file %s: %s", tempfile, e)
+        if delete and filename and os.path.exists(filename):
+            from xpra.net.mmap_pipe import clean_mmap
+            clean_mmap(filename)
+
     def init_mmap(self, mmap_filename, mmap_group, socket_filename):
         log("init_mmap(%s, %s, %s)", mmap_filename, mmap_group, socket_filename)
         from xpra.os_util import get_int_uuid
@@ -548,7 +548,7 @@ class WindowClient(StubClientMixin):
         assert tray_widget, "could not instantiate a system tray for tray id %s" % wid
         tray_widget.show()
         from xpra.client.client_tray import ClientTray
-        mmap = getattr(self, "mmap", None)
+        mmap = getattr(self, "mmap_areas", None) or getattr(self, "mmap", None)
         return ClientTray(client, wid, w, h, metadata, tray_widget, self.mmap_enabled, mmap)
 
 
@@ -881,18 +881,23 @@ class WindowClient(StubClientMixin):
         override_redirect = window._override_redirect
         backing = window._backing
         current_icon = window._current_icon
-        delta_pixel_data, video_decoder, csc_decoder, decoder_lock = None, None, None, None
+        delta_pixel_data, tile_cache, video_decoder, csc_decoder, decoder_lock = None, None, None, None, None
+        video_streams = {}
         try:
             if backing:
                 delta_pixel_data = backing._delta_pixel_data
+                #the server still expects us to have the tiles it sent:
+                tile_cache = backing._tile_cache
                 video_decoder = backing._video_decoder
                 csc_decoder = backing._csc_decoder
+                video_streams = backing._video_streams
                 decoder_lock = backing._decoder_lock
                 if decoder_lock:
                     decoder_lock.acquire()
                     log("reinit_windows() will preserve video=%s and csc=%s for %s", video_decoder, csc_decoder, wid)
                     backing._video_decoder = None
                     backing._csc_decoder = None
+                    backing._video_streams = {}
                     backing._decoder_lock = None
                     backing.close()
 
@@ -920,8 +925,10 @@ class WindowClient(StubClientMixin):
             if backing:
                 backing = window._backing
                 backing._delta_pixel_data = delta_pixel_data
+                backing._tile_cache = tile_cache
                 backing._video_decoder = video_decoder
                 backing._csc_decoder = csc_decoder
+                backing._video_streams = video_streams
                 backing._decoder_lock = decoder_lock
             if current_icon:
                 window.update_icon(current_icon)
@@ -1311,7 +1318,10 @@ class WindowClient(StubClientMixin):
         window = self._id_to_window.get(wid)
         if packet[0]==b"eos":
             if window:
-                window.eos()
+                stream = 0
+                if len(packet)>2:
+                    stream = packet[2]
+                window.eos(stream)
             return
         x, y, width, height, coding, data, packet_sequence, rowstride = packet[2:10]
         if not window:
@@ -13,7 +13,8 @@ from xpra.net import compression
 from xpra.util import typedict, csv, envint, envbool, repr_ellipsized
 from xpra.codecs.loader import get_codec, is_loaded
 from xpra.codecs.video_helper import getVideoHelper
-from xpra.os_util import BytesIOClass, bytestostr, _buffer
+from xpra.codecs.tile_cache import TileCache
+from xpra.os_util import BytesIOClass, bytestostr, memoryview_to_bytes, _buffer
 try:
     from xpra.codecs.xor.cyxor import xor_str   #@UnresolvedImport
 except ImportError:
@@ -22,8 +23,11 @@ from xpra.log import Logger
 
 log = Logger("paint")
 deltalog = Logger("delta")
+tilelog = Logger("tile")
 
-DELTA_BUCKETS = envint("XPRA_DELTA_BUCKETS", 5)
+DELTA_BUCKETS = envint("XPRA_DELTA_BUCKETS", 64)
+TILE_CACHE = envint("XPRA_TILE_CACHE", 64)
+TILE_CACHE_PIXELS = envint("XPRA_TILE_CACHE_PIXELS", 8*1024*1024)
 INTEGRITY_HASH = envbool("XPRA_INTEGRITY_HASH", False)
 PAINT_BOX = envint("XPRA_PAINT_BOX", 0) or envint("XPRA_OPENGL_PAINT_BOX", 0)
 WEBP_PILLOW = envbool("XPRA_WEBP_PILLOW", False)
@@ -87,8 +91,12 @@ class WindowBackingBase(object):
         self._alpha_enabled = window_alpha
         self._backing = None
         self._delta_pixel_data = [None for _ in range(DELTA_BUCKETS)]
+        self._tile_cache = TileCache(TILE_CACHE, TILE_CACHE_PIXELS)
         self._video_decoder = None
         self._csc_decoder = None
+        #the decoders for the additional video streams:
+        #stream -> (video decoder, csc decoder)
+        self._video_streams = {}
         self._decoder_lock = Lock()
         self._PIL_encodings = []
         self.default_paint_box_line_width = PAINT_BOX or 1
@@ -131,21 +139,38 @@ class WindowBackingBase(object):
             log("close_decoder(%s) lock %s not acquired", blocking, dl)
             return False
         try:
-            self.do_clean_video_decoder()
-            self.do_clean_csc_decoder()
+            for stream in [0]+list(self._video_streams.keys()):
+                self.do_clean_video_decoder(stream)
+                self.do_clean_csc_decoder(stream)
             return True
         finally:
             dl.release()
 
-    def do_clean_video_decoder(self):
-        if self._video_decoder:
-            self._video_decoder.clean()
-            self._video_decoder = None
+    def get_stream_decoders(self, stream=0):
+        if stream==0:
+            return self._video_decoder, self._csc_decoder
+        return self._video_streams.get(stream, (None, None))
 
-    def do_clean_csc_decoder(self):
-        if self._csc_decoder:
-            self._csc_decoder.clean()
-            self._csc_decoder = None
+    def set_stream_decoders(self, stream, vd, cd):
+        if stream==0:
+            self._video_decoder = vd
+            self._csc_decoder = cd
+        elif vd or cd:
+            self._video_streams[stream] = (vd, cd)
+        else:
+            self._video_streams.pop(stream, None)
+
+    def do_clean_video_decoder(self, stream=0):
+        vd, cd = self.get_stream_decoders(stream)
+        if vd:
+            vd.clean()
+            self.set_stream_decoders(stream, None, cd)
+
+    def do_clean_csc_decoder(self, stream=0):
+        vd, cd = self.get_stream_decoders(stream)
+        if cd:
+            cd.clean()
+            self.set_stream_decoders(stream, vd, None)
 
 
     def get_encoding_properties(self):
@@ -338,6 +363,7 @@ class WindowBackingBase(object):
             the actual paint code is in _do_paint_rgb[24|32]
         """
         try:
+            self.may_store_tile(rgb_format, img_data, width, height, rowstride, options)
             if not options.boolget("paint", True):
                 fire_paint_callbacks(callbacks)
                 return
@@ -367,11 +393,11 @@ class WindowBackingBase(object):
         raise Exception("override me!")
 
 
-    def eos(self):
+    def eos(self, stream=0):
         dl = self._decoder_lock
         with dl:
-            self.do_clean_csc_decoder()
-            self.do_clean_video_decoder()
+            self.do_clean_csc_decoder(stream)
+            self.do_clean_video_decoder(stream)
 
 
     def make_csc(self, src_width, src_height, src_format,
@@ -459,26 +485,28 @@ class WindowBackingBase(object):
             decoder_colorspaces = decoder_module.get_input_colorspaces(coding)
             assert input_colorspace in decoder_colorspaces, "decoder does not support %s for %s" % (input_colorspace, coding)
 
-            vd = self._video_decoder
+            #each video region of the window uses its own stream:
+            stream = options.intget("stream", 0)
+            vd = self.get_stream_decoders(stream)[0]
             if vd:
                 if options.intget("frame", -1)==0:
-                    log("paint_with_video_decoder: first frame of new stream")
-                    self.do_clean_video_decoder()
+                    log("paint_with_video_decoder: first frame of new stream %i", stream)
+                    self.do_clean_video_decoder(stream)
                 elif vd.get_encoding()!=coding:
                     log("paint_with_video_decoder: encoding changed from %s to %s", vd.get_encoding(), coding)
-                    self.do_clean_video_decoder()
+                    self.do_clean_video_decoder(stream)
                 elif vd.get_width()!=enc_width or vd.get_height()!=enc_height:
                     log("paint_with_video_decoder: video dimensions have changed from %s to %s", (vd.get_width(), vd.get_height()), (enc_width, enc_height))
-                    self.do_clean_video_decoder()
+                    self.do_clean_video_decoder(stream)
                 elif vd.get_colorspace()!=input_colorspace:
                     #this should only happen on encoder restart, which means this should be the first frame:
                     log.warn("Warning: colorspace unexpectedly changed from %s to %s", vd.get_colorspace(), input_colorspace)
-                    self.do_clean_video_decoder()
-            if self._video_decoder is None:
-                log("paint_with_video_decoder: new %s(%s,%s,%s)", decoder_module.Decoder, width, height, input_colorspace)
+                    self.do_clean_video_decoder(stream)
+            if self.get_stream_decoders(stream)[0] is None:
+                log("paint_with_video_decoder: new %s(%s,%s,%s) for stream %i", decoder_module.Decoder, width, height, input_colorspace, stream)
                 vd = decoder_module.Decoder()
                 vd.init_context(coding, enc_width, enc_height, input_colorspace)
-                self._video_decoder = vd
+                self.set_stream_decoders(stream, vd, self.get_stream_decoders(stream)[1])
                 log("paint_with_video_decoder: info=%s", vd.get_info())
 
             img = vd.decompress_image(img_data, options)
@@ -504,23 +532,24 @@ class WindowBackingBase(object):
         #as some video formats like vpx can forward transparency
         #also we could skip the csc step in some cases:
         pixel_format = img.get_pixel_format()
-        cd = self._csc_decoder
+        stream = options.intget("stream", 0)
+        vd, cd = self.get_stream_decoders(stream)
         if cd is not None:
             if cd.get_src_format()!=pixel_format:
                 log("do_video_paint csc: switching src format from %s to %s", cd.get_src_format(), pixel_format)
-                self.do_clean_csc_decoder()
+                self.do_clean_csc_decoder(stream)
             elif cd.get_dst_format() not in target_rgb_formats:
                 log("do_video_paint csc: switching dst format from %s to %s", cd.get_dst_format(), target_rgb_formats)
-                self.do_clean_csc_decoder()
+                self.do_clean_csc_decoder(stream)
             elif cd.get_src_width()!=enc_width or cd.get_src_height()!=enc_height:
                 log("do_video_paint csc: switching src size from %sx%s to %sx%s",
                          enc_width, enc_height, cd.get_src_width(), cd.get_src_height())
-                self.do_clean_csc_decoder()
+                self.do_clean_csc_decoder(stream)
             elif cd.get_dst_width()!=width or cd.get_dst_height()!=height:
                 log("do_video_paint csc: switching src size from %sx%s to %sx%s",
                          width, height, cd.get_dst_width(), cd.get_dst_height())
-                self.do_clean_csc_decoder()
-        if self._csc_decoder is None:
+                self.do_clean_csc_decoder(stream)
+        if self.get_stream_decoders(stream)[1] is None:
             #use higher quality csc to compensate for lower quality source
             #(which generally means that we downscaled via YUV422P or lower)
             #or when upscaling the video:
@@ -529,7 +558,7 @@ class WindowBackingBase(object):
             cd = self.make_csc(enc_width, enc_height, pixel_format,
                                            width, height, target_rgb_formats, csc_speed)
             log("do_video_paint new csc decoder: %s", cd)
-            self._csc_decoder = cd
+            self.set_stream_decoders(stream, vd, cd)
         rgb_format = cd.get_dst_format()
         rgb = cd.convert_image(img)
         log("do_video_paint rgb using %s.convert_image(%s)=%s", cd, img, rgb)
@@ -559,6 +588,33 @@ class WindowBackingBase(object):
     def paint_scroll(self, _img_data, _options, callbacks):
         raise NotImplementedError("no paint scroll on %s" % type(self))
 
+    def may_store_tile(self, rgb_format, img_data, width, height, rowstride, options):
+        """ must be called from UI thread by do_paint_rgb, even if the paint is skipped """
+        tile = options.intget("tile", 0)
+        if tile and options.strget("encoding")!="tile":
+            #the server wants us to keep these pixels in the tile cache:
+            tilelog("storing %ix%i %s tile %#x", width, height, rgb_format, tile)
+            self._tile_cache.add(tile, width*height, (width, height, rgb_format, rowstride, memoryview_to_bytes(img_data)))
+
+    def paint_tile(self, x, y, width, height, options, callbacks):
+        """ must be called from UI thread,
+            so that tiles are stored and retrieved in the same order as the server expects """
+        tile = options.intget("tile", 0)
+        tdata = self._tile_cache.get(tile)
+        if tdata is None:
+            message = "tile %#x is missing from the cache" % tile
+            tilelog(message)
+            fire_paint_callbacks(callbacks, False, message)
+            return
+        twidth, theight, rgb_format, rowstride, data = tdata
+        if twidth!=width or theight!=height:
+            message = "tile %#x is %ix%i, not %ix%i" % (tile, twidth, theight, width, height)
+            tilelog(message)
+            fire_paint_callbacks(callbacks, False, message)
+            return
+        tilelog("painting %ix%i %s tile %#x at %i,%i", width, height, rgb_format, tile, x, y)
+        self.do_paint_rgb(rgb_format, data, x, y, width, height, rowstride, options, callbacks)
+
 
     def draw_region(self, x, y, width, height, coding, img_data, rowstride, options, callbacks):
         """ dispatches the paint to one of the paint_XXXX methods """
@@ -603,6 +659,8 @@ class WindowBackingBase(object):
                 self.paint_image(coding, img_data, x, y, width, height, options, callbacks)
             elif coding == "scroll":
                 self.paint_scroll(img_data, options, callbacks)
+            elif coding == "tile":
+                self.idle_add(self.paint_tile, x, y, width, height, options, callbacks)
             else:
                 self.do_draw_region(x, y, width, height, coding, img_data, rowstride, options, callbacks)
         except Exception:
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import sys
+import json
+import platform
+from math import log as mlog
+
+from xpra.os_util import monotonic_time, get_cpu_count, osexpand
+from xpra.util import envint, envbool
+from xpra.log import Logger
+
+log = Logger("codec", "video", "score")
+
+CODEC_BENCHMARK = envbool("XPRA_CODEC_BENCHMARK", True)
+BENCHMARK_FILENAME = "codec-benchmark.json"
+BENCHMARK_FRAMES = envint("XPRA_CODEC_BENCHMARK_FRAMES", 10)
+BENCHMARK_RESOLUTIONS = ((640, 480), (1280, 720), (1920, 1080))
+BENCHMARK_QUALITY = 50
+BENCHMARK_SPEED = 50
+#the throughput which corresponds to a speed of 100, in MPixels/s,
+#every halving of the throughput loses 20 points:
+ENCODER_REFERENCE = envint("XPRA_CODEC_BENCHMARK_ENCODER_REFERENCE", 200)
+CSC_REFERENCE = envint("XPRA_CODEC_BENCHMARK_CSC_REFERENCE", 2000)
+SPEED_STEP = 20
+
+
+"""
+Measures the speed and setup cost of the video encoders and csc modules on this host,
+so the video pipeline scores can use those instead of the static values declared in the codec specs.
+The results are saved to disk and loaded by the video helper,
+they are ignored if they were measured on a different cpu or with a different version of the codec.
+"""
+
+def get_host_id():
+    cpu = ""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except (IOError, OSError):
+        cpu = platform.processor()
+    return "%s %s x %i" % (platform.machine(), cpu, get_cpu_count())
+
+def get_benchmark_filename():
+    filename = os.environ.get("XPRA_CODEC_BENCHMARK_FILE")
+    if filename:
+        return filename
+    from xpra.platform.paths import get_user_conf_dirs
+    dirs = get_user_conf_dirs()
+    if not dirs:
+        return None
+    return os.path.join(osexpand(dirs[0]), BENCHMARK_FILENAME)
+
+def get_spec_key(spec):
+    out = getattr(spec, "encoding", None) or spec.output_colorspace
+    return "%s:%s:%s" % (spec.codec_type, spec.input_colorspace, out)
+
+def get_spec_version(spec):
+    module = sys.modules.get(getattr(spec.codec_class, "__module__", ""))
+    get_version = getattr(module, "get_version", None)
+    if not get_version:
+        return ""
+    try:
+        return str(get_version())
+    except Exception:
+        return ""
+
+def get_speed(mpps, reference):
+    if mpps<=0:
+        return 0
+    return max(0, min(100, int(100+SPEED_STEP*mlog(float(mpps)/reference, 2))))
+
+def get_setup_cost(setup_ms):
+    #one point per millisecond:
+    return max(0, min(100, int(setup_ms)))
+
+
+def make_pixels(size, frame):
+    #a gradient with some noise, shifted for each frame so the encoders have some work to do:
+    gradient = bytes(bytearray(range(256)))*4
+    noise = os.urandom(1024)
+    blocks = [noise if i%8==frame%8 else gradient for i in range(size//1024+1)]
+    return b"".join(blocks)[:size]
+
+def make_benchmark_image(pixel_format, w, h, frame=0):
+    from xpra.codecs.image_wrapper import ImageWrapper
+    from xpra.codecs.codec_constants import get_subsampling_divs
+    if pixel_format.startswith("YUV") or pixel_format=="GBRP":
+        divs = get_subsampling_divs(pixel_format)
+        planes = [make_pixels(w//xdiv*h//ydiv, frame) for xdiv, ydiv in divs]
+        strides = [w//xdiv for xdiv, _ in divs]
+        return ImageWrapper(0, 0, w, h, planes, pixel_format, 32, strides, planes=ImageWrapper._3_PLANES, thread_safe=True)
+    bpp = {"r210" : 4}.get(pixel_format, len(pixel_format))
+    stride = w*bpp
+    return ImageWrapper(0, 0, w, h, make_pixels(stride*h, frame), pixel_format, 32, stride, planes=ImageWrapper.PACKED, thread_safe=True)
+
+
+def get_benchmark_sizes(spec, resolutions):
+    for w, h in resolutions:
+        w &= spec.width_mask
+        h &= spec.height_mask
+        if spec.min_w<=w<=spec.max_w and spec.min_h<=h<=spec.max_h:
+            yield w, h
+
+def benchmark_encoder(spec, w, h, frames=BENCHMARK_FRAMES):
+    """ returns the setup time in milliseconds and the throughput in MPixels/s """
+    images = [make_benchmark_image(spec.input_colorspace, w, h, i) for i in range(frames)]
+    e = spec.make_instance()
+    try:
+        start = monotonic_time()
+        e.init_context(w, h, spec.input_colorspace, spec.output_colorspaces, spec.encoding,
+                       BENCHMARK_QUALITY, BENCHMARK_SPEED, (1, 1), {})
+        setup = monotonic_time()-start
+        start = monotonic_time()
+        for image in images:
+            e.compress_image(image)
+        elapsed = monotonic_time()-start
+    finally:
+        e.clean()
+    return setup*1000, w*h*frames/max(elapsed, 0.000001)/1000/1000
+
+def benchmark_csc(spec, w, h, frames=BENCHMARK_FRAMES):
+    """ returns the setup time in milliseconds and the throughput in MPixels/s """
+    images = [make_benchmark_image(spec.input_colorspace, w, h, i) for i in range(frames)]
+    e = spec.make_instance()
+    try:
+        start = monotonic_time()
+        e.init_context(w, h, spec.input_colorspace, w, h, spec.output_colorspace, BENCHMARK_SPEED)
+        setup = monotonic_time()-start
+        start = monotonic_time()
+        for image in images:
+            out = e.convert_image(image)
+            out.free()
+        elapsed = monotonic_time()-start
+    finally:
+        e.clean()
+    return setup*1000, w*h*frames/max(elapsed, 0.000001)/1000/1000
+
+
+def get_specs(vh):
+    """ returns the encoder and csc specs found in this video helper """
+    encoder_specs = []
+    for encoding in vh.get_encodings():
+        for specs in vh.get_encoder_specs(encoding).values():
+            encoder_specs += [spec for spec in specs if spec not in encoder_specs]
+    csc_specs = []
+    for in_csc in vh.get_csc_inputs():
+        for specs in vh.get_csc_specs(in_csc).values():
+            csc_specs += [spec for spec in specs if spec not in csc_specs]
+    return encoder_specs, csc_specs
+
+def run_benchmark(vh, resolutions=BENCHMARK_RESOLUTIONS, frames=BENCHMARK_FRAMES, progress_cb=None):
+    results = {"host" : get_host_id()}
+    encoder_specs, csc_specs = get_specs(vh)
+    for name, specs, benchmark in (
+        ("encoders",    encoder_specs,  benchmark_encoder),
+        ("csc",         csc_specs,      benchmark_csc),
+        ):
+        d = results.setdefault(name, {})
+        for spec in specs:
+            key = get_spec_key(spec)
+            measurements = []
+            for w, h in get_benchmark_sizes(spec, resolutions):
+                try:
+                    setup, mpps = benchmark(spec, w, h, frames)
+                except Exception as e:
+                    log("%s(%s, %i, %i, %i)", benchmark, spec, w, h, frames, exc_info=True)
+                    log.warn("Warning: failed to benchmark %s at %ix%i", key, w, h)
+                    log.warn(" %s", e)
+                    continue
+                if progress_cb:
+                    progress_cb(key, w, h, setup, mpps)
+                measurements.append((w*h, round(setup, 3), round(mpps, 3)))
+            if measurements:
+                d[key] = {
+                    "version"   : get_spec_version(spec),
+                    "results"   : measurements,
+                    }
+    return results
+
+
+def save_benchmark(results, filename):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname, 0o700)
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+def load_benchmark(filename):
+    """ returns the results, or None if the file is missing or was not created on this host """
+    if not filename or not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, "r") as f:
+            results = json.load(f)
+    except Exception as e:
+        log("load_benchmark(%s)", filename, exc_info=True)
+        log.warn("Warning: failed to load the codec benchmark results from '%s':", filename)
+        log.warn(" %s", e)
+        return None
+    host = get_host_id()
+    if results.get("host")!=host:
+        log.warn("Warning: ignoring the codec benchmark results from '%s'", filename)
+        log.warn(" they were measured on '%s', not '%s'", results.get("host"), host)
+        return None
+    return results
+
+def apply_benchmark(vh, results):
+    """
+        Updates the specs found in the video helper with the measured values,
+        returns the number of specs updated.
+    """
+    from xpra.codecs.video_helper import specs_generation
+    encoder_specs, csc_specs = get_specs(vh)
+    count = 0
+    for name, specs, reference in (
+        ("encoders",    encoder_specs,  ENCODER_REFERENCE),
+        ("csc",         csc_specs,      CSC_REFERENCE),
+        ):
+        d = results.get(name, {})
+        for spec in specs:
+            key = get_spec_key(spec)
+            r = d.get(key)
+            if not r:
+                continue
+            if r.get("version")!=get_spec_version(spec):
+                log("ignoring the benchmark results for %s: version %s vs %s", key, r.get("version"), get_spec_version(spec))
+                continue
+            spec.measured = tuple(sorted((int(pixels), get_speed(mpps, reference), get_setup_cost(setup))
+                                         for pixels, setup, mpps in r.get("results", ())))
+            log("%s measured=%s (static speed=%i, setup-cost=%i)", key, spec.measured, spec.speed, spec.setup_cost)
+            count += 1
+    if count:
+        specs_generation.increase()
+    return count
+
+def load_and_apply_benchmark(vh):
+    if not CODEC_BENCHMARK:
+        return 0
+    filename = get_benchmark_filename()
+    results = load_benchmark(filename)
+    if not results:
+        return 0
+    count = apply_benchmark(vh, results)
+    log("applied the codec benchmark results from '%s' to %i codec specs", filename, count)
+    return count
+
+
+def benchmark(video_encoders, csc_modules, filename=None, resolutions=BENCHMARK_RESOLUTIONS, frames=BENCHMARK_FRAMES):
+    from xpra.codecs.loader import load_codecs
+    from xpra.codecs.video_helper import VideoHelper
+    load_codecs(decoders=False)
+    vh = VideoHelper()
+    vh.set_modules(video_encoders, csc_modules)
+    vh.init()
+    filename = filename or get_benchmark_filename()
+    def progress(key, w, h, setup, mpps):
+        print("%-40s %4ix%-4i  setup: %7.1fms  %8.1f MPixels/s" % (key, w, h, setup, mpps))
+    try:
+        results = run_benchmark(vh, resolutions, frames, progress)
+    finally:
+        vh.cleanup()
+    if not filename:
+        print("no location found for saving the results")
+        return 1
+    save_benchmark(results, filename)
+    print("results saved to '%s'" % filename)
+    return 0
+
+def run_codec_benchmark(options, args):
+    filename = None
+    if args:
+        filename = args[0]
+    return benchmark(options.video_encoders, options.csc_modules, filename)
+
+
+def main(argv):
+    from optparse import OptionParser
+    from xpra.platform import program_context
+    from xpra.codecs.video_helper import ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS
+    parser = OptionParser(usage="%prog [options] [FILENAME]")
+    parser.add_option("--frames", action="store", type="int", dest="frames", default=BENCHMARK_FRAMES,
+                      help="The number of frames to process at each resolution. Default: %default.")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                      help="Show debug messages.")
+    options, args = parser.parse_args(argv[1:])
+    if len(args)>1:
+        parser.error("too many arguments")
+    with program_context("Codec Benchmark"):
+        if options.verbose:
+            log.enable_debug()
+        filename = None
+        if args:
+            filename = args[0]
+        return benchmark(ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS, filename, frames=max(1, options.frames))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -57,6 +57,18 @@ class CodecStateException(Exception):
     pass
 
 
+def interpolate(points, x):
+    """ piecewise linear interpolation of (x, y) points sorted by x, clamped at both ends """
+    px, py = points[0]
+    if x<=px:
+        return py
+    for nx, ny in points[1:]:
+        if x<=nx:
+            return py + (ny-py)*(x-px)/float(max(1, nx-px))
+        px, py = nx, ny
+    return py
+
+
 class _codec_spec(object):
 
     #I can't imagine why someone would have more than this many
@@ -88,6 +100,9 @@ class _codec_spec(object):
         self.height_mask = height_mask
         self.can_scale = can_scale
         self.max_instances = 0
+        #values measured on this host by the codec benchmark (if any),
+        #as (pixels, speed, setup_cost) tuples sorted by pixel count:
+        self.measured = ()
         self._exported_fields = ["codec_class", "codec_type",
                         "quality", "speed",
                         "setup_cost", "cpu_cost", "gpu_cost", "score_boost",
@@ -125,6 +140,16 @@ class _codec_spec(object):
             d[k] = getattr(self, k)
         return d
 
+    def get_speed(self, pixels=0):
+        if not self.measured:
+            return self.speed
+        return int(interpolate(tuple((p, s) for p, s, _ in self.measured), pixels))
+
+    def get_setup_cost(self, pixels=0):
+        if not self.measured:
+            return self.setup_cost
+        return int(interpolate(tuple((p, c) for p, _, c in self.measured), pixels))
+
     def get_runtime_factor(self):
         #a cost multiplier that some encoder may want to override
         #1.0 means no change:
@@ -483,6 +483,7 @@ cdef class Encoder:
     cdef object frame_types
     cdef object blank_buffer
     cdef uint64_t first_frame_timestamp
+    cdef int force_idr
 
     cdef object __weakref__
 
@@ -510,6 +511,7 @@ cdef class Encoder:
         self.last_frame_times = deque(maxlen=200)
         self.time = 0
         self.first_frame_timestamp = 0
+        self.force_idr = 0
         self.bandwidth_limit = options.intget("bandwidth-limit", 0)
         self.profile = self._get_profile(options, self.src_format)
         self.export_nals = options.intget("h264.export-nals", 0)
@@ -634,6 +636,7 @@ cdef class Encoder:
         self.bytes_out = 0
         self.last_frame_times = []
         self.first_frame_timestamp = 0
+        self.force_idr = 0
         f = self.file
         if f:
             self.file = None
@@ -812,6 +815,10 @@ cdef class Encoder:
         istrides = image.get_rowstride()
 
         x264_picture_init(&pic_in)
+        if self.force_idr:
+            #first frame of a restarted stream:
+            pic_in.i_type = X264_TYPE_IDR
+            self.force_idr = 0
 
         if self.src_format.find("RGB")>=0 or self.src_format.find("BGR")>=0:
             assert len(pixels)>0
@@ -914,6 +921,21 @@ cdef class Encoder:
             self.file.flush()
         return cdata, client_options
 
+    def restart(self):
+        """
+            Starts a new stream using the same context,
+            so this encoder can be re-used for another window or another pipeline:
+            the next frame will be an IDR frame.
+            (the timestamps are not reset since the pts must keep increasing)
+            Returns False if the encoder cannot be restarted.
+        """
+        if self.context==NULL or x264_encoder_delayed_frames(self.context)>0:
+            return False
+        self.frames = 0
+        self.frame_types = {}
+        self.force_idr = 1
+        return True
+
     def flush(self, unsigned long frame_no):
         if self.frames>frame_no or self.context==NULL:
             return None, {}
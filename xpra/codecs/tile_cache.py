@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from collections import OrderedDict
+
+
+"""
+A content-addressed cache of pixel tiles, keyed by the hash of their pixels.
+The client uses it to store the pixels it has painted,
+the server uses an identical instance (without the pixel data) to track what the client has,
+so that it can send a reference to the cached tile instead of the pixels.
+Both sides must apply the same operations in the same order
+so that they evict the same entries: this is why the limits are expressed
+as a number of entries and a number of pixels, and not in bytes.
+"""
+class TileCache(object):
+
+    def __init__(self, max_entries, max_pixels):
+        self.max_entries = max_entries
+        self.max_pixels = max_pixels
+        self.tiles = OrderedDict()
+        self.pixels = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "TileCache(%i entries, %i pixels)" % (len(self.tiles), self.pixels)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def can_store(self, pixels):
+        return self.max_entries>0 and pixels<=self.max_pixels
+
+    def get(self, key):
+        """ returns the value stored for this key and marks it as recently used """
+        entry = self.tiles.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.tiles[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def add(self, key, pixels, value):
+        assert self.can_store(pixels), "tile is too big for this cache: %i pixels" % pixels
+        entry = self.tiles.pop(key, None)
+        if entry:
+            self.pixels -= entry[0]
+        self.tiles[key] = (pixels, value)
+        self.pixels += pixels
+        while len(self.tiles)>self.max_entries or self.pixels>self.max_pixels:
+            _, (opixels, _) = self.tiles.popitem(last=False)
+            self.pixels -= opixels
+
+    def clear(self):
+        self.tiles = OrderedDict()
+        self.pixels = 0
+
+    def get_info(self):
+        return {
+            "entries"       : len(self.tiles),
+            "pixels"        : self.pixels,
+            "max-entries"   : self.max_entries,
+            "max-pixels"    : self.max_pixels,
+            "hits"          : self.hits,
+            "misses"        : self.misses,
+            }
@@ -9,7 +9,7 @@ import sys
 from threading import Lock
 
 from xpra.codecs.loader import get_codec, get_codec_error
-from xpra.util import csv, engs
+from xpra.util import csv, engs, AtomicInteger
 from xpra.log import Logger
 
 log = Logger("codec", "video")
@@ -27,6 +27,14 @@ CODEC_TO_MODULE = {
     "ffmpeg"     : "enc_ffmpeg",
     }
 
+#incremented every time the encoder or csc specs change,
+#so the users can invalidate the data they derived from them (ie: pipeline scores):
+specs_generation = AtomicInteger()
+
+def get_specs_generation():
+    return specs_generation.get()
+
+
 def has_codec_module(module_name):
     top_module = "xpra.codecs.%s" % module_name
     try:
@@ -164,6 +172,7 @@ class VideoHelper(object):
             self._video_encoder_specs = {}
             self._csc_encoder_specs = {}
             self._video_decoder_specs = {}
+            specs_generation.increase()
             self.video_encoders = []
             self.csc_modules = []
             self.video_decoders = []
@@ -229,9 +238,18 @@ class VideoHelper(object):
             self.init_video_encoders_options()
             self.init_csc_options()
             self.init_video_decoders_options()
+            self.init_benchmark()
             self._initialized = True
         log("VideoHelper.init() done")
 
+    def init_benchmark(self):
+        #use the speed and setup cost measured on this host, if we have them:
+        from xpra.codecs.codec_benchmark import load_and_apply_benchmark
+        try:
+            load_and_apply_benchmark(self)
+        except Exception:
+            log.error("Error loading the codec benchmark results", exc_info=True)
+
     def get_encodings(self):
         return tuple(self._video_encoder_specs.keys())
 
@@ -300,6 +318,7 @@ class VideoHelper(object):
 
     def add_encoder_spec(self, encoding, colorspace, spec):
         self._video_encoder_specs.setdefault(encoding, {}).setdefault(colorspace, []).append(spec)
+        specs_generation.increase()
 
 
     def init_csc_options(self):
@@ -344,6 +363,7 @@ class VideoHelper(object):
 
     def add_csc_spec(self, in_csc, out_csc, spec):
         self._csc_encoder_specs.setdefault(in_csc, {}).setdefault(out_csc, []).append(spec)
+        specs_generation.increase()
 
 
     def init_video_decoders_options(self):
@@ -213,7 +213,11 @@ STRUCT_KNOWN_FILTERS = OrderedDict([
                 ("encoding"     , "Server side encoding selection and compression"),
                 ("scaling"      , "Picture scaling"),
                 ("delta"        , "Delta pre-compression"),
+                ("tile"         , "Client tile cache"),
+                ("sharing"      , "Encoder output shared between clients"),
+                ("trace"        , "Damage trace recording and replay"),
                 ("scroll"       , "Scrolling detection and compression"),
+                ("content"      , "Pixel content classification"),
                 ("xor"          , "XOR delta pre-compression"),
                 ("subregion"    , "Video subregion processing"),
                 ("regiondetect" , "Video region detection"),
@@ -0,0 +1,325 @@
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import socket
+import asyncio
+from threading import Lock, Event
+from concurrent.futures import ThreadPoolExecutor
+
+from xpra.os_util import Queue
+from xpra.util import envint
+from xpra.make_thread import start_thread
+from xpra.net.protocol import Protocol, SEND_INVALID_PACKET, SEND_INVALID_PACKET_DATA
+from xpra.net.bytestreams import SocketConnection, ABORT, SOCKET_WRITEV, WRITEV_MAX_BUFFERS
+from xpra.log import Logger
+
+log = Logger("network", "protocol")
+
+#the number of threads used for compressing, encrypting and parsing packets, shared by all connections:
+WORKERS = envint("XPRA_ASYNCIO_WORKERS", min(32, (os.cpu_count() or 1)*2))
+
+
+"""
+An implementation of the Protocol class which does not use any threads of its own:
+the sockets of all the connections are multiplexed in a single asyncio event loop,
+and the packet formatting and parsing (compression, encryption and encoding)
+runs in a thread pool shared by all the connections.
+Only plain sockets are supported, see is_supported().
+"""
+
+_loop = None
+_executor = None
+_lock = Lock()
+
+def get_event_loop():
+    global _loop, _executor
+    with _lock:
+        if _loop is None:
+            _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="protocol")
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(_executor)
+            start_thread(_loop.run_forever, "asyncio-loop", daemon=True)
+    return _loop
+
+
+def is_supported(conn):
+    #ssl and ssh connections subclass SocketConnection,
+    #but they cannot be used with non-blocking sockets:
+    return type(conn) is SocketConnection and isinstance(conn._socket, socket.socket)
+
+
+class AsyncioProtocol(Protocol):
+
+    def __init__(self, *args, **kwargs):
+        Protocol.__init__(self, *args, **kwargs)
+        self._loop = get_event_loop()
+        #we don't use any of the protocol threads:
+        self._read_thread = None
+        #the formatting is paced by the writes, so this queue does not need to block:
+        self._write_queue = Queue()
+        self._parser = self.packet_parser()
+        next(self._parser)
+        self._socket = None
+        self._fd = -1
+        self._socket_timeout = None
+        self._reading = False
+        self._writing = False
+        self._formatting = False
+        self._write_buffers = None
+        self._write_item = None
+        self._released = Event()
+
+    def __repr__(self):
+        return "AsyncioProtocol(%s)" % self._conn
+
+    def get_info(self, alias_info=True):
+        info = Protocol.get_info(self, alias_info)
+        info["asyncio"] = {
+            "workers"   : WORKERS,
+            "reading"   : self._reading,
+            "writing"   : self._writing,
+            "formatting": self._formatting,
+            }
+        return info
+
+    def wait_for_io_threads_exit(self, timeout=None):
+        if not self._released.wait(timeout):
+            log.warn("Warning: %s is still registered with the event loop (timeout=%s)", self._conn or "cleared connection", timeout)
+            return False
+        return True
+
+
+    def start(self):
+        def start_network_io():
+            if not self._closed:
+                self._loop.call_soon_threadsafe(self._start_io)
+        self.idle_add(start_network_io)
+        if SEND_INVALID_PACKET:
+            self.timeout_add(SEND_INVALID_PACKET*1000, self.raw_write, SEND_INVALID_PACKET_DATA)
+
+    def _start_io(self):
+        conn = self._conn
+        if self._closed or not conn:
+            self._released.set()
+            return
+        sock = conn._socket
+        self._socket = sock
+        self._fd = sock.fileno()
+        self._socket_timeout = sock.gettimeout()
+        sock.setblocking(False)
+        self._resume_reading()
+        self._pump()
+
+    def _release_socket(self):
+        #runs in the event loop thread
+        if self._fd>=0:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            self._fd = -1
+            self._reading = self._writing = False
+        #hand the socket back in blocking mode (see steal_connection):
+        sock = self._socket
+        if sock:
+            self._socket = None
+            try:
+                sock.settimeout(self._socket_timeout)
+            except (OSError, ValueError):
+                log("failed to restore the socket timeout", exc_info=True)
+        self._released.set()
+
+    def terminate_queue_threads(self):
+        Protocol.terminate_queue_threads(self)
+        try:
+            self._loop.call_soon_threadsafe(self._release_socket)
+        except RuntimeError:
+            #the event loop is gone
+            self._released.set()
+
+    def _io_error(self, name, e):
+        if self._closed:
+            return
+        self._internal_error("%s connection %s reset" % (name, self._conn), e, exc_info=e.args[0] not in ABORT)
+
+
+    #reading:
+    def _resume_reading(self):
+        if self._fd>=0 and not self._closed and not self._reading:
+            self._loop.add_reader(self._fd, self._read_ready)
+            self._reading = True
+
+    def _read_ready(self):
+        conn = self._conn
+        if self._closed or not conn:
+            return
+        try:
+            if conn.fd_passing:
+                buf = conn.recv_with_fds(self.read_buffer_size)
+            else:
+                buf = conn._socket.recv(self.read_buffer_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, socket.error) as e:
+            self._io_error("read", e)
+            return
+        conn.input_bytecount += len(buf)
+        conn.input_readcount += 1
+        #stop reading until this buffer has been parsed:
+        self._loop.remove_reader(self._fd)
+        self._reading = False
+        if not buf:
+            log("read: eof")
+            self.idle_add(self.close)
+            return
+        self.input_raw_packetcount += 1
+        f = self._loop.run_in_executor(None, self._process_read, buf)
+        f.add_done_callback(self._parse_done)
+
+    def read_queue_put(self, data):
+        #runs in the thread pool, one buffer at a time for each connection
+        parser = self._parser
+        if not parser or self._closed:
+            return
+        try:
+            parser.send(data)
+        except StopIteration:
+            self._parser = None
+
+    def _parse_done(self, f):
+        e = f.exception()
+        if e and not self._closed:
+            self._internal_error("error in network packet reading/parsing", e, exc_info=e)
+            return
+        if self._parser:
+            self._resume_reading()
+
+
+    #writing:
+    def source_has_more(self):
+        shm = self._source_has_more
+        if not shm or self._closed:
+            return
+        shm.set()
+        self._wakeup()
+
+    def raw_write(self, items, start_cb=None, end_cb=None, fail_cb=None, synchronous=True, more=False):
+        self._write_queue.put((items, start_cb, end_cb, fail_cb, synchronous, more))
+        self._wakeup()
+
+    def _wakeup(self):
+        #may be called from any thread
+        if not self._closed:
+            self._loop.call_soon_threadsafe(self._pump)
+
+    def _pump(self):
+        """
+            Runs in the event loop thread whenever there may be something to send:
+            sends the next item from the write queue,
+            or formats the next packet from the packet source once the write queue is empty.
+        """
+        if self._closed or self._fd<0:
+            return
+        if self._write_buffers is None:
+            #we are the only consumer of this queue:
+            if self._write_queue.empty():
+                #format another packet?
+                shm = self._source_has_more
+                if shm and shm.is_set() and self._get_packet_cb and not self._formatting:
+                    self._formatting = True
+                    f = self._loop.run_in_executor(None, self._format_packet)
+                    f.add_done_callback(self._format_done)
+                return
+            items = self._write_queue.get_nowait()
+            if items is None:
+                log("write: empty marker, exiting")
+                self.close()
+                return
+            self._start_write(*items)
+        self._flush()
+
+    def _format_packet(self):
+        #runs in the thread pool
+        gpc = self._get_packet_cb
+        if self._closed or not gpc:
+            return
+        self._add_packet_to_queue(*gpc())
+
+    def _format_done(self, f):
+        self._formatting = False
+        e = f.exception()
+        if e and not self._closed:
+            self._internal_error("error in network packet write/format", e, exc_info=e)
+            return
+        self._pump()
+
+    def _start_write(self, buf_data, start_cb=None, end_cb=None, _fail_cb=None, _synchronous=True, more=False):
+        conn = self._conn
+        if more or len(buf_data)>1:
+            conn.set_nodelay(False)
+        if len(buf_data)>1:
+            conn.set_cork(True)
+        if start_cb:
+            try:
+                start_cb(conn.output_bytecount)
+            except Exception:
+                if not self._closed:
+                    log.error("Error on write start callback %s", start_cb, exc_info=True)
+        self._write_buffers = [memoryview(buf) for buf in buf_data if buf]
+        self._write_item = (len(buf_data), end_cb, more)
+
+    def _flush(self):
+        conn = self._conn
+        if self._closed or not conn:
+            return
+        sock = conn._socket
+        buffers = self._write_buffers
+        while buffers:
+            try:
+                if conn.pending_fds:
+                    written = conn.send_with_fds(buffers[:WRITEV_MAX_BUFFERS])
+                elif SOCKET_WRITEV and len(buffers)>1:
+                    written = sock.sendmsg(buffers[:WRITEV_MAX_BUFFERS])
+                else:
+                    written = sock.send(buffers[0])
+            except (BlockingIOError, InterruptedError):
+                written = 0
+            except (OSError, socket.error) as e:
+                self._io_error("write", e)
+                return
+            if not written:
+                #wait for the socket to become writeable again:
+                if not self._writing:
+                    self._loop.add_writer(self._fd, self._flush)
+                    self._writing = True
+                return
+            conn.output_bytecount += written
+            conn.output_writecount += 1
+            self.output_raw_packetcount += 1
+            while written>0:
+                size = buffers[0].nbytes
+                if written<size:
+                    buffers[0] = buffers[0][written:]
+                    break
+                written -= size
+                buffers.pop(0)
+        if self._writing:
+            self._loop.remove_writer(self._fd)
+            self._writing = False
+        count, end_cb, more = self._write_item
+        self._write_buffers = None
+        self._write_item = None
+        if count>1:
+            conn.set_cork(False)
+        if not more:
+            conn.set_nodelay(True)
+        if end_cb:
+            try:
+                end_cb(conn.output_bytecount)
+            except Exception:
+                if not self._closed:
+                    log.error("Error on write end callback %s", end_cb, exc_info=True)
+        self.output_packetcount += 1
+        #give the other connections a chance to run before sending the next item:
+        self._loop.call_soon(self._pump)
@@ -9,10 +9,13 @@ import os
 import time
 import errno
 import socket
+from array import array
+from threading import Lock
+from collections import deque
 
 from xpra.net.common import ConnectionClosedException
 from xpra.util import envint, envbool, csv
-from xpra.os_util import WIN32, PYTHON2, POSIX, LINUX
+from xpra.os_util import WIN32, PYTHON2, POSIX, LINUX, memoryview_to_bytes
 from xpra.platform.features import TCP_OPTIONS, IP_OPTIONS, SOCKET_OPTIONS
 from xpra.log import Logger
 
@@ -27,6 +30,14 @@ if SOCKET_CORK:
         log.warn(" %s", e)
         SOCKET_CORK = False
 SOCKET_NODELAY = envbool("XPRA_SOCKET_NODELAY", None)
+#send multiple buffers with a single sendmsg call (not available with python2 or on win32):
+SOCKET_WRITEV = envbool("XPRA_SOCKET_WRITEV", True) and hasattr(socket.socket, "sendmsg")
+#the maximum number of buffers we pass to sendmsg:
+WRITEV_MAX_BUFFERS = envint("XPRA_WRITEV_MAX_BUFFERS", 64)
+#pass file descriptors over unix domain sockets (ie: memfd buffers):
+FD_PASSING = envbool("XPRA_FD_PASSING", True) and hasattr(socket, "SCM_RIGHTS") and hasattr(socket.socket, "recvmsg")
+#the maximum number of file descriptors we can receive with each read:
+FD_PASSING_MAX = envint("XPRA_FD_PASSING_MAX", 16)
 VSOCK_TIMEOUT = envint("XPRA_VSOCK_TIMEOUT", 5)
 SOCKET_TIMEOUT = envint("XPRA_SOCKET_TIMEOUT", 20)
 SSL_PEEK = PYTHON2 and envbool("XPRA_SSL_PEEK", True)
@@ -189,6 +200,13 @@ class Connection(object):
         #not implemented
         return None
 
+    def can_writev(self):
+        return False
+
+    def writev(self, buffers):
+        #connections without vectored writes just send the buffers joined together:
+        return self.write(b"".join(memoryview_to_bytes(buf) for buf in buffers))
+
     def _write(self, *args):
         """ wraps do_write with packet accounting """
         w = self.untilConcludes(*args)
@@ -308,6 +326,11 @@ class SocketConnection(Connection):
             self.filename = remote
         if SOCKET_NODELAY is not None and self.socktype in TCP_SOCKTYPES:
             self.do_set_nodelay(SOCKET_NODELAY)
+        #file descriptors:
+        self.fd_passing = False
+        self.fd_lock = Lock()
+        self.pending_fds = []
+        self.received_fds = deque()
 
     def set_nodelay(self, nodelay):
         if SOCKET_NODELAY is None and self.socktype in TCP_SOCKTYPES and self.nodelay!=nodelay:
@@ -328,11 +351,80 @@ class SocketConnection(Connection):
         return self._socket.recv(n, socket.MSG_PEEK)
 
     def read(self, n):
+        if self.fd_passing:
+            return self._read(self.recv_with_fds, n)
         return self._read(self._socket.recv, n)
 
     def write(self, buf):
+        if self.pending_fds:
+            return self._write(self.send_with_fds, [buf])
         return self._write(self._socket.send, buf)
 
+    def can_writev(self):
+        #ssh channels and other socket wrappers may not support sendmsg:
+        return SOCKET_WRITEV and isinstance(self._socket, socket.socket)
+
+    def writev(self, buffers):
+        """ writes as much as we can from the list of buffers in one call, returns the number of bytes written """
+        if self.pending_fds:
+            return self._write(self.send_with_fds, buffers[:WRITEV_MAX_BUFFERS])
+        return self._write(self._socket.sendmsg, buffers[:WRITEV_MAX_BUFFERS])
+
+
+    def can_pass_fds(self):
+        """ only unix domain sockets can pass file descriptors """
+        return FD_PASSING and isinstance(self._socket, socket.socket) and self._socket.family==getattr(socket, "AF_UNIX", None)
+
+    def enable_fd_passing(self):
+        """ from now on, we read with recvmsg so we can receive file descriptors """
+        assert self.can_pass_fds()
+        self.fd_passing = True
+
+    def send_fds(self, fds):
+        """
+            The file descriptors are sent along with the next write,
+            so they always arrive before the packet we are about to queue.
+            We take ownership of the file descriptors and close them once they have been sent.
+        """
+        assert self.can_pass_fds()
+        with self.fd_lock:
+            self.pending_fds += list(fds)
+
+    def pop_received_fd(self):
+        """ returns the oldest file descriptor we have received, or -1 """
+        try:
+            return self.received_fds.popleft()
+        except IndexError:
+            return -1
+
+    def send_with_fds(self, buffers):
+        with self.fd_lock:
+            fds = self.pending_fds
+            self.pending_fds = []
+        try:
+            r = self._socket.sendmsg(buffers, [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", fds))])
+        except:
+            #try again with the next write:
+            with self.fd_lock:
+                self.pending_fds = fds+self.pending_fds
+            raise
+        log("sent file descriptors %s", fds)
+        for fd in fds:
+            os.close(fd)
+        return r
+
+    def recv_with_fds(self, n):
+        data, ancdata, flags, _ = self._socket.recvmsg(n, socket.CMSG_SPACE(FD_PASSING_MAX*array("i").itemsize))
+        for level, ctype, cdata in ancdata:
+            if level==socket.SOL_SOCKET and ctype==socket.SCM_RIGHTS:
+                fds = array("i")
+                fds.frombytes(cdata[:len(cdata)-len(cdata)%fds.itemsize])
+                log("received file descriptors %s", fds.tolist())
+                self.received_fds.extend(fds)
+        if flags & socket.MSG_CTRUNC:
+            log.warn("Warning: some file descriptors have been discarded")
+        return data
+
     def close(self):
         s = self._socket
         try:
@@ -341,6 +433,15 @@ class SocketConnection(Connection):
             i = s
         log("%s.close() for socket=%s", self, i)
         Connection.close(self)
+        with self.fd_lock:
+            fds = self.pending_fds+list(self.received_fds)
+            self.pending_fds = []
+            self.received_fds.clear()
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
         #meaningless for udp:
         try:
             s.settimeout(0)
@@ -518,6 +619,10 @@ if SSL_PEEK:
 class SSLSocketConnection(SocketConnection):
     SSL_TIMEOUT_MESSAGES = ("The read operation timed out", "The write operation timed out")
 
+    def can_writev(self):
+        #ssl sockets do not implement sendmsg
+        return False
+
     def can_retry(self, e):
         if getattr(e, "library", None)=="SSL":
             reason = getattr(e, "reason", None)
@@ -5,16 +5,24 @@
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
+import os
 import sys
+import struct
+from threading import local
 
 def debug(msg, *args, **kwargs):
     from xpra.log import Logger
     logger = Logger("network", "protocol")
     logger.debug(msg, *args, **kwargs)
-from xpra.net.header import LZ4_FLAG, ZLIB_FLAG, LZO_FLAG
+from xpra.net.header import LZ4_FLAG, ZLIB_FLAG, LZO_FLAG, ZSTD_FLAG, CHUNKED_FLAG
+from xpra.util import envint
 
 
 MAX_SIZE = 256*1024*1024
+#payloads larger than this are split into chunks which are compressed in parallel:
+CHUNKED_COMPRESSION_SIZE = envint("XPRA_CHUNKED_COMPRESSION_SIZE", 4*1024*1024)
+CHUNK_SIZE = max(64*1024, envint("XPRA_COMPRESSION_CHUNK_SIZE", 1024*1024))
+COMPRESSION_THREADS = envint("XPRA_COMPRESSION_THREADS", 4)
 
 
 python_lz4_version = None
@@ -91,6 +99,125 @@ except Exception as e:
         raise Exception("lzo is not supported!")
 
 
+python_zstd_version = None
+zstd_version = None
+has_zstd = False
+#maps xpra's 0-10 compression levels to zstd levels:
+ZSTD_LEVELS = (1, 1, 1, 2, 3, 3, 5, 7, 9, 13, 19)
+#directories containing pre-trained dictionaries, named after the type of packets they are for,
+#ie: "control.zdict", "clipboard.zdict" or "metadata.zdict"
+ZSTD_DICTIONARY_DIRS = [x for x in os.environ.get("XPRA_ZSTD_DICTIONARY_DIRS", "").split(os.pathsep) if x]
+#the packets which have their own dictionary, everything else uses the "control" dictionary:
+ZSTD_DICTIONARY_PACKETS = {
+    "metadata"  : ("new-window", "new-override-redirect", "new-tray", "window-metadata"),
+    "clipboard" : ("clipboard-token", "clipboard-request", "clipboard-contents", "clipboard-contents-none"),
+    }
+#compression contexts cannot be shared between threads:
+zstd_contexts = local()
+try:
+    import zstandard
+    python_zstd_version = zstandard.__version__
+    zstd_version = ".".join(str(x) for x in zstandard.ZSTD_VERSION)
+    has_zstd = True
+except ImportError as e:
+    debug("zstd not found: %s", e)
+    del e
+
+zstd_dictionaries = None
+zstd_dictionary_types = {}
+def get_zstd_dictionaries():
+    """ loads the dictionaries from ZSTD_DICTIONARY_DIRS the first time this is called """
+    global zstd_dictionaries
+    if zstd_dictionaries is None:
+        zstd_dictionaries = {}
+        if has_zstd:
+            for dirname in ZSTD_DICTIONARY_DIRS:
+                try:
+                    filenames = sorted(os.listdir(dirname))
+                except OSError as e:
+                    debug("cannot list zstd dictionary directory '%s': %s", dirname, e)
+                    continue
+                for filename in filenames:
+                    dict_type, ext = os.path.splitext(filename)
+                    if ext!=".zdict" or dict_type in zstd_dictionary_types:
+                        continue
+                    try:
+                        with open(os.path.join(dirname, filename), "rb") as f:
+                            zdict = zstandard.ZstdCompressionDict(f.read())
+                        dict_id = zdict.dict_id()
+                        assert dict_id>0, "not a zstd dictionary"
+                    except Exception as e:
+                        debug("failed to load zstd dictionary '%s' from '%s': %s", filename, dirname, e)
+                        continue
+                    debug("loaded zstd '%s' dictionary %#x from '%s'", dict_type, dict_id, dirname)
+                    zstd_dictionaries[dict_id] = zdict
+                    zstd_dictionary_types[dict_type] = dict_id
+    return zstd_dictionaries
+
+def get_zstd_dictionary_id(packet_type, dict_ids):
+    """ returns the id of the dictionary to use for this type of packet, if the peer has it too """
+    get_zstd_dictionaries()
+    if not isinstance(packet_type, str):
+        try:
+            packet_type = packet_type.decode("latin1")
+        except AttributeError:
+            return 0
+    dict_type = "control"
+    for t, packet_types in ZSTD_DICTIONARY_PACKETS.items():
+        if packet_type in packet_types:
+            dict_type = t
+            break
+    dict_id = zstd_dictionary_types.get(dict_type, 0)
+    if dict_id not in dict_ids:
+        return 0
+    return dict_id
+
+def zstd_compress(packet, level, dict_id=0):
+    if not has_zstd:
+        raise Exception("zstd is not supported!")
+    key = (level, dict_id)
+    compressors = getattr(zstd_contexts, "compressors", None)
+    if compressors is None:
+        compressors = zstd_contexts.compressors = {}
+    compressor = compressors.get(key)
+    if compressor is None:
+        zlevel = ZSTD_LEVELS[max(0, min(10, level))]
+        if dict_id:
+            compressor = zstandard.ZstdCompressor(level=zlevel, dict_data=get_zstd_dictionaries()[dict_id])
+        else:
+            compressor = zstandard.ZstdCompressor(level=zlevel)
+        compressors[key] = compressor
+    return min(15, level) | ZSTD_FLAG, compressor.compress(packet)
+
+def zstd_decompress(data):
+    #the dictionary id and the content size are recorded in the frame header:
+    params = zstandard.get_frame_parameters(data)
+    #when the size is declared, the decompressor allocates it regardless of 'max_output_size':
+    size = params.content_size
+    if size!=zstandard.CONTENTSIZE_UNKNOWN and size>MAX_SIZE:
+        raise InvalidCompressionException("uncompressed data is too large: %iMB, limit is %iMB" % (size//1024//1024, MAX_SIZE//1024//1024))
+    dict_id = params.dict_id
+    decompressors = getattr(zstd_contexts, "decompressors", None)
+    if decompressors is None:
+        decompressors = zstd_contexts.decompressors = {}
+    decompressor = decompressors.get(dict_id)
+    if decompressor is None:
+        if dict_id:
+            zdict = get_zstd_dictionaries().get(dict_id)
+            if zdict is None:
+                raise InvalidCompressionException("missing zstd dictionary %#x" % dict_id)
+            decompressor = zstandard.ZstdDecompressor(dict_data=zdict)
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+        decompressors[dict_id] = decompressor
+    return decompressor.decompress(data, max_output_size=MAX_SIZE)
+
+def train_zstd_dictionary(samples, dict_size=112640):
+    """ trains a dictionary from sample packets, the data can be saved to ZSTD_DICTIONARY_DIRS """
+    assert has_zstd, "zstd is not available"
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+
 try:
     import zlib
     has_zlib = True
@@ -123,18 +250,20 @@ else:
 use_zlib = has_zlib
 use_lzo = has_lzo
 use_lz4 = has_lz4
+use_zstd = has_zstd
 
 #all the compressors we know about, in best compatibility order:
-ALL_COMPRESSORS = ["zlib", "lz4", "lzo"]
+ALL_COMPRESSORS = ["zlib", "lz4", "lzo", "zstd"]
 
 #order for performance:
-PERFORMANCE_ORDER = ["lz4", "lzo", "zlib"]
+PERFORMANCE_ORDER = ["lz4", "zstd", "lzo", "zlib"]
 
 
 _COMPRESSORS = {
         "zlib"  : zcompress,
         "lz4"   : lz4_compress,
         "lzo"   : lzo_compress,
+        "zstd"  : zstd_compress,
         "none"  : nocompress,
                }
 
@@ -156,6 +285,16 @@ def get_compression_caps():
                               ""            : True,
                               "version"     : python_lz4_version,
                               }
+    _zstd = {"" : use_zstd}
+    if zstd_version:
+        _zstd["version"] = zstd_version
+        _zstd["dictionaries"] = sorted(get_zstd_dictionaries().keys())
+    if python_zstd_version:
+        caps["python-zstandard"] = {
+                              ""            : True,
+                              "version"     : python_zstd_version,
+                              }
+    caps["chunked-compression"] = True
     _zlib = {
              ""             : use_zlib,
              }
@@ -164,6 +303,7 @@ def get_compression_caps():
     caps.update({
                  "lz4"                   : _lz4,
                  "lzo"                   : _lzo,
+                 "zstd"                  : _zstd,
                  "zlib"                  : _zlib,
                  })
     return caps
@@ -172,6 +312,7 @@ def get_enabled_compressors(order=ALL_COMPRESSORS):
     enabled = [x for x,b in {
             "lz4"                   : use_lz4,
             "lzo"                   : use_lzo,
+            "zstd"                  : use_zstd,
             "zlib"                  : use_zlib,
             }.items() if b]
     #order them:
@@ -241,33 +382,113 @@ class Compressible(LargeStructure):
         raise Exception("compress() not defined on %s" % self)
 
 
-def compressed_wrapper(datatype, data, level=5, zlib=False, lz4=False, lzo=False, can_inline=True):
+def compressed_wrapper(datatype, data, level=5, zlib=False, lz4=False, lzo=False, zstd=False, can_inline=True, chunked=False):
     if isinstance(data, memoryview):
         data = data.tobytes()
     size = len(data)
     if size>MAX_SIZE:
         raise Exception("uncompressed data is too large: %iMB, limit is %iMB" % (size//1024//1024, MAX_SIZE//1024//1024))
-    if lz4:
+    if zstd:
+        assert use_zstd, "cannot use zstd"
+        algo = "zstd"
+        compress = zstd_compress
+    elif lz4:
         assert use_lz4, "cannot use lz4"
         algo = "lz4"
-        cl, cdata = lz4_compress(data, level)
+        compress = lz4_compress
     elif lzo:
         assert use_lzo, "cannot use lzo"
         algo = "lzo"
-        cl, cdata = lzo_compress(data, level)
+        compress = lzo_compress
     else:
         assert zlib and use_zlib, "cannot use zlib"
         algo = "zlib"
-        cl, cdata = zcompress(data, level)
+        compress = zcompress
+    if chunked and size>=CHUNKED_COMPRESSION_SIZE:
+        cl, cdata = chunked_compress(compress, data, level)
+    else:
+        cl, cdata = compress(data, level)
     return LevelCompressed(datatype, cdata, cl, algo, can_inline=can_inline)
 
 
+#number of chunks, followed by the compressed and uncompressed size of each chunk:
+_chunks_count_struct = struct.Struct(b"!L")
+_chunk_sizes_struct = struct.Struct(b"!LL")
+
+compression_pool = None
+def get_compression_pool():
+    """ the threads used for compressing and decompressing chunks, or None if not available """
+    global compression_pool
+    if compression_pool is None and COMPRESSION_THREADS>1:
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            debug("no thread pool, chunks will be processed sequentially")
+            compression_pool = False
+        else:
+            compression_pool = ThreadPoolExecutor(max_workers=COMPRESSION_THREADS)
+    return compression_pool or None
+
+def map_chunks(fn, items):
+    #the compressors release the GIL, so the chunks can be processed in parallel:
+    pool = get_compression_pool()
+    if pool and len(items)>1:
+        return list(pool.map(fn, items))
+    return [fn(x) for x in items]
+
+def chunked_compress(compress, data, level, chunk_size=CHUNK_SIZE):
+    """
+        Splits the data into chunks which are compressed independently and in parallel,
+        the chunks are concatenated after a header containing their sizes.
+    """
+    size = len(data)
+    def compress_chunk(start):
+        chunk = data[start:start+chunk_size]
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        return len(chunk), compress(chunk, level)
+    results = map_chunks(compress_chunk, range(0, size, chunk_size))
+    cl = results[0][1][0]
+    parts = [_chunks_count_struct.pack(len(results))]
+    for usize, (_, cdata) in results:
+        parts.append(_chunk_sizes_struct.pack(len(cdata), usize))
+    parts += [cdata for _, (_, cdata) in results]
+    return cl | CHUNKED_FLAG, b"".join(parts)
+
+def chunked_decompress(data, level):
+    count = _chunks_count_struct.unpack_from(data)[0]
+    pos = _chunks_count_struct.size
+    end = pos+count*_chunk_sizes_struct.size
+    if count==0 or end>len(data):
+        raise InvalidCompressionException("invalid number of chunks: %i" % count)
+    chunks = []
+    total = 0
+    for i in range(count):
+        csize, usize = _chunk_sizes_struct.unpack_from(data, pos+i*_chunk_sizes_struct.size)
+        chunks.append((end, csize, usize))
+        end += csize
+        total += usize
+    if end!=len(data):
+        raise InvalidCompressionException("chunk sizes do not match the data size: %i vs %i" % (end, len(data)))
+    if total>MAX_SIZE:
+        raise InvalidCompressionException("uncompressed data is too large: %iMB, limit is %iMB" % (total//1024//1024, MAX_SIZE//1024//1024))
+    def decompress_chunk(chunk):
+        start, csize, usize = chunk
+        udata = decompress(data[start:start+csize], level)
+        if len(udata)!=usize:
+            raise InvalidCompressionException("expected %i bytes but got %i" % (usize, len(udata)))
+        return udata
+    return b"".join(map_chunks(decompress_chunk, chunks))
+
+
 class InvalidCompressionException(Exception):
     pass
 
 
 def get_compression_type(level):
-    if level & LZ4_FLAG:
+    if level & ZSTD_FLAG:
+        return "zstd"
+    elif level & LZ4_FLAG:
         return "lz4"
     elif level & LZO_FLAG:
         return "lzo"
@@ -275,11 +496,18 @@ def get_compression_type(level):
         return "zlib"
 
 
-import struct
 LZ4_HEADER = struct.Struct(b'<L')
 def decompress(data, level):
     #log.info("decompress(%s bytes, %s) type=%s", len(data), get_compression_type(level))
-    if level & LZ4_FLAG:
+    if level & CHUNKED_FLAG:
+        return chunked_decompress(data, level & ~CHUNKED_FLAG)
+    if level & ZSTD_FLAG:
+        if not has_zstd:
+            raise InvalidCompressionException("zstd is not available")
+        if not use_zstd:
+            raise InvalidCompressionException("zstd is not enabled")
+        return zstd_decompress(data)
+    elif level & LZ4_FLAG:
         if not has_lz4:
             raise InvalidCompressionException("lz4 is not available")
         if not use_lz4:
@@ -307,6 +535,7 @@ NAME_TO_FLAG = {
                 "lz4"   : LZ4_FLAG,
                 "zlib"  : 0,
                 "lzo"   : LZO_FLAG,
+                "zstd"  : ZSTD_FLAG,
                 }
 
 def decompress_by_name(data, algo):
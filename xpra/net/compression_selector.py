@@ -0,0 +1,124 @@
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.util import envint, envfloat
+
+
+#how many packets we compress with each option before trusting the statistics:
+PROBE_COUNT = envint("XPRA_COMPRESSION_PROBE_COUNT", 3)
+#try all the options again every N packets of the same type:
+REPROBE_INTERVAL = envint("XPRA_COMPRESSION_REPROBE_INTERVAL", 200)
+#the link speed used for weighing the time spent compressing against the bytes saved:
+BANDWIDTH = envint("XPRA_COMPRESSION_BANDWIDTH", 10*1000*1000)
+#weight of the new samples in the moving averages:
+SMOOTHING = envfloat("XPRA_COMPRESSION_SMOOTHING", 0.2)
+#the strongest level we try for packet types that compress well:
+MAX_LEVEL = envint("XPRA_COMPRESSION_MAX_LEVEL", 9)
+
+NONE = ("none", 0)
+
+
+class CompressionStats(object):
+    """ moving averages of the compression ratio and speed for one packet type using one compressor and level """
+
+    def __init__(self):
+        self.count = 0
+        self.last_used = 0
+        self.ratio = 1.0
+        self.time_per_byte = 0.0
+
+    def record(self, in_size, out_size, elapsed):
+        ratio = float(out_size)/max(1, in_size)
+        time_per_byte = float(elapsed)/max(1, in_size)
+        if self.count==0:
+            self.ratio = ratio
+            self.time_per_byte = time_per_byte
+        else:
+            self.ratio += (ratio-self.ratio)*SMOOTHING
+            self.time_per_byte += (time_per_byte-self.time_per_byte)*SMOOTHING
+        self.count += 1
+
+    def get_info(self):
+        return {
+            "count"         : self.count,
+            "ratio"         : int(self.ratio*100),
+            "speed"         : int(1.0/max(self.time_per_byte, 1e-9)),
+            }
+
+
+"""
+Chooses whether to compress each type of packet, and with which compressor and level:
+the cost of each option is the time spent compressing plus the time it takes to send the result,
+using the ratio and speed measured for this packet type.
+Options without enough samples are probed first, and all of them are probed again regularly,
+so we adapt when the contents of the packets change.
+"""
+class CompressionSelector(object):
+
+    def __init__(self, bandwidth=BANDWIDTH):
+        self.bandwidth = bandwidth
+        self.options = ()
+        self.packet_types = {}
+        self.packet_counts = {}
+
+    def set_options(self, compressors, level):
+        """
+            The compressors are in order of preference, the first one is the default,
+            we also try the default compressor with a stronger level.
+        """
+        options = [NONE]
+        if level>0:
+            options += [(c, level) for c in compressors if c!="none"]
+            if compressors and level<MAX_LEVEL:
+                options.append((compressors[0], MAX_LEVEL))
+        self.options = tuple(options)
+
+    def get_cost(self, stats, size):
+        #in seconds:
+        return size*stats.time_per_byte + size*stats.ratio*8.0/max(1, self.bandwidth)
+
+    def select(self, packet_type, size):
+        """ returns the compressor name and level to use for this packet """
+        options = self.options
+        if len(options)<=1:
+            return NONE
+        type_stats = self.packet_types.setdefault(packet_type, {})
+        count = self.packet_counts.get(packet_type, 0)+1
+        self.packet_counts[packet_type] = count
+        def get_stats(option):
+            stats = type_stats.get(option)
+            if stats is None:
+                stats = type_stats[option] = CompressionStats()
+            return stats
+        #not compressing costs nothing to measure:
+        none_stats = get_stats(NONE)
+        none_stats.count = max(none_stats.count, PROBE_COUNT)
+        #probe the options which don't have enough samples yet,
+        #or the one we haven't used for the longest time:
+        probe = [o for o in options if get_stats(o).count<PROBE_COUNT]
+        if not probe and count % REPROBE_INTERVAL==0:
+            probe = [min(options[1:], key=lambda o : get_stats(o).last_used)]
+        if probe:
+            option = probe[0]
+        else:
+            option = min(options, key=lambda o : self.get_cost(get_stats(o), size))
+        get_stats(option).last_used = count
+        return option
+
+    def record(self, packet_type, option, in_size, out_size, elapsed):
+        type_stats = self.packet_types.setdefault(packet_type, {})
+        stats = type_stats.get(option)
+        if stats is None:
+            stats = type_stats[option] = CompressionStats()
+        stats.record(in_size, out_size, elapsed)
+
+    def get_info(self):
+        info = {
+            "bandwidth" : self.bandwidth,
+            "options"   : tuple("%s:%i" % o for o in self.options),
+            }
+        for packet_type, type_stats in self.packet_types.items():
+            info.setdefault("packets", {})[packet_type] = dict(("%s:%i" % o, s.get_info()) for o, s in type_stats.items() if o in self.options)
+        return info
@@ -16,6 +16,8 @@ FLAGS_YAML      = 0x4
 ZLIB_FLAG       = 0x0       #assume zlib if no other compression flag is set
 LZ4_FLAG        = 0x10
 LZO_FLAG        = 0x20
+ZSTD_FLAG       = 0x40
+CHUNKED_FLAG    = 0x80      #the data is made of independently compressed chunks
 FLAGS_NOHEADER  = 0x10000   #never encoded, so we can use a value bigger than a byte
 
 
@@ -4,9 +4,11 @@
 # later version. See the file COPYING for details.
 
 import os
+from bisect import bisect
+from threading import Lock
 from ctypes import c_ubyte, c_char, c_uint32
 
-from xpra.util import roundup
+from xpra.util import roundup, envint
 from xpra.os_util import memoryview_to_bytes, shellsub, get_group_id, get_groups, WIN32, POSIX
 from xpra.scripts.config import FALSE_OPTIONS, TRUE_OPTIONS
 from xpra.simple_stats import std_unit
@@ -15,6 +17,8 @@ from xpra.log import Logger
 log = Logger("mmap")
 
 MMAP_GROUP = os.environ.get("XPRA_MMAP_GROUP", "xpra")
+#the allocator hands out blocks which are a multiple of this size:
+MMAP_ALLOC_UNIT = max(4096, envint("XPRA_MMAP_ALLOC_UNIT", 4096))
 
 
 """
@@ -163,6 +167,34 @@ def init_client_mmap(mmap_group=None, socket_filename=None, size=128*1024*1024,
         clean_mmap(mmap_filename)
         return rerr()
 
+MEMFD_SUPPORTED = hasattr(os, "memfd_create")
+
+def init_memfd_area(size):
+    """
+        Creates an anonymous shared memory area,
+        which can only be shared with another process by passing it the file descriptor.
+        Returns the file descriptor and the mmap object: (fd, mmap_area)
+    """
+    import mmap
+    fd = os.memfd_create("xpra-mmap", os.MFD_CLOEXEC)     #@UndefinedVariable
+    try:
+        os.ftruncate(fd, size)
+        mmap_area = mmap.mmap(fd, size)
+    except Exception:
+        os.close(fd)
+        raise
+    log("init_memfd_area(%i)=%i, %s", size, fd, mmap_area)
+    return fd, mmap_area
+
+def map_memfd_area(fd, size):
+    """ maps the memfd area we have received, the file descriptor is closed """
+    import mmap
+    try:
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
 def clean_mmap(mmap_filename):
     log("clean_mmap(%s)", mmap_filename)
     if mmap_filename and os.path.exists(mmap_filename):
@@ -244,6 +276,8 @@ def mmap_read(mmap_area, *descr_data):
         Reads data from the mmap_area as written by 'mmap_write'.
         The descr_data is the list of mmap chunks used.
     """
+    if isinstance(mmap_area, MmapAreas):
+        return mmap_area.read(*descr_data)
     data_start = int_from_buffer(mmap_area, 0)
     if len(descr_data)==1:
         #construct an array directly from the mmap zone:
@@ -266,6 +300,8 @@ def mmap_write(mmap_area, mmap_size, data):
         returns the chunks of the mmap area used (or None if it failed)
         and the mmap area's free memory.
     """
+    if isinstance(mmap_area, MmapAllocator):
+        return mmap_area.write(data)
     #This is best explained using diagrams:
     #mmap_area=[&S&E-------------data-------------]
     #The first pair of 4 bytes are occupied by:
@@ -340,3 +376,192 @@ def mmap_write(mmap_area, mmap_size, data):
             mmap_data_end.value = 8+l2
     log("sending damage with mmap: %s", data)
     return chunks, mmap_free_size
+
+
+"""
+A set of mmap areas addressed using a single range of offsets:
+each area starts at its own base offset, so the chunks we exchange can point to any of them.
+There is always a gap between areas, so a chunk never spans more than one area.
+"""
+class MmapAreas(object):
+
+    def __init__(self):
+        self.bases = []
+        self.areas = []
+
+    def __repr__(self):
+        return "MmapAreas(%i areas, %sB)" % (len(self.areas), std_unit(self.get_size(), unit=1024))
+
+    def get_size(self):
+        return sum(size for _, size in self.areas)
+
+    def get_next_base(self):
+        """ where the next area should be added """
+        if not self.areas:
+            return 0
+        base = self.bases[-1]
+        size = self.areas[-1][1]
+        return roundup(base+size, MMAP_ALLOC_UNIT)+MMAP_ALLOC_UNIT
+
+    def add_area(self, mmap_area, size, base=None):
+        if base is None:
+            base = self.get_next_base()
+        elif base<self.get_next_base():
+            raise ValueError("invalid mmap area base %#x, the next area must start at or after %#x" % (base, self.get_next_base()))
+        self.bases.append(base)
+        self.areas.append((mmap_area, size))
+        log("add_area(%s, %i, %#x)", mmap_area, size, base)
+        return base
+
+    def remove_area(self, base):
+        """ removes the area and returns it, only use this for areas which are not being used yet """
+        i = self.bases.index(base)
+        self.bases.pop(i)
+        return self.areas.pop(i)[0]
+
+    def get_area(self, offset, length):
+        """ returns the mmap area containing this chunk and the offset within that area """
+        i = bisect(self.bases, offset)-1
+        if i<0:
+            raise ValueError("invalid mmap offset %#x" % offset)
+        mmap_area, size = self.areas[i]
+        local = offset-self.bases[i]
+        if local+length>size:
+            raise ValueError("mmap chunk %#x of %i bytes does not fit in the area at %#x" % (offset, length, self.bases[i]))
+        return mmap_area, local
+
+    def read(self, *descr_data):
+        """
+            Unlike 'mmap_read', we don't update the ring buffer pointers:
+            the space is freed when the packet is acknowledged.
+        """
+        if len(descr_data)==1:
+            offset, length = descr_data[0]
+            mmap_area, local = self.get_area(offset, length)
+            arraytype = c_char * length
+            return arraytype.from_buffer(mmap_area, local)
+        data = []
+        for offset, length in descr_data:
+            mmap_area, local = self.get_area(offset, length)
+            data.append(mmap_area[local:local+length])
+        return b"".join(data)
+
+
+"""
+Allocates the space used for sending pixel data via the mmap areas.
+Unlike the ring buffer used by 'mmap_write', the blocks can be freed in any order,
+so a slow window does not prevent the others from using the space that is left.
+The free blocks are kept in lists of size classes (powers of two of the allocation unit),
+they are split when allocated and merged with their free neighbours when freed.
+This is used from the encode threads and from the network thread (acks) concurrently.
+"""
+class MmapAllocator(MmapAreas):
+
+    def __init__(self, full_cb=None):
+        MmapAreas.__init__(self)
+        self.full_cb = full_cb
+        self.lock = Lock()
+        #size class -> set of free block offsets:
+        self.free_lists = {}
+        #offset -> size of the free blocks:
+        self.free_blocks = {}
+        #end offset -> start offset of the free blocks:
+        self.free_ends = {}
+        #offset -> size of the allocated blocks:
+        self.allocated = {}
+        self.free_size = 0
+
+    def __repr__(self):
+        return "MmapAllocator(%i areas, %sB free)" % (len(self.areas), std_unit(self.free_size, unit=1024))
+
+    def add_area(self, mmap_area, size, base=None, reserved=0):
+        """ the 'reserved' bytes at the start of the area will never be allocated """
+        with self.lock:
+            base = MmapAreas.add_area(self, mmap_area, size, base)
+            start = roundup(base+reserved, MMAP_ALLOC_UNIT)
+            end = (base+size)//MMAP_ALLOC_UNIT*MMAP_ALLOC_UNIT
+            if end>start:
+                self._add_free(start, end-start)
+                self.free_size += end-start
+        return base
+
+    def _size_class(self, size):
+        return (size//MMAP_ALLOC_UNIT).bit_length()
+
+    def _add_free(self, offset, size):
+        self.free_blocks[offset] = size
+        self.free_ends[offset+size] = offset
+        self.free_lists.setdefault(self._size_class(size), set()).add(offset)
+
+    def _remove_free(self, offset):
+        size = self.free_blocks.pop(offset)
+        del self.free_ends[offset+size]
+        self.free_lists[self._size_class(size)].discard(offset)
+        return size
+
+    def allocate(self, size):
+        """ returns the offset of a block of at least 'size' bytes, or -1 if there is no room """
+        size = roundup(max(1, size), MMAP_ALLOC_UNIT)
+        sc = self._size_class(size)
+        with self.lock:
+            offset = -1
+            #the blocks in the same size class may be too small,
+            #those in the larger classes are always big enough:
+            fits = [o for o in self.free_lists.get(sc, ()) if self.free_blocks[o]>=size]
+            if fits:
+                offset = min(fits)
+            else:
+                for c in sorted(self.free_lists.keys()):
+                    if c>sc and self.free_lists[c]:
+                        offset = min(self.free_lists[c])
+                        break
+            if offset<0:
+                return -1
+            block_size = self._remove_free(offset)
+            if block_size>size:
+                self._add_free(offset+size, block_size-size)
+            self.allocated[offset] = size
+            self.free_size -= size
+        return offset
+
+    def free(self, offset):
+        with self.lock:
+            size = self.allocated.pop(offset, 0)
+            if not size:
+                log.warn("Warning: mmap block %#x is not allocated", offset)
+                return
+            self.free_size += size
+            #merge with the free blocks before and after this one:
+            prev = self.free_ends.get(offset)
+            if prev is not None:
+                size += self._remove_free(prev)
+                offset = prev
+            if offset+size in self.free_blocks:
+                size += self._remove_free(offset+size)
+            self._add_free(offset, size)
+
+    def write(self, data):
+        """ same as 'mmap_write', but the space must be freed once the client is done with it """
+        l = len(data)
+        offset = self.allocate(l)
+        if offset<0 and self.full_cb:
+            log("mmap allocator is full, cannot store %i bytes: %s", l, self.get_info())
+            #this may add a new area straight away:
+            self.full_cb(l)
+            offset = self.allocate(l)
+        if offset<0:
+            return None, self.free_size-l
+        mmap_area, local = self.get_area(offset, l)
+        mmap_area[local:local+l] = memoryview_to_bytes(data)
+        return [(offset, l)], self.free_size
+
+    def get_info(self):
+        with self.lock:
+            return {
+                "areas"     : len(self.areas),
+                "size"      : self.get_size(),
+                "free"      : self.free_size,
+                "allocated" : len(self.allocated),
+                "fragments" : len(self.free_blocks),
+                "largest"   : max(self.free_blocks.values() or [0]),
+                }
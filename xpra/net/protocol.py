@@ -12,11 +12,13 @@ import os
 from socket import error as socket_error
 from threading import Lock, Event
 
-from xpra.os_util import PYTHON3, Queue, memoryview_to_bytes, strtobytes, bytestostr, hexstr
+from xpra.os_util import PYTHON3, Queue, memoryview_to_bytes, strtobytes, bytestostr, hexstr, monotonic_time
 from xpra.util import repr_ellipsized, csv, envint, envbool
 from xpra.make_thread import make_thread, start_thread
 from xpra.net.common import ConnectionClosedException          #@UndefinedVariable (pydev false positive)
 from xpra.net.bytestreams import ABORT
+from xpra.net.read_buffer import ReadBuffer
+from xpra.net.compression_selector import CompressionSelector
 from xpra.net import compression
 from xpra.net.compression import (
     decompress, sanity_checks as compression_sanity_checks,
@@ -54,6 +56,8 @@ INLINE_SIZE = envint("XPRA_INLINE_SIZE", 32768)
 FAKE_JITTER = envint("XPRA_FAKE_JITTER", 0)
 MIN_COMPRESS_SIZE = envint("XPRA_MIN_COMPRESS_SIZE", 378)
 SEND_INVALID_PACKET = envint("XPRA_SEND_INVALID_PACKET", 0)
+#choose the compressor and level for each type of packet:
+ADAPTIVE_COMPRESSION = envbool("XPRA_ADAPTIVE_COMPRESSION", True)
 SEND_INVALID_PACKET_DATA = strtobytes(os.environ.get("XPRA_SEND_INVALID_PACKET_DATA", b"ZZinvalid-packetZZ"))
 
 
@@ -178,6 +182,15 @@ class Protocol(object):
         self.compressor = "none"
         self._compress = compression.nocompress
         self.compression_level = 0
+        #the zstd dictionaries we have in common with the peer:
+        self.zstd_dictionaries = ()
+        #whether the peer can decompress payloads made of multiple chunks:
+        self.chunked_compression = False
+        #all the compressors we have in common with the peer, the default one first:
+        self.compressors = ()
+        self.compression_selector = None
+        if ADAPTIVE_COMPRESSION:
+            self.compression_selector = CompressionSelector()
         self.cipher_in = None
         self.cipher_in_name = None
         self.cipher_in_block_size = 0
@@ -196,7 +209,8 @@ class Protocol(object):
     STATE_FIELDS = ("max_packet_size", "large_packets", "send_aliases", "receive_aliases",
                     "cipher_in", "cipher_in_name", "cipher_in_block_size", "cipher_in_padding",
                     "cipher_out", "cipher_out_name", "cipher_out_block_size", "cipher_out_padding",
-                    "compression_level", "encoder", "compressor")
+                    "compression_level", "encoder", "compressor", "compressors", "zstd_dictionaries",
+                    "chunked_compression")
 
     def save_state(self):
         state = {}
@@ -294,6 +308,8 @@ class Protocol(object):
                                                    },
                         },
             }
+        if self.compression_selector:
+            info["output"]["compression"] = self.compression_selector.get_info()
         c = self._compress
         if c:
             info["compressor"] = compression.get_compressor_name(self._compress)
@@ -494,18 +510,37 @@ class Protocol(object):
             return
         opts = compression.get_enabled_compressors(order=compression.PERFORMANCE_ORDER)
         log("enable_compressor_from_caps(..) options=%s", opts)
-        for c in opts:      #ie: [zlib, lz4, lzo]
-            if caps.boolget(c):
-                self.enable_compressor(c)
-                return
-        log.warn("compression disabled: no matching compressor found")
-        self.enable_compressor("none")
+        #ie: [lz4, zstd, lzo, zlib]
+        common = [c for c in opts if caps.boolget(c)]
+        if not common:
+            log.warn("compression disabled: no matching compressor found")
+            self.enable_compressor("none")
+            return
+        if "zstd" in common:
+            ours = compression.get_zstd_dictionaries()
+            self.zstd_dictionaries = tuple(x for x in caps.intlistget("zstd.dictionaries", ()) if x in ours)
+            log("zstd dictionaries in common: %s", csv(hex(x) for x in self.zstd_dictionaries))
+        self.chunked_compression = caps.boolget("chunked-compression")
+        #the other compressors may also be used by the compression selector:
+        self.compressors = tuple(common)
+        self.enable_compressor(common[0])
 
     def enable_compressor(self, compressor):
         self._compress = compression.get_compressor(compressor)
         self.compressor = compressor
+        if compressor=="none":
+            self.compressors = ()
+        else:
+            #this one becomes the default:
+            self.compressors = (compressor, ) + tuple(x for x in self.compressors if x!=compressor)
+        self.update_compression_options()
         log("enable_compressor(%s): %s", compressor, self._compress)
 
+    def update_compression_options(self):
+        selector = self.compression_selector
+        if selector:
+            selector.set_options(self.compressors, self.compression_level)
+
 
     def noencode(self, data):
         #just send data as a string for clients that don't understand xpra packet format:
@@ -583,7 +618,7 @@ class Protocol(object):
                 log.warn("Warning: found a large uncompressed item")
                 log.warn(" in packet '%s' at position %i: %s bytes", packet[0], i, len(item))
                 #add new binary packet with large item:
-                cl, cdata = self._compress(item, level)
+                cl, cdata = self.compress_packet(packet[0], item, level)
                 packets.append((0, i, cl, cdata))
                 #replace this item with an empty string placeholder:
                 packet[i] = ''
@@ -615,7 +650,7 @@ class Protocol(object):
         #compress, but don't bother for small packets:
         if level>0 and len(main_packet)>min_comp_size:
             try:
-                cl, cdata = self._compress(main_packet, level)
+                cl, cdata = self.compress_packet(packet_type, main_packet, level)
             except Exception as e:
                 log.error("Error compressing '%s' packet", packet_type)
                 log.error(" %s", e)
@@ -625,10 +660,37 @@ class Protocol(object):
             packets.append((proto_flags, 0, 0, main_packet))
         return packets
 
+    def compress_packet(self, packet_type, data, level):
+        selector = self.compression_selector
+        if not selector or not self.compressors:
+            return self.compress_with(self.compressor, packet_type, data, level)
+        #let the selector choose the compressor and level for this type of packet:
+        option = selector.select(packet_type, len(data))
+        compressor, level = option
+        start = monotonic_time()
+        cl, cdata = self.compress_with(compressor, packet_type, data, level)
+        selector.record(packet_type, option, len(data), len(cdata), monotonic_time()-start)
+        return cl, cdata
+
+    def compress_with(self, compressor, packet_type, data, level):
+        if compressor=="zstd" and self.zstd_dictionaries:
+            #use the dictionary trained for this type of packet:
+            dict_id = compression.get_zstd_dictionary_id(packet_type, self.zstd_dictionaries)
+            compress = lambda data, level : compression.zstd_compress(data, level, dict_id)
+        elif compressor==self.compressor:
+            compress = self._compress
+        else:
+            compress = compression.get_compressor(compressor)
+        if self.chunked_compression and compressor!="none" and level>0 and len(data)>=compression.CHUNKED_COMPRESSION_SIZE:
+            #large payloads are compressed in parallel:
+            return compression.chunked_compress(compress, data, level)
+        return compress(data, level)
+
     def set_compression_level(self, level):
         #this may be used next time encode() is called
         assert 0<=level<=10, "invalid compression level: %s (must be between 0 and 10" % level
         self.compression_level = level
+        self.update_compression_options()
 
 
     def _io_thread_loop(self, name, callback):
@@ -694,18 +756,39 @@ class Protocol(object):
         con = self._conn
         if not con:
             return
-        for buf in buf_data:
-            while buf and not self._closed:
-                written = con.write(buf)
-                #example test code, for sending small chunks very slowly:
-                #written = con.write(buf[:1024])
-                #import time
-                #time.sleep(0.05)
-                if written:
-                    buf = buf[written:]
-                    self.output_raw_packetcount += 1
+        if con.can_writev():
+            self.writev_buffers(con, buf_data)
+        else:
+            for buf in buf_data:
+                while buf and not self._closed:
+                    written = con.write(buf)
+                    #example test code, for sending small chunks very slowly:
+                    #written = con.write(buf[:1024])
+                    #import time
+                    #time.sleep(0.05)
+                    if written:
+                        buf = buf[written:]
+                        self.output_raw_packetcount += 1
         self.output_packetcount += 1
 
+    def writev_buffers(self, con, buf_data):
+        #send the header and all the chunks with as few system calls as possible,
+        #skipping over what has already been sent without copying anything:
+        buffers = [memoryview(buf) for buf in buf_data if buf]
+        i = 0
+        while i<len(buffers) and not self._closed:
+            written = con.writev(buffers[i:])
+            if not written:
+                continue
+            self.output_raw_packetcount += 1
+            while written>0:
+                size = buffers[i].nbytes
+                if written<size:
+                    buffers[i] = buffers[i][written:]
+                    break
+                written -= size
+                i += 1
+
 
     def _read_thread_loop(self):
         self._io_thread_loop("read", self._read)
@@ -796,8 +879,25 @@ class Protocol(object):
 
     def do_read_parse_thread_loop(self):
         """
-            Process the individual network packets placed in _read_queue.
-            Concatenate the raw packet data, then try to parse it.
+            Feeds the raw data placed in _read_queue to the packet parser.
+        """
+        parser = self.packet_parser()
+        next(parser)
+        while not self._closed:
+            buf = self._read_queue.get()
+            if not buf:
+                log("parse thread: empty marker, exiting")
+                self.idle_add(self.close)
+                return
+            try:
+                parser.send(buf)
+            except StopIteration:
+                return
+
+    def packet_parser(self):
+        """
+            A generator which receives the raw network data using send(),
+            concatenates it, then tries to parse it.
             Extract the individual packets from the potentially large buffer,
             saving the rest of the buffer for later, and optionally decompress this data
             and re-construct the one python-object-packet from potentially multiple packets (see packet_index).
@@ -807,43 +907,41 @@ class Protocol(object):
             from the UI thread will need to use a callback (usually via 'idle_add')
         """
         header = b""
-        read_buffers = []
+        read_buffer = ReadBuffer(READ_BUFFER_SIZE)
+        #large payloads are copied straight into their own buffer:
+        payload = None
+        payload_pos = 0
         payload_size = -1
         padding_size = 0
         packet_index = 0
         compression_level = 0
         raw_packets = {}
         while not self._closed:
-            buf = self._read_queue.get()
-            if not buf:
-                log("parse thread: empty marker, exiting")
-                self.idle_add(self.close)
-                return
-
-            read_buffers.append(buf)
-            while read_buffers:
+            buf = yield
+            if payload is not None:
+                n = min(len(buf), payload_size-payload_pos)
+                if n==len(buf):
+                    payload[payload_pos:payload_pos+n] = buf
+                else:
+                    mv = memoryview(buf)
+                    payload[payload_pos:payload_pos+n] = mv[:n]
+                    read_buffer.append(mv[n:])
+                payload_pos += n
+            else:
+                read_buffer.append(buf)
+            while not self._closed:
                 #have we read the header yet?
                 if payload_size<0:
-                    #try to handle the first buffer:
-                    buf = read_buffers[0]
-                    if not header and buf[0] not in ("P", ord("P")):
+                    if not read_buffer:
+                        break
+                    if read_buffer.peek(1)[0] not in ("P", ord("P")):
+                        buf = read_buffer.take(len(read_buffer))
                         self._invalid_header(buf, "invalid packet header byte %s" % buf)
                         return
-                    #how much to we need to slice off to complete the header:
-                    read = min(len(buf), HEADER_SIZE-len(header))
-                    header += memoryview_to_bytes(buf[:read])
-                    if len(header)<HEADER_SIZE:
+                    if len(read_buffer)<HEADER_SIZE:
                         #need to process more buffers to get a full header:
-                        read_buffers.pop(0)
-                        continue
-                    elif len(buf)>read:
-                        #got the full header and more, keep the rest of the packet:
-                        read_buffers[0] = buf[read:]
-                    else:
-                        #we only got the header:
-                        assert len(buf)==read
-                        read_buffers.pop(0)
-                        continue
+                        break
+                    header = read_buffer.take(HEADER_SIZE)
                     #parse the header:
                     # format: struct.pack(b'cBBBL', ...) - HEADER_SIZE bytes
                     _, protocol_flags, compression_level, packet_index, data_size = unpack_header(header)
@@ -883,31 +981,26 @@ class Protocol(object):
                             return False
                         self.timeout_add(1000, check_packet_size, payload_size, header)
 
-                #how much data do we have?
-                bl = sum(len(v) for v in read_buffers)
-                if bl<payload_size:
-                    # incomplete packet, wait for the rest to arrive
-                    break
+                    if READ_BUFFER_SIZE<payload_size<=self.max_packet_size and len(read_buffer)<payload_size:
+                        #allocate the whole payload buffer now,
+                        #so we only copy the data once as it arrives:
+                        #(packets bigger than max_packet_size are not validated yet,
+                        # so we don't allocate memory for them until the data actually arrives)
+                        payload = bytearray(payload_size)
+                        payload_pos = read_buffer.take_into(payload)
 
-                buf = read_buffers[0]
-                if len(buf)==payload_size:
-                    #exact match, consume it all:
-                    data = read_buffers.pop(0)
-                elif len(buf)>payload_size:
-                    #keep rest of packet for later:
-                    read_buffers[0] = buf[payload_size:]
-                    data = buf[:payload_size]
+                #how much data do we have?
+                if payload is not None:
+                    if payload_pos<payload_size:
+                        # incomplete packet, wait for the rest to arrive
+                        break
+                    data = memoryview(payload)
+                    payload = None
                 else:
-                    #we need to aggregate chunks,
-                    #just concatenate them all:
-                    data = b"".join(read_buffers)
-                    if bl==payload_size:
-                        #nothing left:
-                        read_buffers = []
-                    else:
-                        #keep the left over:
-                        read_buffers = [data[payload_size:]]
-                        data = data[:payload_size]
+                    if len(read_buffer)<payload_size:
+                        # incomplete packet, wait for the rest to arrive
+                        break
+                    data = read_buffer.take(payload_size)
 
                 #decrypt if needed:
                 if self.cipher_in:
@@ -965,7 +1058,8 @@ class Protocol(object):
                 header = b""
                 if packet_index>0:
                     #raw packet, store it and continue:
-                    raw_packets[packet_index] = data
+                    #(the packet handlers expect bytes, not a view of our payload buffer)
+                    raw_packets[packet_index] = memoryview_to_bytes(data)
                     payload_size = -1
                     if len(raw_packets)>=4:
                         self.invalid("too many raw packets: %s" % len(raw_packets), data)
@@ -986,7 +1080,7 @@ class Protocol(object):
                     log("failed to parse %s packet: %s", etype, hexstr(data[:128]))
                     log(" %s", e)
                     log(" data: %s", repr_ellipsized(data))
-                    log(" packet index=%i, packet size=%i, buffer size=%s", packet_index, payload_size, bl)
+                    log(" packet index=%i, packet size=%i, buffer size=%s", packet_index, payload_size, len(read_buffer))
                     self.gibberish("failed to parse %s packet" % etype, data)
                     return
 
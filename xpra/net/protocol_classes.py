@@ -3,22 +3,45 @@
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
-def get_client_protocol_class(socktype):
+from xpra.util import envbool
+from xpra.os_util import PYTHON3
+from xpra.log import Logger
+
+log = Logger("network", "protocol")
+
+#use a single event loop for all the plain socket connections instead of 4 threads per connection:
+ASYNCIO_PROTOCOL = PYTHON3 and envbool("XPRA_ASYNCIO_PROTOCOL", False)
+
+
+def get_client_protocol_class(socktype, conn=None):
     if socktype=="udp":
         from xpra.net.udp_protocol import UDPClientProtocol
         return UDPClientProtocol
     elif socktype in ("ws", "wss"):
         from xpra.net.websockets.protocol import WebSocketProtocol
         return WebSocketProtocol
-    from xpra.net.protocol import Protocol
-    return Protocol
+    return get_xpra_protocol_class(conn)
 
-def get_server_protocol_class(socktype):
+def get_server_protocol_class(socktype, conn=None):
     if socktype=="udp":
         from xpra.net.udp_protocol import UDPServerProtocol
         return UDPServerProtocol
     elif socktype in ("ws", "wss"):
         from xpra.net.websockets.protocol import WebSocketProtocol
         return WebSocketProtocol
+    return get_xpra_protocol_class(conn)
+
+def get_xpra_protocol_class(conn=None):
+    if ASYNCIO_PROTOCOL and conn is not None:
+        try:
+            from xpra.net.asyncio_protocol import AsyncioProtocol, is_supported
+        except ImportError as e:
+            log("get_xpra_protocol_class(%s)", conn, exc_info=True)
+            log.warn("Warning: cannot use the asyncio protocol:")
+            log.warn(" %s", e)
+        else:
+            if is_supported(conn):
+                return AsyncioProtocol
+            log("asyncio protocol is not supported for %s", conn)
     from xpra.net.protocol import Protocol
     return Protocol
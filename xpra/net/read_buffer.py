@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+
+"""
+A receive buffer for the packet parser:
+the data is appended at the end and consumed from the start,
+the unread bytes are only moved back to the start when we run out of room,
+and the buffer only grows when a single packet does not fit.
+This avoids concatenating and slicing bytes objects for every packet we parse.
+"""
+class ReadBuffer(object):
+
+    def __init__(self, size=65536):
+        self.initial_size = size
+        self.buffer = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def __repr__(self):
+        return "ReadBuffer(%i of %i bytes)" % (len(self), len(self.buffer))
+
+    def __len__(self):
+        return self.end-self.start
+
+    def reserve(self, n):
+        """ makes room for 'n' more bytes at the end of the buffer """
+        if self.end+n<=len(self.buffer):
+            return
+        l = self.end-self.start
+        size = len(self.buffer)
+        if l+n>size:
+            #grow:
+            new_buffer = bytearray(max(size*2, l+n))
+            new_buffer[:l] = memoryview(self.buffer)[self.start:self.end]
+            self.buffer = new_buffer
+        elif l:
+            #compact:
+            mv = memoryview(self.buffer)
+            mv[:l] = mv[self.start:self.end].tobytes()
+        self.start = 0
+        self.end = l
+
+    def append(self, data):
+        n = len(data)
+        if not n:
+            return
+        self.reserve(n)
+        self.buffer[self.end:self.end+n] = data
+        self.end += n
+
+    def peek(self, n):
+        """ returns a view of the first 'n' bytes, only valid until the buffer is modified """
+        return memoryview(self.buffer)[self.start:self.start+min(n, len(self))]
+
+    def take(self, n):
+        """ consumes the first 'n' bytes and returns a copy """
+        assert n<=len(self), "cannot take %i bytes from %s" % (n, self)
+        data = memoryview(self.buffer)[self.start:self.start+n].tobytes()
+        self.consume(n)
+        return data
+
+    def take_into(self, target, offset=0):
+        """ consumes as many bytes as we can fit in 'target' from 'offset', returns how many """
+        n = min(len(self), len(target)-offset)
+        if n>0:
+            target[offset:offset+n] = memoryview(self.buffer)[self.start:self.start+n]
+            self.consume(n)
+        return max(0, n)
+
+    def consume(self, n):
+        self.start += n
+        if self.start==self.end:
+            self.start = self.end = 0
+            if len(self.buffer)>self.initial_size*4:
+                #don't hold on to the memory used by a large packet:
+                self.buffer = bytearray(self.initial_size)
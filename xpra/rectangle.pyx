@@ -12,11 +12,11 @@
 from __future__ import absolute_import
 
 #what I want is a real macro!
-cdef inline int MIN(int a, int b):
+cdef inline int MIN(int a, int b) nogil:
     if a<=b:
         return a
     return b
-cdef inline int MAX(int a, int b):
+cdef inline int MAX(int a, int b) nogil:
     if a>=b:
         return a
     return b
@@ -211,3 +211,309 @@ def merge_all(rectangles):
         if y2>ry2:
             ry2 = y2
     return rectangle(rx, ry, rx2-rx, ry2-ry)
+
+
+from libc.stdlib cimport malloc, realloc, free    #pylint: disable=syntax-error
+
+cdef extern from "string.h":
+    int memcmp(const void *s1, const void *s2, size_t n) nogil
+    void *memcpy(void *dest, const void *src, size_t n) nogil
+
+ctypedef struct box_t:
+    int x1
+    int y1
+    int x2
+    int y2
+
+DEF OP_UNION = 0
+DEF OP_SUBSTRACT = 1
+DEF OP_INTERSECT = 2
+
+cdef inline int op_inside(const int op, const int in_a, const int in_b) nogil:
+    if op==OP_UNION:
+        return in_a or in_b
+    if op==OP_SUBSTRACT:
+        return in_a and not in_b
+    return in_a and in_b
+
+cdef inline int edge(const box_t *spans, const int i) nogil:
+    #even edges are the start of a span, odd ones the end:
+    if i & 1:
+        return spans[i>>1].x2
+    return spans[i>>1].x1
+
+
+cdef struct boxes_t:
+    box_t *boxes
+    int n
+    int size
+
+cdef int boxes_append(boxes_t *b, const int x1, const int y1, const int x2, const int y2) nogil:
+    cdef box_t *nboxes
+    cdef int nsize
+    if b.n>=b.size:
+        nsize = MAX(16, b.size*2)
+        nboxes = <box_t*> realloc(b.boxes, nsize*sizeof(box_t))
+        if nboxes==NULL:
+            return -1
+        b.boxes = nboxes
+        b.size = nsize
+    b.boxes[b.n].x1 = x1
+    b.boxes[b.n].y1 = y1
+    b.boxes[b.n].x2 = x2
+    b.boxes[b.n].y2 = y2
+    b.n += 1
+    return 0
+
+cdef inline int band_end(const box_t *boxes, const int n, const int start) nogil:
+    cdef int i = start+1
+    while i<n and boxes[i].y1==boxes[start].y1:
+        i += 1
+    return i
+
+cdef int band_op(boxes_t *out, const int op, const int y1, const int y2,
+                 const box_t *a, const int na, const box_t *b, const int nb) nogil:
+    """
+        Combines the spans from a and b using the operator,
+        and adds the resulting band from y1 to y2 to the output,
+        coalescing it with the previous band when the spans are identical.
+        Returns -1 on memory allocation failure.
+    """
+    cdef int start = out.n
+    cdef int ia = 0, ib = 0, x, inside = 0, sx = 0, now_inside
+    while ia<na*2 or ib<nb*2:
+        if ia<na*2 and (ib>=nb*2 or edge(a, ia)<=edge(b, ib)):
+            x = edge(a, ia)
+        else:
+            x = edge(b, ib)
+        while ia<na*2 and edge(a, ia)==x:
+            ia += 1
+        while ib<nb*2 and edge(b, ib)==x:
+            ib += 1
+        now_inside = op_inside(op, ia & 1, ib & 1)
+        if now_inside and not inside:
+            sx = x
+        elif inside and not now_inside:
+            if boxes_append(out, sx, y1, x, y2)<0:
+                return -1
+        inside = now_inside
+    cdef int count = out.n-start
+    if count==0 or start==0:
+        return 0
+    #find the previous band:
+    cdef int pstart = start-1
+    while pstart>0 and out.boxes[pstart-1].y1==out.boxes[start-1].y1:
+        pstart -= 1
+    if out.boxes[pstart].y2!=y1 or start-pstart!=count:
+        return 0
+    cdef int i
+    for i in range(count):
+        if out.boxes[pstart+i].x1!=out.boxes[start+i].x1 or out.boxes[pstart+i].x2!=out.boxes[start+i].x2:
+            return 0
+    #same spans, extend the previous band:
+    for i in range(count):
+        out.boxes[pstart+i].y2 = y2
+    out.n = start
+    return 0
+
+cdef int region_op(boxes_t *out, const int op, const box_t *a, const int na, const box_t *b, const int nb) nogil:
+    """
+        Sweeps both banded regions from top to bottom,
+        and applies the operator to the spans found in each horizontal strip.
+    """
+    cdef int ia = 0, ib = 0
+    cdef int ea = 0, eb = 0
+    cdef int y, ybot, a_active, b_active
+    if na>0:
+        ea = band_end(a, na, 0)
+    if nb>0:
+        eb = band_end(b, nb, 0)
+    if na>0 and nb>0:
+        y = MIN(a[0].y1, b[0].y1)
+    elif na>0:
+        y = a[0].y1
+    elif nb>0:
+        y = b[0].y1
+    else:
+        return 0
+    while ia<na or ib<nb:
+        a_active = ia<na and a[ia].y1<=y
+        b_active = ib<nb and b[ib].y1<=y
+        if not a_active and not b_active:
+            #skip to the next band:
+            if ia<na and ib<nb:
+                y = MIN(a[ia].y1, b[ib].y1)
+            elif ia<na:
+                y = a[ia].y1
+            else:
+                y = b[ib].y1
+            continue
+        ybot = 0x7fffffff
+        if a_active:
+            ybot = MIN(ybot, a[ia].y2)
+        elif ia<na:
+            ybot = MIN(ybot, a[ia].y1)
+        if b_active:
+            ybot = MIN(ybot, b[ib].y2)
+        elif ib<nb:
+            ybot = MIN(ybot, b[ib].y1)
+        if band_op(out, op, y, ybot,
+                   a+ia, (ea-ia) if a_active else 0,
+                   b+ib, (eb-ib) if b_active else 0)<0:
+            return -1
+        y = ybot
+        if a_active and a[ia].y2<=y:
+            ia = ea
+            if ia<na:
+                ea = band_end(a, na, ia)
+        if b_active and b[ib].y2<=y:
+            ib = eb
+            if ib<nb:
+                eb = band_end(b, nb, ib)
+    return 0
+
+
+cdef class region:
+    """
+        A set of pixels stored as a list of non-overlapping boxes grouped in horizontal bands,
+        like pixman and X11 regions: all the boxes in a band have the same vertical extents,
+        and they are sorted by their vertical then horizontal position.
+        The union, substraction and intersection operations run in linear time
+        in the number of boxes and without holding the GIL.
+    """
+
+    cdef boxes_t b
+
+    def __cinit__(self):
+        self.b.boxes = NULL
+        self.b.n = 0
+        self.b.size = 0
+
+    def __init__(self, rects=()):
+        cdef rectangle r
+        for r in rects:
+            self.union(r.x, r.y, r.width, r.height)
+
+    def __dealloc__(self):
+        free(self.b.boxes)
+        self.b.boxes = NULL
+
+    def __len__(self):
+        return self.b.n
+
+    def __bool__(self):
+        return self.b.n>0
+
+    def __repr__(self):
+        return "region(%s)" % self.get_rectangles()
+
+    cdef int do_op(self, const int op, const box_t *boxes, const int n) except -1:
+        cdef boxes_t out
+        out.boxes = NULL
+        out.n = 0
+        out.size = 0
+        cdef int r
+        with nogil:
+            r = region_op(&out, op, self.b.boxes, self.b.n, boxes, n)
+        if r<0:
+            free(out.boxes)
+            raise MemoryError("failed to allocate memory for %i region boxes" % out.size)
+        free(self.b.boxes)
+        self.b = out
+        return 0
+
+    cdef int rect_op(self, const int op, const int x, const int y, const int w, const int h) except -1:
+        cdef box_t box
+        if w<=0 or h<=0:
+            if op==OP_INTERSECT:
+                self.clear()
+            return 0
+        box.x1 = x
+        box.y1 = y
+        box.x2 = x+w
+        box.y2 = y+h
+        return self.do_op(op, &box, 1)
+
+    def union(self, const int x, const int y, const int w, const int h):
+        self.rect_op(OP_UNION, x, y, w, h)
+
+    def union_rect(self, rectangle rect):
+        self.rect_op(OP_UNION, rect.x, rect.y, rect.width, rect.height)
+
+    def union_region(self, region other):
+        self.do_op(OP_UNION, other.b.boxes, other.b.n)
+
+    def substract(self, const int x, const int y, const int w, const int h):
+        self.rect_op(OP_SUBSTRACT, x, y, w, h)
+
+    def substract_rect(self, rectangle rect):
+        self.rect_op(OP_SUBSTRACT, rect.x, rect.y, rect.width, rect.height)
+
+    def substract_region(self, region other):
+        self.do_op(OP_SUBSTRACT, other.b.boxes, other.b.n)
+
+    def intersect(self, const int x, const int y, const int w, const int h):
+        self.rect_op(OP_INTERSECT, x, y, w, h)
+
+    def intersect_rect(self, rectangle rect):
+        self.rect_op(OP_INTERSECT, rect.x, rect.y, rect.width, rect.height)
+
+    def intersect_region(self, region other):
+        self.do_op(OP_INTERSECT, other.b.boxes, other.b.n)
+
+    def clear(self):
+        free(self.b.boxes)
+        self.b.boxes = NULL
+        self.b.n = 0
+        self.b.size = 0
+
+    def copy(self):
+        cdef region c = region()
+        if self.b.n>0:
+            c.b.boxes = <box_t*> malloc(self.b.n*sizeof(box_t))
+            if c.b.boxes==NULL:
+                raise MemoryError("failed to allocate memory for %i region boxes" % self.b.n)
+            memcpy(c.b.boxes, self.b.boxes, self.b.n*sizeof(box_t))
+            c.b.n = self.b.n
+            c.b.size = self.b.n
+        return c
+
+    def get_area(self):
+        cdef unsigned long long area = 0
+        cdef int i
+        with nogil:
+            for i in range(self.b.n):
+                area += (self.b.boxes[i].x2-self.b.boxes[i].x1) * (self.b.boxes[i].y2-self.b.boxes[i].y1)
+        return area
+
+    def get_extents(self):
+        """ returns the bounding rectangle, or None if the region is empty """
+        if self.b.n==0:
+            return None
+        cdef int i
+        cdef int x1 = self.b.boxes[0].x1
+        cdef int x2 = self.b.boxes[0].x2
+        with nogil:
+            for i in range(1, self.b.n):
+                x1 = MIN(x1, self.b.boxes[i].x1)
+                x2 = MAX(x2, self.b.boxes[i].x2)
+        cdef int y1 = self.b.boxes[0].y1
+        cdef int y2 = self.b.boxes[self.b.n-1].y2
+        return rectangle(x1, y1, x2-x1, y2-y1)
+
+    def contains(self, const int x, const int y, const int w, const int h):
+        cdef region r = self.copy()
+        r.intersect(x, y, w, h)
+        return r.get_area()==w*h
+
+    def contains_rect(self, rectangle rect):
+        return self.contains(rect.x, rect.y, rect.width, rect.height)
+
+    def get_rectangles(self):
+        cdef int i
+        cdef box_t *box
+        rects = []
+        for i in range(self.b.n):
+            box = &self.b.boxes[i]
+            rects.append(rectangle(box.x1, box.y1, box.x2-box.x1, box.y2-box.y1))
+        return rects
@@ -475,6 +475,8 @@ OPTION_TYPES = {
                     "encryption"        : str,
                     "encryption-keyfile": str,
                     "pidfile"           : str,
+                    "damage-trace"      : str,
+                    "tuning-profile"    : str,
                     "mode"              : str,
                     "ssh"               : str,
                     "systemd-run"       : str,
@@ -660,6 +662,7 @@ OPTIONS_ADDED_SINCE_V1 = [
     "uid", "gid", "chdir", "min-port", "rfb-upgrade", "bandwidth-limit",
     "forward-xdg-open", "modal-windows", "bandwidth-detection",
     "bind-ssh", "ssh-auth", "ssh-upgrade",
+    "damage-trace", "tuning-profile",
     ]
 OPTIONS_COMPAT_NAMES = {
     "--compression_level=" : "-z"
@@ -877,6 +880,8 @@ def get_defaults():
                     "encryption-keyfile": "",
                     "tcp-encryption-keyfile": "",
                     "pidfile"           : "",
+                    "damage-trace"      : "",
+                    "tuning-profile"    : "",
                     "ssh"               : DEFAULT_SSH_COMMAND,
                     "systemd-run"       : get_default_systemd_run(),
                     "systemd-run-args"  : "",
@@ -124,7 +124,7 @@ def configure_logging(options, mode):
     if mode in (
         "showconfig", "info", "id", "attach", "launcher", "stop", "print",
         "control", "list", "list-mdns", "sessions", "mdns-gui", "bug-report",
-        "opengl", "opengl-probe", "test-connect",
+        "opengl", "opengl-probe", "test-connect", "codec-benchmark",
         ):
         s = sys.stdout
     else:
@@ -464,6 +464,9 @@ def run_mode(script_file, error_cb, options, args, mode, defaults):
             return 0
         elif mode == "showconfig":
             return run_showconfig(options, args)
+        elif mode == "codec-benchmark":
+            from xpra.codecs.codec_benchmark import run_codec_benchmark
+            return run_codec_benchmark(options, args)
         else:
             error_cb("invalid mode '%s'" % mode)
             return 1
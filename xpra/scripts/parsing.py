@@ -219,6 +219,7 @@ def do_parse_cmdline(cmdline, defaults):
                         "\t%prog print DISPLAY filename\n",
                         "\t%prog version [DISPLAY]\n"
                         "\t%prog showconfig\n"
+                        "\t%prog codec-benchmark [FILENAME]\n"
                         "\t%prog list\n"
                         "\t%prog sessions\n"
                         "\t%prog launcher\n"
@@ -934,6 +935,16 @@ def do_parse_cmdline(cmdline, defaults):
     group.add_option("--sync-xvfb", action="store",
                       dest="sync_xvfb", default=defaults.sync_xvfb,
                       help="How often to synchronize the virtual framebuffer used for X11 seamless servers (0 to disable). Default: %s." % defaults.sync_xvfb)
+    group.add_option("--damage-trace", action="store",
+                      dest="damage_trace", default=defaults.damage_trace,
+                      help="Record the damage events of all the windows to this file,"
+                      + " the trace can be replayed offline using 'python -m xpra.server.window.damage_replay'."
+                      + " Default: '%default'.")
+    group.add_option("--tuning-profile", action="store",
+                      dest="tuning_profile", default=defaults.tuning_profile,
+                      help="Load the batch delay, speed and quality tuning parameters from this file,"
+                      + " profiles can be generated from damage traces using 'python -m xpra.server.window.batch_tuner'."
+                      + " Default: '%default'.")
     group.add_option("--socket-dirs", action="append",
                       dest="socket_dirs", default=[],
                       help="Directories to look for the socket files in. Default: %s." % os.path.pathsep.join("'%s'" % x for x in defaults.socket_dirs))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from bisect import bisect_left
+from threading import Lock
+
+from xpra.log import Logger
+
+log = Logger("http", "stats")
+
+
+"""
+Exports the server performance statistics using the Prometheus text exposition format (version 0.0.4),
+this is much cheaper to generate than the full "xpra info" dictionary
+and can be scraped by most monitoring systems.
+See http://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+#bucket upper bounds, in seconds:
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+#batch delays are recorded in milliseconds:
+DELAY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram(object):
+    """
+        Cumulative histogram which can be updated from any thread.
+        Unlike the deques used for calculating the recent averages,
+        the counts never expire, which is what Prometheus expects.
+    """
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0]*(len(self.buckets)+1)
+        self.sum = 0
+        self.lock = Lock()
+
+    def __repr__(self):
+        return "Histogram(%s)" % (self.buckets,)
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def get_count(self):
+        return sum(self.counts)
+
+    def get_cumulative_counts(self):
+        """ returns the cumulative count for each bucket, including "+Inf" """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        c = 0
+        for i, bound in enumerate(self.buckets+("+Inf", )):
+            c += counts[i]
+            cumulative.append((bound, c))
+        return cumulative, total
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, escape_label_value(v)) for k, v in labels)
+
+def format_value(value):
+    if isinstance(value, float):
+        if value!=value:
+            return "NaN"
+        if value==int(value) and abs(value)<1e15:
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+
+class MetricsWriter(object):
+    """
+        Collects the samples for each metric family,
+        so that all the samples of a family are written together
+        after a single HELP and TYPE line, as required by the format.
+    """
+
+    def __init__(self, prefix="xpra_"):
+        self.prefix = prefix
+        self.families = []
+        self.samples = {}
+
+    def add_family(self, name, mtype, description):
+        if name not in self.samples:
+            self.families.append((name, mtype, description))
+            self.samples[name] = []
+
+    def add_sample(self, name, labels, value):
+        self.samples[name].append(("", labels, value))
+
+    def gauge(self, name, description, value, labels=()):
+        self.add_family(name, "gauge", description)
+        self.add_sample(name, labels, value)
+
+    def counter(self, name, description, value, labels=()):
+        self.add_family(name, "counter", description)
+        self.add_sample(name, labels, value)
+
+    def histogram(self, name, description, histogram, labels=()):
+        self.add_family(name, "histogram", description)
+        samples = self.samples[name]
+        cumulative, total = histogram.get_cumulative_counts()
+        for bound, count in cumulative:
+            samples.append(("_bucket", tuple(labels)+(("le", format_value(bound)), ), count))
+        samples.append(("_sum", labels, total))
+        samples.append(("_count", labels, cumulative[-1][1]))
+
+    def get_text(self):
+        lines = []
+        for name, mtype, description in self.families:
+            fullname = self.prefix+name
+            lines.append("# HELP %s %s" % (fullname, description))
+            lines.append("# TYPE %s %s" % (fullname, mtype))
+            for suffix, labels, value in self.samples[name]:
+                lines.append("%s%s%s %s" % (fullname, suffix, format_labels(labels), format_value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def add_client_metrics(writer, source):
+    """ adds the metrics for a ClientConnection and all its window sources """
+    client = (("client", source.uuid), )
+    stats = getattr(source, "statistics", None)
+    if stats:
+        writer.gauge("packet_queue_size", "Number of packets waiting to be sent to the client",
+                     len(source.packet_queue), client)
+        writer.gauge("encode_queue_size", "Number of items waiting to be processed by the encoding thread",
+                     source.encode_queue_size(), client)
+        writer.counter("damage_events_total", "Number of damage events received",
+                       stats.damage_events_count, client)
+        writer.counter("damage_packets_total", "Number of damage packets sent",
+                       stats.packet_count, client)
+        writer.gauge("client_latency_seconds", "Recent average client latency",
+                     stats.recent_client_latency, client)
+        writer.gauge("congestion_value", "Network congestion value",
+                     stats.congestion_value, client)
+    conn = getattr(getattr(source, "protocol", None), "_conn", None)
+    if conn:
+        writer.counter("sent_bytes_total", "Number of bytes sent to the client",
+                       conn.output_bytecount, client)
+        writer.counter("received_bytes_total", "Number of bytes received from the client",
+                       conn.input_bytecount, client)
+    for wid, ws in tuple(getattr(source, "window_sources", {}).items()):
+        wlabels = client+(("wid", wid), )
+        wstats = ws.statistics
+        writer.gauge("batch_delay_milliseconds", "Current batch delay",
+                     ws.batch_config.delay, wlabels)
+        writer.gauge("speed", "Current encoding speed", ws._current_speed, wlabels)
+        writer.gauge("quality", "Current encoding quality", ws._current_quality, wlabels)
+        for coding, value in tuple(wstats.encoding_bytes.items()):
+            writer.counter("encoding_bytes_total", "Number of compressed bytes produced for each encoding",
+                           value, wlabels+(("encoding", coding), ))
+        for coding, (frames, pixels) in tuple(wstats.encoding_totals.items()):
+            elabels = wlabels+(("encoding", coding), )
+            writer.counter("encoding_frames_total", "Number of frames sent for each encoding", frames, elabels)
+            writer.counter("encoding_pixels_total", "Number of pixels sent for each encoding", pixels, elabels)
+        writer.histogram("encode_time_seconds", "Time spent compressing each screen update",
+                         wstats.encode_time_histogram, wlabels)
+        writer.histogram("batch_delay_actual_milliseconds", "Time the damage events were delayed for batching",
+                         wstats.batch_delay_histogram, wlabels)
+        writer.histogram("damage_latency_seconds", "Time from the damage event until the packet is sent",
+                         wstats.damage_latency_histogram, wlabels)
+        writer.histogram("client_decode_time_seconds", "Time the client took to decode each screen update",
+                         wstats.client_decode_histogram, wlabels)
+
+def get_server_metrics(server_sources):
+    writer = MetricsWriter()
+    sources = tuple(server_sources)
+    writer.gauge("clients", "Number of clients connected", len(sources))
+    for source in sources:
+        try:
+            add_client_metrics(writer, source)
+        except Exception:
+            log.error("Error collecting metrics for %s", source, exc_info=True)
+    return writer.get_text()
@@ -12,6 +12,9 @@ from xpra.scripts.config import parse_bool_or_int
 from xpra.codecs.codec_constants import PREFERED_ENCODING_ORDER, PROBLEMATIC_ENCODINGS
 from xpra.codecs.loader import load_codecs, get_codec, has_codec, codec_versions
 from xpra.codecs.video_helper import getVideoHelper
+from xpra.server.window.shared_encode import get_shared_encode_cache
+from xpra.server.window.video_pool import get_video_pool
+from xpra.server.window.video_scoring import get_score_cache
 from xpra.server.mixins.stub_server_mixin import StubServerMixin
 
 
@@ -43,6 +46,16 @@ class EncodingServer(StubServerMixin):
         if opts.video_scaling.lower() not in ("auto", "on"):
             self.scaling_control = parse_bool_or_int("video-scaling", opts.video_scaling)
         getVideoHelper().set_modules(video_encoders=opts.video_encoders, csc_modules=opts.csc_modules)
+        if opts.tuning_profile:
+            from xpra.server.window.batch_tuner import load_tuning_profile
+            try:
+                profile = load_tuning_profile(opts.tuning_profile)
+                log.info("loaded tuning profile '%s'", opts.tuning_profile)
+                log.info(" with %i parameters", len(profile))
+            except Exception as e:
+                log("load_tuning_profile(%s)", opts.tuning_profile, exc_info=True)
+                log.error("Error: failed to load tuning profile '%s':", opts.tuning_profile)
+                log.error(" %s", e)
 
     def setup(self):
         self.init_encodings()
@@ -53,6 +66,7 @@ class EncodingServer(StubServerMixin):
         self.init_encodings()
 
     def cleanup(self):
+        get_video_pool().cleanup()
         getVideoHelper().cleanup()
 
 
@@ -72,6 +86,9 @@ class EncodingServer(StubServerMixin):
         info = {
             "encodings" : self.get_encoding_info(),
             "video"     : getVideoHelper().get_info(),
+            "shared-encode" : get_shared_encode_cache().get_info(),
+            "video-pool"    : get_video_pool().get_info(),
+            "video-scoring" : get_score_cache().get_info(),
             }
         for k,v in codec_versions.items():
             info.setdefault("encoding", {}).setdefault(k, {})["version"] = v
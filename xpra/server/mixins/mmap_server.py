@@ -6,6 +6,7 @@
 
 import os.path
 
+from xpra.os_util import bytestostr
 from xpra.scripts.config import parse_bool
 from xpra.server.mixins.stub_server_mixin import StubServerMixin
 
@@ -28,6 +29,20 @@ class MMAP_Server(StubServerMixin):
             self.supports_mmap = bool(parse_bool("mmap", opts.mmap.lower()))
 
 
+    def init_packet_handlers(self):
+        if self.supports_mmap:
+            self._authenticated_packet_handlers.update({
+                "mmap-area" : self._process_mmap_area,
+                })
+
+    def _process_mmap_area(self, proto, packet):
+        ss = self._server_sources.get(proto)
+        if not ss:
+            return
+        mmap_filename, mmap_size, base, token, token_index, token_bytes = packet[1:7]
+        ss.add_mmap_area(bytestostr(mmap_filename), mmap_size, base, token, token_index, token_bytes)
+
+
     def get_info(self, _proto=None):
         return {
             "mmap" : {
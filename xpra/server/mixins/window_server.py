@@ -29,6 +29,7 @@ class WindowServer(StubServerMixin):
         self.window_filters = []
         self.window_min_size = 0, 0
         self.window_max_size = 2**15-1, 2**15-1
+        self.damage_trace = None
 
     def init(self, opts):
         def parse_window_size(v, default_value=(0, 0)):
@@ -46,11 +47,28 @@ class WindowServer(StubServerMixin):
         minw, minh = self.window_min_size
         maxw, maxh = self.window_max_size
         self.update_size_constraints(minw, minh, maxw, maxh)
+        if opts.damage_trace:
+            from xpra.os_util import osexpand
+            from xpra.server.window.damage_trace import DamageTraceRecorder
+            self.damage_trace = DamageTraceRecorder(osexpand(opts.damage_trace))
 
     def setup(self):
+        dt = self.damage_trace
+        if dt:
+            try:
+                dt.start()
+            except Exception as e:
+                log("%s.start()", dt, exc_info=True)
+                log.error("Error: failed to start the damage trace recorder:")
+                log.error(" %s", e)
+                self.damage_trace = None
         self.load_existing_windows()
 
     def cleanup(self):
+        dt = self.damage_trace
+        if dt:
+            self.damage_trace = None
+            dt.stop()
         for window in tuple(self._window_to_id.keys()):
             window.unmanage()
         #this can cause errors if we receive packets during shutdown:
@@ -74,12 +92,16 @@ class WindowServer(StubServerMixin):
             }
 
     def get_info(self, _proto):
-        return {
+        info = {
             "state" : {
                 "windows" : len([window for window in tuple(self._id_to_window.values()) if window.is_managed()]),
                 },
             "filters" : tuple((uuid,repr(f)) for uuid, f in self.window_filters),
             }
+        dt = self.damage_trace
+        if dt:
+            info["damage-trace"] = dt.get_info()
+        return info
 
     def get_ui_info(self, _proto, _client_uuids=None, wids=None, *_args):
         """ info that must be collected from the UI thread
@@ -245,6 +267,17 @@ class WindowServer(StubServerMixin):
 
     def refresh_window_area(self, window, x, y, width, height, options={}):
         wid = self._window_to_id[window]
+        dt = self.damage_trace
+        if dt:
+            try:
+                dt.record(wid, window, x, y, width, height)
+            except Exception as e:
+                #don't let the recorder prevent us from sending the damage:
+                log("%s.record%s", dt, (wid, window, x, y, width, height), exc_info=True)
+                log.error("Error: failed to record the damage event, stopping the damage trace:")
+                log.error(" %s", e)
+                self.damage_trace = None
+                dt.stop(0)
         for ss in tuple(self._server_sources.values()):
             ss.damage(wid, window, x, y, width, height, options)
 
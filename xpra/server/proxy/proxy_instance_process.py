@@ -251,8 +251,8 @@ class ProxyInstanceProcess(Process):
         #setup protocol wrappers:
         self.server_packets = Queue(PROXY_QUEUE_SIZE)
         self.client_packets = Queue(PROXY_QUEUE_SIZE)
-        client_protocol_class = get_client_protocol_class(self.client_conn.socktype)
-        server_protocol_class = get_server_protocol_class(self.server_conn.socktype)
+        client_protocol_class = get_client_protocol_class(self.client_conn.socktype, self.client_conn)
+        server_protocol_class = get_server_protocol_class(self.server_conn.socktype, self.server_conn)
         self.client_protocol = client_protocol_class(self, self.client_conn, self.process_client_packet, self.get_client_packet)
         self.client_protocol.restore_state(self.client_state)
         self.server_protocol = server_protocol_class(self, self.server_conn, self.process_server_packet, self.get_server_packet)
@@ -474,6 +474,7 @@ class ProxyInstanceProcess(Process):
         OPTION_WHITELIST = {"compression_level" : number,
                             "lz4"               : parse_bool,
                             "lzo"               : parse_bool,
+                            "zstd"              : parse_bool,
                             "zlib"              : parse_bool,
                             "rencode"           : parse_bool,
                             "bencode"           : parse_bool,
@@ -489,7 +490,8 @@ class ProxyInstanceProcess(Process):
         return d
 
     def filter_client_caps(self, caps):
-        fc = self.filter_caps(caps, (b"cipher", b"challenge", b"digest", b"aliases", b"compression", b"lz4", b"lz0", b"zlib"))
+        #file descriptors cannot be forwarded, so memfd transfers are not possible via the proxy:
+        fc = self.filter_caps(caps, (b"cipher", b"challenge", b"digest", b"aliases", b"compression", b"lz4", b"lz0", b"zlib", b"mmap.memfd"))
         #the display string may override the username:
         username = self.disp_desc.get("username")
         if username:
@@ -648,8 +650,10 @@ class ProxyInstanceProcess(Process):
             zlib = compression.use_zlib and self.caps.boolget("zlib", True)
             lz4 = compression.use_lz4 and self.caps.boolget("lz4", False)
             lzo = compression.use_lzo and self.caps.boolget("lzo", False)
-            if zlib or lz4 or lzo:
-                packet[index] = compressed_wrapper(name, data, zlib=zlib, lz4=lz4, lzo=lzo, can_inline=False)
+            zstd = compression.use_zstd and self.caps.boolget("zstd", False)
+            chunked = self.caps.boolget("chunked-compression")
+            if zlib or lz4 or lzo or zstd:
+                packet[index] = compressed_wrapper(name, data, zlib=zlib, lz4=lz4, lzo=lzo, zstd=zstd, can_inline=False, chunked=chunked)
             else:
                 #prevent warnings about large uncompressed data
                 packet[index] = Compressed("raw %s" % name, data, can_inline=True)
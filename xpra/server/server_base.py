@@ -680,8 +680,14 @@ class ServerBase(ServerBaseClass):
     def get_http_scripts(self):
         scripts = ServerCore.get_http_scripts(self)
         scripts["/audio.mp3"] = self.http_audio_mp3_request
+        scripts["/metrics"] = self.http_metrics_request
         return scripts
 
+    def http_metrics_request(self, handler):
+        from xpra.server.metrics import get_server_metrics, CONTENT_TYPE
+        text = get_server_metrics(tuple(self._server_sources.values()))
+        return self.send_http_response(handler, text.encode("utf8"), CONTENT_TYPE)
+
     def http_audio_mp3_request(self, handler):
         def err(code=500):
             handler.send_response(code)
@@ -28,6 +28,7 @@ from xpra.net.bytestreams import (
     )
 from xpra.net.net_util import get_network_caps, get_info as get_net_info
 from xpra.net.protocol import Protocol, sanity_checks
+from xpra.net.protocol_classes import get_xpra_protocol_class
 from xpra.net.digest import get_salt, gendigest, choose_digest
 from xpra.platform import set_name
 from xpra.platform.paths import get_app_dir
@@ -1020,8 +1021,10 @@ class ServerCore(object):
                 pass
 
 
-    def make_protocol(self, socktype, conn, protocol_class=Protocol):
+    def make_protocol(self, socktype, conn, protocol_class=None):
         """ create a new xpra Protocol instance and start it """
+        if protocol_class is None:
+            protocol_class = get_xpra_protocol_class(conn)
         def xpra_protocol_class(conn):
             """ adds xpra protocol tweaks after creating the instance """
             protocol = protocol_class(self, conn, self.process_packet)
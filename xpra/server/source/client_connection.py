@@ -81,6 +81,8 @@ MIN_BANDWIDTH = envint("XPRA_MIN_BANDWIDTH", 5*1024*1024)
 AUTO_BANDWIDTH_PCT = envint("XPRA_AUTO_BANDWIDTH_PCT", 80)
 assert AUTO_BANDWIDTH_PCT>1 and AUTO_BANDWIDTH_PCT<=100, "invalid value for XPRA_AUTO_BANDWIDTH_PCT: %i" % AUTO_BANDWIDTH_PCT
 YIELD = envbool("XPRA_YIELD", False)
+ENCODE_THREADS = envint("XPRA_ENCODE_THREADS", 1)
+assert ENCODE_THREADS>0, "invalid value for XPRA_ENCODE_THREADS: %i" % ENCODE_THREADS
 
 counter = AtomicInteger()
 
@@ -101,6 +103,9 @@ The UI thread calls damage(), which goes into WindowSource and eventually (batch
 adds the damage pixels ready for processing to the encode_work_queue,
 items are picked off by the separate 'encode' thread (see 'encode_loop')
 and added to the damage_packet_queue.
+When XPRA_ENCODE_THREADS is greater than one, we use a pool of 'encode' threads instead,
+each with its own queue: all the items for a given window are routed to the same thread,
+so they are still processed in order, but different windows can be encoded in parallel.
 """
 
 class ClientConnection(ClientConnectionClass):
@@ -131,10 +136,10 @@ class ClientConnection(ClientConnectionClass):
                                                     #(only packet is required - the rest can be 0/None for clipboard packets)
         # the encode work queue is used by mixins that need to encode data before sending it,
         # ie: encodings and clipboard
-        self.encode_work_queue = None               #this queue will hold functions to call to compress data (pixels, clipboard)
-                                                    #items placed in this queue are picked off by the "encode" thread,
+        self.encode_work_queues = []                #these queues will hold functions to call to compress data (pixels, clipboard)
+                                                    #items placed in these queues are picked off by the "encode" threads,
                                                     #the functions should add the packets they generate to the 'packet_queue'
-        self.encode_thread = None
+        self.encode_threads = []
         self.ordinary_packets = []
         self.socket_dir = socket_dir
         self.unix_socket_paths = unix_socket_paths
@@ -313,24 +318,50 @@ class ClientConnection(ClientConnectionClass):
     # The encode thread loop management:
     #
     def queue_encode(self, item):
-        #start the encode work queue:
-        self.encode_work_queue = Queue()            #holds functions to call to compress data (pixels, clipboard)
-                                                    #items placed in this queue are picked off by the "encode" thread,
+        #start the encode work queues and their threads:
+        for i in range(ENCODE_THREADS):
+            q = Queue()                             #holds functions to call to compress data (pixels, clipboard)
+                                                    #items placed in this queue are picked off by its "encode" thread,
                                                     #the functions should add the packets they generate to the 'packet_queue'
-        self.queue_encode = self.encode_work_queue.put
-        self.encode_work_queue.put(item)
-        self.encode_thread = start_thread(self.encode_loop, "encode")
+            self.encode_work_queues.append(q)
+            name = "encode"
+            if ENCODE_THREADS>1:
+                name = "encode-%i" % i
+            self.encode_threads.append(start_thread(self.encode_loop, name, args=(q,)))
+        self.queue_encode = self.do_queue_encode
+        self.do_queue_encode(item)
+
+    def do_queue_encode(self, item):
+        queues = self.encode_work_queues
+        if item is None:
+            #end of queue marker, every thread must get one:
+            for q in queues:
+                q.put(None)
+            return
+        queues[self.get_encode_queue_index(item[1])].put(item)
 
-    def encode_queue_size(self):
-        ewq = self.encode_work_queue
-        if ewq is None:
+    def get_encode_queue_index(self, fn):
+        """
+            Items are routed using the window id of the object the function is bound to,
+            so that all the items for the same window end up in the same queue.
+        """
+        n = len(self.encode_work_queues)
+        if n==1 or getattr(self, "mmap_size", 0)>0:
+            #the mmap area is a ring buffer which the client reads in the order we write it,
+            #so we cannot write to it from multiple threads:
             return 0
-        return ewq.qsize()
+        wid = getattr(getattr(fn, "__self__", None), "wid", 0)
+        return wid % n
+
+    def encode_queue_size(self):
+        return sum(q.qsize() for q in self.encode_work_queues)
 
     def call_in_encode_thread(self, *fn_and_args):
         """
             This is used by WindowSource to queue damage processing to be done in the 'encode' thread.
             The 'encode_and_send_cb' will then add the resulting packet to the 'packet_queue' via 'queue_packet'.
+            The function should be a method bound to the WindowSource,
+            so that it can be routed to the encode thread which handles this window.
         """
         self.statistics.compression_work_qsizes.append((monotonic_time(), self.encode_queue_size()))
         self.queue_encode(fn_and_args)
@@ -349,16 +380,16 @@ class ClientConnection(ClientConnectionClass):
         if p:
             p.source_has_more()
 
-    def encode_loop(self):
+    def encode_loop(self, encode_work_queue):
         """
             This runs in a separate thread and calls all the function callbacks
-            which are added to the 'encode_work_queue'.
+            which are added to its 'encode_work_queue'.
             Must run until we hit the end of queue marker,
             to ensure all the queued items get called,
             those that are marked as optional will be skipped when is_closed()
         """
         while True:
-            fn_and_args = self.encode_work_queue.get(True)
+            fn_and_args = encode_work_queue.get(True)
             if fn_and_args is None:
                 return              #empty marker
             #some function calls are optional and can be skipped when closing:
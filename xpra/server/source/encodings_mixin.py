@@ -13,7 +13,7 @@ from xpra.server.source.stub_source_mixin import StubSourceMixin
 from xpra.server.window.batch_config import DamageBatchConfig
 from xpra.codecs.video_helper import getVideoHelper
 from xpra.codecs.codec_constants import video_spec
-from xpra.net.compression import compressed_wrapper, Compressed, use_lz4, use_lzo
+from xpra.net.compression import compressed_wrapper, Compressed, use_lz4, use_lzo, use_zstd
 from xpra.os_util import monotonic_time, strtobytes
 from xpra.server.background_worker import add_work_item
 from xpra.util import csv, typedict, envint
@@ -61,6 +61,8 @@ class EncodingsMixin(StubSourceMixin):
         self.zlib = True
         self.lz4 = use_lz4
         self.lzo = use_lzo
+        self.zstd = use_zstd
+        self.chunked_compression = False
 
         #for managing the recalculate_delays work:
         self.calculate_window_pixels = {}
@@ -106,8 +108,9 @@ class EncodingsMixin(StubSourceMixin):
 
 
     def compressed_wrapper(self, datatype, data, min_saving=128):
-        if self.zlib or self.lz4 or self.lzo:
-            cw = compressed_wrapper(datatype, data, zlib=self.zlib, lz4=self.lz4, lzo=self.lzo, can_inline=False)
+        if self.zlib or self.lz4 or self.lzo or self.zstd:
+            cw = compressed_wrapper(datatype, data, zlib=self.zlib, lz4=self.lz4, lzo=self.lzo, zstd=self.zstd, can_inline=False,
+                                    chunked=self.chunked_compression)
             if len(cw)+min_saving<=len(data):
                 #the compressed version is smaller, use it:
                 return cw
@@ -247,6 +250,8 @@ class EncodingsMixin(StubSourceMixin):
         self.zlib = c.boolget("zlib", True)
         self.lz4 = c.boolget("lz4", False) and use_lz4
         self.lzo = c.boolget("lzo", False) and use_lzo
+        self.zstd = c.boolget("zstd", False) and use_zstd
+        self.chunked_compression = c.boolget("chunked-compression")
 
         self.vrefresh = c.intget("vrefresh", -1)
 
@@ -425,6 +430,8 @@ class EncodingsMixin(StubSourceMixin):
                 "auto_refresh"      : self.auto_refresh_delay,
                 "lz4"               : self.lz4,
                 "lzo"               : self.lzo,
+                "zstd"              : self.zstd,
+                "chunked-compression" : self.chunked_compression,
                 "vertical-refresh"  : self.vrefresh,
                 }
         ieo = dict(self.icons_encoding_options)
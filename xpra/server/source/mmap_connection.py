@@ -6,6 +6,7 @@
 
 import os
 
+from xpra.util import envbool, envint
 from xpra.os_util import WIN32
 from xpra.simple_stats import std_unit
 from xpra.server.source.stub_source_mixin import StubSourceMixin
@@ -13,6 +14,13 @@ from xpra.log import Logger
 
 log = Logger("mmap")
 
+MMAP_ALLOCATOR = envbool("XPRA_MMAP_ALLOCATOR", True)
+#how many mmap areas the client may add during the session:
+MMAP_MAX_AREAS = envint("XPRA_MMAP_MAX_AREAS", 4)
+#use memfd areas for local clients that cannot access a shared file:
+MEMFD = envbool("XPRA_MEMFD", True)
+MEMFD_SIZE = envint("XPRA_MEMFD_SIZE", 256*1024*1024)
+
 
 class MMAP_Connection(StubSourceMixin):
 
@@ -20,8 +28,10 @@ class MMAP_Connection(StubSourceMixin):
         self.supports_mmap = False
         self.mmap_filename = None
         self.min_mmap_size = 0
+        self.mmap_protocol = None
 
-    def init_from(self, _protocol, server):
+    def init_from(self, protocol, server):
+        self.mmap_protocol = protocol
         self.supports_mmap = server.supports_mmap
         self.mmap_filename = server.mmap_filename
         self.min_mmap_size = server.min_mmap_size
@@ -33,9 +43,18 @@ class MMAP_Connection(StubSourceMixin):
         self.mmap_client_token_index = 512
         self.mmap_client_token_bytes = 0
         self.mmap_client_namespace = False
+        self.mmap_allocator = None
+        self.mmap_area_requested = False
+        self.mmap_memfd = False
 
     def cleanup(self):
         mmap = self.mmap
+        allocator = self.mmap_allocator
+        self.mmap_allocator = None
+        if allocator:
+            for mmap_area, _ in allocator.areas:
+                if mmap_area is not mmap:
+                    mmap_area.close()
         if mmap:
             self.mmap = None
             self.mmap_size = 0
@@ -47,6 +66,11 @@ class MMAP_Connection(StubSourceMixin):
         sep = ["_", "."][self.mmap_client_namespace]
         def mmapattr(k):
             return "mmap%s%s" % (sep, k)
+        self.parse_mmap_file_caps(c, mmapattr)
+        if self.mmap_size==0 and c.boolget(mmapattr("memfd")):
+            self.init_memfd()
+
+    def parse_mmap_file_caps(self, c, mmapattr):
         mmap_filename = c.strget(mmapattr("file"))
         if not mmap_filename:
             return
@@ -96,6 +120,11 @@ class MMAP_Connection(StubSourceMixin):
                         #use the expected default for older versions:
                         self.mmap_client_token_index = DEFAULT_TOKEN_INDEX
                     write_mmap_token(self.mmap, self.mmap_client_token, self.mmap_client_token_index, self.mmap_client_token_bytes)
+                    if MMAP_ALLOCATOR and c.boolget(mmapattr("allocator")):
+                        from xpra.net.mmap_pipe import MmapAllocator, MMAP_ALLOC_UNIT
+                        self.mmap_allocator = MmapAllocator(self.request_mmap_area)
+                        #the start of the first area is used by the ring buffer pointers:
+                        self.mmap_allocator.add_area(self.mmap, self.mmap_size, 0, MMAP_ALLOC_UNIT)
         if self.mmap_size>0:
             log.info(" mmap is enabled using %sB area in %s", std_unit(self.mmap_size, unit=1024), mmap_filename)
 
@@ -108,8 +137,88 @@ class MMAP_Connection(StubSourceMixin):
             mmapattr("token",       self.mmap_client_token)
             mmapattr("token_index", self.mmap_client_token_index)
             mmapattr("token_bytes", self.mmap_client_token_bytes)
+            mmapattr("allocator",   self.mmap_allocator is not None)
+        if self.mmap_memfd:
+            caps["mmap.memfd"] = True
         return caps
 
+
+    def init_memfd(self):
+        """
+            The client is on the same host but we cannot use its mmap file,
+            we create the areas ourselves and pass the file descriptors with the packets.
+        """
+        from xpra.net.mmap_pipe import MEMFD_SUPPORTED, MmapAllocator
+        conn = getattr(self.mmap_protocol, "_conn", None)
+        if not (self.supports_mmap and MEMFD and MEMFD_SUPPORTED and conn and conn.can_pass_fds()):
+            log("memfd not available: supported=%s, enabled=%s, connection=%s", MEMFD_SUPPORTED, MEMFD, conn)
+            return
+        self.mmap_memfd = True
+        #the areas are only created when we need them:
+        self.mmap_allocator = MmapAllocator(self.add_memfd_area)
+        self.mmap_size = MEMFD_SIZE
+        log.info(" memfd transfers are enabled")
+
+    def add_memfd_area(self, size):
+        #called by the allocator from the encode thread
+        from xpra.util import roundup
+        from xpra.net.mmap_pipe import init_memfd_area, MMAP_ALLOC_UNIT
+        allocator = self.mmap_allocator
+        if not allocator or len(allocator.areas)>=MMAP_MAX_AREAS:
+            return
+        size = max(MEMFD_SIZE, roundup(size*2, MMAP_ALLOC_UNIT))
+        fd, mmap_area = init_memfd_area(size)
+        base = allocator.get_next_base()
+        log("new memfd area %i of %i bytes at %#x", fd, size, base)
+        #the file descriptor will arrive before the packet:
+        self.mmap_protocol._conn.send_fds([fd])
+        self.send("memfd-area", base, size)
+        allocator.add_area(mmap_area, size, base)
+
+
+    def request_mmap_area(self, size):
+        """
+            Called by the allocator when it runs out of space (from the encode thread):
+            ask the client for another area, one at a time.
+        """
+        allocator = self.mmap_allocator
+        if not allocator or self.mmap_area_requested or len(allocator.areas)>=MMAP_MAX_AREAS:
+            return
+        log("requesting a new mmap area for %i bytes", size)
+        self.mmap_area_requested = True
+        self.send_async("mmap-area-request", size)
+
+    def add_mmap_area(self, mmap_filename, mmap_size, base, token, token_index, token_bytes):
+        from xpra.net.mmap_pipe import init_server_mmap, read_mmap_token
+        self.mmap_area_requested = False
+        allocator = self.mmap_allocator
+        ok = False
+        if not allocator:
+            log.warn("Warning: cannot add an mmap area, the allocator is not enabled")
+        elif len(allocator.areas)>=MMAP_MAX_AREAS:
+            log.warn("Warning: too many mmap areas, the limit is %i", MMAP_MAX_AREAS)
+        elif WIN32 and mmap_filename.startswith("/"):
+            log.warn("Warning: mmap_file '%s' is a unix path", mmap_filename)
+        else:
+            mmap_area, size = init_server_mmap(mmap_filename, mmap_size)
+            if mmap_area:
+                v = read_mmap_token(mmap_area, token_index, token_bytes)
+                if v!=token:
+                    log.warn("Warning: mmap token verification failed for the new area '%s'", mmap_filename)
+                    log.warn(" expected '%#x', found '%#x'", token, v)
+                else:
+                    try:
+                        allocator.add_area(mmap_area, size, base)
+                        ok = True
+                    except ValueError as e:
+                        log.warn("Warning: cannot add mmap area '%s':", mmap_filename)
+                        log.warn(" %s", e)
+                if not ok:
+                    mmap_area.close()
+        if ok:
+            log.info(" added %sB mmap area in %s", std_unit(mmap_size, unit=1024), mmap_filename)
+        self.send_async("mmap-area-ack", base, ok)
+
     def get_info(self):
         return {
             "mmap" : {
@@ -117,5 +226,6 @@ class MMAP_Connection(StubSourceMixin):
                 "enabled"       : self.mmap is not None,
                 "size"          : self.mmap_size,
                 "filename"      : self.mmap_filename or "",
+                "allocator"     : self.mmap_allocator.get_info() if self.mmap_allocator else {},
                 },
             }
@@ -498,7 +498,8 @@ class WindowsMixin(StubSourceMixin):
             batch_config = self.make_batch_config(wid, window)
             ww, wh = window.get_dimensions()
             bandwidth_limit = self.bandwidth_limit
-            mmap = getattr(self, "mmap", None)
+            #the allocator takes care of writing to all the mmap areas, if enabled:
+            mmap = getattr(self, "mmap_allocator", None) or getattr(self, "mmap", None)
             mmap_size = getattr(self, "mmap_size", 0)
             av_sync = getattr(self, "av_sync", False)
             av_sync_delay = getattr(self, "av_sync_delay", 0)
@@ -15,6 +15,38 @@ from xpra.log import Logger
 
 log = Logger("server", "stats")
 
+#the weights and reference values used by the heuristics below,
+#the defaults were tuned by hand,
+#they can be overriden by loading a tuning profile (see batch_tuner)
+DEFAULT_TUNING = {
+    #how much we trust the delays we have actually used vs the ones we wanted to use:
+    "batch.actual-delay-weight"         : 0.75,
+    #number of frames of backlog at which we compress more:
+    "speed.backlog-frames"              : 4,
+    #reference damage latency (ms) and how much it increases for larger windows:
+    "speed.ref-latency"                 : 10,
+    "speed.ref-latency-per-mpixel"      : 25,
+    #try to never go higher than N times the reference latency:
+    "speed.latency-abs-ratio"           : 3,
+    #pixel rate in MPixels/s at which we should reach 100% speed:
+    "speed.max-pixel-rate"              : 50,
+    #below this bandwidth limit in Mbps, lower the speed ceiling:
+    "speed.bandwidth-ref"               : 10,
+    #minimum client decoding speed in MPixels/s:
+    "speed.min-decode-speed"            : 1.0,
+    #number of frames of backlog at which we use the minimum quality:
+    "quality.backlog-frames"            : 4,
+    #below this bandwidth limit in Mbps, lower the quality:
+    "quality.bandwidth-ref"             : 10,
+    #how much congestion events lower the quality:
+    "quality.congestion"                : 10,
+    #how many times the reference delay is good enough:
+    "quality.batch-tolerance"           : 3.0,
+    #how many times the target latency we tolerate before lowering the quality:
+    "quality.latency-ratio"             : 3.0,
+    }
+TUNING = DEFAULT_TUNING.copy()
+
 
 def get_low_limit(mmap_enabled, window_dimensions):
     #the number of pixels which can be considered 'low' in terms of backlog.
@@ -78,7 +110,8 @@ def update_batch_delay(batch, factors, min_delay=0):
     tv, tw = 0.0, 0.0
     decay = max(1, logp(current_delay/batch.min_delay)/5.0)
     max_delay = batch.max_delay
-    for delays, d_weight in ((batch.last_delays, 0.25), (batch.last_actual_delays, 0.75)):
+    adw = TUNING["batch.actual-delay-weight"]
+    for delays, d_weight in ((batch.last_delays, 1-adw), (batch.last_actual_delays, adw)):
         delays = tuple(delays or ())
         #get the weighted average
         #older values matter less, we decay them according to how much we batch already
@@ -115,6 +148,7 @@ def update_batch_delay(batch, factors, min_delay=0):
     batch.factors = valid_factors
 
 def get_target_speed(window_dimensions, batch, global_statistics, statistics, bandwidth_limit, min_speed, speed_data):
+    tuning = TUNING
     low_limit = get_low_limit(global_statistics.mmap_size>0, window_dimensions)
     #***********************************************************
     # encoding speed:
@@ -125,17 +159,17 @@ def get_target_speed(window_dimensions, batch, global_statistics, statistics, ba
     #backlog factor:
     _, pixels_backlog, _ = statistics.get_client_backlog()
     pb_ratio = float(pixels_backlog)/low_limit
-    pixels_bl_s = 100 - int(100*logp(pb_ratio/4))    #4 frames behind or more -> compress more
+    pixels_bl_s = 100 - int(100*logp(pb_ratio/tuning["speed.backlog-frames"]))    #4 frames behind or more -> compress more
 
     #megapixels per second:
     mpixels = low_limit/1024.0/1024.0
     #for larger window sizes, we should be downscaling,
     #and don't want to wait too long for those anyway:
-    ref_damage_latency = (10 + 25 * (1+mathlog(max(1, mpixels))))/1000.0
+    ref_damage_latency = (tuning["speed.ref-latency"] + tuning["speed.ref-latency-per-mpixel"] * (1+mathlog(max(1, mpixels))))/1000.0
 
     adil = statistics.avg_damage_in_latency or 0
     #abs: try to never go higher than N times the reference latency:
-    dam_lat_abs = max(0, (adil-ref_damage_latency)) / (ref_damage_latency * 3)
+    dam_lat_abs = max(0, (adil-ref_damage_latency)) / (ref_damage_latency * tuning["speed.latency-abs-ratio"])
 
     if batch.locked:
         target_damage_latency = ref_damage_latency
@@ -178,7 +212,7 @@ def get_target_speed(window_dimensions, batch, global_statistics, statistics, ba
     if len(lde)>5 and mpixels_per_s>=1:
         #above 50 MPixels/s, we should reach 100% speed
         #(even x264 peaks at tens of MPixels/s)
-        pps = sqrt(mpixels_per_s/50.0)
+        pps = sqrt(mpixels_per_s/float(tuning["speed.max-pixel-rate"]))
         #if there aren't many pixels,
         #we can spend more time compressing them better:
         #(since it isn't going to cost too much to compress)
@@ -189,7 +223,7 @@ def get_target_speed(window_dimensions, batch, global_statistics, statistics, ba
     if bandwidth_limit>0:
         #below N Mbps, lower the speed ceiling,
         #so we will compress better:
-        N = 10
+        N = tuning["speed.bandwidth-ref"]
         bandwidth_s = int(100*sqrt(float(bandwidth_limit)/(N*1000*1000)))
 
     gcv = global_statistics.congestion_value
@@ -200,7 +234,7 @@ def get_target_speed(window_dimensions, batch, global_statistics, statistics, ba
 
     #ensure we decode at a reasonable speed (for slow / low-power clients)
     #maybe this should be configurable?
-    min_decode_speed = 1*1000*1000      #MPixels/s
+    min_decode_speed = tuning["speed.min-decode-speed"]*1000*1000      #MPixels/s
     ads = statistics.avg_decode_speed or 0
     dec_lat = 0
     if ads>0:
@@ -237,6 +271,7 @@ def get_target_speed(window_dimensions, batch, global_statistics, statistics, ba
 
 
 def get_target_quality(window_dimensions, batch, global_statistics, statistics, bandwidth_limit, min_quality, min_speed):
+    tuning = TUNING
     low_limit = get_low_limit(global_statistics.mmap_size>0, window_dimensions)
     #***********************************************************
     # quality:
@@ -248,17 +283,17 @@ def get_target_quality(window_dimensions, batch, global_statistics, statistics,
     #backlog factor:
     packets_backlog, pixels_backlog, _ = statistics.get_client_backlog()
     pb_ratio = float(pixels_backlog)/low_limit
-    pixels_bl_q = 1 - logp(pb_ratio/4)    #4 frames behind or more -> min quality
+    pixels_bl_q = 1 - logp(pb_ratio/tuning["quality.backlog-frames"])    #4 frames behind or more -> min quality
 
     #bandwidth limit factor:
     bandwidth_q = 1
     if bandwidth_limit>0:
         #below 10Mbps, lower the quality
-        bandwidth_q = int(100*sqrt(bandwidth_limit/(10.0*1000*1000)))
+        bandwidth_q = int(100*sqrt(bandwidth_limit/(tuning["quality.bandwidth-ref"]*1000.0*1000)))
 
     #congestion factor:
     gcv = global_statistics.congestion_value
-    congestion_q = 1 - gcv*10
+    congestion_q = 1 - gcv*tuning["quality.congestion"]
 
     #batch delay factor:
     batch_q = 1
@@ -269,7 +304,7 @@ def get_target_quality(window_dimensions, batch, global_statistics, statistics,
             #so when we start and we don't have any records, we don't lower quality
             #just because the start delay is higher than min_delay
             #anything less than N times the reference delay is good enough:
-            N = 3.0-min_speed/50.0
+            N = tuning["quality.batch-tolerance"]-min_speed/50.0
             #if the min-speed is high, reduce tolerance:
             tolerance = 10-int(min_speed//10)
             ref_delay = max(0, tolerance+N*(batch.START_DELAY*10 + batch.min_delay*recs) // (recs+10))
@@ -279,7 +314,7 @@ def get_target_quality(window_dimensions, batch, global_statistics, statistics,
     latency_q = 1
     if global_statistics.client_latency and global_statistics.recent_client_latency>0:
         #if the recent latency is too high, keep quality lower:
-        latency_q = 3.0 * statistics.target_latency / global_statistics.recent_client_latency
+        latency_q = tuning["quality.latency-ratio"] * statistics.target_latency / global_statistics.recent_client_latency
 
     #target is the lowest value of all those limits:
     target = max(0, min(1, pixels_bl_q, bandwidth_q, congestion_q, batch_q, latency_q))
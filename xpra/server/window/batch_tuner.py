@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import sys
+
+from xpra.server.window import batch_delay_calculator
+from xpra.server.window.batch_config import DamageBatchConfig
+from xpra.log import Logger
+
+log = Logger("stats", "trace")
+
+
+"""
+Tuning profiles override the weights used by the batch delay, speed and quality heuristics
+(see batch_delay_calculator) and the default batch delays (see batch_config).
+The server loads them at startup using the "tuning-profile" option.
+
+The tuner searches for the values which give the best results for a set of damage traces
+(recorded with the "damage-trace" server option) replayed over a simulated network link,
+so that different profiles can be generated for different environments,
+ie: low latency LAN vs high latency, low bandwidth WAN.
+
+A profile is a text file using the same syntax as the xpra configuration files,
+ie: "speed.backlog-frames = 4"
+"""
+
+#the DamageBatchConfig class attributes we can tune:
+BATCH_CONFIG_ATTRIBUTES = {
+    "batch.min-delay"       : "MIN_DELAY",
+    "batch.max-delay"       : "MAX_DELAY",
+    "batch.start-delay"     : "START_DELAY",
+    "batch.expire-delay"    : "EXPIRE_DELAY",
+    }
+
+#the range of values the tuner will try for each parameter:
+PARAMETER_RANGES = {
+    "batch.min-delay"                   : (1, 100),
+    "batch.max-delay"                   : (50, 2000),
+    "batch.start-delay"                 : (5, 500),
+    "batch.expire-delay"                : (10, 500),
+    "batch.actual-delay-weight"         : (0.1, 1.0),
+    "speed.backlog-frames"              : (1, 16),
+    "speed.ref-latency"                 : (1, 100),
+    "speed.ref-latency-per-mpixel"      : (5, 100),
+    "speed.latency-abs-ratio"           : (1, 10),
+    "speed.max-pixel-rate"              : (5, 500),
+    "speed.bandwidth-ref"               : (1, 100),
+    "speed.min-decode-speed"            : (0.1, 10),
+    "quality.backlog-frames"            : (1, 16),
+    "quality.bandwidth-ref"             : (1, 100),
+    "quality.congestion"                : (1, 50),
+    "quality.batch-tolerance"           : (1, 10),
+    "quality.latency-ratio"             : (1, 10),
+    }
+
+#the multipliers applied to the current value when searching:
+STEPS = (0.5, 0.75, 1.5, 2)
+
+
+def get_tuning_profile():
+    """ returns the values currently in use """
+    profile = dict(batch_delay_calculator.TUNING)
+    for name, attr in BATCH_CONFIG_ATTRIBUTES.items():
+        profile[name] = getattr(DamageBatchConfig, attr)
+    return profile
+
+def apply_tuning_profile(profile):
+    for name, value in profile.items():
+        attr = BATCH_CONFIG_ATTRIBUTES.get(name)
+        if attr:
+            setattr(DamageBatchConfig, attr, int(value))
+        elif name in batch_delay_calculator.DEFAULT_TUNING:
+            batch_delay_calculator.TUNING[name] = value
+        else:
+            raise ValueError("invalid tuning parameter '%s'" % name)
+    log("apply_tuning_profile(%s)", profile)
+
+def parse_value(name, value):
+    v = float(value)
+    minv, maxv = PARAMETER_RANGES.get(name, (None, None))
+    if (minv is not None and v<minv) or (maxv is not None and v>maxv):
+        raise ValueError("value %s for '%s' is out of range %s to %s" % (value, name, minv, maxv))
+    if v==int(v):
+        return int(v)
+    return v
+
+def load_tuning_profile(filename):
+    from xpra.scripts.config import read_config
+    if not os.path.isfile(filename):
+        raise ValueError("tuning profile '%s' not found" % filename)
+    d = read_config(filename)
+    profile = {}
+    for name, value in d.items():
+        if isinstance(value, list):
+            #use the last value specified:
+            value = value[-1]
+        profile[name] = parse_value(name, value)
+    apply_tuning_profile(profile)
+    return profile
+
+def save_tuning_profile(filename, profile, comments=()):
+    with open(filename, "w") as f:
+        f.write("# xpra tuning profile\n")
+        for comment in comments:
+            f.write("# %s\n" % comment)
+        f.write("\n")
+        for name in sorted(profile.keys()):
+            f.write("%s = %s\n" % (name, profile[name]))
+
+
+class BatchTuner(object):
+    """
+        Searches the parameter space one parameter at a time (coordinate descent),
+        keeping any change which lowers the cost of replaying the traces.
+        The cost is a weighted sum of:
+        - the 90th percentile of the damage to ack latency, in milliseconds
+        - the amount of data sent, in MB
+        - the quality loss (100 minus the average quality)
+    """
+
+    def __init__(self, traces, replay_options, latency_weight=1.0, bytes_weight=0, quality_weight=2.0):
+        self.traces = traces
+        self.replay_options = replay_options
+        self.latency_weight = latency_weight
+        self.bytes_weight = bytes_weight
+        self.quality_weight = quality_weight
+        self.evaluations = 0
+
+    def get_cost(self, results):
+        latency = results.get("latency", {}).get("90p", 0)
+        mbytes = results.get("bytes", 0)/1024.0/1024.0
+        quality_loss = 100-results.get("quality", 100)
+        return self.latency_weight*latency + self.bytes_weight*mbytes + self.quality_weight*quality_loss
+
+    def evaluate(self, profile):
+        from xpra.server.window.damage_replay import DamageReplay
+        apply_tuning_profile(profile)
+        cost = 0
+        for trace in self.traces:
+            replay = DamageReplay(trace, **self.replay_options)
+            cost += self.get_cost(replay.run())
+        self.evaluations += 1
+        log("evaluate(%s)=%.1f", profile, cost)
+        return cost
+
+    def get_candidates(self, profile, name):
+        value = profile[name]
+        minv, maxv = PARAMETER_RANGES[name]
+        candidates = []
+        for step in STEPS:
+            v = value*step
+            if isinstance(value, int):
+                v = int(round(v))
+            v = max(minv, min(maxv, v))
+            if v!=value and v not in candidates:
+                candidates.append(v)
+        return candidates
+
+    def tune(self, rounds=2, parameters=None):
+        best = get_tuning_profile()
+        best_cost = self.evaluate(best)
+        log.info("initial cost: %.1f", best_cost)
+        for i in range(rounds):
+            improved = False
+            for name in (parameters or sorted(PARAMETER_RANGES.keys())):
+                for value in self.get_candidates(best, name):
+                    candidate = dict(best)
+                    candidate[name] = value
+                    cost = self.evaluate(candidate)
+                    if cost<best_cost:
+                        log.info("round %i: %s=%s lowers the cost to %.1f", i+1, name, value, cost)
+                        best, best_cost = candidate, cost
+                        improved = True
+                        break
+            if not improved:
+                break
+        apply_tuning_profile(best)
+        return best, best_cost
+
+
+def main(argv):
+    from optparse import OptionParser
+    from xpra.platform import program_context
+    from xpra.log import enable_color
+    parser = OptionParser(usage="%prog [options] TRACEFILE [TRACEFILE..]")
+    parser.add_option("--output", action="store", dest="output", default="tuning-profile.conf",
+                      help="The file to write the tuned profile to. Default: '%default'.")
+    parser.add_option("--profile", action="store", dest="profile", default="",
+                      help="Start from the values in this tuning profile.")
+    parser.add_option("--rounds", action="store", type="int", dest="rounds", default=2,
+                      help="Maximum number of passes over all the parameters. Default: %default.")
+    parser.add_option("--parameters", action="store", dest="parameters", default="",
+                      help="Comma separated list of the parameters to tune. Default: all.")
+    parser.add_option("--encoding", action="store", dest="encoding", default="auto",
+                      help="The encoding to use. Default: '%default'.")
+    parser.add_option("--latency", action="store", type="int", dest="latency", default=20,
+                      help="The round trip latency of the simulated client, in milliseconds. Default: %default.")
+    parser.add_option("--bandwidth", action="store", type="float", dest="bandwidth", default=100,
+                      help="The bandwidth of the simulated link in Mbps, 0 for unlimited. Default: %default.")
+    parser.add_option("--decode-speed", action="store", type="float", dest="decode_speed", default=100,
+                      help="The decoding speed of the simulated client in MPixels per second, 0 for instant. Default: %default.")
+    parser.add_option("--speed", action="store", type="float", dest="speed", default=1.0,
+                      help="Replay speed factor. Default: %default.")
+    parser.add_option("--latency-weight", action="store", type="float", dest="latency_weight", default=1.0,
+                      help="Cost of each millisecond of latency. Default: %default.")
+    parser.add_option("--bytes-weight", action="store", type="float", dest="bytes_weight", default=0,
+                      help="Cost of each MB sent. Default: %default.")
+    parser.add_option("--quality-weight", action="store", type="float", dest="quality_weight", default=2.0,
+                      help="Cost of each quality point lost. Default: %default.")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                      help="Show debug messages.")
+    options, args = parser.parse_args(argv[1:])
+    if not args:
+        parser.error("specify at least one damage trace file")
+    parameters = [x.strip() for x in options.parameters.split(",") if x.strip()]
+    for name in parameters:
+        if name not in PARAMETER_RANGES:
+            parser.error("invalid parameter '%s'" % name)
+    with program_context("Batch Tuner"):
+        enable_color()
+        if options.verbose:
+            log.enable_debug()
+        from xpra.codecs.loader import load_codecs
+        from xpra.codecs.video_helper import getVideoHelper, ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS
+        load_codecs(decoders=False)
+        vh = getVideoHelper()
+        vh.set_modules(ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS)
+        vh.init()
+        if options.profile:
+            load_tuning_profile(options.profile)
+        replay_options = {
+            "encoding"      : options.encoding,
+            "latency"       : options.latency,
+            "bandwidth"     : int(options.bandwidth*1000*1000),
+            "decode_speed"  : options.decode_speed,
+            "speed"         : max(0.01, options.speed),
+            }
+        tuner = BatchTuner(args, replay_options, options.latency_weight, options.bytes_weight, options.quality_weight)
+        profile, cost = tuner.tune(options.rounds, parameters)
+        comments = (
+            "generated from %i trace%s: %s" % (len(args), "s"[:len(args)>1], ", ".join(args)),
+            "link: %ims latency, %sMbps, client decoding at %sMPixels/s" % (options.latency, options.bandwidth, options.decode_speed),
+            "cost: %.1f after %i evaluations" % (cost, tuner.evaluations),
+            )
+        save_tuning_profile(options.output, profile, comments)
+        log.info("tuning profile saved to '%s'", options.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
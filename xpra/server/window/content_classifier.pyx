@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+#!python
+#cython: auto_pickle=False, boundscheck=False, wraparound=False, cdivision=True, language_level=3
+
+from __future__ import absolute_import
+
+from xpra.util import envint
+from xpra.log import Logger
+log = Logger("encoding", "content")
+
+from xpra.buffers.membuf cimport object_as_buffer
+
+from libc.stdint cimport uint8_t, uint32_t
+from libc.string cimport memset
+
+
+"""
+Classifies the contents of a screen update by sampling its pixels,
+so that text, user interface elements and pictures found in the same window
+can each use the most appropriate encoding.
+"""
+
+#maximum number of pixels we sample:
+MAX_SAMPLES = max(64, envint("XPRA_CLASSIFY_MAX_SAMPLES", 4096))
+#at least this percentage of smooth transitions with many colors is a picture:
+GRADIENT_PCT = envint("XPRA_CLASSIFY_GRADIENT_PCT", 25)
+PICTURE_COLORS = envint("XPRA_CLASSIFY_PICTURE_COLORS", 64)
+#sharp edges are text:
+TEXT_EDGE_PCT = envint("XPRA_CLASSIFY_TEXT_EDGE_PCT", 4)
+#large flat areas are user interface elements:
+UI_FLAT_PCT = envint("XPRA_CLASSIFY_UI_FLAT_PCT", 50)
+
+DEF MAX_COLORS = 256            #stop counting colors above this value
+DEF COLOR_SLOTS = 1024          #size of the color hash table, must be a power of 2
+DEF EDGE_DIFF = 96              #sum of the absolute channel differences for an edge
+DEF GRADIENT_DIFF = 24          #maximum sum of the absolute channel differences for a gradient
+cdef uint32_t EMPTY_SLOT = 0xffffffff
+cdef uint32_t HASH_MULT = 2654435761
+
+#the mask for the color channels, as read from memory using native (little endian) uint32 values:
+COLOR_MASKS = {
+    "BGRX"  : 0x00ffffff,
+    "BGRA"  : 0x00ffffff,
+    "RGBX"  : 0x00ffffff,
+    "RGBA"  : 0x00ffffff,
+    "XRGB"  : 0xffffff00,
+    "ARGB"  : 0xffffff00,
+    }
+
+
+cdef inline int absdiff(uint32_t a, uint32_t b) nogil:
+    if a>b:
+        return a-b
+    return b-a
+
+cdef inline int pixel_diff(uint32_t p1, uint32_t p2) nogil:
+    #sum of the absolute differences of all the channels,
+    #the alpha / padding channel has already been masked out
+    cdef int d = 0
+    cdef int i
+    for i in range(4):
+        d += absdiff((p1>>(i*8)) & 0xff, (p2>>(i*8)) & 0xff)
+    return d
+
+cdef inline int edge_type(int d) nogil:
+    if d==0:
+        return 0
+    if d<=GRADIENT_DIFF:
+        return 1
+    if d>=EDGE_DIFF:
+        return 2
+    return 3
+
+
+def get_pixel_stats(pixels, unsigned int width, unsigned int height, unsigned int rowstride, uint32_t mask=0x00ffffff, unsigned int max_samples=MAX_SAMPLES):
+    """
+        Samples the pixels on a regular grid and compares each sample with its right and bottom neighbours.
+        Returns the number of samples, the number of colors found (up to MAX_COLORS),
+        and the number of samples in flat areas, on sharp edges and on smooth gradients.
+        Only 32 bits per pixel formats are supported.
+    """
+    if width<2 or height<2:
+        return 0, 0, 0, 0, 0
+    cdef uint8_t *buf = NULL
+    cdef Py_ssize_t buf_len = 0
+    assert object_as_buffer(pixels, <const void**> &buf, &buf_len)==0
+    assert buf_len>=rowstride*(height-1)+width*4, "buffer length=%i is too small for %ix%i with rowstride %i" % (buf_len, width, height, rowstride)
+    assert rowstride>=width*4, "invalid rowstride %i for width %i" % (rowstride, width)
+    cdef unsigned int step = 1
+    while ((width-2)//step+1)*((height-2)//step+1)>max_samples:
+        step += 1
+    cdef uint32_t colors[COLOR_SLOTS]
+    memset(colors, 0xff, sizeof(colors))
+    cdef unsigned int samples = 0, ncolors = 0, flat = 0, edges = 0, gradients = 0
+    cdef unsigned int x, y, slot
+    cdef uint32_t p, right, below
+    cdef int t1, t2
+    cdef uint32_t *row
+    with nogil:
+        y = 0
+        while y<height-1:
+            row = <uint32_t*> (buf + y*rowstride)
+            x = 0
+            while x<width-1:
+                p = row[x] & mask
+                right = row[x+1] & mask
+                below = (<uint32_t*> (<uint8_t*> row + rowstride))[x] & mask
+                samples += 1
+                if ncolors<MAX_COLORS:
+                    slot = ((p*HASH_MULT) >> 22) & (COLOR_SLOTS-1)
+                    while colors[slot]!=EMPTY_SLOT and colors[slot]!=p:
+                        slot = (slot+1) & (COLOR_SLOTS-1)
+                    if colors[slot]==EMPTY_SLOT:
+                        colors[slot] = p
+                        ncolors += 1
+                t1 = edge_type(pixel_diff(p, right))
+                t2 = edge_type(pixel_diff(p, below))
+                if t1==0 and t2==0:
+                    flat += 1
+                elif t1==2 or t2==2:
+                    edges += 1
+                elif t1<=1 and t2<=1:
+                    gradients += 1
+                x += step
+            y += step
+    return samples, ncolors, flat, edges, gradients
+
+
+def classify_stats(unsigned int samples, unsigned int ncolors, unsigned int flat, unsigned int edges, unsigned int gradients):
+    """ returns "text", "ui", "picture" or an empty string if there isn't enough data """
+    if samples<16:
+        return ""
+    if gradients*100>=samples*GRADIENT_PCT and ncolors>=PICTURE_COLORS:
+        return "picture"
+    if edges*100>=samples*TEXT_EDGE_PCT:
+        return "text"
+    if flat*100>=samples*UI_FLAT_PCT:
+        return "ui"
+    if ncolors>=PICTURE_COLORS:
+        return "picture"
+    return "ui"
+
+
+def classify_image(image):
+    """
+        Returns the content type of the pixels in this image wrapper:
+        "text", "ui", "picture" or an empty string if we cannot tell.
+    """
+    mask = COLOR_MASKS.get(image.get_pixel_format())
+    if mask is None or image.get_bytesperpixel()!=4:
+        return ""
+    stats = get_pixel_stats(image.get_pixels(), image.get_width(), image.get_height(), image.get_rowstride(), mask)
+    content_type = classify_stats(*stats)
+    log("classify_image(%s) stats=%s, content-type=%s", image, stats, content_type)
+    return content_type
@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import sys
+import random
+from time import sleep
+from heapq import heappush, heappop
+
+from xpra.os_util import monotonic_time
+from xpra.util import typedict, envint
+from xpra.simple_stats import get_list_stats
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.buffers.membuf import get_xxh64           #@UnresolvedImport
+from xpra.server.window.window_video_source import WindowVideoSource
+from xpra.server.window.damage_trace import (
+    read_damage_trace, WINDOW, DAMAGE, FLAG_OR, FLAG_ALPHA, FLAG_TRAY,
+    )
+from xpra.log import Logger
+
+log = Logger("damage", "trace")
+
+#bytes added to each packet for the packet header and the other draw packet attributes:
+PACKET_OVERHEAD = envint("XPRA_REPLAY_PACKET_OVERHEAD", 64)
+#how long we wait for the pending packets to be acknowledged after the last event, in milliseconds:
+DRAIN_TIMEOUT = envint("XPRA_REPLAY_DRAIN_TIMEOUT", 5000)
+#how often we recalculate the batch delay, speed and quality, in milliseconds:
+#(same as ClientConnection)
+RECALCULATE_DELAY = 1000
+
+#same defaults as the python client:
+DELTA_BUCKETS = 64
+TILE_CACHE = 64
+TILE_CACHE_PIXELS = 8*1024*1024
+
+
+"""
+Replays a damage trace recorded with the server's "damage-trace" option
+through real WindowVideoSource instances,
+so that the effect of changes to the batching, encoding selection or encoders
+can be measured offline using production damage patterns.
+
+The windows return the pixels recorded in the trace,
+or deterministic synthetic pixels derived from the hash if only the hashes were recorded.
+(synthetic pixels reproduce the damage patterns and the repeated frames
+but not the compression ratios of the real contents)
+Everything runs in the main thread, which takes the place of the UI thread,
+the encode thread and the network layer.
+The client is modelled as a link with a fixed bandwidth and latency,
+which acknowledges each draw packet once it has been received and decoded.
+"""
+
+
+class ReplayLoop(object):
+    """
+        A minimal main loop with the same semantics as glib's idle_add and timeout_add:
+        callbacks are called again for as long as they return True.
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.cancelled = set()
+        self.counter = 0
+
+    def idle_add(self, fn, *args):
+        return self.timeout_add(0, fn, *args)
+
+    def timeout_add(self, delay, fn, *args):
+        self.counter += 1
+        heappush(self.timers, (monotonic_time()+delay/1000.0, self.counter, delay, fn, args))
+        return self.counter
+
+    def source_remove(self, tid):
+        self.cancelled.add(tid)
+
+    def run_until(self, deadline):
+        """ runs the timers which are due before the deadline, sleeping when needed """
+        while True:
+            timers = self.timers
+            if timers and timers[0][0]<=deadline:
+                due, tid, delay, fn, args = heappop(timers)
+                if tid in self.cancelled:
+                    self.cancelled.remove(tid)
+                    continue
+                wait = due-monotonic_time()
+                if wait>0:
+                    sleep(wait)
+                if fn(*args):
+                    heappush(timers, (monotonic_time()+delay/1000.0, tid, delay, fn, args))
+            else:
+                wait = deadline-monotonic_time()
+                if wait>0:
+                    sleep(wait)
+                return
+
+
+class ReplayWindow(object):
+    """
+        Stands in for the server window model,
+        the pixels come from the trace and are kept in a BGRX / BGRA framebuffer.
+    """
+
+    def __init__(self, wid, width, height, flags, content_type):
+        self.wid = wid
+        self.width = 0
+        self.height = 0
+        self.flags = flags
+        self.content_type = content_type
+        self.pixels = bytearray()
+        self.counter = 0
+        self.resize(width, height)
+
+    def __repr__(self):
+        return "ReplayWindow(%i : %ix%i)" % (self.wid, self.width, self.height)
+
+    def resize(self, width, height):
+        if (width, height)==(self.width, self.height):
+            return
+        pixels = bytearray(width*height*4)
+        #preserve the existing pixels:
+        cw = min(width, self.width)*4
+        for y in range(min(height, self.height)):
+            pixels[y*width*4:y*width*4+cw] = self.pixels[y*self.width*4:y*self.width*4+cw]
+        self.pixels = pixels
+        self.width = width
+        self.height = height
+
+    def update(self, x, y, w, h, pixels):
+        """ paint the pixels from the trace into our framebuffer """
+        x = max(0, x)
+        y = max(0, y)
+        w = min(w, self.width-x)
+        h = min(h, self.height-y)
+        if w<=0 or h<=0:
+            return
+        if isinstance(pixels, tuple):
+            rowstride, pixel_format, data = pixels
+            if len(pixel_format)==4 and rowstride>=w*4:
+                for row in range(h):
+                    pos = ((y+row)*self.width+x)*4
+                    self.pixels[pos:pos+w*4] = data[row*rowstride:row*rowstride+w*4]
+                return
+            #we can't use this pixel format directly,
+            #so use synthetic pixels instead:
+            pixels = get_xxh64(data)
+        if pixels is None:
+            #no pixel data recorded, every update is unique:
+            self.counter += 1
+            pixels = (self.wid<<32) + self.counter
+        #generate a deterministic pattern from the hash:
+        rng = random.Random(pixels)
+        block = bytes(bytearray(rng.getrandbits(8) for _ in range(256)))
+        pattern = block*(w*4//256+2)
+        for row in range(h):
+            pos = ((y+row)*self.width+x)*4
+            #shift each row so that they are not all identical:
+            shift = (row*4)%256
+            self.pixels[pos:pos+w*4] = pattern[shift:shift+w*4]
+
+
+    def get_image(self, x, y, width, height):
+        x = max(0, x)
+        y = max(0, y)
+        width = min(width, self.width-x)
+        height = min(height, self.height-y)
+        if width<=0 or height<=0:
+            return None
+        rowstride = self.width*4
+        rows = (self.pixels[(y+row)*rowstride+x*4:(y+row)*rowstride+(x+width)*4] for row in range(height))
+        data = b"".join(bytes(row) for row in rows)
+        if self.has_alpha():
+            return ImageWrapper(x, y, width, height, data, "BGRA", 32, width*4, 4)
+        return ImageWrapper(x, y, width, height, data, "BGRX", 24, width*4, 4)
+
+    def get_dimensions(self):
+        return self.width, self.height
+
+    def is_managed(self):
+        return True
+
+    def is_tray(self):
+        return bool(self.flags & FLAG_TRAY)
+
+    def is_OR(self):
+        return bool(self.flags & FLAG_OR)
+
+    def has_alpha(self):
+        return bool(self.flags & FLAG_ALPHA)
+
+    def is_shadow(self):
+        return False
+
+    def acknowledge_changes(self):
+        pass
+
+    def get_property_names(self):
+        return ("content-type", )
+
+    def get_dynamic_property_names(self):
+        return ()
+
+    def get_internal_property_names(self):
+        return ()
+
+    def get_property(self, prop):
+        if prop=="content-type":
+            return self.content_type
+        if prop=="depth":
+            return 32 if self.has_alpha() else 24
+        return None
+
+    def get(self, name, default_value=None):
+        v = self.get_property(name)
+        if v is None:
+            return default_value
+        return v
+
+    def connect(self, *_args):
+        return 0
+
+    def disconnect(self, *_args):
+        pass
+
+
+def get_packet_size(packet):
+    size = PACKET_OVERHEAD
+    for v in packet:
+        if isinstance(v, (list, tuple)):
+            #ie: scroll data
+            size += 24*len(v)
+        elif not isinstance(v, (int, float, dict, str)) and hasattr(v, "__len__"):
+            size += len(v)
+    return size
+
+
+class ReplayWindowSource(WindowVideoSource):
+    """
+        Records the damage time, the encoding time and the quality of each draw packet,
+        so the replay can calculate the latency when the packet is acknowledged.
+    """
+
+    def __init__(self, *args):
+        self.packet_times = {}
+        self.encoding_sequences = []
+        WindowVideoSource.__init__(self, *args)
+
+    def make_data_packet(self, damage_time, process_damage_time, image, coding, sequence, options, flush):
+        self.encoding_sequences = []
+        start = monotonic_time()
+        try:
+            return WindowVideoSource.make_data_packet(self, damage_time, process_damage_time, image, coding, sequence, options, flush)
+        finally:
+            #split the encoding time between the packets we have generated:
+            elapsed = monotonic_time()-start
+            sequences = self.encoding_sequences
+            for seq in sequences:
+                damage_time, _, quality = self.packet_times[seq]
+                self.packet_times[seq] = (damage_time, elapsed/len(sequences), quality)
+            self.encoding_sequences = []
+
+    def queue_damage_packet(self, packet, damage_time=0, process_damage_time=0, options={}):
+        sequence = packet[8]
+        #lossless encodings don't specify the quality:
+        quality = packet[10].get("quality", 100)
+        self.packet_times[sequence] = (damage_time, 0, quality)
+        self.encoding_sequences.append(sequence)
+        WindowVideoSource.queue_damage_packet(self, packet, damage_time, process_damage_time, options)
+
+
+class DamageReplay(object):
+
+    def __init__(self, filename, encoding="auto", latency=20, bandwidth=100*1000*1000, decode_speed=100, speed=1.0, batch_config=None):
+        self.filename = filename
+        self.encoding = encoding
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.decode_speed = decode_speed
+        self.speed = speed
+        self.batch_config = batch_config
+        self.loop = ReplayLoop()
+        self.windows = {}
+        self.window_sources = {}
+        self.encode_queue = []
+        self.encode_scheduled = False
+        self.link_free = 0
+        self.bytes_queued = 0
+        self.damage_events = 0
+        self.packets = []
+        self.duration = 0
+        self.statistics = None
+        self.encoding_server = None
+
+    def __repr__(self):
+        return "DamageReplay(%s)" % self.filename
+
+    def init_encodings(self):
+        from xpra.server.mixins.encoding_server import EncodingServer
+        from xpra.server.source.source_stats import GlobalPerformanceStatistics
+        es = EncodingServer()
+        es.encoding = self.encoding
+        es.init_encodings()
+        self.encoding_server = es
+        self.statistics = GlobalPerformanceStatistics()
+
+    def get_client_encoding_options(self):
+        from xpra.codecs.video_helper import getVideoHelper
+        from xpra.net.compression import use_lz4
+        core_encodings = self.encoding_server.core_encodings
+        return typedict({
+            "flush"             : True,
+            "client_options"    : True,
+            "csc_atoms"         : True,
+            "video_reinit"      : True,
+            "video_scaling"     : True,
+            "transparency"      : True,
+            "rgb_zlib"          : True,
+            "rgb_lz4"           : use_lz4,
+            "scrolling"         : True,
+            "scrolling.motion"  : True,
+            "supports_delta"    : tuple(x for x in ("png", "rgb24", "rgb32") if x in core_encodings),
+            "delta_buckets"     : DELTA_BUCKETS,
+            "tile_cache"        : TILE_CACHE,
+            "tile_cache.pixels" : TILE_CACHE_PIXELS,
+            "full_csc_modes"    : getVideoHelper().get_server_full_csc_modes_for_rgb("RGB", "RGBX", "RGBA"),
+            })
+
+    def make_window_source(self, window):
+        from xpra.server.window.batch_config import DamageBatchConfig
+        from xpra.codecs.video_helper import getVideoHelper
+        es = self.encoding_server
+        if self.batch_config:
+            batch_config = self.batch_config.clone()
+        else:
+            batch_config = DamageBatchConfig()
+        batch_config.wid = window.wid
+        ww, wh = window.get_dimensions()
+        encoding = self.encoding if self.encoding in es.encodings else "auto"
+        ws = ReplayWindowSource(
+                          self.loop.idle_add, self.loop.timeout_add, self.loop.source_remove,
+                          ww, wh,
+                          self.record_congestion_event, self.encode_queue_size, self.call_in_encode_thread, self.queue_packet, self.compressed_wrapper,
+                          self.statistics,
+                          window.wid, window, batch_config, 0,
+                          False, 0,
+                          getVideoHelper(),
+                          es.core_encodings, es.encodings,
+                          encoding, es.encodings, es.core_encodings, ["premult_argb32"], self.get_client_encoding_options(), typedict(),
+                          ("BGRX", "BGRA", "RGBX", "RGBA", "RGB", "BGR"),
+                          typedict(),
+                          None, 0, 0, 0)
+        return ws
+
+
+    def record_congestion_event(self, source, late_pct=0, send_speed=0):
+        log("congestion event: %s, late=%i%%, send speed=%i", source, late_pct, send_speed)
+
+    def compressed_wrapper(self, datatype, data, min_saving=128):
+        from xpra.net.compression import compressed_wrapper, Compressed
+        cw = compressed_wrapper(datatype, data, zlib=True, can_inline=False)
+        if len(cw)+min_saving<=len(data):
+            return cw
+        return Compressed("raw %s" % datatype, data, can_inline=True)
+
+    def encode_queue_size(self):
+        return len(self.encode_queue)
+
+    def call_in_encode_thread(self, _optional, fn, *args):
+        self.encode_queue.append((fn, args))
+        if not self.encode_scheduled:
+            self.encode_scheduled = True
+            self.loop.idle_add(self.process_encode_queue)
+
+    def process_encode_queue(self):
+        fn, args = self.encode_queue.pop(0)
+        try:
+            fn(*args)
+        except Exception:
+            log.error("Error during encoding:", exc_info=True)
+        self.encode_scheduled = len(self.encode_queue)>0
+        return self.encode_scheduled
+
+    def queue_packet(self, packet, wid=0, _pixels=0, start_send_cb=None, end_send_cb=None, _fail_cb=None, _wait_for_more=False):
+        """
+            Simulates sending the packet over a link with a fixed bandwidth,
+            the packets are sent one after the other.
+        """
+        size = get_packet_size(packet)
+        now = monotonic_time()
+        start = max(now, self.link_free)
+        end = start
+        if self.bandwidth>0:
+            end += size*8.0/self.bandwidth
+        self.link_free = end
+        sent = self.bytes_queued
+        self.bytes_queued += size
+        if start_send_cb:
+            self.loop.timeout_add((start-now)*1000, start_send_cb, sent)
+        if end_send_cb:
+            self.loop.timeout_add((end-now)*1000, end_send_cb, sent+size)
+        if packet[0]=="draw":
+            decode_time = 0
+            if self.decode_speed>0:
+                #in microseconds:
+                decode_time = int(packet[4]*packet[5]/self.decode_speed)
+            #the client sends the ack once the packet has been received and decoded:
+            self.loop.timeout_add((end-now)*1000+self.latency+decode_time/1000.0, self.ack_packet, packet, size, decode_time)
+
+    def ack_packet(self, packet, size, decode_time):
+        wid, _, _, width, height, coding = packet[1:7]
+        sequence = packet[8]
+        ws = self.window_sources.get(wid)
+        if not ws:
+            return
+        damage_time, encode_time, quality = ws.packet_times.pop(sequence, (0, 0, 100))
+        latency = 0
+        if damage_time>0:
+            latency = monotonic_time()-damage_time
+        self.packets.append((wid, coding, size, width*height, encode_time, latency, quality))
+        ws.damage_packet_acked(sequence, width, height, decode_time, "")
+
+    def recalculate_delays(self):
+        gs = self.statistics
+        gs.bytes_sent.append((monotonic_time(), self.bytes_queued))
+        gs.update_averages()
+        for ws in self.window_sources.values():
+            ws.statistics.update_averages()
+            ws.calculate_batch_delay(True, False, False)
+            ws.reconfigure()
+        return True
+
+
+    def is_idle(self):
+        if self.encode_queue:
+            return False
+        for ws in self.window_sources.values():
+            if ws._damage_delayed or ws.statistics.damage_ack_pending or ws.packet_times:
+                return False
+        return True
+
+    def run(self):
+        if not self.encoding_server:
+            self.init_encodings()
+        loop = self.loop
+        loop.timeout_add(RECALCULATE_DELAY, self.recalculate_delays)
+        start = monotonic_time()
+        for record in read_damage_trace(self.filename):
+            rtype, t, wid = record[:3]
+            loop.run_until(start+t/self.speed)
+            if rtype==WINDOW:
+                ww, wh, flags, content_type = record[3:]
+                window = self.windows.get(wid)
+                if window:
+                    window.resize(ww, wh)
+                    window.flags = flags
+                    window.content_type = content_type
+                else:
+                    window = ReplayWindow(wid, ww, wh, flags, content_type)
+                    self.windows[wid] = window
+                    self.window_sources[wid] = self.make_window_source(window)
+            elif rtype==DAMAGE:
+                window = self.windows.get(wid)
+                if not window:
+                    log.warn("Warning: damage event for unknown window %i", wid)
+                    continue
+                x, y, w, h, pixels = record[3:]
+                window.update(x, y, w, h, pixels)
+                self.damage_events += 1
+                self.window_sources[wid].damage(x, y, w, h, {"damage" : True})
+        #wait for the pending packets:
+        end = monotonic_time()
+        deadline = end+DRAIN_TIMEOUT/1000.0
+        while not self.is_idle() and monotonic_time()<deadline:
+            loop.run_until(monotonic_time()+0.01)
+        self.duration = monotonic_time()-start
+        for ws in self.window_sources.values():
+            ws.cleanup()
+        #run the cleanup callbacks:
+        loop.run_until(monotonic_time())
+        return self.get_results()
+
+
+    def get_results(self):
+        """
+            Summary of the replay: encode time and latency are in milliseconds,
+            the quality is weighted by the number of pixels.
+        """
+        def stats(values):
+            return get_list_stats(int(v*1000) for v in values)
+        packets = self.packets
+        pixels = sum(p[3] for p in packets)
+        encodings = {}
+        for coding in sorted(set(p[1] for p in packets)):
+            cpackets = tuple(p for p in packets if p[1]==coding)
+            encodings[coding] = {
+                "packets"   : len(cpackets),
+                "bytes"     : sum(p[2] for p in cpackets),
+                "pixels"    : sum(p[3] for p in cpackets),
+                "encode"    : stats(p[4] for p in cpackets),
+                }
+        return {
+            "duration"      : int(self.duration*1000),
+            "windows"       : len(self.windows),
+            "damage-events" : self.damage_events,
+            "packets"       : len(packets),
+            "bytes"         : sum(p[2] for p in packets),
+            "pixels"        : pixels,
+            "quality"       : sum(p[3]*p[6] for p in packets)//max(1, pixels),
+            "encode"        : stats(p[4] for p in packets),
+            "latency"       : stats(p[5] for p in packets),
+            "encoding"      : encodings,
+            }
+
+
+def main(argv):
+    from optparse import OptionParser
+    from xpra.platform import program_context
+    from xpra.util import print_nested_dict
+    from xpra.log import enable_color
+    parser = OptionParser(usage="%prog [options] TRACEFILE")
+    parser.add_option("--encoding", action="store", dest="encoding", default="auto",
+                      help="The encoding to use. Default: '%default'.")
+    parser.add_option("--latency", action="store", type="int", dest="latency", default=20,
+                      help="The round trip latency of the simulated client, in milliseconds. Default: %default.")
+    parser.add_option("--bandwidth", action="store", type="float", dest="bandwidth", default=100,
+                      help="The bandwidth of the simulated link in Mbps, 0 for unlimited. Default: %default.")
+    parser.add_option("--decode-speed", action="store", type="float", dest="decode_speed", default=100,
+                      help="The decoding speed of the simulated client in MPixels per second, 0 for instant. Default: %default.")
+    parser.add_option("--speed", action="store", type="float", dest="speed", default=1.0,
+                      help="Replay speed factor. Default: %default.")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+                      help="Show debug messages.")
+    options, args = parser.parse_args(argv[1:])
+    if len(args)!=1:
+        parser.error("specify a damage trace file")
+    with program_context("Damage Replay"):
+        enable_color()
+        if options.verbose:
+            log.enable_debug()
+        from xpra.codecs.loader import load_codecs
+        from xpra.codecs.video_helper import getVideoHelper, ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS
+        load_codecs(decoders=False)
+        vh = getVideoHelper()
+        vh.set_modules(ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS)
+        vh.init()
+        replay = DamageReplay(args[0], options.encoding, options.latency, int(options.bandwidth*1000*1000),
+                              options.decode_speed, max(0.01, options.speed))
+        results = replay.run()
+        print_nested_dict(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
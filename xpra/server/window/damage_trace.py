@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import zlib
+import struct
+
+from xpra.os_util import monotonic_time, memoryview_to_bytes, strtobytes, bytestostr, Queue
+from xpra.util import envint
+from xpra.make_thread import start_thread
+from xpra.buffers.membuf import get_xxh64           #@UnresolvedImport
+from xpra.log import Logger
+
+log = Logger("damage", "trace")
+
+#what we record for the damaged pixels: "none", "hash" or "raw"
+DAMAGE_TRACE_PIXELS = os.environ.get("XPRA_DAMAGE_TRACE_PIXELS", "hash")
+#in "hash" mode, only capture the pixels of each window this often, in milliseconds:
+#(the capture runs in the UI thread, the other damage events are recorded without pixels)
+DAMAGE_TRACE_HASH_INTERVAL = envint("XPRA_DAMAGE_TRACE_HASH_INTERVAL", 100)
+#stop recording when the file reaches this size, in MB:
+DAMAGE_TRACE_MAX_SIZE = envint("XPRA_DAMAGE_TRACE_MAX_SIZE", 1024)*1024*1024
+
+
+"""
+A damage trace is a compact binary file recording the damage events of all the windows,
+so that the exact same sequence can be replayed offline through the window sources,
+see damage_replay.
+
+The file starts with the magic string and a version byte,
+followed by a sequence of records, each one starting with:
+record type (byte), window id (uint32), time since the start of the recording in seconds (double)
+"window" records are written before the first damage event of each window,
+and whenever its size or attributes change: width, height (uint32), flags (byte),
+followed by the content-type as a length prefixed utf8 string.
+"damage" records contain: x, y (int32), width, height (uint32), pixel mode (byte),
+followed by the pixel data, which depends on the pixel mode:
+- none: nothing
+- hash: the xxh64 hash of the pixels (uint64)
+- raw: rowstride (uint32), the length prefixed pixel format, and the length prefixed zlib compressed pixels
+All values are little endian.
+"""
+MAGIC = b"xpra-damage-trace"
+VERSION = 1
+
+WINDOW = 1
+DAMAGE = 2
+
+FLAG_OR = 1
+FLAG_ALPHA = 2
+FLAG_TRAY = 4
+
+PIXELS_NONE = 0
+PIXELS_HASH = 1
+PIXELS_RAW = 2
+PIXEL_MODES = {
+    "none"  : PIXELS_NONE,
+    "hash"  : PIXELS_HASH,
+    "raw"   : PIXELS_RAW,
+    }
+
+RECORD_HEADER = struct.Struct("<BId")
+WINDOW_RECORD = struct.Struct("<IIB")
+DAMAGE_RECORD = struct.Struct("<iiIIB")
+HASH = struct.Struct("<Q")
+UINT32 = struct.Struct("<I")
+UINT16 = struct.Struct("<H")
+
+
+def pack_str(s):
+    b = strtobytes(s or "")
+    return UINT16.pack(len(b))+b
+
+def get_window_flags(window):
+    flags = 0
+    if window.is_OR():
+        flags |= FLAG_OR
+    if window.has_alpha():
+        flags |= FLAG_ALPHA
+    if window.is_tray():
+        flags |= FLAG_TRAY
+    return flags
+
+
+class DamageTraceRecorder(object):
+
+    def __init__(self, filename, pixels=DAMAGE_TRACE_PIXELS, max_size=DAMAGE_TRACE_MAX_SIZE,
+                 hash_interval=DAMAGE_TRACE_HASH_INTERVAL):
+        if pixels not in PIXEL_MODES:
+            raise ValueError("invalid damage trace pixel mode '%s', use: %s" % (pixels, ", ".join(PIXEL_MODES.keys())))
+        self.filename = filename
+        self.pixels = pixels
+        self.pixel_mode = PIXEL_MODES[pixels]
+        self.max_size = max_size
+        self.hash_interval = hash_interval/1000.0
+        self.start_time = monotonic_time()
+        self.windows = {}
+        #wid -> time of the last pixel capture:
+        self.last_capture = {}
+        self.records = 0
+        self.size = 0
+        self.file = None
+        self.queue = Queue()
+        self.thread = None
+
+    def __repr__(self):
+        return "DamageTraceRecorder(%s)" % self.filename
+
+    def start(self):
+        self.file = open(self.filename, "wb")
+        self.file.write(MAGIC+struct.pack("<B", VERSION))
+        self.size = len(MAGIC)+1
+        self.start_time = monotonic_time()
+        self.thread = start_thread(self.write_loop, "damage-trace", daemon=True)
+        log.info("recording damage events to '%s'", self.filename)
+        log.info(" with pixel mode '%s'", self.pixels)
+
+    def stop(self, timeout=5):
+        t = self.thread
+        if not t:
+            return
+        self.thread = None
+        self.queue.put(None)
+        if timeout>0:
+            t.join(timeout)
+        log.info("recorded %i damage trace records to '%s'", self.records, self.filename)
+
+
+    def get_info(self):
+        return {
+            "filename"  : self.filename,
+            "pixels"    : self.pixels,
+            "hash-interval" : int(self.hash_interval*1000),
+            "records"   : self.records,
+            "size"      : self.size,
+            "windows"   : len(self.windows),
+            }
+
+
+    def record(self, wid, window, x, y, w, h):
+        """
+            Called from the UI thread for each damage event,
+            the pixels are captured immediately (if needed)
+            but compressing and writing them to disk is done in the trace thread.
+        """
+        if not self.thread or w<=0 or h<=0:
+            return
+        now = monotonic_time()-self.start_time
+        ww, wh = window.get_dimensions()
+        flags = get_window_flags(window)
+        content_type = window.get("content-type") or ""
+        wattrs = (ww, wh, flags, content_type)
+        if self.windows.get(wid)!=wattrs:
+            self.windows[wid] = wattrs
+            data = RECORD_HEADER.pack(WINDOW, wid, now) + WINDOW_RECORD.pack(ww, wh, flags) + pack_str(content_type)
+            self.queue.put((data, None))
+        mode = self.pixel_mode
+        pixels = None
+        if mode==PIXELS_HASH:
+            #sample the pixels:
+            if now-self.last_capture.get(wid, -self.hash_interval)<self.hash_interval:
+                mode = PIXELS_NONE
+            else:
+                self.last_capture[wid] = now
+        if mode!=PIXELS_NONE:
+            pixels = self.capture_pixels(window, x, y, w, h)
+            if pixels is None:
+                mode = PIXELS_NONE
+        data = RECORD_HEADER.pack(DAMAGE, wid, now) + DAMAGE_RECORD.pack(x, y, w, h, mode)
+        if mode==PIXELS_HASH:
+            data += HASH.pack(pixels)
+            pixels = None
+        self.queue.put((data, pixels))
+
+    def capture_pixels(self, window, x, y, w, h):
+        image = window.get_image(x, y, w, h)
+        if image is None:
+            return None
+        try:
+            pixels = image.get_pixels()
+            if self.pixel_mode==PIXELS_HASH:
+                return get_xxh64(pixels)
+            #make a copy, the image buffer may be re-used:
+            return image.get_rowstride(), image.get_pixel_format(), memoryview_to_bytes(pixels)
+        finally:
+            image.free()
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data, pixels = item
+            if pixels is not None:
+                rowstride, pixel_format, raw = pixels
+                cdata = zlib.compress(raw, 1)
+                data += UINT32.pack(rowstride) + pack_str(pixel_format) + UINT32.pack(len(cdata)) + cdata
+            if self.size+len(data)>self.max_size:
+                log.warn("Warning: damage trace file '%s' is full", self.filename)
+                log.warn(" recording stopped after %i records", self.records)
+                break
+            try:
+                self.file.write(data)
+            except Exception as e:
+                log("write_loop()", exc_info=True)
+                log.error("Error writing to damage trace file '%s':", self.filename)
+                log.error(" %s", e)
+                break
+            self.size += len(data)
+            self.records += 1
+        self.thread = None
+        try:
+            self.file.close()
+        except (IOError, OSError):
+            log("failed to close %s", self.file, exc_info=True)
+
+
+def read_damage_trace(filename):
+    """
+        Generator which parses a damage trace file and yields the records as tuples:
+        (WINDOW, time, wid, width, height, flags, content_type)
+        (DAMAGE, time, wid, x, y, width, height, pixels)
+        where pixels is None, the hash of the pixels,
+        or a tuple with the rowstride, pixel format and the actual pixels.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("'%s' is not a damage trace file" % filename)
+    pos = len(MAGIC)
+    version = struct.unpack_from("<B", data, pos)[0]
+    if version!=VERSION:
+        raise ValueError("unsupported damage trace version %i" % version)
+    pos += 1
+    def read_str(pos):
+        l = UINT16.unpack_from(data, pos)[0]
+        pos += UINT16.size
+        return bytestostr(data[pos:pos+l]), pos+l
+    while pos<len(data):
+        rtype, wid, t = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        if rtype==WINDOW:
+            ww, wh, flags = WINDOW_RECORD.unpack_from(data, pos)
+            pos += WINDOW_RECORD.size
+            content_type, pos = read_str(pos)
+            yield WINDOW, t, wid, ww, wh, flags, content_type
+        elif rtype==DAMAGE:
+            x, y, w, h, mode = DAMAGE_RECORD.unpack_from(data, pos)
+            pos += DAMAGE_RECORD.size
+            pixels = None
+            if mode==PIXELS_HASH:
+                pixels = HASH.unpack_from(data, pos)[0]
+                pos += HASH.size
+            elif mode==PIXELS_RAW:
+                rowstride = UINT32.unpack_from(data, pos)[0]
+                pixel_format, pos = read_str(pos+UINT32.size)
+                l = UINT32.unpack_from(data, pos)[0]
+                pos += UINT32.size
+                pixels = rowstride, pixel_format, zlib.decompress(data[pos:pos+l])
+                pos += l
+            elif mode!=PIXELS_NONE:
+                raise ValueError("invalid pixel mode %i at offset %i" % (mode, pos))
+            yield DAMAGE, t, wid, x, y, w, h, pixels
+        else:
+            raise ValueError("invalid record type %i at offset %i" % (rtype, pos))
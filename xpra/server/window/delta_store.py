@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from threading import Lock
+from collections import OrderedDict
+
+from xpra.os_util import monotonic_time
+from xpra.util import envint
+from xpra.log import Logger
+
+log = Logger("delta")
+
+#memory budget for each window, in KB:
+DELTA_STORE_SIZE = envint("XPRA_DELTA_STORE_SIZE", 4096)*1024
+
+
+"""
+Tracks the pixel data the client holds in its delta buckets for a window.
+Entries are indexed by geometry (width, height, pixel format and encoding),
+and by the hash of their pixels within each geometry,
+so finding a reference frame does not require scanning all the buckets.
+The bucket numbers are the ones used in the "delta", "store" and "bucket" client options,
+they are allocated here and recycled in least-recently-used order
+when we run out of buckets or when the memory budget is exceeded.
+"""
+class DeltaStore(object):
+
+    def __init__(self, buckets, max_size=DELTA_STORE_SIZE):
+        self.buckets = buckets
+        self.max_size = max_size
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def __repr__(self):
+        return "DeltaStore(%i entries, %i bytes)" % (len(self.entries), self.size)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            #bucket -> entry, least recently used first:
+            self.entries = OrderedDict()
+            #geometry -> {hash : bucket}, least recently used first:
+            self.geometries = {}
+            self.size = 0
+
+    def can_store(self, size):
+        return self.buckets>0 and size<=self.max_size
+
+
+    def get(self, geometry, chash):
+        """
+            Returns the best reference entry for these pixels:
+            the one with identical contents if we have it,
+            otherwise the most recently used entry with the same geometry.
+            The entry is a list: [bucket, geometry, hash, sequence, pixels, hits, last used].
+        """
+        with self.lock:
+            hashes = self.geometries.get(geometry)
+            if not hashes:
+                self.misses += 1
+                return None
+            bucket = hashes.get(chash)
+            if bucket is None:
+                bucket = next(reversed(hashes.values()))
+            entry = self.entries[bucket]
+            self._touch(entry)
+            self.hits += 1
+            return entry
+
+    def _touch(self, entry):
+        bucket, geometry, chash = entry[:3]
+        self.entries[bucket] = self.entries.pop(bucket)
+        hashes = self.geometries[geometry]
+        hashes[chash] = hashes.pop(chash)
+        entry[6] = monotonic_time()
+
+    def add(self, geometry, chash, sequence, pixels, hits=0, bucket=-1):
+        """
+            Stores the pixels and returns the bucket the client must store them in.
+            The client stores the new pixels in the bucket it used as reference,
+            so the caller must specify this bucket if there was one.
+        """
+        size = len(pixels)
+        assert self.can_store(size), "cannot store %i bytes in %s" % (size, self)
+        with self.lock:
+            if bucket in self.entries:
+                self._remove(bucket)
+            other = self.geometries.get(geometry, {}).get(chash)
+            if other is not None:
+                #we only need one entry with these pixels:
+                self._remove(other)
+                if bucket<0:
+                    bucket = other
+            #evict until we have a free bucket and enough space:
+            while self.entries and (len(self.entries)>=self.buckets or self.size+size>self.max_size):
+                lru = next(iter(self.entries.keys()))
+                log("delta store: evicting bucket %i", lru)
+                self._remove(lru)
+                self.evictions += 1
+            if bucket<0:
+                used = set(self.entries.keys())
+                bucket = next(i for i in range(self.buckets) if i not in used)
+            self.entries[bucket] = [bucket, geometry, chash, sequence, pixels, hits, monotonic_time()]
+            self.geometries.setdefault(geometry, OrderedDict())[chash] = bucket
+            self.size += size
+            return bucket
+
+    def remove(self, bucket):
+        with self.lock:
+            if bucket in self.entries:
+                self._remove(bucket)
+
+    def _remove(self, bucket):
+        entry = self.entries.pop(bucket)
+        geometry, chash = entry[1:3]
+        hashes = self.geometries[geometry]
+        del hashes[chash]
+        if not hashes:
+            del self.geometries[geometry]
+        self.size -= len(entry[4])
+
+
+    def get_info(self):
+        now = monotonic_time()
+        buckets = {}
+        for bucket, entry in tuple(self.entries.items()):
+            _, geometry, _, sequence, pixels, hits, last_used = entry
+            w, h, pixel_format, coding = geometry
+            buckets[bucket] = w, h, pixel_format, coding, sequence, len(pixels), hits, int((now-last_used)*1000)
+        return {
+            "buckets"       : self.buckets,
+            "entries"       : len(self.entries),
+            "size"          : self.size,
+            "max-size"      : self.max_size,
+            "hits"          : self.hits,
+            "misses"        : self.misses,
+            "evictions"     : self.evictions,
+            "bucket"        : buckets,
+            }
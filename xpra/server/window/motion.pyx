@@ -14,7 +14,11 @@ import time
 import struct
 import collections
 
-from xpra.util import envbool, repr_ellipsized, csv
+from threading import Semaphore
+
+from xpra.util import envbool, envint, repr_ellipsized, csv
+from xpra.os_util import Queue, get_cpu_count
+from xpra.make_thread import start_thread
 from xpra.log import Logger
 log = Logger("encoding", "scroll")
 
@@ -23,15 +27,37 @@ from xpra.rectangle import rectangle
 
 
 cdef int DEBUG = envbool("XPRA_SCROLL_DEBUG", False)
+#keep a copy of the pixels so we can find blocks moving in any direction:
+MOTION_2D = envbool("XPRA_SCROLL_2D", True)
+#use multiple threads for checksumming large images:
+HASH_THREADS = max(1, envint("XPRA_SCROLL_HASH_THREADS", min(4, get_cpu_count())))
+#minimum number of bytes to checksum for each thread:
+HASH_MIN_SIZE = max(1, envint("XPRA_SCROLL_HASH_MIN_SIZE", 2*1024*1024))
 
 
-from libc.stdint cimport uint8_t, int16_t, uint16_t, int16_t, uint64_t, uintptr_t
+from libc.stdint cimport uint8_t, int16_t, uint16_t, int16_t, int32_t, uint32_t, uint64_t, uintptr_t
 from libc.stdlib cimport free, malloc
-from libc.string cimport memset, memcpy
+from libc.string cimport memset, memcpy, memcmp
 
 
 DEF MIN_LINE_COUNT = 5
 
+#2D motion detection:
+DEF PROBE_SIZE = 16             #number of pixels hashed for each probe
+DEF INDEX_ROW_STEP = 16         #only index every Nth row of the reference picture
+DEF PROBE_STEP = 32             #horizontal distance between probes in the new picture
+DEF MAX_PROBE_MATCHES = 4       #ignore probes matching too many locations (ie: repeated patterns)
+DEF TILE_SIZE = 16              #motion vectors are verified using tiles of this size
+DEF MAX_VECTORS = 4             #number of motion vectors we verify
+DEF MIN_VOTES = 4               #minimum number of probes matching a motion vector
+DEF VOTE_SLOTS = 4096
+cdef uint64_t HASH_MULT = 0x100000001b3
+
+#tile states:
+DEF TILE_REPAINT = 0
+DEF TILE_UNCHANGED = 1
+#values above this are motion vector indexes + 2
+
 DEF MAXINT64 = 2**63
 DEF MAXUINT64 = 2**64
 DEF MASK64 = 2**64-1
@@ -52,6 +78,155 @@ cdef dd(uint16_t *d, uint16_t l):
 assert sizeof(uint64_t)==64//8, "uint64_t is not 64-bit: %i!" % sizeof(uint64_t)
 
 
+cdef inline uint64_t probe_hash(const uint32_t *p) nogil:
+    cdef uint64_t hv = 0
+    cdef int i
+    for i in range(PROBE_SIZE):
+        hv = hv*HASH_MULT + p[i]
+    return hv
+
+cdef inline int is_uniform(const uint32_t *p) nogil:
+    #cheap test to skip blank areas, which would match everywhere:
+    return p[0]==p[PROBE_SIZE-1] and p[0]==p[PROBE_SIZE//2]
+
+cdef inline int MIN(int a, int b) nogil:
+    if a<=b:
+        return a
+    return b
+
+cdef int best_votes(uint64_t *vote_keys, uint32_t *votes, int32_t *vx, int32_t *vy) nogil:
+    cdef uint32_t best[MAX_VECTORS]
+    cdef int n = 0, i, j
+    cdef uint32_t slot
+    for slot in range(VOTE_SLOTS):
+        if votes[slot]<MIN_VOTES:
+            continue
+        #insertion sort into the best vectors:
+        i = n
+        if i==MAX_VECTORS:
+            if votes[slot]<=best[MAX_VECTORS-1]:
+                continue
+            i = MAX_VECTORS-1
+        else:
+            n += 1
+        while i>0 and best[i-1]<votes[slot]:
+            best[i] = best[i-1]
+            vx[i] = vx[i-1]
+            vy[i] = vy[i-1]
+            i -= 1
+        best[i] = votes[slot]
+        vx[i] = <int32_t> (vote_keys[slot] & 0xffff) - 0x8000
+        vy[i] = <int32_t> ((vote_keys[slot]>>16) & 0xffff) - 0x8000
+    return n
+
+cdef merge_tiles(uint8_t *tiles, int tiles_x, int tiles_y, int width, int height):
+    """
+        Merges the tiles into rectangles:
+        first the horizontal runs of tiles with the same state,
+        then the runs with identical extents on consecutive rows.
+        Returns a list of (state, (x, y, w, h))
+    """
+    cdef int tx, ty, start
+    cdef uint8_t state
+    rects = []
+    current = {}
+    for ty in range(tiles_y):
+        runs = {}
+        tx = 0
+        while tx<tiles_x:
+            state = tiles[ty*tiles_x+tx]
+            start = tx
+            while tx<tiles_x and tiles[ty*tiles_x+tx]==state:
+                tx += 1
+            key = (state, start, tx)
+            runs[key] = current.pop(key, ty)
+        #close the runs which did not continue on this row:
+        for key, y in current.items():
+            rects.append((key[0], tile_rect(key[1], y, key[2], ty, width, height)))
+        current = runs
+    for key, y in current.items():
+        rects.append((key[0], tile_rect(key[1], y, key[2], tiles_y, width, height)))
+    return rects
+
+cdef tile_rect(int tx1, int ty1, int tx2, int ty2, int width, int height):
+    cdef int x = tx1*TILE_SIZE
+    cdef int y = ty1*TILE_SIZE
+    return x, y, MIN(tx2*TILE_SIZE, width)-x, MIN(ty2*TILE_SIZE, height)-y
+
+
+cdef void hash_rows(uint64_t *a, uint8_t *buf, size_t rowstride, size_t row_len, int start, int end,
+                    uint8_t *dirty, uint8_t *copy, uint8_t *copy_rows) nogil:
+    """
+        Checksum the rows (all of them, or only the ones marked as dirty),
+        and copy them to the pixel buffer if we have one (all of them, or only the ones marked in copy_rows).
+    """
+    cdef int i
+    for i in range(start, end):
+        if dirty==NULL or dirty[i]:
+            a[i] = <uint64_t> xxh64(buf+i*rowstride, row_len, 0)
+        if copy!=NULL and (copy_rows==NULL or copy_rows[i]):
+            memcpy(copy+i*row_len, buf+i*rowstride, row_len)
+
+def _hash_rows(uintptr_t a, uintptr_t buf, size_t rowstride, size_t row_len, int start, int end,
+               uintptr_t dirty, uintptr_t copy, uintptr_t copy_rows):
+    with nogil:
+        hash_rows(<uint64_t*> a, <uint8_t*> buf, rowstride, row_len, start, end,
+                  <uint8_t*> dirty, <uint8_t*> copy, <uint8_t*> copy_rows)
+
+
+class HashThreads(object):
+    """
+        Worker threads used for checksumming the rows of large images,
+        the checksums are calculated without holding the GIL.
+    """
+    def __init__(self, count):
+        self.queue = Queue()
+        self.threads = [start_thread(self.run, "scroll-hash-%i" % i, daemon=True) for i in range(count)]
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            done, args = item
+            try:
+                _hash_rows(*args)
+            except Exception:
+                log.error("Error calculating row checksums", exc_info=True)
+            finally:
+                done.release()
+
+hash_threads = None
+def get_hash_threads():
+    global hash_threads
+    if hash_threads is None:
+        hash_threads = HashThreads(HASH_THREADS-1)
+    return hash_threads
+
+cdef hash_rows_threaded(uint64_t *a, uint8_t *buf, size_t rowstride, size_t row_len, int height,
+                        uint8_t *dirty, uint8_t *copy, uint8_t *copy_rows):
+    """
+        Splits large images into chunks of rows
+        which are hashed in parallel by the hash threads and the current thread.
+    """
+    cdef int n = MIN(HASH_THREADS, row_len*height//HASH_MIN_SIZE)
+    if n<=1:
+        with nogil:
+            hash_rows(a, buf, rowstride, row_len, 0, height, dirty, copy, copy_rows)
+        return
+    threads = get_hash_threads()
+    done = Semaphore(0)
+    cdef int chunk = (height+n-1)//n
+    cdef int i
+    for i in range(1, n):
+        threads.queue.put((done, (<uintptr_t> a, <uintptr_t> buf, rowstride, row_len, i*chunk, MIN(height, (i+1)*chunk),
+                                  <uintptr_t> dirty, <uintptr_t> copy, <uintptr_t> copy_rows)))
+    with nogil:
+        hash_rows(a, buf, rowstride, row_len, 0, chunk, dirty, copy, copy_rows)
+    for i in range(1, n):
+        done.acquire()
+
+
 cdef class ScrollData:
 
     cdef object __weakref__
@@ -59,6 +234,10 @@ cdef class ScrollData:
     cdef uint16_t *distances
     cdef uint64_t *a1        #checksums of reference picture
     cdef uint64_t *a2        #checksums of latest picture
+    cdef uint8_t *p1         #pixels of reference picture (for 2D motion)
+    cdef uint8_t *p2         #pixels of latest picture (for 2D motion)
+    cdef uint8_t *dirty      #rows checksummed by the last update, NULL if all of them
+    cdef uint8_t bpp
     cdef uint8_t matched
     cdef int16_t x
     cdef int16_t y
@@ -89,15 +268,21 @@ cdef class ScrollData:
         for i,v in enumerate(arr):
             self.a2[i] = <uint64_t> abs(v)
 
-    def update(self, pixels, int16_t x, int16_t y, uint16_t width, uint16_t height, uint16_t rowstride, uint8_t bpp=4):
+    def update(self, pixels, int16_t x, int16_t y, uint16_t width, uint16_t height, uint16_t rowstride, uint8_t bpp=4, damage=None):
         """
             Add a new image to compare with,
             checksum its rows into a2,
             and push existing values (if we had any) into a1.
+            If specified, damage is the list of rectangles (in window coordinates)
+            which may have changed since the previous image,
+            and only the rows they intersect will be checksummed again.
         """
         if DEBUG:
-            log("%s.update%s a1=%#x, a2=%#x, distances=%#x, current size: %ix%i", self, (repr_ellipsized(pixels), x, y, width, height, rowstride, bpp), <uintptr_t> self.a1, <uintptr_t> self.a2, <uintptr_t> self.distances, self.width, self.height)
+            log("%s.update%s a1=%#x, a2=%#x, distances=%#x, current size: %ix%i", self, (repr_ellipsized(pixels), x, y, width, height, rowstride, bpp, damage), <uintptr_t> self.a1, <uintptr_t> self.a2, <uintptr_t> self.distances, self.width, self.height)
         assert width>0 and height>0, "invalid dimensions: %ix%i" % (width, height)
+        #we can only re-use the existing checksums if the area has not changed:
+        if x!=self.x or y!=self.y or self.a2==NULL:
+            damage = None
         #this is a new picture, shift a2 into a1 if we have it:
         if self.a1:
             free(self.a1)
@@ -114,11 +299,21 @@ cdef class ScrollData:
             if self.a1:
                 free(self.a1)
                 self.a1 = NULL
+            if self.p1:
+                free(self.p1)
+                self.p1 = NULL
+            if self.p2:
+                free(self.p2)
+                self.p2 = NULL
+            if self.dirty:
+                free(self.dirty)
+                self.dirty = NULL
             if self.distances:
                 free(self.distances)
                 self.distances = NULL
             self.width = width
             self.height = height
+            damage = None
         #allocate new checksum array:
         assert self.a2==NULL
         cdef size_t asize = height*(sizeof(uint64_t))
@@ -133,12 +328,57 @@ cdef class ScrollData:
         cdef size_t row_len = width*bpp
         assert row_len<=rowstride, "invalid row length: %ix%i=%i but rowstride is %i" % (width, bpp, width*bpp, rowstride)
         cdef uint64_t *a2 = self.a2
-        cdef unsigned long long seed = 0
         cdef uint16_t i
-        with nogil:
-            for i in range(height):
-                a2[i] = <uint64_t> xxh64(buf, row_len, seed)
-                buf += rowstride
+        cdef uint8_t *pixcopy = NULL
+        if MOTION_2D and bpp==4:
+            #recycle the reference picture buffer:
+            pixcopy = self.p1
+            self.p1 = self.p2
+            self.p2 = NULL
+            if pixcopy==NULL:
+                pixcopy = <uint8_t*> memalign(row_len*height)
+                assert pixcopy!=NULL, "pixel copy memory allocation failed"
+            self.p2 = pixcopy
+        elif self.p1 or self.p2:
+            free(self.p1)
+            free(self.p2)
+            self.p1 = NULL
+            self.p2 = NULL
+        self.bpp = bpp
+        cdef uint8_t *dirty = NULL
+        cdef uint8_t *copy_rows = NULL
+        cdef int start, end
+        if damage is not None:
+            #start from the previous checksums,
+            #and only mark the rows which may have changed:
+            dirty = <uint8_t*> malloc(height)
+            assert dirty!=NULL, "row state memory allocation failed"
+            memcpy(a2, self.a1, asize)
+            with nogil:
+                for i in range(height):
+                    #also rehash invalidated rows:
+                    dirty[i] = a2[i]==0
+            for dx, dy, dw, dh in damage:
+                if dx>=x+width or dx+dw<=x:
+                    continue
+                start = max(0, dy-y)
+                end = min(height, dy+dh-y)
+                if end>start:
+                    memset(dirty+start, 1, end-start)
+            if pixcopy!=NULL and self.dirty!=NULL:
+                #the recycled pixel buffer holds the picture from two updates ago,
+                #so we also need to copy the rows which changed in the previous update:
+                copy_rows = <uint8_t*> malloc(height)
+                assert copy_rows!=NULL, "row state memory allocation failed"
+                with nogil:
+                    for i in range(height):
+                        copy_rows[i] = dirty[i] | self.dirty[i]
+        try:
+            hash_rows_threaded(a2, buf, rowstride, row_len, height, dirty, pixcopy, copy_rows)
+        finally:
+            free(copy_rows)
+            free(self.dirty)
+            self.dirty = dirty
 
     def calculate(self, uint16_t max_distance=1000):
         """
@@ -347,6 +587,209 @@ cdef class ScrollData:
             self.a2 = NULL
 
 
+    def calculate_motion(self, int max_distance=1000):
+        """
+            Find the blocks of pixels which have moved from the reference picture
+            to the latest one, in any direction.
+            This requires a copy of both pictures, and only works with 32-bit pixels.
+            Returns a list of copy instructions: (x, y, w, h, xdelta, ydelta),
+            where x, y, w and h define the source area in the reference picture,
+            and a list of rectangles (x, y, w, h) which must be repainted.
+            The areas which have not changed are not included in either list.
+        """
+        if self.a1==NULL or self.a2==NULL or self.p1==NULL or self.p2==NULL or self.bpp!=4:
+            return None
+        cdef int width = self.width
+        cdef int height = self.height
+        if width<PROBE_SIZE or height<TILE_SIZE:
+            return None
+        cdef int32_t vx[MAX_VECTORS]
+        cdef int32_t vy[MAX_VECTORS]
+        cdef int nvectors = self.find_motion_vectors(max_distance, vx, vy)
+        if DEBUG:
+            log("calculate_motion(%i) found %i vectors: %s", max_distance, nvectors, [(vx[i], vy[i]) for i in range(nvectors)])
+        if nvectors==0:
+            return None
+        #assign each tile to a motion vector, or mark it as unchanged or to repaint:
+        cdef int tiles_x = (width+TILE_SIZE-1)//TILE_SIZE
+        cdef int tiles_y = (height+TILE_SIZE-1)//TILE_SIZE
+        cdef uint8_t *tiles = <uint8_t*> malloc(tiles_x*tiles_y)
+        assert tiles!=NULL, "tile map memory allocation failed"
+        cdef int tx, ty, tw, th, v, moved = 0
+        try:
+            with nogil:
+                for ty in range(tiles_y):
+                    th = MIN(TILE_SIZE, height-ty*TILE_SIZE)
+                    for tx in range(tiles_x):
+                        tw = MIN(TILE_SIZE, width-tx*TILE_SIZE)
+                        if self.tile_match(tx*TILE_SIZE, ty*TILE_SIZE, tw, th, 0, 0):
+                            tiles[ty*tiles_x+tx] = TILE_UNCHANGED
+                            continue
+                        tiles[ty*tiles_x+tx] = TILE_REPAINT
+                        for v in range(nvectors):
+                            if self.tile_match(tx*TILE_SIZE, ty*TILE_SIZE, tw, th, vx[v], vy[v]):
+                                tiles[ty*tiles_x+tx] = 2+v
+                                moved += 1
+                                break
+            if moved==0:
+                return None
+            rects = merge_tiles(tiles, tiles_x, tiles_y, width, height)
+        finally:
+            free(tiles)
+        copies = []
+        repaint = []
+        for state, rect in rects:
+            x, y, w, h = rect
+            if state==TILE_REPAINT:
+                repaint.append(rect)
+            elif state>TILE_UNCHANGED:
+                v = state-2
+                copies.append((x-vx[v], y-vy[v], w, h, vx[v], vy[v]))
+        return copies, repaint
+
+    cdef int tile_match(self, int x, int y, int w, int h, int dx, int dy) nogil:
+        """
+            Is the tile at x, y in the latest picture identical
+            to the one at x-dx, y-dy in the reference picture?
+            (rows which have been invalidated cannot be used as source)
+        """
+        cdef int sx = x-dx
+        cdef int sy = y-dy
+        if sx<0 or sy<0 or sx+w>self.width or sy+h>self.height:
+            return 0
+        cdef int row_len = self.width*4
+        cdef int i
+        for i in range(h):
+            if self.a1[sy+i]==0:
+                return 0
+            if memcmp(self.p2+(y+i)*row_len+x*4, self.p1+(sy+i)*row_len+sx*4, w*4)!=0:
+                return 0
+        return 1
+
+    cdef int find_motion_vectors(self, int max_distance, int32_t *vx, int32_t *vy):
+        """
+            Index the hash of every run of PROBE_SIZE pixels
+            found on every INDEX_ROW_STEP row of the reference picture,
+            then lookup probes from the latest picture in this index,
+            each match is a vote for the motion vector between the two locations.
+            Returns the number of vectors found, the best ones first.
+        """
+        cdef int width = self.width
+        cdef int height = self.height
+        cdef int positions = width-PROBE_SIZE+1
+        cdef int entries = positions*((height+INDEX_ROW_STEP-1)//INDEX_ROW_STEP)
+        cdef uint32_t slots = 1024
+        while slots<entries*2:
+            slots *= 2
+        cdef uint64_t *keys = <uint64_t*> malloc(slots*sizeof(uint64_t))
+        cdef int32_t *locations = <int32_t*> malloc(slots*sizeof(int32_t))
+        cdef uint64_t *vote_keys = <uint64_t*> malloc(VOTE_SLOTS*sizeof(uint64_t))
+        cdef uint32_t *votes = <uint32_t*> malloc(VOTE_SLOTS*sizeof(uint32_t))
+        cdef int nvectors = 0
+        try:
+            assert keys!=NULL and locations!=NULL and vote_keys!=NULL and votes!=NULL, "motion index memory allocation failed"
+            with nogil:
+                memset(locations, 0xff, slots*sizeof(int32_t))
+                memset(votes, 0, VOTE_SLOTS*sizeof(uint32_t))
+                self.index_reference(keys, locations, slots)
+                self.vote(keys, locations, slots, vote_keys, votes, max_distance)
+                nvectors = best_votes(vote_keys, votes, vx, vy)
+        finally:
+            free(keys)
+            free(locations)
+            free(vote_keys)
+            free(votes)
+        return nvectors
+
+    cdef void index_reference(self, uint64_t *keys, int32_t *locations, uint32_t slots) nogil:
+        cdef int width = self.width
+        cdef uint64_t pow_mult = 1
+        cdef int i, x, y
+        for i in range(PROBE_SIZE-1):
+            pow_mult *= HASH_MULT
+        cdef uint32_t *row
+        cdef uint64_t hv
+        cdef uint32_t slot
+        for y in range(0, self.height, INDEX_ROW_STEP):
+            if self.a1[y]==0:
+                continue
+            row = <uint32_t*> (self.p1+y*width*4)
+            hv = probe_hash(row)
+            for x in range(width-PROBE_SIZE+1):
+                if x>0:
+                    #rolling hash:
+                    hv = (hv-row[x-1]*pow_mult)*HASH_MULT + row[x+PROBE_SIZE-1]
+                if is_uniform(row+x):
+                    continue
+                slot = <uint32_t> (hv & (slots-1))
+                while locations[slot]>=0:
+                    slot = (slot+1) & (slots-1)
+                keys[slot] = hv
+                locations[slot] = y*width+x
+
+    cdef void vote(self, uint64_t *keys, int32_t *locations, uint32_t slots,
+                   uint64_t *vote_keys, uint32_t *votes, int max_distance) nogil:
+        cdef int width = self.width
+        cdef int x, y, ox, oy, dx, dy, n, i
+        cdef int nvectors = 0
+        cdef uint32_t *row
+        cdef uint32_t *orow
+        cdef uint64_t hv, vkey
+        cdef uint32_t slot, vslot
+        cdef int32_t matches[MAX_PROBE_MATCHES]
+        for y in range(self.height):
+            if self.a2[y]==self.a1[y]:
+                #this row has not changed
+                continue
+            row = <uint32_t*> (self.p2+y*width*4)
+            for x in range(0, width-PROBE_SIZE+1, PROBE_STEP):
+                if is_uniform(row+x):
+                    continue
+                hv = probe_hash(row+x)
+                slot = <uint32_t> (hv & (slots-1))
+                n = 0
+                while locations[slot]>=0 and n<=MAX_PROBE_MATCHES:
+                    if keys[slot]==hv:
+                        if n<MAX_PROBE_MATCHES:
+                            matches[n] = locations[slot]
+                        n += 1
+                    slot = (slot+1) & (slots-1)
+                if n==0 or n>MAX_PROBE_MATCHES:
+                    continue
+                for i in range(n):
+                    ox = matches[i] % width
+                    oy = matches[i] // width
+                    dx = x-ox
+                    dy = y-oy
+                    if (dx==0 and dy==0) or dx>max_distance or dx<-max_distance or dy>max_distance or dy<-max_distance:
+                        continue
+                    orow = <uint32_t*> (self.p1+oy*width*4)
+                    if memcmp(row+x, orow+ox, PROBE_SIZE*4)!=0:
+                        #hash collision
+                        continue
+                    vkey = ((<uint64_t> (dy+0x8000))<<16) | (<uint64_t> (dx+0x8000))
+                    vslot = <uint32_t> ((vkey*HASH_MULT)>>52) & (VOTE_SLOTS-1)
+                    while votes[vslot]>0 and vote_keys[vslot]!=vkey:
+                        vslot = (vslot+1) & (VOTE_SLOTS-1)
+                    if votes[vslot]==0:
+                        if nvectors>=VOTE_SLOTS//2:
+                            #too many different vectors, keep the ones we have:
+                            continue
+                        nvectors += 1
+                        vote_keys[vslot] = vkey
+                    votes[vslot] += 1
+
+    def get_changed_lines(self):
+        """ the number of lines which differ between the two pictures """
+        if self.a1==NULL or self.a2==NULL:
+            return 0
+        cdef uint16_t changed = 0
+        cdef uint16_t i
+        for i in range(self.height):
+            if self.a1[i]!=self.a2[i]:
+                changed += 1
+        return changed
+
     def get_best_match(self):
         if self.a1==NULL or self.a2==NULL:
             return 0, 0
@@ -376,3 +819,15 @@ cdef class ScrollData:
         if ptr:
             self.a2 = NULL
             free(ptr)
+        ptr = <void*> self.p1
+        if ptr:
+            self.p1 = NULL
+            free(ptr)
+        ptr = <void*> self.p2
+        if ptr:
+            self.p2 = NULL
+            free(ptr)
+        ptr = <void*> self.dirty
+        if ptr:
+            self.dirty = NULL
+            free(ptr)
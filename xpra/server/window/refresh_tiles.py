@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from threading import Lock
+
+from xpra.rectangle import rectangle   #@UnresolvedImport
+
+
+"""
+Tracks which parts of a window are lossy on the client,
+using one byte per tile of a fixed size grid aligned on the window's origin.
+A tile is marked as soon as any of its pixels are painted with a lossy update,
+and it is only cleared when a lossless update covers it completely,
+so the refresh never misses any lossy pixels but does not resend the tiles which are already sharp.
+The tiles are updated from the network thread and consumed from the UI thread.
+"""
+class RefreshTiles(object):
+
+    def __init__(self, width, height, tile_size=64):
+        self.tile_size = tile_size
+        self.lock = Lock()
+        self.resize(width, height)
+
+    def __repr__(self):
+        return "RefreshTiles(%i of %ix%i tiles)" % (self.count, self.tiles_x, self.tiles_y)
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count>0
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(self.get_rectangles())
+
+    def resize(self, width, height):
+        ts = self.tile_size
+        with self.lock:
+            self.width = width
+            self.height = height
+            self.tiles_x = (width+ts-1)//ts
+            self.tiles_y = (height+ts-1)//ts
+            self.bitmap = bytearray(self.tiles_x*self.tiles_y)
+            self.count = 0
+            #where the next refresh should start from,
+            #so a small budget still gets to refresh all the tiles in turn:
+            self.next_tile = 0
+
+    def clear(self):
+        with self.lock:
+            self.bitmap = bytearray(self.tiles_x*self.tiles_y)
+            self.count = 0
+
+
+    def get_tile_rect(self, tx, ty):
+        ts = self.tile_size
+        return rectangle(tx*ts, ty*ts, min(ts, self.width-tx*ts), min(ts, self.height-ty*ts))
+
+    def get_tile_range(self, rect, inside=False):
+        """
+            The range of tiles intersecting with this rectangle,
+            or fully contained within it when 'inside' is set.
+            (tiles at the right and bottom edge of the window may be smaller)
+        """
+        ts = self.tile_size
+        x1 = max(0, rect.x)
+        y1 = max(0, rect.y)
+        x2 = min(self.width, rect.x+rect.width)
+        y2 = min(self.height, rect.y+rect.height)
+        if x2<=x1 or y2<=y1:
+            return 0, 0, 0, 0
+        if not inside:
+            return x1//ts, y1//ts, (x2+ts-1)//ts, (y2+ts-1)//ts
+        tx2 = x2//ts if x2<self.width else self.tiles_x
+        ty2 = y2//ts if y2<self.height else self.tiles_y
+        return (x1+ts-1)//ts, (y1+ts-1)//ts, tx2, ty2
+
+    def add(self, rect):
+        """
+            Marks the tiles covered by this lossy update,
+            returns the number of pixels of the update within the window,
+            (even if the tiles were already marked: the area is still changing)
+        """
+        tx1, ty1, tx2, ty2 = self.get_tile_range(rect)
+        with self.lock:
+            bitmap = self.bitmap
+            for ty in range(ty1, ty2):
+                for tx in range(tx1, tx2):
+                    i = ty*self.tiles_x+tx
+                    if not bitmap[i]:
+                        bitmap[i] = 1
+                        self.count += 1
+        w = min(self.width, rect.x+rect.width)-max(0, rect.x)
+        h = min(self.height, rect.y+rect.height)-max(0, rect.y)
+        return max(0, w)*max(0, h)
+
+    def remove(self, rect):
+        """ clears the tiles fully covered by this lossless update """
+        tx1, ty1, tx2, ty2 = self.get_tile_range(rect, True)
+        with self.lock:
+            bitmap = self.bitmap
+            for ty in range(ty1, ty2):
+                for tx in range(tx1, tx2):
+                    i = ty*self.tiles_x+tx
+                    if bitmap[i]:
+                        bitmap[i] = 0
+                        self.count -= 1
+
+    def get_pixel_count(self):
+        ts = self.tile_size
+        #close enough: the tiles on the edges may be smaller
+        return min(self.count*ts*ts, self.width*self.height)
+
+    def get_rectangles(self):
+        with self.lock:
+            return self.merge_rows(range(len(self.bitmap)))
+
+    def merge_rows(self, indexes):
+        #merge the marked tiles horizontally:
+        rects = []
+        tiles_x = self.tiles_x
+        ts = self.tile_size
+        run_start = run_row = -1
+        run_end = 0
+        for i in indexes:
+            if not self.bitmap[i]:
+                continue
+            ty, tx = divmod(i, tiles_x)
+            if ty==run_row and tx==run_end:
+                run_end += 1
+                continue
+            if run_row>=0:
+                rects.append(self.get_run_rect(run_start, run_end, run_row, ts))
+            run_start, run_end, run_row = tx, tx+1, ty
+        if run_row>=0:
+            rects.append(self.get_run_rect(run_start, run_end, run_row, ts))
+        return rects
+
+    def get_run_rect(self, tx1, tx2, ty, ts):
+        x = tx1*ts
+        y = ty*ts
+        return rectangle(x, y, min(tx2*ts, self.width)-x, min(ts, self.height-y))
+
+    def take(self, max_pixels):
+        """
+            Clears and returns the rectangles for up to 'max_pixels' worth of tiles
+            (always at least one tile), starting from where the last call stopped.
+        """
+        with self.lock:
+            n = len(self.bitmap)
+            if not self.count or not n:
+                return []
+            ts = self.tile_size
+            taken = []
+            pixels = 0
+            start = self.next_tile % n
+            i = start
+            for j in range(n):
+                i = (start+j) % n
+                if not self.bitmap[i]:
+                    continue
+                if taken and pixels+ts*ts>max_pixels:
+                    break
+                taken.append(i)
+                pixels += ts*ts
+            else:
+                i = start
+            self.next_tile = i
+            #merge before clearing the bitmap:
+            rects = self.merge_rows(sorted(taken))
+            for i in taken:
+                self.bitmap[i] = 0
+            self.count -= len(taken)
+            return rects
+
+    def get_info(self):
+        return {
+            "tile-size" : self.tile_size,
+            "tiles"     : self.count,
+            "grid"      : (self.tiles_x, self.tiles_y),
+            }
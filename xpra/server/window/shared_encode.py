@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from threading import Lock, Event
+from collections import OrderedDict
+
+from xpra.os_util import monotonic_time
+from xpra.util import envint
+from xpra.log import Logger
+
+log = Logger("encoding", "sharing")
+
+SHARED_ENCODE_CACHE_SIZE = envint("XPRA_SHARED_ENCODE_CACHE_SIZE", 64)*1024*1024
+SHARED_ENCODE_EXPIRY = envint("XPRA_SHARED_ENCODE_EXPIRY", 2000)
+#how long to wait for another window source to finish encoding the same pixels, in milliseconds:
+SHARED_ENCODE_WAIT = envint("XPRA_SHARED_ENCODE_WAIT", 1000)
+
+#only stateless picture encodings can be shared,
+#video encoders maintain a stream state for each client:
+SHARED_ENCODINGS = ("rgb24", "rgb32", "png", "png/P", "png/L", "jpeg", "webp", "jpeg2000")
+
+
+"""
+When the same window is forwarded to more than one client (sharing mode),
+each client connection has its own WindowSource for this window.
+This cache allows those WindowSource instances to re-use the result of an encoder call
+made by another one, as long as the pixels and the encoding parameters are identical.
+Each WindowSource still creates its own "draw" packet from the shared data,
+since the packet sequence numbers are specific to each client.
+The first lookup that misses registers the key as pending,
+so the lookups made by the other clients' encode threads wait for its result
+instead of encoding the same pixels again.
+"""
+class SharedEncodeCache(object):
+
+    def __init__(self, max_size=SHARED_ENCODE_CACHE_SIZE, expiry=SHARED_ENCODE_EXPIRY, wait=SHARED_ENCODE_WAIT):
+        self.max_size = max_size
+        self.expiry = expiry/1000.0
+        self.wait = wait/1000.0
+        self.lock = Lock()
+        self.window_sources = {}
+        self.entries = OrderedDict()
+        #key -> Event, for the encodes in progress:
+        self.pending = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def __repr__(self):
+        return "SharedEncodeCache(%i entries)" % len(self.entries)
+
+    def add_window_source(self, wid):
+        with self.lock:
+            self.window_sources[wid] = self.window_sources.get(wid, 0)+1
+
+    def remove_window_source(self, wid):
+        with self.lock:
+            count = self.window_sources.get(wid, 0)-1
+            if count>0:
+                self.window_sources[wid] = count
+                return
+            self.window_sources.pop(wid, None)
+            #no-one is going to use those entries now:
+            for key in tuple(k for k in self.entries.keys() if k[0]==wid):
+                self._remove(key)
+
+    def is_shared(self, wid):
+        return self.window_sources.get(wid, 0)>1
+
+
+    def _get_entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0]<monotonic_time()-self.expiry:
+            return None
+        return entry[2]
+
+    def get(self, key):
+        """
+            Returns the encoder output for this key,
+            or None if there is no valid entry for it.
+            If another encode thread is already encoding the same pixels,
+            we wait for its result.
+            When this returns None, the caller must call 'put' or 'release' for this key.
+            The client options are copied since the caller may modify them.
+        """
+        with self.lock:
+            ret = self._get_entry(key)
+            if ret is None:
+                pending = self.pending.get(key)
+                if pending is None:
+                    self.pending[key] = Event()
+                    self.misses += 1
+                    return None
+        if ret is None:
+            log("shared encode cache: waiting for %s", key[:6])
+            pending.wait(self.wait)
+            with self.lock:
+                self.waits += 1
+                ret = self._get_entry(key)
+                if ret is None:
+                    #the other encoder failed or took too long:
+                    self.misses += 1
+                    return None
+        with self.lock:
+            self.hits += 1
+        coding, data, client_options, outw, outh, outstride, bpp = ret
+        return coding, data, dict(client_options), outw, outh, outstride, bpp
+
+    def release(self, key):
+        """ wakes up the threads waiting for this key, without adding an entry """
+        with self.lock:
+            pending = self.pending.pop(key, None)
+        if pending:
+            pending.set()
+
+    def put(self, key, ret):
+        coding, data, client_options, outw, outh, outstride, bpp = ret
+        size = len(data)
+        if size>self.max_size//4:
+            self.release(key)
+            return
+        ret = coding, data, dict(client_options), outw, outh, outstride, bpp
+        now = monotonic_time()
+        with self.lock:
+            pending = self.pending.pop(key, None)
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (now, size, ret)
+            self.size += size
+            #expire old entries first, then the least recently added ones until we fit:
+            cutoff = now-self.expiry
+            while self.entries:
+                oldest_key, (t, _, _) = next(iter(self.entries.items()))
+                if self.size<=self.max_size and t>=cutoff:
+                    break
+                self._remove(oldest_key)
+        if pending:
+            pending.set()
+        log("shared encode cache: added %s (%i bytes), %i entries using %i bytes", key[:6], size, len(self.entries), self.size)
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+
+    def get_info(self):
+        return {
+            "entries"       : len(self.entries),
+            "size"          : self.size,
+            "max-size"      : self.max_size,
+            "expiry"        : int(self.expiry*1000),
+            "hits"          : self.hits,
+            "misses"        : self.misses,
+            "waits"         : self.waits,
+            "pending"       : len(self.pending),
+            "windows"       : dict(self.window_sources),
+            }
+
+
+instance = None
+def get_shared_encode_cache():
+    global instance
+    if instance is None:
+        instance = SharedEncodeCache()
+    return instance
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+from threading import Lock
+from collections import OrderedDict
+
+from xpra.os_util import monotonic_time, bytestostr
+from xpra.util import envint, envbool
+from xpra.log import Logger
+
+log = Logger("encoding", "video")
+
+VIDEO_POOL = envbool("XPRA_VIDEO_POOL", True)
+#maximum number of idle instances:
+VIDEO_POOL_SIZE = envint("XPRA_VIDEO_POOL_SIZE", 8)
+#maximum memory used by the idle instances, in MB (rough estimate):
+VIDEO_POOL_MEMORY = envint("XPRA_VIDEO_POOL_MEMORY", 256)*1024*1024
+#idle instances are freed after this delay, in seconds:
+VIDEO_POOL_EXPIRY = envint("XPRA_VIDEO_POOL_EXPIRY", 60)
+#only the codecs which do not hold any per-thread or per-device state can be pooled:
+VIDEO_POOL_TYPES = tuple(x.strip() for x in os.environ.get("XPRA_VIDEO_POOL_TYPES", "swscale,libyuv,x264").split(",") if x.strip())
+
+
+def get_csc_key(csc_type, src_width, src_height, src_format, dst_width, dst_height, dst_format, speed):
+    return ("csc", csc_type, src_width, src_height, src_format, dst_width, dst_height, dst_format, int(speed))
+
+#options which change how the encoders are initialized, in addition to the ones prefixed with the encoding or encoder type:
+ENCODER_KEY_OPTIONS = ("content-type", "b-frames", "bandwidth-limit", "max-delayed")
+
+def get_encoder_options_key(encoder_type, encoding, options):
+    """
+        The encoders are initialized with the client's encoding options,
+        (ie: "h264.profile" or "h264.cabac") so an instance can only be re-used
+        for a client which uses the same values.
+    """
+    prefixes = ("%s." % encoding, "%s." % encoder_type)
+    key = []
+    for k, v in options.items():
+        k = bytestostr(k)
+        if k in ENCODER_KEY_OPTIONS or k.startswith(prefixes):
+            key.append((k, repr(v)))
+    return tuple(sorted(key))
+
+def get_encoder_key(encoder_type, encoding, width, height, src_format, dst_formats, scaling, options):
+    return ("encoder", encoder_type, encoding, width, height, src_format, tuple(dst_formats), tuple(scaling),
+            get_encoder_options_key(encoder_type, encoding, options))
+
+def get_instance_size(key):
+    #the csc step holds one output frame, the encoders also hold their reference frames:
+    if key[0]=="csc":
+        return key[5]*key[6]*4
+    return key[3]*key[4]*4*4
+
+
+"""
+Creating a video encoder or a colourspace converter is expensive,
+and it happens every time a window is resized or a new video region is detected.
+Instead of freeing them, the window sources return the instances they no longer need to this pool,
+so the next pipeline using exactly the same parameters can re-use them.
+Video encoders are only pooled if they can restart their stream (see restart()),
+the pool is bounded by the number of instances, their estimated memory usage and their age.
+"""
+class VideoPool(object):
+
+    def __init__(self, max_count=VIDEO_POOL_SIZE, max_size=VIDEO_POOL_MEMORY, expiry=VIDEO_POOL_EXPIRY):
+        self.max_count = max_count
+        self.max_size = max_size
+        self.expiry = expiry
+        self.lock = Lock()
+        #serial -> (key, time, size, instance):
+        self.entries = OrderedDict()
+        self.serial = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def __repr__(self):
+        return "VideoPool(%i instances)" % len(self.entries)
+
+    def get(self, key):
+        """ returns an idle instance created with the parameters in 'key', or None """
+        if not VIDEO_POOL:
+            return None
+        with self.lock:
+            expired = self._expire(monotonic_time())
+            instance = None
+            for serial in reversed(self.entries):
+                if self.entries[serial][0]==key:
+                    instance = self._remove(serial)
+                    break
+            if instance is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._clean(expired)
+        log("video pool get(%s)=%s", key, instance)
+        return instance
+
+    def put(self, key, instance):
+        """
+            Adds an idle instance to the pool,
+            returns False if it cannot be pooled, in which case the caller must clean it.
+        """
+        if not VIDEO_POOL or instance.get_type() not in VIDEO_POOL_TYPES:
+            return False
+        size = get_instance_size(key)
+        if size>self.max_size or self.max_count<=0:
+            return False
+        now = monotonic_time()
+        with self.lock:
+            self.serial += 1
+            self.entries[self.serial] = (key, now, size, instance)
+            self.size += size
+            evicted = self._expire(now)
+            while len(self.entries)>self.max_count or self.size>self.max_size:
+                evicted.append(self._remove(next(iter(self.entries))))
+                self.evicted += 1
+        log("video pool put(%s, %s), %i instances using %i bytes", key, instance, len(self.entries), self.size)
+        self._clean(evicted)
+        return True
+
+    def _expire(self, now):
+        expired = []
+        cutoff = now-self.expiry
+        while self.entries:
+            serial, (_, t, _, _) = next(iter(self.entries.items()))
+            if t>=cutoff:
+                break
+            expired.append(self._remove(serial))
+        return expired
+
+    def _remove(self, serial):
+        _, _, size, instance = self.entries.pop(serial)
+        self.size -= size
+        return instance
+
+    def _clean(self, instances):
+        #we don't hold the lock whilst cleaning the instances:
+        for instance in instances:
+            log("video pool: cleaning %s", instance)
+            try:
+                instance.clean()
+            except Exception:
+                log.error("Error cleaning %s", instance, exc_info=True)
+
+    def cleanup(self):
+        with self.lock:
+            instances = [self._remove(serial) for serial in tuple(self.entries.keys())]
+        self._clean(instances)
+
+
+    def get_info(self):
+        with self.lock:
+            instances = {}
+            for key, _, _, _ in self.entries.values():
+                k = "%s:%s" % (key[0], key[1])
+                instances[k] = instances.get(k, 0)+1
+        return {
+            ""              : VIDEO_POOL,
+            "types"         : VIDEO_POOL_TYPES,
+            "instances"     : instances,
+            "size"          : self.size,
+            "max-size"      : self.max_size,
+            "max-count"     : self.max_count,
+            "expiry"        : self.expiry,
+            "hits"          : self.hits,
+            "misses"        : self.misses,
+            "evicted"       : self.evicted,
+            }
+
+
+instance = None
+def get_video_pool():
+    global instance
+    if instance is None:
+        instance = VideoPool()
+    return instance
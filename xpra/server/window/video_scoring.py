@@ -4,14 +4,22 @@
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
-from xpra.util import envint
+from threading import Lock
+from collections import OrderedDict
+
+from xpra.util import envint, envbool
 from xpra.codecs.codec_constants import LOSSY_PIXEL_FORMATS
+from xpra.codecs.video_helper import get_specs_generation
 from xpra.log import Logger
 
 scorelog = Logger("score")
 
 GPU_BIAS = envint("XPRA_GPU_BIAS", 100)
 MIN_FPS_COST = envint("XPRA_MIN_FPS_COST", 4)
+SCORE_CACHE = envbool("XPRA_SCORE_CACHE", True)
+SCORE_CACHE_SIZE = envint("XPRA_SCORE_CACHE_SIZE", 4096)
+#the quality and speed targets are rounded to this value when caching:
+SCORE_BUCKET = max(1, envint("XPRA_SCORE_BUCKET", 5))
 
 SUBSAMPLING_QUALITY_LOSS = {
     "YUV420P"   : 186,      #1.66 + 0.2
@@ -48,7 +56,7 @@ def get_quality_score(csc_format, csc_spec, encoder_spec, scaling, target_qualit
             qscore *= 2.0
     return int(qscore)
 
-def get_speed_score(csc_format, csc_spec, encoder_spec, scaling, target_speed=100):
+def get_speed_score(csc_format, csc_spec, encoder_spec, scaling, target_speed=100, pixels=0):
     #when subsampling, add the speed gains to the video encoder
     #which now has less work to do:
     mult = {
@@ -56,7 +64,7 @@ def get_speed_score(csc_format, csc_spec, encoder_spec, scaling, target_speed=10
         "YUV422P"   : 80,
         }.get(csc_format, 60)
     #score based on speed:
-    speed = int(encoder_spec.speed*mult//100)
+    speed = int(encoder_spec.get_speed(pixels)*mult//100)
     #the encoder speed matters less
     #when the target speed is low:
     ts = min(100, max(1, target_speed))
@@ -65,38 +73,102 @@ def get_speed_score(csc_format, csc_spec, encoder_spec, scaling, target_speed=10
         #if there is a csc step,
         #then we lose some performance,
         #but less if the csc is fast
-        sscore = sscore - 20 - (100-csc_spec.speed)//2
+        sscore = sscore - 20 - (100-csc_spec.get_speed(pixels))//2
     #when already downscaling, favour YUV420P subsampling:
     if csc_format=="YUV420P" and scaling!=(1, 1):
         sscore += 25
     return max(0, min(100, sscore))
 
-def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
-                       target_quality, min_quality,
-                       target_speed, min_speed,
-                       current_csce, current_ve,
-                       score_delta, ffps, detection=True):
+_MISSING = object()
+
+class ScoreCache(object):
+    """
+        Caches the part of the pipeline scores which only depends on the codec specs,
+        the dimensions and the quality and speed targets.
+        The cache is cleared when the video helper's specs change.
     """
-        Given an optional csc step (csc_format and csc_spec), and
-        and a required encoding step (encoder_spec and width/height),
-        we calculate a score of how well this matches our requirements:
-        * our quality target "self._currend_quality"
-        * our speed target "self._current_speed"
-        * how expensive it would be to switch to this pipeline option
-        Note: we know the current pipeline settings, so the "switching
-        cost" will be lower for pipelines that share components with the
-        current one.
 
-        Can be called from any thread.
+    def __init__(self, max_size=SCORE_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.generation = -1
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "ScoreCache(%i entries)" % len(self.entries)
+
+    def get(self, key, generation):
+        """ returns the cached value, or _MISSING """
+        with self.lock:
+            if generation!=self.generation:
+                self.entries.clear()
+                self.generation = generation
+            v = self.entries.get(key, _MISSING)
+            if v is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return v
+
+    def put(self, key, generation, value):
+        with self.lock:
+            if generation!=self.generation:
+                return
+            self.entries[key] = value
+            while len(self.entries)>self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_info(self):
+        return {
+            ""          : SCORE_CACHE,
+            "entries"   : len(self.entries),
+            "max-size"  : self.max_size,
+            "bucket"    : SCORE_BUCKET,
+            "hits"      : self.hits,
+            "misses"    : self.misses,
+            }
+
+instance = None
+def get_score_cache():
+    global instance
+    if instance is None:
+        instance = ScoreCache()
+    return instance
+
+
+def get_static_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
+                     target_quality, min_quality, target_speed):
+    """
+        The part of the pipeline score which does not depend on the current pipeline,
+        memoized when SCORE_CACHE is enabled.
+        (the quality and speed targets are rounded to SCORE_BUCKET so we get more cache hits)
     """
+    if not SCORE_CACHE:
+        return do_get_static_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
+                                   target_quality, min_quality, target_speed)
+    def bucket(v):
+        return int(v)//SCORE_BUCKET*SCORE_BUCKET
+    target_quality = bucket(target_quality)
+    min_quality = bucket(min_quality)
+    target_speed = bucket(target_speed)
+    key = (enc_in_format, csc_spec, encoder_spec, width, height, scaling, target_quality, min_quality, target_speed)
+    generation = get_specs_generation()
+    cache = get_score_cache()
+    v = cache.get(key, generation)
+    if v is _MISSING:
+        v = do_get_static_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
+                                target_quality, min_quality, target_speed)
+        cache.put(key, generation, v)
+    return v
+
+def do_get_static_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
+                        target_quality, min_quality, target_speed):
     def clamp(v):
         return max(0, min(100, v))
     qscore = clamp(get_quality_score(enc_in_format, csc_spec, encoder_spec, scaling, target_quality, min_quality))
-    sscore = clamp(get_speed_score(enc_in_format, csc_spec, encoder_spec, scaling, target_speed))
-
-    #multiplier for setup_cost:
-    #(lose points if we have less than N fps)
-    setup_cost_mult = int(detection)*(1+max(0, MIN_FPS_COST-ffps))
+    sscore = clamp(get_speed_score(enc_in_format, csc_spec, encoder_spec, scaling, target_speed, width*height))
 
     #how well the codec deals with larger screen sizes:
     sizescore = 100
@@ -111,11 +183,6 @@ def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, sca
         sdisc = 100-encoder_spec.size_efficiency
         sizescore = max(0, 100-pixels*sdisc//1048576//4)
 
-    #runtime codec adjustements:
-    runtime_score = 100
-    #score for "edge resistance" via setup cost:
-    ecsc_score = 100
-
     csc_width = 0
     csc_height = 0
     if csc_spec:
@@ -124,21 +191,6 @@ def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, sca
         height_mask = csc_spec.height_mask & encoder_spec.height_mask
         csc_width = width & width_mask
         csc_height = height & height_mask
-        if enc_in_format=="RGB":
-            #converting to "RGB" is often a waste of CPU
-            #(can only get selected because the csc step will do scaling,
-            # but even then, the YUV subsampling are better options)
-            ecsc_score = 1
-        elif current_csce is None or current_csce.get_dst_format()!=enc_in_format or \
-           type(current_csce)!=csc_spec.codec_class or \
-           current_csce.get_src_width()!=csc_width or current_csce.get_src_height()!=csc_height:
-            #if we have to change csc, account for new csc setup cost:
-            ecsc_score = max(0, 80 - int(csc_spec.setup_cost*setup_cost_mult*80//100))
-        else:
-            ecsc_score = 80
-        ecsc_score += csc_spec.score_boost
-        runtime_score *= csc_spec.get_runtime_factor()
-
         csc_scaling = scaling
         encoder_scaling = (1, 1)
         if scaling!=(1,1) and not csc_spec.can_scale:
@@ -152,7 +204,6 @@ def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, sca
         enc_width, enc_height = get_encoder_dimensions(encoder_spec, csc_width, csc_height, scaling)
     else:
         #not using csc at all!
-        ecsc_score = 100
         width_mask = encoder_spec.width_mask
         height_mask = encoder_spec.height_mask
         enc_width = width & width_mask
@@ -172,18 +223,70 @@ def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, sca
         scorelog("video size %ix%i out of range for %s, max %ix%i", enc_width, enc_height, encoder_spec.codec_type, encoder_spec.max_w, encoder_spec.max_h)
         return None
 
+    #gpu vs cpu
+    gpu_score = max(0, GPU_BIAS-50)*encoder_spec.gpu_cost//50
+    cpu_score = max(0, 50-GPU_BIAS)*encoder_spec.cpu_cost//50
+    return qscore, sscore, sizescore, gpu_score, cpu_score, csc_scaling, csc_width, csc_height, encoder_scaling, enc_width, enc_height
+
+
+def get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
+                       target_quality, min_quality,
+                       target_speed, min_speed,
+                       current_csce, current_ve,
+                       score_delta, ffps, detection=True):
+    """
+        Given an optional csc step (csc_format and csc_spec), and
+        and a required encoding step (encoder_spec and width/height),
+        we calculate a score of how well this matches our requirements:
+        * our quality target "self._currend_quality"
+        * our speed target "self._current_speed"
+        * how expensive it would be to switch to this pipeline option
+        Note: we know the current pipeline settings, so the "switching
+        cost" will be lower for pipelines that share components with the
+        current one.
+
+        Can be called from any thread.
+    """
+    static_score = get_static_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
+                                    target_quality, min_quality, target_speed)
+    if static_score is None:
+        return None
+    qscore, sscore, sizescore, gpu_score, cpu_score, csc_scaling, csc_width, csc_height, encoder_scaling, enc_width, enc_height = static_score
+
+    #multiplier for setup_cost:
+    #(lose points if we have less than N fps)
+    setup_cost_mult = int(detection)*(1+max(0, MIN_FPS_COST-ffps))
+
+    #runtime codec adjustements:
+    runtime_score = 100
+    #score for "edge resistance" via setup cost:
+    ecsc_score = 100
+
+    if csc_spec:
+        if enc_in_format=="RGB":
+            #converting to "RGB" is often a waste of CPU
+            #(can only get selected because the csc step will do scaling,
+            # but even then, the YUV subsampling are better options)
+            ecsc_score = 1
+        elif current_csce is None or current_csce.get_dst_format()!=enc_in_format or \
+           type(current_csce)!=csc_spec.codec_class or \
+           current_csce.get_src_width()!=csc_width or current_csce.get_src_height()!=csc_height:
+            #if we have to change csc, account for new csc setup cost:
+            ecsc_score = max(0, 80 - int(csc_spec.get_setup_cost(width*height)*setup_cost_mult*80//100))
+        else:
+            ecsc_score = 80
+        ecsc_score += csc_spec.score_boost
+        runtime_score *= csc_spec.get_runtime_factor()
+
     ee_score = 100
     if current_ve is None or current_ve.get_type()!=encoder_spec.codec_type or \
        current_ve.get_src_format()!=enc_in_format or \
        current_ve.get_width()!=enc_width or current_ve.get_height()!=enc_height:
         #account for new encoder setup cost:
-        ee_score = 100 - int(encoder_spec.setup_cost*setup_cost_mult)
+        ee_score = 100 - int(encoder_spec.get_setup_cost(enc_width*enc_height)*setup_cost_mult)
         ee_score += encoder_spec.score_boost
     #edge resistance score: average of csc and encoder score:
     er_score = (ecsc_score + ee_score) // 2
-    #gpu vs cpu
-    gpu_score = max(0, GPU_BIAS-50)*encoder_spec.gpu_cost//50
-    cpu_score = max(0, 50-GPU_BIAS)*encoder_spec.cpu_cost//50
     score = int((qscore+sscore+er_score+sizescore+score_delta+gpu_score+cpu_score)*runtime_score//100//5)
     scorelog("get_pipeline_score(%-7s, %-24r, %-24r, %5i, %5i) quality: %3i, speed: %3i, setup: %3i - %3i runtime: %3i scaling: %s / %s, encoder dimensions=%sx%s, sizescore=%3i, client score delta=%3i, cpu score=%3i, gpu score=%3i, score=%3i",
              enc_in_format, csc_spec, encoder_spec, width, height,
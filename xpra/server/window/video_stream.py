@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# This file is part of Xpra.
+# Copyright (C) 2019 Antoine Martin <antoine@xpra.org>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from xpra.os_util import monotonic_time, bytestostr
+from xpra.util import envint
+from xpra.rectangle import rectangle          #@UnresolvedImport
+from xpra.server.window.video_subregion import VideoSubregion, MIN_W, MIN_H
+from xpra.server.window.video_pool import get_video_pool, get_csc_key, get_encoder_key
+from xpra.log import Logger
+
+sslog = Logger("regiondetect")
+videolog = Logger("video")
+
+#maximum number of video streams per window, including the video subregion:
+VIDEO_STREAMS = envint("XPRA_VIDEO_STREAMS", 4)
+#how many times a rectangle must be damaged (within MAX_TIME) to become a video stream:
+MIN_STREAM_EVENTS = envint("XPRA_VIDEO_STREAM_MIN_EVENTS", 10)
+#existing streams are kept as long as they get this many damage events:
+KEEP_STREAM_EVENTS = envint("XPRA_VIDEO_STREAM_KEEP_EVENTS", 5)
+#video encoders generally require even dimensions:
+STREAM_MASK = 0xFFFE
+
+
+def identify_video_streams(ww, wh, last_damage_events, from_time, exclude=(), current=(), max_count=VIDEO_STREAMS-1):
+    """
+        Returns the rectangles which are damaged often enough to be sent as separate video streams:
+        they must be at least MIN_W x MIN_H, fit within the window
+        and they cannot intersect the 'exclude' rectangles or each other.
+        The 'current' rectangles need fewer damage events to be kept.
+    """
+    if max_count<=0:
+        return []
+    counts = {}
+    for t,x,y,w,h in tuple(last_damage_events):
+        if t<from_time or w<MIN_W or h<MIN_H or x<0 or y<0 or x+w>ww or y+h>wh:
+            continue
+        r = rectangle(x, y, w & STREAM_MASK, h & STREAM_MASK)
+        if any(r.intersects_rect(e) for e in exclude):
+            continue
+        counts[r] = counts.get(r, 0)+1
+    def min_events(r):
+        if r in current:
+            return KEEP_STREAM_EVENTS
+        return MIN_STREAM_EVENTS
+    #existing streams first, then the most damaged and the biggest:
+    def sort_key(item):
+        r, count = item
+        return (r not in current, -count, -r.width*r.height, r.y, r.x)
+    regions = []
+    for r, count in sorted(counts.items(), key=sort_key):
+        if count<min_events(r):
+            continue
+        if any(r.intersects_rect(x) for x in regions):
+            continue
+        regions.append(r)
+        if len(regions)>=max_count:
+            break
+    sslog("identify_video_streams(%i, %i, %i events, %s, %s, %s, %i)=%s",
+          ww, wh, len(counts), from_time, exclude, current, max_count, regions)
+    return regions
+
+
+"""
+An additional video region of a window,
+sent to the client as a separate stream with its own csc and video encoder,
+so that windows with several animated areas (ie: a wallboard with many charts)
+do not have to fall back to non-video encodings for all but one of them.
+The refresh of the region once it stops updating is tracked by its own VideoSubregion,
+with detection turned off since the rectangle is managed by the window source.
+The pipeline attributes are only accessed from the encode thread.
+"""
+class VideoStream(object):
+
+    def __init__(self, stream_id, rect, timeout_add, source_remove, refresh_cb, auto_refresh_delay):
+        self.stream_id = stream_id
+        self.timeout_add = timeout_add
+        self.source_remove = source_remove
+        self.idle_timer = None
+        self.subregion = VideoSubregion(timeout_add, source_remove, refresh_cb, auto_refresh_delay, True)
+        self.subregion.set_detection(False)
+        self.subregion.set_region(rect.x, rect.y, rect.width, rect.height)
+        self.closed = False
+        self.csce = None
+        self.csc_key = None
+        self.ve = None
+        self.ve_key = None
+        self.frames = 0
+
+    def __repr__(self):
+        return "VideoStream(%i: %s)" % (self.stream_id, self.rectangle)
+
+    @property
+    def rectangle(self):
+        return self.subregion.rectangle
+
+    def close(self):
+        """ the window source is no longer using this stream, stop its refresh timers """
+        self.closed = True
+        self.cancel_idle_timer()
+        self.subregion.cleanup()
+
+    def cancel_idle_timer(self):
+        it = self.idle_timer
+        if it:
+            self.idle_timer = None
+            self.source_remove(it)
+
+    def schedule_idle_timer(self, delay, callback):
+        """ calls callback(stream) unless another frame is encoded within delay milliseconds """
+        self.cancel_idle_timer()
+        if delay>0 and not self.closed:
+            self.idle_timer = self.timeout_add(delay, self.idle_timeout, callback)
+
+    def idle_timeout(self, callback):
+        self.idle_timer = None
+        callback(self)
+        return False
+
+    def get_info(self):
+        info = self.subregion.get_info()
+        info["frames"] = self.frames
+        for prefix, x in (("csc", self.csce), ("encoder", self.ve)):
+            if x:
+                i = x.get_info()
+                i[""] = x.get_type()
+                info[prefix] = i
+        return info
+
+
+    def check_pipeline(self, encodings, width, height, src_format):
+        """ returns True if the current pipeline can be used for the given input """
+        ve = self.ve
+        csce = self.csce
+        if ve is None or ve.is_closed() or (csce and csce.is_closed()):
+            return False
+        if csce:
+            if csce.get_src_format()!=src_format:
+                return False
+            if csce.get_src_width()!=width or csce.get_src_height()!=height:
+                return False
+        elif ve.get_src_format()!=src_format:
+            return False
+        return ve.get_encoding() in encodings and ve.get_width()==width and ve.get_height()==height
+
+    def setup_pipeline(self, scores, width, height, src_format, quality, speed, full_csc_modes, encoding_options, video_options):
+        """
+            Tries each pipeline option until one succeeds.
+            Streams do not use scaling, so the options which would scale are skipped.
+        """
+        for option in scores:
+            _score, _scaling, _csc_scaling, csc_width, csc_height, csc_spec, \
+                enc_in_format, encoder_scaling, enc_width, enc_height, encoder_spec = option
+            if (enc_width, enc_height)!=(width, height) or encoder_scaling!=(1, 1):
+                continue
+            try:
+                if self.setup_pipeline_option(width, height, src_format, quality, speed,
+                                              csc_spec, enc_in_format, encoder_spec,
+                                              full_csc_modes, encoding_options, video_options):
+                    return True
+            except Exception as e:
+                videolog("setup_pipeline_option%s", option, exc_info=True)
+                videolog.warn("Warning: failed to setup video pipeline %s for stream %i:", option, self.stream_id)
+                videolog.warn(" %s", e)
+            self.clean()
+        return False
+
+    def setup_pipeline_option(self, width, height, src_format, quality, speed,
+                              csc_spec, enc_in_format, encoder_spec,
+                              full_csc_modes, encoding_options, video_options):
+        if width & encoder_spec.width_mask!=width or height & encoder_spec.height_mask!=height:
+            return False
+        start = monotonic_time()
+        pool = get_video_pool()
+        if csc_spec:
+            if width & csc_spec.width_mask!=width or height & csc_spec.height_mask!=height:
+                return False
+            csc_speed = min(speed, 100-quality/2.0)
+            self.csc_key = get_csc_key(csc_spec.codec_type, width, height, src_format,
+                                       width, height, enc_in_format, csc_speed)
+            self.csce = pool.get(self.csc_key)
+            if self.csce is None:
+                self.csce = csc_spec.make_instance()
+                self.csce.init_context(width, height, src_format,
+                                       width, height, enc_in_format, int(csc_speed))
+        dst_formats = tuple(bytestostr(x) for x in full_csc_modes.strlistget(encoder_spec.encoding))
+        options = encoding_options.copy()
+        options.update(video_options)
+        self.ve_key = get_encoder_key(encoder_spec.codec_type, encoder_spec.encoding, width, height, enc_in_format,
+                                      dst_formats, (1, 1), options)
+        self.ve = pool.get(self.ve_key)
+        if self.ve is not None:
+            self.ve.set_encoding_speed(speed)
+            self.ve.set_encoding_quality(quality)
+        else:
+            self.ve = encoder_spec.make_instance()
+            self.ve.init_context(width, height, enc_in_format,
+                                 dst_formats, encoder_spec.encoding,
+                                 quality, speed, (1, 1), options)
+        self.frames = 0
+        videolog("stream %i setup_pipeline: csc=%s, video encoder=%s, setup took %.2fms",
+                 self.stream_id, self.csce, self.ve, (monotonic_time()-start)*1000.0)
+        return True
+
+    def clean(self):
+        """
+            Returns the csc and video encoder to the pool, or frees them,
+            returns True if there was a video encoder.
+        """
+        pool = get_video_pool()
+        csce, csc_key = self.csce, self.csc_key
+        ve, ve_key = self.ve, self.ve_key
+        self.csce = self.csc_key = self.ve = self.ve_key = None
+        if csce and not (csc_key and pool.put(csc_key, csce)):
+            csce.clean()
+        if ve:
+            restart = getattr(ve, "restart", None)
+            if not (ve_key and restart and not ve.is_closed() and restart() and pool.put(ve_key, ve)):
+                ve.clean()
+        return ve is not None
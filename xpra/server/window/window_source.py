@@ -12,21 +12,27 @@ import threading
 from math import sqrt
 from collections import deque
 
-from xpra.os_util import memoryview_to_bytes, strtobytes, monotonic_time
+from xpra.os_util import memoryview_to_bytes, strtobytes, bytestostr, monotonic_time
 from xpra.util import envint, envbool, csv, typedict, first_time
 from xpra.server.window.windowicon_source import WindowIconSource
 from xpra.server.window.content_guesser import guess_content_type, get_content_type_properties
 from xpra.server.window.window_stats import WindowPerformanceStatistics
 from xpra.server.window.batch_config import DamageBatchConfig
 from xpra.server.window.batch_delay_calculator import calculate_batch_delay, get_target_speed, get_target_quality
+from xpra.server.window.delta_store import DeltaStore
+from xpra.server.window.shared_encode import get_shared_encode_cache, SHARED_ENCODINGS
+from xpra.server.window.content_classifier import classify_image   #@UnresolvedImport
+from xpra.server.window.refresh_tiles import RefreshTiles
 from xpra.server.cystats import time_weighted_average, logp #@UnresolvedImport
-from xpra.rectangle import rectangle, add_rectangle, remove_rectangle, merge_all   #@UnresolvedImport
+from xpra.rectangle import rectangle, region, merge_all   #@UnresolvedImport
 from xpra.server.picture_encode import rgb_encode, webp_encode, mmap_send
 from xpra.simple_stats import get_list_stats
 from xpra.codecs.xor.cyxor import xor_str           #@UnresolvedImport
+from xpra.buffers.membuf import get_xxh64           #@UnresolvedImport
 from xpra.codecs.argb.argb import argb_swap         #@UnresolvedImport
 from xpra.codecs.rgb_transform import rgb_reformat
 from xpra.codecs.loader import get_codec
+from xpra.codecs.tile_cache import TileCache
 from xpra.codecs.codec_constants import PREFERED_ENCODING_ORDER, LOSSY_PIXEL_FORMATS
 from xpra.net import compression
 from xpra.log import Logger
@@ -38,14 +44,22 @@ damagelog = Logger("window", "damage")
 scalinglog = Logger("scaling")
 iconlog = Logger("icon")
 deltalog = Logger("delta")
+tilelog = Logger("tile")
 avsynclog = Logger("av-sync")
 statslog = Logger("stats")
+contentlog = Logger("content")
 bandwidthlog = Logger("bandwidth")
 
 
 AUTO_REFRESH = envbool("XPRA_AUTO_REFRESH", True)
 AUTO_REFRESH_QUALITY = envint("XPRA_AUTO_REFRESH_QUALITY", 100)
 AUTO_REFRESH_SPEED = envint("XPRA_AUTO_REFRESH_SPEED", 50)
+AUTO_REFRESH_TILE_SIZE = max(8, envint("XPRA_AUTO_REFRESH_TILE_SIZE", 64))
+#maximum number of bytes each refresh cycle should send, 0 for automatic:
+AUTO_REFRESH_BYTE_BUDGET = envint("XPRA_AUTO_REFRESH_BYTE_BUDGET", 0)
+#when automatic, use this percentage of the bandwidth limit:
+AUTO_REFRESH_BANDWIDTH_PCT = envint("XPRA_AUTO_REFRESH_BANDWIDTH_PCT", 25)
+AUTO_REFRESH_MAX_BYTES = envint("XPRA_AUTO_REFRESH_MAX_BYTES", 4*1024*1024)
 
 INITIAL_QUALITY = envint("XPRA_INITIAL_QUALITY", 65)
 INITIAL_SPEED = envint("XPRA_INITIAL_SPEED", 40)
@@ -59,6 +73,9 @@ DELTA = envbool("XPRA_DELTA", True)
 MIN_DELTA_SIZE = envint("XPRA_MIN_DELTA_SIZE", 1024)
 MAX_DELTA_SIZE = envint("XPRA_MAX_DELTA_SIZE", 32768)
 MAX_DELTA_HITS = envint("XPRA_MAX_DELTA_HITS", 20)
+MAX_DELTA_BUCKETS = envint("XPRA_MAX_DELTA_BUCKETS", 64)
+TILE_CACHE = envbool("XPRA_TILE_CACHE", True)
+TILE_CACHE_MIN_PIXELS = envint("XPRA_TILE_CACHE_MIN_PIXELS", 4096)
 MIN_WINDOW_REGION_SIZE = envint("XPRA_MIN_WINDOW_REGION_SIZE", 1024)
 MAX_SOFT_EXPIRED = envint("XPRA_MAX_SOFT_EXPIRED", 5)
 ACK_JITTER = envint("XPRA_ACK_JITTER", 20)
@@ -76,6 +93,16 @@ AV_SYNC_TIME_CHANGE = envint("XPRA_AV_SYNC_TIME_CHANGE", 500)
 PAINT_FLUSH = envbool("XPRA_PAINT_FLUSH", True)
 SEND_TIMESTAMPS = envbool("XPRA_SEND_TIMESTAMPS", False)
 DAMAGE_STATISTICS = envbool("XPRA_DAMAGE_STATISTICS", False)
+SHARED_ENCODE = envbool("XPRA_SHARED_ENCODE", True)
+CONTENT_CLASSIFY = envbool("XPRA_CONTENT_CLASSIFY", True)
+CLASSIFY_MIN_PIXELS = envint("XPRA_CLASSIFY_MIN_PIXELS", 4096)
+#pictures updated this many times in a row are video:
+CLASSIFY_VIDEO_FRAMES = envint("XPRA_CLASSIFY_VIDEO_FRAMES", 10)
+CLASSIFY_VIDEO_INTERVAL = envint("XPRA_CLASSIFY_VIDEO_INTERVAL", 250)/1000.0
+#split large screen updates into tiles so each tile can use a different encoding:
+TILED_ENCODING = envbool("XPRA_TILED_ENCODING", True)
+TILED_ENCODING_SIZE = max(16, envint("XPRA_TILED_ENCODING_SIZE", 128))
+TILED_ENCODING_MIN_PIXELS = envint("XPRA_TILED_ENCODING_MIN_PIXELS", 256*256)
 
 HARDCODED_ENCODING = os.environ.get("XPRA_HARDCODED_ENCODING")
 
@@ -83,20 +110,47 @@ INFINITY = float("inf")
 TRANSPARENCY_ENCODINGS = ("webp", "png", "rgb32")
 LOSSLESS_ENCODINGS = ("rgb", "png", "png/P", "png/L")
 REFRESH_ENCODINGS = ("webp", "png", "rgb24", "rgb32", "jpeg2000")
+#tiles can be replaced by a client cache reference for these encodings:
+TILE_ENCODINGS = ("rgb24", "rgb32", "png", "png/P", "png/L", "jpeg", "webp", "jpeg2000")
+#but the client can only cache the pixels it receives losslessly:
+TILE_STORE_ENCODINGS = ("rgb24", "rgb32", "png")
+#the encodings we can switch from using the content classifier:
+CLASSIFY_ENCODINGS = ("png", "webp", "jpeg", "jpeg2000")
+LOSSLESS_CONTENT_TYPES = ("text", "ui")
+LOSSY_CONTENT_TYPES = ("picture", "video")
 
 
 class DelayedRegions(object):
     def __init__(self, damage_time, regions, encoding, options):
         self.expired = False
         self.damage_time = damage_time
-        self.regions = regions
+        #accumulate the damage in a banded region,
+        #which handles large numbers of small rectangles efficiently:
+        self.region = region(regions)
         self.encoding = encoding
         self.options = options or {}
 
+    @property
+    def regions(self):
+        return self.region.get_rectangles()
+
 
 def capr(v):
     return min(100, max(0, int(v)))
 
+def split_tiles(pos, size, tile_size):
+    """
+        Splits the segment starting at 'pos' into parts aligned on multiples of 'tile_size',
+        returns the offset (relative to 'pos') and length of each part.
+    """
+    parts = []
+    offset = 0
+    while offset<size:
+        l = min(size-offset, tile_size-(pos+offset)%tile_size)
+        parts.append((offset, l))
+        offset += l
+    return parts
+
 """
 We create a Window Source for each window we send pixels for.
 
@@ -130,6 +184,14 @@ class WindowSource(WindowIconSource):
         # mmap:
         self._mmap = mmap
         self._mmap_size = mmap_size
+        self._mmap_allocator = None
+        if mmap:
+            from xpra.net.mmap_pipe import MmapAllocator
+            if isinstance(mmap, MmapAllocator):
+                #the space used by each draw packet is freed when the client acknowledges it:
+                self._mmap_allocator = mmap
+        #damage packet sequence -> mmap chunks:
+        self._mmap_allocations = {}
 
         self.init_vars()
 
@@ -175,8 +237,9 @@ class WindowSource(WindowIconSource):
         if not window.is_tray() and DELTA:
             self.supports_delta = [x for x in encoding_options.strlistget("supports_delta", []) if x in ("png", "rgb24", "rgb32")]
             if self.supports_delta:
-                self.delta_buckets = min(25, encoding_options.intget("delta_buckets", 1))
-                self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+                delta_buckets = min(MAX_DELTA_BUCKETS, encoding_options.intget("delta_buckets", 1))
+                if delta_buckets>0:
+                    self.delta_store = DeltaStore(delta_buckets)
         self.batch_config = batch_config
         #auto-refresh:
         self.auto_refresh_delay = auto_refresh_delay
@@ -185,6 +248,23 @@ class WindowSource(WindowIconSource):
         self.video_helper = video_helper
         if window.is_shadow():
             self.max_delta_size = -1
+        #mirror of the client's tile cache for this window:
+        self.tile_cache = None
+        tile_cache_entries = encoding_options.intget("tile_cache", 0)
+        if TILE_CACHE and tile_cache_entries>0 and not window.is_tray():
+            self.tile_cache = TileCache(tile_cache_entries, encoding_options.intget("tile_cache.pixels", 0))
+        #re-use the output of other clients' encoders for the same window (sharing mode):
+        self.shared_encode_cache = None
+        if SHARED_ENCODE and not window.is_tray():
+            self.shared_encode_cache = get_shared_encode_cache()
+            self.shared_encode_cache.add_window_source(wid)
+
+        #content classification of the pixels (see classify_encoding):
+        self.classify_content = False
+        self.picture_updates = {}
+        self.content_classified = {}
+        #for tiled screen updates, the content type and quality of each tile we have sent:
+        self.tile_quality_map = {}
 
         self.is_idle = False
         self.is_OR = window.is_OR()
@@ -192,6 +272,8 @@ class WindowSource(WindowIconSource):
         self.is_shadow = window.is_shadow()
         self.has_alpha = window.has_alpha()
         self.window_dimensions = ww, wh
+        #the tiles which are lossy on the client:
+        self.refresh_tiles = RefreshTiles(ww, wh, AUTO_REFRESH_TILE_SIZE)
         #where the window is mapped on the client:
         self.mapped_at = None
         self.fullscreen = not self.is_tray and window.get("fullscreen")
@@ -336,8 +418,7 @@ class WindowSource(WindowIconSource):
         self.supports_transparency = False
         self.full_frames_only = False
         self.supports_delta = ()
-        self.delta_buckets = 0
-        self.delta_pixel_data = ()
+        self.delta_store = None
         self.suspended = False
         self.strict = STRICT_MODE
         #
@@ -352,7 +433,7 @@ class WindowSource(WindowIconSource):
         self.refresh_event_time = 0
         self.refresh_target_time = 0
         self.refresh_timer = None
-        self.refresh_regions = []
+        self.refresh_tiles = RefreshTiles(0, 0)
         self.timeout_timer = None
         self.expire_timer = None
         self.soft_timer = None
@@ -392,7 +473,12 @@ class WindowSource(WindowIconSource):
 
     def cleanup(self):
         self.cancel_damage()
+        self.free_mmap_allocations()
         log("encoding_totals for wid=%s with primary encoding=%s : %s", self.wid, self.encoding, self.statistics.encoding_totals)
+        sec = self.shared_encode_cache
+        if sec:
+            self.shared_encode_cache = None
+            sec.remove_window_source(self.wid)
         self.init_vars()
         #make sure we don't queue any more screen updates for encoding:
         self._damage_cancelled = INFINITY
@@ -455,6 +541,8 @@ class WindowSource(WindowIconSource):
                 "min-delay"     : self.min_auto_refresh_delay,
                 "delay"         : self.auto_refresh_delay,
                 "base-delay"    : self.base_auto_refresh_delay,
+                "byte-budget"   : self.get_refresh_byte_budget(),
+                "tiles"         : self.refresh_tiles.get_info(),
                 "last-event"    : {
                     "elapsed"    : int(1000*(monotonic_time()-larm[0])),
                     "message"    : larm[1],
@@ -462,12 +550,6 @@ class WindowSource(WindowIconSource):
                 }
             }
 
-        now = monotonic_time()
-        buckets_info = {}
-        for i,x in enumerate(self.delta_pixel_data):
-            if x:
-                w, h, pixel_format, coding, store, buflen, _, hits, last_used = x
-                buckets_info[i] = w, h, pixel_format, coding, store, buflen, hits, int((now-last_used)*1000)
         #remove large default dict:
         info.update({
                 "idle"                  : self.is_idle,
@@ -487,12 +569,20 @@ class WindowSource(WindowIconSource):
                 "full-frames-only"      : self.full_frames_only,
                 "supports-transparency" : self.supports_transparency,
                 "flush"                 : self.supports_flush,
+                "shared-encode"         : bool(self.shared_encode_cache) and self.shared_encode_cache.is_shared(self.wid),
+                "tile-cache"            : self.tile_cache.get_info() if self.tile_cache is not None else {},
                 "delta"                 : {""               : self.supports_delta,
-                                           "buckets"        : self.delta_buckets,
-                                           "bucket"         : buckets_info,
+                                           "store"          : self.delta_store.get_info() if self.delta_store else {},
                                            },
                 "property"              : self.get_property_info(),
                 "content-type"          : self.content_type or "",
+                "content-classifier"    : {""               : self.classify_content,
+                                           "classified"     : dict(self.content_classified),
+                                           },
+                "tiled"                 : {""               : self.classify_content and TILED_ENCODING,
+                                           "tile-size"      : TILED_ENCODING_SIZE,
+                                           "tiles"          : len(self.tile_quality_map),
+                                           },
                 "batch"                 : self.batch_config.get_info(),
                 "soft-timeout"          : {
                                            "expired"        : self.soft_expired,
@@ -726,10 +816,15 @@ class WindowSource(WindowIconSource):
         if self.encoding==encoding:
             return
         self.statistics.reset()
-        self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+        self.clear_delta_store()
         self.update_encoding_selection(encoding)
 
 
+    def clear_delta_store(self):
+        ds = self.delta_store
+        if ds:
+            ds.clear()
+
     def update_encoding_selection(self, encoding=None, exclude=[], init=False):
         #now we have the real list of encodings we can use:
         #"rgb32" and "rgb24" encodings are both aliased to "rgb"
@@ -802,6 +897,11 @@ class WindowSource(WindowIconSource):
 
     def assign_encoding_getter(self):
         self.get_best_encoding = self.get_best_encoding_impl()
+        self.classify_content = CONTENT_CLASSIFY and self.get_best_encoding in self.get_classify_encoding_getters()
+
+    def get_classify_encoding_getters(self):
+        #the content classifier can only override automatic encoding selection:
+        return (self.get_auto_encoding, )
 
     def get_best_encoding_impl(self):
         if HARDCODED_ENCODING:
@@ -891,7 +991,7 @@ class WindowSource(WindowIconSource):
         #so we don't have an encoding that does transparency...
         return self.get_auto_encoding(w, h, speed, quality)
 
-    def get_auto_encoding(self, w, h, speed, quality, *_args):
+    def get_auto_encoding(self, w, h, speed, quality, current_encoding=None, content_type=None):
         if w*h<self._rgb_auto_threshold:
             return "rgb24"
         co = self.common_encodings
@@ -899,6 +999,18 @@ class WindowSource(WindowIconSource):
         if depth>24 and "rgb32" in co and self.client_bit_depth>24:
             #the only encoding that can do higher bit depth at present
             return "rgb32"
+        if content_type=="ui" and self.rgb_lz4 and "rgb24" in co:
+            #flat areas compress very well and very quickly with lz4:
+            return "rgb24"
+        if content_type in LOSSLESS_CONTENT_TYPES and "png" in co:
+            #keep text and user interface elements sharp:
+            return "png"
+        if content_type in LOSSY_CONTENT_TYPES and depth in (24, 32) and w>=2 and h>=2:
+            #pictures compress much better with a lossy encoding,
+            #and jpeg is the fastest one for video content:
+            for x in (("webp", "jpeg"), ("jpeg", "webp"))[content_type=="video"]:
+                if x in co:
+                    return x
         if depth in (24, 32) and "webp" in co and w>=2 and h>=2:
             return "webp"
         if "png" in co and ((quality>=80 and speed<80) or depth<=16):
@@ -907,7 +1019,7 @@ class WindowSource(WindowIconSource):
             return "jpeg"
         if "jpeg2000" in co and w>=32 and h>=32:
             return "jpeg2000"
-        return (x for x in co if x!="rgb").next()
+        return next(x for x in co if x!="rgb")
 
     def get_current_or_rgb(self, pixel_count, *_args):
         if pixel_count<self._rgb_auto_threshold:
@@ -942,9 +1054,11 @@ class WindowSource(WindowIconSource):
         self.cancel_av_sync_timer()
         self.cancel_decode_error_refresh_timer()
         #if a region was delayed, we can just drop it now:
-        self.refresh_regions = []
+        self.refresh_tiles.clear()
         self._damage_delayed = None
-        self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+        self.tile_quality_map = {}
+        self.clear_delta_store()
+        self.free_unsent_mmap_allocations()
         #make sure we don't account for those as they will get dropped
         #(generally before encoding - only one may still get encoded):
         for sequence in tuple(self.statistics.encoding_pending.keys()):
@@ -1251,6 +1365,7 @@ class WindowSource(WindowIconSource):
         if self.window_dimensions != (ww, wh):
             self.statistics.last_resized = now
             self.window_dimensions = ww, wh
+            self.refresh_tiles.resize(ww, wh)
             log("window dimensions changed: %ix%i", ww, wh)
             self.encode_queue_max_size = max(2, min(30, MAX_SYNC_BUFFER_SIZE//(ww*wh*4)))
         if self.full_frames_only:
@@ -1267,10 +1382,8 @@ class WindowSource(WindowIconSource):
         delayed = self._damage_delayed
         if delayed:
             #use existing delayed region:
-            regions = delayed.regions
             if not self.full_frames_only:
-                region = rectangle(x, y, w, h)
-                add_rectangle(regions, region)
+                delayed.region.union(x, y, w, h)
             #merge/override options
             if options is not None:
                 override = options.get("override_options", False)
@@ -1281,7 +1394,7 @@ class WindowSource(WindowIconSource):
                     if override or k not in existing_options:
                         existing_options[k] = options[k]
             damagelog("do_damage%-24s wid=%s, using existing %i delayed regions created %.1fms ago",
-                (x, y, w, h, options), self.wid, len(regions), now-delayed.damage_time)
+                (x, y, w, h, options), self.wid, len(delayed.region), now-delayed.damage_time)
             if not self.expire_timer and not self.soft_timer and self.soft_expired==0:
                 log.error("Error: bug, found a delayed region without a timer!")
                 self.expire_timer = self.timeout_add(0, self.expire_delayed_region)
@@ -1566,6 +1679,7 @@ class WindowSource(WindowIconSource):
             now = monotonic_time()
             actual_delay = int(1000 * (now-delayed.damage_time))
             self.batch_config.last_actual_delays.append((now, actual_delay))
+            self.statistics.batch_delay_histogram.observe(actual_delay)
             self.send_delayed_regions(delayed)
         return False
 
@@ -1738,7 +1852,12 @@ class WindowSource(WindowIconSource):
         """
         self.statistics.encoding_pending[sequence] = (damage_time, w, h)
         try:
-            packet = self.make_data_packet(damage_time, process_damage_time, image, coding, sequence, options, flush)
+            if self.must_tile(w, h, coding, options):
+                packets = self.make_tile_packets(damage_time, process_damage_time, image, coding, sequence, options, flush)
+            else:
+                if self.classify_content and coding in CLASSIFY_ENCODINGS and w*h>=CLASSIFY_MIN_PIXELS and not options.get("auto_refresh"):
+                    coding, options = self.classify_encoding(image, coding, options)
+                packets = ((self.make_data_packet(damage_time, process_damage_time, image, coding, sequence, options, flush), options), )
         finally:
             self.free_image_wrapper(image)
             del image
@@ -1749,10 +1868,96 @@ class WindowSource(WindowIconSource):
                 pass
         #NOTE: we MUST send it (even if the window is cancelled by now..)
         #because the code may rely on the client having received this frame
-        if not packet:
-            return
-        #queue packet for sending:
-        self.queue_damage_packet(packet, damage_time, process_damage_time, options)
+        for packet, packet_options in packets:
+            if packet:
+                #queue packet for sending:
+                self.queue_damage_packet(packet, damage_time, process_damage_time, packet_options)
+
+
+    def classify_encoding(self, image, coding, options):
+        """
+            The encoding was chosen using only the window attributes and the size of the region,
+            now that we have the pixels, we can choose the encoding best suited to their contents.
+            (this runs in the encode thread)
+        """
+        content_type = classify_image(image)
+        if not content_type:
+            return coding, options
+        if content_type=="picture":
+            content_type = self.get_picture_content_type(image)
+        self.content_classified[content_type] = self.content_classified.get(content_type, 0) + 1
+        speed = options.get("speed") or self._current_speed
+        quality = options.get("quality") or self._current_quality
+        encoding = self.get_classified_encoding(image.get_width(), image.get_height(), speed, quality, coding, content_type)
+        contentlog("classify_encoding(%s, %s, %s) content-type=%s, encoding=%s", image, coding, options, content_type, encoding)
+        options = options.copy()
+        options["content-type"] = content_type
+        return encoding or coding, options
+
+    def get_picture_content_type(self, image):
+        #a picture which is updated repeatedly is video:
+        key = (image.get_target_x(), image.get_target_y(), image.get_width(), image.get_height())
+        now = monotonic_time()
+        count, last = self.picture_updates.get(key, (0, 0))
+        if now-last>CLASSIFY_VIDEO_INTERVAL:
+            count = 0
+        if len(self.picture_updates)>=256:
+            self.picture_updates = {}
+        self.picture_updates[key] = (count+1, now)
+        if count+1>=CLASSIFY_VIDEO_FRAMES:
+            return "video"
+        return "picture"
+
+    def get_classified_encoding(self, w, h, speed, quality, coding, content_type):
+        return self.get_auto_encoding(w, h, speed, quality, coding, content_type)
+
+
+    def must_tile(self, w, h, coding, options):
+        return self.classify_content and TILED_ENCODING and coding in CLASSIFY_ENCODINGS and \
+            w*h>=TILED_ENCODING_MIN_PIXELS and (w>TILED_ENCODING_SIZE or h>TILED_ENCODING_SIZE) and \
+            not options.get("auto_refresh")
+
+    def make_tile_packets(self, damage_time, process_damage_time, image, coding, sequence, options, flush):
+        """
+            Splits a large screen update into tiles aligned on the window's tile grid,
+            and chooses the encoding of each tile from its contents,
+            so lossy encodings are only used where there are pictures.
+            The tiles are sent as one batch: only the last one has a zero flush value.
+            (this runs in the encode thread)
+        """
+        x = image.get_target_x()
+        y = image.get_target_y()
+        tiles = tuple((tx, ty, tw, th)
+                      for ty, th in split_tiles(y, image.get_height(), TILED_ENCODING_SIZE)
+                      for tx, tw in split_tiles(x, image.get_width(), TILED_ENCODING_SIZE))
+        packets = []
+        n = len(tiles)
+        for i, (tx, ty, tw, th) in enumerate(tiles):
+            tile = image.get_sub_image(tx, ty, tw, th)
+            try:
+                tile_coding, tile_options = self.classify_encoding(tile, coding, options)
+                packet = self.make_data_packet(damage_time, process_damage_time, tile, tile_coding, sequence, tile_options, (flush or 0)+n-1-i)
+            finally:
+                tile.free()
+            if packet:
+                self.update_tile_quality_map(packet, tile_options)
+                packets.append((packet, tile_options))
+        log("make_tile_packets(..) sent %ix%i at %i,%i as %i tiles: %s", image.get_width(), image.get_height(), x, y, n, [p[0][6] for p in packets])
+        return packets
+
+    def update_tile_quality_map(self, packet, options):
+        x, y, w, h, coding = packet[2:7]
+        coding = bytestostr(coding)
+        if coding in LOSSLESS_ENCODINGS or coding.startswith("rgb"):
+            quality = 100
+        else:
+            quality = packet[10].get("quality", options.get("quality") or self._current_quality)
+        ts = TILED_ENCODING_SIZE
+        content_type = options.get("content-type", "")
+        qmap = self.tile_quality_map
+        for ty in range(y//ts, (y+h-1)//ts+1):
+            for tx in range(x//ts, (x+w-1)//ts+1):
+                qmap[(tx, ty)] = (content_type, quality)
 
 
     def schedule_auto_refresh(self, packet, options):
@@ -1762,7 +1967,7 @@ class WindowSource(WindowIconSource):
         encoding = strtobytes(packet[6])
         region = rectangle(*packet[2:6])    #x,y,w,h
         client_options = packet[10]     #info about this packet from the encoder
-        if (encoding.startswith(b"png") and (self.image_depth<=24 or self.image_depth==32)) or encoding.startswith(b"rgb"):
+        if (encoding.startswith(b"png") and (self.image_depth<=24 or self.image_depth==32)) or encoding.startswith(b"rgb") or encoding==b"tile":
             actual_quality = 100
             lossy = False
         else:
@@ -1781,7 +1986,7 @@ class WindowSource(WindowIconSource):
             if not self.refresh_timer:
                 #nothing due for refresh, still nothing to do
                 msg = "nothing to do"
-            elif not self.refresh_regions:
+            elif not self.refresh_tiles:
                 msg = "covered all regions that needed a refresh, cancelling refresh timer"
                 self.cancel_refresh_timer()
             else:
@@ -1796,16 +2001,14 @@ class WindowSource(WindowIconSource):
                 msg = "keeping existing timer (all pixels outside area)"
             else:
                 msg = "added pixels to refresh regions"
-                if self.refresh_regions:
+                if self.refresh_tiles:
                     schedule = True
         now = monotonic_time()
         if schedule:
             #figure out the proportion of pixels that need refreshing:
-            #(some of those rectangles may overlap,
-            # so the value may be greater than the size of the window)
-            pixels = sum(rect.width*rect.height for rect in self.refresh_regions)
+            pixels = self.refresh_tiles.get_pixel_count()
             ww, wh = self.window_dimensions
-            pct = int(min(100, 100*pixels//(ww*wh)) * (1+self.global_statistics.congestion_value))
+            pct = int(min(100, 100*pixels//max(1, ww*wh)) * (1+self.global_statistics.congestion_value))
             if not self.refresh_timer:
                 #we must schedule a new refresh timer
                 self.refresh_event_time = now
@@ -1821,20 +2024,19 @@ class WindowSource(WindowIconSource):
                 self.refresh_target_time = max(target_time, now + sched_delay/1000.0)
                 msg += ", re-scheduling refresh (due in %ims, %ims added - sched_delay=%s, pct=%i, batch=%i)" % (1000*(self.refresh_target_time-now), 1000*(self.refresh_target_time-target_time), sched_delay, pct, self.batch_config.delay)
         self.last_auto_refresh_message = now, msg
-        refreshlog("auto refresh: %5s screen update (actual quality=%3i, lossy=%5s), %s (region=%s, refresh regions=%s)", encoding, actual_quality, lossy, msg, region, self.refresh_regions)
+        refreshlog("auto refresh: %5s screen update (actual quality=%3i, lossy=%5s), %s (region=%s, refresh tiles=%s)", encoding, actual_quality, lossy, msg, region, self.refresh_tiles)
 
     def remove_refresh_region(self, region):
         #removes the given region from the refresh list
         #(also overriden in window video source)
-        remove_rectangle(self.refresh_regions, region)
+        self.refresh_tiles.remove(region)
 
     def add_refresh_region(self, region):
         #adds the given region to the refresh list
         #returns the number of pixels in the region update
         #(overriden in window video source to exclude the video region)
         #Note: this does not run in the UI thread!
-        add_rectangle(self.refresh_regions, region)
-        return region.width*region.height
+        return self.refresh_tiles.add(region)
 
     def can_refresh(self):
         if not AUTO_REFRESH:
@@ -1878,20 +2080,56 @@ class WindowSource(WindowIconSource):
         return False
 
     def timer_full_refresh(self):
-        #copy event time and list of regions (which may get modified by another thread)
+        #copy event time and take the tiles within our budget (the others may get modified by another thread)
         ret = self.refresh_event_time
         self.refresh_event_time = 0
-        regions = self.refresh_regions
-        self.refresh_regions = []
-        if self.can_refresh() and regions and ret>0:
+        if not self.can_refresh() or ret<=0:
+            self.refresh_tiles.clear()
+            return False
+        budget = self.get_refresh_byte_budget()
+        max_pixels = int(budget/self.get_refresh_bytes_per_pixel())
+        regions = self.refresh_tiles.take(max_pixels)
+        if regions:
             now = monotonic_time()
             options = self.get_refresh_options()
             refresh_exclude = self.get_refresh_exclude()
-            refreshlog("timer_full_refresh() after %ims, auto_refresh_encodings=%s, options=%s, regions=%s, refresh_exclude=%s",
-                       1000.0*(monotonic_time()-ret), self.auto_refresh_encodings, options, regions, refresh_exclude)
+            refreshlog("timer_full_refresh() after %ims, auto_refresh_encodings=%s, options=%s, regions=%s, refresh_exclude=%s, budget=%i bytes, %i tiles left",
+                       1000.0*(monotonic_time()-ret), self.auto_refresh_encodings, options, regions, refresh_exclude, budget, len(self.refresh_tiles))
             WindowSource.do_send_delayed_regions(self, now, regions, self.auto_refresh_encodings[0], options, exclude_region=refresh_exclude, get_best_encoding=self.get_refresh_encoding)
+        if self.refresh_tiles and not self.refresh_timer:
+            #over budget, refresh the other tiles in the next cycle:
+            now = monotonic_time()
+            delay = max(self.min_auto_refresh_delay, self.base_auto_refresh_delay)
+            self.refresh_event_time = now
+            self.refresh_target_time = now + delay/1000.0
+            self.refresh_timer = self.timeout_add(delay, self.refresh_timer_function, {})
         return False
 
+    def get_refresh_byte_budget(self):
+        if AUTO_REFRESH_BYTE_BUDGET>0:
+            return AUTO_REFRESH_BYTE_BUDGET
+        bwl = self.bandwidth_limit
+        if bwl<=0:
+            return AUTO_REFRESH_MAX_BYTES
+        #our share of the bandwidth for the duration of a refresh cycle:
+        delay = max(self.min_auto_refresh_delay, self.base_auto_refresh_delay)
+        budget = bwl//8*AUTO_REFRESH_BANDWIDTH_PCT//100*delay//1000
+        budget = int(budget/(1+self.global_statistics.congestion_value))
+        return max(1024, min(AUTO_REFRESH_MAX_BYTES, budget))
+
+    def get_refresh_bytes_per_pixel(self):
+        #use the compression ratio of the recent lossless updates, or assume 1 byte per pixel:
+        pixels = csize = 0
+        refresh_encodings = self.auto_refresh_encodings
+        for _, coding, epixels, _, ecsize, _ in tuple(self.statistics.encoding_stats):
+            #the codings are recorded as bytes by make_data_packet:
+            if bytestostr(coding) in refresh_encodings:
+                pixels += epixels
+                csize += ecsize
+        if pixels<64*64:
+            return 1.0
+        return max(0.01, float(csize)/pixels)
+
     def get_refresh_encoding(self, w, h, speed, quality, coding):
         refresh_encodings = self.auto_refresh_encodings
         encoding = refresh_encodings[0]
@@ -1920,12 +2158,12 @@ class WindowSource(WindowIconSource):
         if not self.auto_refresh_encodings or self.is_cancelled():
             #can happen during cleanup
             return
-        refresh_regions = self.refresh_regions
+        refresh_tiles = repr(self.refresh_tiles)
         #since we're going to refresh the whole window,
         #we don't need to track what needs refreshing:
-        self.refresh_regions = []
+        self.refresh_tiles.clear()
         w, h = self.window_dimensions
-        refreshlog("full_quality_refresh() for %sx%s window with pending refresh regions: %s", w, h, refresh_regions)
+        refreshlog("full_quality_refresh() for %sx%s window with pending refresh tiles: %s", w, h, refresh_tiles)
         new_options = damage_options.copy()
         encoding = self.auto_refresh_encodings[0]
         new_options.update(self.get_refresh_options())
@@ -1960,6 +2198,8 @@ class WindowSource(WindowIconSource):
         ack_pending = [0, coding, 0, 0, 0, width*height, client_options]
         statistics = self.statistics
         statistics.damage_ack_pending[damage_packet_sequence] = ack_pending
+        if coding==b"mmap" and self._mmap_allocator:
+            self._mmap_allocations[damage_packet_sequence] = data
         def start_send(bytecount):
             ack_pending[0] = monotonic_time()
             ack_pending[2] = bytecount
@@ -1969,6 +2209,7 @@ class WindowSource(WindowIconSource):
             ack_pending[4] = bytecount
             if process_damage_time>0:
                 statistics.damage_out_latency.append((now, width*height, actual_batch_delay, now-process_damage_time))
+                statistics.damage_latency_histogram.observe(now-damage_time)
             elapsed_ms = int((now-ack_pending[0])*1000)
             #only record slow send as congestion events
             #if the bandwidth limit is already below the threshold:
@@ -2040,6 +2281,38 @@ class WindowSource(WindowIconSource):
             self.idle_add(self.damage, x, y, width, height)
         return resend
 
+    def free_unsent_mmap_allocations(self):
+        """
+            The packets which have not been sent yet may never be acknowledged,
+            so we free their mmap space now.
+            (if one is sent after all, the client may paint the wrong pixels for a cancelled update)
+        """
+        if not self._mmap_allocations:
+            return
+        pending = self.statistics.damage_ack_pending
+        for sequence in tuple(self._mmap_allocations.keys()):
+            ack_pending = pending.get(sequence)
+            if ack_pending is None or ack_pending[0]==0:
+                self.free_mmap_allocations(sequence)
+
+    def free_mmap_allocations(self, damage_packet_sequence=None):
+        """ frees the mmap space used by this damage packet, or by all of them """
+        allocator = self._mmap_allocator
+        if not allocator:
+            return
+        if damage_packet_sequence is None:
+            sequences = tuple(self._mmap_allocations.keys())
+        else:
+            sequences = (damage_packet_sequence, )
+        for sequence in sequences:
+            self.free_mmap_chunks(self._mmap_allocations.pop(sequence, None))
+
+    def free_mmap_chunks(self, chunks):
+        allocator = self._mmap_allocator
+        if allocator:
+            for offset, _ in (chunks or ()):
+                allocator.free(offset)
+
     def estimate_send_delay(self, bytecount):
         #how long it should take to send this packet (in milliseconds)
         #based on the bandwidth available (if we know it):
@@ -2061,8 +2334,11 @@ class WindowSource(WindowIconSource):
             don't access the window from here!)
         """
         statslog("packet decoding sequence %s for window %s: %sx%s took %.1fms", damage_packet_sequence, self.wid, width, height, decode_time/1000.0)
+        if self._mmap_allocations:
+            self.free_mmap_allocations(damage_packet_sequence)
         if decode_time>0:
             self.statistics.client_decode_time.append((monotonic_time(), width*height, decode_time))
+            self.statistics.client_decode_histogram.observe(decode_time/1000.0/1000.0)
         elif decode_time<0:
             self.client_decode_error(decode_time, message)
         pending = self.statistics.damage_ack_pending.get(damage_packet_sequence)
@@ -2131,7 +2407,10 @@ class WindowSource(WindowIconSource):
             log.warn(" unknown cause")
         self.global_statistics.decode_errors += 1
         #something failed client-side, so we can't rely on the delta being available
-        self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+        self.clear_delta_store()
+        #and the failure may have been a tile cache miss:
+        if self.tile_cache:
+            self.tile_cache.clear()
         if self.window:
             delay = min(1000, 250+self.global_statistics.decode_errors*100)
             self.decode_error_refresh_timer = self.timeout_add(delay, self.decode_error_refresh)
@@ -2175,6 +2454,27 @@ class WindowSource(WindowIconSource):
         psize = isize*4
         log("make_data_packet: image=%s, damage data: %s", image, (self.wid, x, y, w, h, coding))
         start = monotonic_time()
+        #check if the client already has these pixels in its tile cache:
+        tile_key = 0
+        tc = self.tile_cache
+        if tc is not None and coding in TILE_ENCODINGS and isize>=TILE_CACHE_MIN_PIXELS:
+            image.may_restride()
+            #seed the hash with the dimensions,
+            #and make sure the key fits in a signed 64-bit integer for the packet encoders:
+            tile_key = get_xxh64(image.get_pixels(), (w<<16)+h) & 0x7fffffffffffffff
+            #hashing may take some time, check cancellation before touching the cache:
+            #(the client's cache must see the same lookups)
+            if self.is_cancelled(sequence) or self.suspended:
+                log("make_data_packet: dropping data packet for window %s with sequence=%s", self.wid, sequence)
+                return  None
+            if tc.get(tile_key):
+                client_options = {"tile" : tile_key}
+                if self.supports_flush and flush not in (None, 0):
+                    client_options["flush"] = flush
+                end = monotonic_time()
+                tilelog("tile cache hit for %ix%i at %i,%i on wid=%i: %#x", w, h, x, y, self.wid, tile_key)
+                self.statistics.encoding_stats.append((end, "tile", w*h, 32, 8, end-start))
+                return self.make_draw_packet(x, y, w, h, "tile", b"", 0, client_options, options)
         delta, store, bucket, hits = -1, -1, -1, 0
         pixel_format = image.get_pixel_format()
         #use delta pre-compression for this encoding if:
@@ -2183,7 +2483,8 @@ class WindowSource(WindowIconSource):
         #* size is worth xoring (too small is pointless, too big is too expensive)
         #* the pixel format is supported by the client
         # (if we have to rgb_reformat the buffer, it really complicates things)
-        if self.delta_buckets>0 and (coding in self.supports_delta) and self.min_delta_size<isize<self.max_delta_size and \
+        ds = self.delta_store
+        if ds and (coding in self.supports_delta) and self.min_delta_size<isize<self.max_delta_size and \
             pixel_format in self.rgb_formats:
             #this may save space (and lower the cost of xoring):
             image.may_restride()
@@ -2193,29 +2494,32 @@ class WindowSource(WindowIconSource):
             assert dpixels, "failed to get pixels from %s" % image
             dpixels = memoryview_to_bytes(dpixels)
             dlen = len(dpixels)
+            geometry = (w, h, pixel_format, coding)
+            dhash = get_xxh64(dpixels)
             store = sequence
             deltalog("delta available for %s and %i %s pixels on wid=%i", coding, isize, pixel_format, self.wid)
-            for i, dr in enumerate(tuple(self.delta_pixel_data)):
-                if dr is None:
-                    continue
-                lw, lh, lpixel_format, lcoding, lsequence, buflen, ldata, hits, _ = dr
-                if lw==w and lh==h and lpixel_format==pixel_format and lcoding==coding and buflen==dlen:
-                    bucket = i
-                    if MAX_DELTA_HITS>0 and hits<MAX_DELTA_HITS:
-                        deltalog("delta: using matching bucket %s: %sx%s (%s, %i bytes, sequence=%i, hit count=%s)", i, lw, lh, lpixel_format, dlen, lsequence, hits)
-                        #xor with this matching delta bucket:
-                        delta = lsequence
-                        xored = xor_str(dpixels, ldata)
-                        image.set_pixels(xored)
-                        dr[-1] = monotonic_time()            #update last used time
-                        hits += 1
-                        dr[-2] = hits               #update hit count
-                    else:
-                        deltalog("delta: too many hits for bucket %s: %s, clearing it", bucket, hits)
-                        hits = 0
-                        self.delta_pixel_data[i] = None
-                        delta = -1
-                    break
+            dr = ds.get(geometry, dhash)
+            if dr:
+                bucket, _, lhash, lsequence, ldata, hits = dr[:6]
+                if len(ldata)!=dlen:
+                    deltalog("delta: bucket %i has a different rowstride, clearing it", bucket)
+                    hits = 0
+                    ds.remove(bucket)
+                elif MAX_DELTA_HITS>0 and hits<MAX_DELTA_HITS:
+                    deltalog("delta: using matching bucket %s: %sx%s (%s, %i bytes, sequence=%i, hit count=%s)", bucket, w, h, pixel_format, dlen, lsequence, hits)
+                    #xor with this matching delta bucket:
+                    delta = lsequence
+                    xored = xor_str(dpixels, ldata)
+                    image.set_pixels(xored)
+                    hits += 1
+                    dr[5] = hits                #update hit count
+                    if lhash==dhash:
+                        #the client already has these exact pixels:
+                        store = -1
+                else:
+                    deltalog("delta: too many hits for bucket %s: %s, clearing it", bucket, hits)
+                    hits = 0
+                    ds.remove(bucket)
 
         #by default, don't set rowstride (the container format will take care of providing it):
         encoder = self._encoders.get(coding)
@@ -2224,19 +2528,44 @@ class WindowSource(WindowIconSource):
                 return None
             else:
                 raise Exception("BUG: no encoder not found for %s" % coding)
-        ret = encoder(coding, image, options)
+        #another client may have encoded the exact same pixels already:
+        ret = None
+        shared_key = None
+        sec = self.shared_encode_cache
+        if sec and delta<0 and coding in SHARED_ENCODINGS and sec.is_shared(self.wid):
+            shared_key = self.get_shared_encode_key(image, coding, options)
+            ret = sec.get(shared_key)
+            log("make_data_packet: shared encode cache %s for %s", ["miss", "hit"][ret is not None], coding)
         if ret is None:
-            log("%s%s returned None", encoder, (coding, image, options))
-            #something went wrong.. nothing we can do about it here!
-            return  None
+            try:
+                ret = encoder(coding, image, options)
+            finally:
+                #this also wakes up the other window sources waiting for this result:
+                if shared_key:
+                    if ret is None:
+                        sec.release(shared_key)
+                    else:
+                        sec.put(shared_key, ret)
+            if ret is None:
+                log("%s%s returned None", encoder, (coding, image, options))
+                #something went wrong.. nothing we can do about it here!
+                return  None
 
         coding, data, client_options, outw, outh, outstride, bpp = ret
         coding = strtobytes(coding)
         #check cancellation list again since the code above may take some time:
-        #but always send mmap data so we can reclaim the space!
-        if coding!="mmap" and (self.is_cancelled(sequence) or self.suspended):
+        #but always send mmap ring buffer data so the client reclaims the space!
+        if (self.is_cancelled(sequence) or self.suspended) and (coding!=b"mmap" or self._mmap_allocator):
+            if coding==b"mmap":
+                #blocks from the allocator are not acked if we drop the packet, free them now:
+                self.free_mmap_chunks(data)
             log("make_data_packet: dropping data packet for window %s with sequence=%s", self.wid, sequence)
             return  None
+        #tell the client to add these pixels to its tile cache:
+        if tile_key and bytestostr(coding) in TILE_STORE_ENCODINGS and outw==w and outh==h and tc.can_store(isize):
+            tc.add(tile_key, isize, True)
+            client_options["tile"] = tile_key
+            tilelog("tile cache: client will store %ix%i %s tile %#x", w, h, coding, tile_key)
         #tell client about delta/store for this pixmap:
         if delta>=0:
             client_options["delta"] = delta
@@ -2246,27 +2575,14 @@ class WindowSource(WindowIconSource):
             if delta>0 and csize>=psize*40//100:
                 #compressed size is more than 40% of the original
                 #maybe delta is not helping us, so clear it:
-                self.delta_pixel_data[bucket] = None
+                ds.remove(bucket)
                 deltalog("delta: clearing bucket %i (compressed size=%s, original size=%s)", bucket, csize, psize)
                 #TODO: could tell the clients they can clear it too
                 #(add a new client capability and send it a zero store value)
-            else:
-                #find the bucket to use:
-                if bucket<0:
-                    lpd = self.delta_pixel_data
-                    try:
-                        bucket = lpd.index(None)
-                        deltalog("delta: found empty bucket %i", bucket)
-                    except ValueError:
-                        #find a bucket which has not been used recently
-                        t = 0
-                        bucket = 0
-                        for i,dr in enumerate(lpd):
-                            if dr and (t==0 or dr[-1]<t):
-                                t = dr[-1]
-                                bucket = i
-                        deltalog("delta: using oldest bucket %i", bucket)
-                self.delta_pixel_data[bucket] = [w, h, pixel_format, coding, store, len(dpixels), dpixels, hits, monotonic_time()]
+            elif ds.can_store(dlen):
+                #the client stores the new pixels in the bucket it used as reference (if any),
+                #otherwise the store will give us a free or least recently used one:
+                bucket = ds.add(geometry, dhash, store, dpixels, hits, bucket)
                 client_options["store"] = store
                 client_options["bucket"] = bucket
                 #record number of frames and pixels:
@@ -2274,7 +2590,7 @@ class WindowSource(WindowIconSource):
                 totals[0] = totals[0] + 1
                 totals[1] = totals[1] + w*h
                 deltalog("delta: client options=%s (for region %s)", client_options, (x, y, w, h))
-        if INTEGRITY_HASH and coding!="mmap":
+        if INTEGRITY_HASH and coding!=b"mmap":
             #could be a compressed wrapper or just raw bytes:
             try:
                 v = data.data
@@ -2297,17 +2613,34 @@ class WindowSource(WindowIconSource):
         compresslog("compress: %5.1fms for %4ix%-4i pixels at %4i,%-4i for wid=%-5i using %9s with ratio %5.1f%%  (%5iKB to %5iKB), sequence %5i, client_options=%s",
                  (end-start)*1000.0, outw, outh, x, y, self.wid, coding, 100.0*csize/psize, psize//1024, csize//1024, self._damage_packet_sequence, client_options)
         self.statistics.encoding_stats.append((end, coding, w*h, bpp, csize, end-start))
+        self.statistics.encode_time_histogram.observe(end-start)
         return self.make_draw_packet(x, y, outw, outh, coding, data, outstride, client_options, options)
 
+    def get_shared_encode_key(self, image, coding, options):
+        """
+            The key must include everything that affects the output of the encoder,
+            so that we only share it with clients that would have produced the same data.
+        """
+        q = options.get("quality") or self.get_quality(coding)
+        s = options.get("speed") or self.get_speed(coding)
+        return (self.wid, image.get_target_x(), image.get_target_y(), image.get_width(), image.get_height(),
+                image.get_rowstride(), image.get_pixel_format(), get_xxh64(image.get_pixels()),
+                coding, q, s, self.content_type, self.supports_transparency, tuple(self.rgb_formats),
+                self.rgb_zlib, self.rgb_lz4, self.rgb_lzo, tuple(self.full_csc_modes.strlistget(coding, ())))
+
     def make_draw_packet(self, x, y, outw, outh, coding, data, outstride, client_options={}, _options={}):
         packet = ("draw", self.wid, x, y, outw, outh, strtobytes(coding), data, self._damage_packet_sequence, outstride, client_options)
         self.global_statistics.packet_count += 1
         self.statistics.packet_count += 1
         self._damage_packet_sequence += 1
-        #record number of frames and pixels:
-        totals = self.statistics.encoding_totals.setdefault(coding, [0, 0])
+        #record number of frames, pixels and compressed bytes,
+        #using the same str key for all the encoding paths:
+        coding = bytestostr(coding)
+        stats = self.statistics
+        totals = stats.encoding_totals.setdefault(coding, [0, 0])
         totals[0] = totals[0] + 1
         totals[1] = totals[1] + outw*outh
+        stats.encoding_bytes[coding] = stats.encoding_bytes.get(coding, 0) + len(data)
         self.encoding_last_used = coding
         #log("make_data_packet: returning packet=%s", packet[:7]+[".."]+packet[8:])
         return packet
@@ -2324,7 +2657,8 @@ class WindowSource(WindowIconSource):
         if pixel_format not in client_rgb_formats:
             if not rgb_reformat(image, client_rgb_formats, self.supports_transparency):
                 raise Exception("cannot find compatible rgb format to use for %s! (supported: %s)" % (pixel_format, self.rgb_formats))
-        return webp_encode(image, self.supports_transparency, q, s, self.content_type)
+        content_type = options.get("content-type") or self.content_type
+        return webp_encode(image, self.supports_transparency, q, s, content_type)
 
     def rgb_encode(self, coding, image, options):
         s = options.get("speed") or self._current_speed
@@ -12,6 +12,7 @@ from collections import deque
 from xpra.simple_stats import get_list_stats, get_weighted_list_stats
 from xpra.os_util import monotonic_time
 from xpra.util import engs, csv, envint
+from xpra.server.metrics import Histogram, TIME_BUCKETS, DELAY_BUCKETS
 from xpra.server.cystats import (logp,      #@UnresolvedImport
     calculate_time_weighted_average,        #@UnresolvedImport
     calculate_size_weighted_average,        #@UnresolvedImport
@@ -56,6 +57,12 @@ class WindowPerformanceStatistics(object):
                                                             #so we can calculate the "client_latency" when the client sends
                                                             #the corresponding ack ("damage-sequence" packet - see "client_ack_damage")
         self.encoding_totals = {}                           #for each encoding, how many frames we sent and how many pixels in total
+        self.encoding_bytes = {}                            #for each encoding, how many compressed bytes we produced
+        #cumulative histograms, exported by the "/metrics" http endpoint:
+        self.encode_time_histogram = Histogram(TIME_BUCKETS)        #time spent compressing, in seconds
+        self.batch_delay_histogram = Histogram(DELAY_BUCKETS)       #actual batch delay, in milliseconds
+        self.damage_latency_histogram = Histogram(TIME_BUCKETS)     #from the damage event to the packet being sent, in seconds
+        self.client_decode_histogram = Histogram(TIME_BUCKETS)      #client decoding time, in seconds
         self.encoding_pending = {}                          #damage regions waiting to be picked up by the encoding thread:
                                                             #for each sequence no: (damage_time, w, h)
         self.last_damage_events = deque(maxlen=4*NRECS)     #every time we get a damage event, we record: time,x,y,w,h
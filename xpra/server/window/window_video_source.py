@@ -9,18 +9,21 @@ import time
 import operator
 import threading
 from math import sqrt
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 from xpra.net.compression import Compressed, LargeStructure
 from xpra.codecs.codec_constants import TransientCodecException, RGB_FORMATS, PIXEL_SUBSAMPLING
 from xpra.server.window.window_source import (
     WindowSource, DelayedRegions,
     STRICT_MODE, AUTO_REFRESH_SPEED, AUTO_REFRESH_QUALITY, MAX_RGB,
+    LOSSLESS_CONTENT_TYPES, LOSSY_CONTENT_TYPES,
     )
 from xpra.rectangle import merge_all          #@UnresolvedImport
-from xpra.server.window.motion import ScrollData                    #@UnresolvedImport
-from xpra.server.window.video_subregion import VideoSubregion, VIDEO_SUBREGION
+from xpra.server.window.motion import ScrollData, MOTION_2D         #@UnresolvedImport
+from xpra.server.window.video_subregion import VideoSubregion, VIDEO_SUBREGION, MAX_TIME
+from xpra.server.window.video_stream import VideoStream, identify_video_streams, VIDEO_STREAMS
 from xpra.server.window.video_scoring import get_pipeline_score
+from xpra.server.window.video_pool import get_video_pool, get_csc_key, get_encoder_key
 from xpra.codecs.codec_constants import PREFERED_ENCODING_ORDER, EDGE_ENCODING_ORDER
 from xpra.util import parse_scaling_value, engs, envint, envbool, csv, roundup, print_nested_dict, first_time
 from xpra.os_util import monotonic_time, strtobytes, bytestostr, PYTHON3
@@ -86,6 +89,10 @@ B_FRAMES = envbool("XPRA_B_FRAMES", True)
 VIDEO_SKIP_EDGE = envbool("XPRA_VIDEO_SKIP_EDGE", False)
 SCROLL_ENCODING = envbool("XPRA_SCROLL_ENCODING", True)
 SCROLL_MIN_PERCENT = max(1, min(100, envint("XPRA_SCROLL_MIN_PERCENT", 50)))
+MAX_MOTION_RECTS = envint("XPRA_MAX_MOTION_RECTS", 20)
+#number of damage rectangles we keep track of,
+#so scroll detection only checksums the rows that may have changed:
+SCROLL_DAMAGE_HISTORY = envint("XPRA_SCROLL_DAMAGE_HISTORY", 256)
 
 SAVE_VIDEO_STREAMS = envbool("XPRA_SAVE_VIDEO_STREAMS", False)
 SAVE_VIDEO_FRAMES = os.environ.get("XPRA_SAVE_VIDEO_FRAMES")
@@ -105,16 +112,24 @@ class WindowVideoSource(WindowSource):
     def __init__(self, *args):
         #this will call init_vars():
         self.supports_scrolling = False
+        self.motion_2d = False
         self.video_subregion = None
+        #the additional video regions: stream id -> VideoStream
+        self.video_streams = {}
+        self.video_stream_counter = 0
         WindowSource.__init__(self, *args)
         self.supports_eos = self.encoding_options.boolget("eos")
         self.scroll_encoding = SCROLL_ENCODING
         self.supports_scrolling = self.scroll_encoding and self.encoding_options.boolget("scrolling") and not STRICT_MODE
         self.scroll_min_percent = self.encoding_options.intget("scrolling.min-percent", SCROLL_MIN_PERCENT)
+        #the client can copy rectangles horizontally and vertically:
+        self.motion_2d = self.supports_scrolling and self.encoding_options.boolget("scrolling.motion") and MOTION_2D
         self.supports_video_scaling = self.encoding_options.boolget("video_scaling", False)
         self.supports_video_b_frames = self.encoding_options.strlistget("video_b_frames", [])
         self.video_max_size = self.encoding_options.intlistget("video_max_size", (8192, 8192), 2, 2)
         self.video_subregion = VideoSubregion(self.timeout_add, self.source_remove, self.refresh_subregion, self.auto_refresh_delay)
+        #how many video streams the client can decode for each window:
+        self.max_video_streams = max(1, min(VIDEO_STREAMS, self.encoding_options.intget("video_streams", 1)))
         self.video_stream_file = None
 
     def init_encoders(self):
@@ -136,6 +151,9 @@ class WindowVideoSource(WindowSource):
         #those two instances should only ever be modified or accessed from the encode thread:
         self._csc_encoder = None
         self._video_encoder = None
+        #the parameters used for creating them, so they can be returned to the pool:
+        self._csc_pool_key = None
+        self._video_encoder_pool_key = None
         self._last_pipeline_check = 0
 
     def __repr__(self):
@@ -171,12 +189,17 @@ class WindowVideoSource(WindowSource):
         self.encode_from_queue_due = 0
         self.scroll_data = None
         self.last_scroll_time = 0
+        self.scroll_damage = deque(maxlen=SCROLL_DAMAGE_HISTORY)
+        self.scroll_damage_seq = 0
+        self.scroll_update_seq = 0
 
     def do_set_auto_refresh_delay(self, min_delay, delay):
         WindowSource.do_set_auto_refresh_delay(self, min_delay, delay)
         r = self.video_subregion
         if r:
             r.set_auto_refresh_delay(self.base_auto_refresh_delay)
+        for stream in self.video_streams.values():
+            stream.subregion.set_auto_refresh_delay(self.base_auto_refresh_delay)
 
     def update_av_sync_frame_delay(self):
         self.av_sync_frame_delay = 0
@@ -205,6 +228,10 @@ class WindowVideoSource(WindowSource):
             sri = sr.get_info()
             sri["video-mode"] = self.subregion_is_video()
             info["video_subregion"] = sri
+        streams = self.video_streams
+        if streams:
+            info["video_streams"] = dict((stream_id, stream.get_info()) for stream_id, stream in streams.items())
+        info["max-video-streams"] = self.max_video_streams
         info["scaling"] = self.actual_scaling
         info["supports_video_scaling"] = self.supports_video_scaling
         info["video-max-size"] = self.video_max_size
@@ -230,6 +257,7 @@ class WindowVideoSource(WindowSource):
                  "scrolling"      : {
                      "enabled"      : self.supports_scrolling,
                      "min-percent"  : self.scroll_min_percent,
+                     "motion"       : self.motion_2d,
                      }
                  }
         if self._last_pipeline_check>0:
@@ -300,6 +328,9 @@ class WindowVideoSource(WindowSource):
         """
         self.cancel_video_encoder_flush()
         self.video_context_clean()
+        for stream in self.video_streams.values():
+            stream.cancel_idle_timer()
+            self.call_in_encode_thread(False, self.do_clean_video_stream, stream)
 
     def video_context_clean(self):
         """ Calls clean() from the encode thread """
@@ -310,23 +341,33 @@ class WindowVideoSource(WindowSource):
                 log.warn("video_context_clean() for wid %i: %s and %s", self.wid, csce, ve)
                 import traceback
                 traceback.print_stack()
+            csc_key = self._csc_pool_key
+            ve_key = self._video_encoder_pool_key
             self._csc_encoder = None
             self._video_encoder = None
-            def clean():
-                if DEBUG_VIDEO_CLEAN:
-                    log.warn("video_context_clean() done")
-                self.csc_clean(csce)
-                self.ve_clean(ve)
-            self.call_in_encode_thread(False, clean)
-
-    def csc_clean(self, csce):
+            self._csc_pool_key = None
+            self._video_encoder_pool_key = None
+            #use a bound method so this is routed to the same encode thread as this window:
+            self.call_in_encode_thread(False, self.do_video_context_clean, csce, ve, csc_key, ve_key)
+
+    def do_video_context_clean(self, csce, ve, csc_key=None, ve_key=None):
+        if DEBUG_VIDEO_CLEAN:
+            log.warn("video_context_clean() done")
+        self.csc_clean(csce, csc_key)
+        self.ve_clean(ve, ve_key)
+
+    def csc_clean(self, csce, pool_key=None):
+        """ the instance is returned to the pool if we have its key, or freed """
         if csce:
-            csce.clean()
+            if not (pool_key and get_video_pool().put(pool_key, csce)):
+                csce.clean()
 
-    def ve_clean(self, ve):
+    def ve_clean(self, ve, pool_key=None):
         self.cancel_video_encoder_timer()
         if ve:
-            ve.clean()
+            restart = getattr(ve, "restart", None)
+            if not (pool_key and restart and not ve.is_closed() and restart() and get_video_pool().put(pool_key, ve)):
+                ve.clean()
             #only send eos if this video encoder is still current,
             #(otherwise, sending the new stream will have taken care of it already,
             # and sending eos then would close the new stream, not the old one!)
@@ -336,6 +377,78 @@ class WindowVideoSource(WindowSource):
             if SAVE_VIDEO_STREAMS:
                 self.close_video_stream_file()
 
+    def do_clean_video_stream(self, stream):
+        """ frees the pipeline of an additional video stream, runs in the encode thread """
+        #only send eos if the stream has been removed,
+        #(otherwise the next frame will start a new stream)
+        if stream.clean() and stream.closed and self.supports_eos:
+            log("sending eos for wid %i stream %i", self.wid, stream.stream_id)
+            self.queue_packet(("eos", self.wid, stream.stream_id))
+
+    def video_stream_timeout(self, stream):
+        videolog("video_stream_timeout() will close the pipeline of %s", stream)
+        self.call_in_encode_thread(False, self.do_clean_video_stream, stream)
+
+    def clear_video_streams(self):
+        streams = self.video_streams
+        if streams:
+            self.set_video_streams([])
+
+    def set_video_streams(self, rects):
+        """
+            Updates the additional video streams so they match the rectangles given,
+            keeping the existing streams for the rectangles which have not changed.
+        """
+        streams = self.video_streams
+        new_streams = {}
+        removed = []
+        for stream_id, stream in streams.items():
+            if stream.rectangle in rects:
+                new_streams[stream_id] = stream
+            else:
+                removed.append(stream)
+        current = tuple(stream.rectangle for stream in new_streams.values())
+        for rect in rects:
+            if rect not in current:
+                self.video_stream_counter += 1
+                stream = VideoStream(self.video_stream_counter, rect,
+                                     self.timeout_add, self.source_remove, self.refresh_subregion, self.base_auto_refresh_delay)
+                refreshlog("new video stream %s", stream)
+                new_streams[stream.stream_id] = stream
+                WindowSource.remove_refresh_region(self, rect)
+        self.video_streams = new_streams
+        for stream in removed:
+            sublog("removing video stream %s", stream)
+            rect = stream.rectangle
+            stream.close()
+            self.call_in_encode_thread(False, self.do_clean_video_stream, stream)
+            if rect:
+                #the region may still need a refresh:
+                self.add_refresh_region(rect)
+
+    def update_video_streams(self, ww, wh):
+        """
+            Finds the regions which should be sent as additional video streams,
+            this is only done when we already have a video subregion.
+        """
+        vr = self.video_subregion.rectangle
+        if not vr or self.max_video_streams<=1:
+            self.clear_video_streams()
+            return
+        streams = self.video_streams
+        from_time = max(self.statistics.last_resized, monotonic_time()-MAX_TIME)
+        exclude = [vr]+self.video_subregion.exclusion_zones
+        current = tuple(stream.rectangle for stream in streams.values())
+        rects = identify_video_streams(ww, wh, self.statistics.last_damage_events, from_time,
+                                       exclude, current, self.max_video_streams-1)
+        if set(current)!=set(rects):
+            sublog("video streams were %s, now %s", current, rects)
+            self.set_video_streams(rects)
+        for stream in self.video_streams.values():
+            #update the fps:
+            stream.subregion.identify_video_subregion(ww, wh, self.statistics.damage_events_count,
+                                                      self.statistics.last_damage_events, self.statistics.last_resized)
+
     def close_video_stream_file(self):
         vsf = self.video_stream_file
         if vsf:
@@ -348,6 +461,9 @@ class WindowVideoSource(WindowSource):
     def ui_cleanup(self):
         WindowSource.ui_cleanup(self)
         self.video_subregion = None
+        for stream in self.video_streams.values():
+            stream.close()
+        self.video_streams = {}
 
 
     def set_new_encoding(self, encoding, strict=None):
@@ -380,6 +496,7 @@ class WindowVideoSource(WindowSource):
         #client may restrict csc modes for specific windows
         self.supports_scrolling = self.scroll_encoding and properties.boolget("encoding.scrolling", self.supports_scrolling) and not STRICT_MODE
         self.scroll_min_percent = properties.intget("scrolling.min-percent", self.scroll_min_percent)
+        self.motion_2d = self.supports_scrolling and properties.boolget("encoding.scrolling.motion", self.motion_2d) and MOTION_2D
         self.supports_video_scaling = properties.boolget("encoding.video_scaling", self.supports_video_scaling)
         self.video_subregion.supported = properties.boolget("encoding.video_subregion", VIDEO_SUBREGION) and VIDEO_SUBREGION
         if properties.get("scaling.control") is not None:
@@ -495,7 +612,15 @@ class WindowVideoSource(WindowSource):
                 return nonvideo(quality+30, "not enough pixels")
         return current_encoding
 
-    def get_best_nonvideo_encoding(self, ww, wh, speed, quality, current_encoding=None, options=[]):
+    def get_classify_encoding_getters(self):
+        return WindowSource.get_classify_encoding_getters(self) + (self.get_best_encoding_video, )
+
+    def get_classified_encoding(self, w, h, speed, quality, coding, content_type):
+        if not self.non_video_encodings:
+            return WindowSource.get_classified_encoding(self, w, h, speed, quality, coding, content_type)
+        return self.get_best_nonvideo_encoding(w, h, speed, quality, coding, self.non_video_encodings, content_type)
+
+    def get_best_nonvideo_encoding(self, ww, wh, speed, quality, current_encoding=None, options=[], content_type=None):
         #if we're here, then the window has no alpha (or the client cannot handle alpha)
         #and we can ignore the current encoding
         options = options or self.non_video_encodings
@@ -514,11 +639,16 @@ class WindowVideoSource(WindowSource):
         #take into account how many pixels need to be encoded:
         #more pixels means we switch to lossless more easily
         lossless_q = min(100, self._lossless_threshold_base + self._lossless_threshold_pixel_boost * pixel_count / (ww*wh))
+        lossless_content = content_type in LOSSLESS_CONTENT_TYPES
+        if content_type in LOSSY_CONTENT_TYPES:
+            lossless_q = 101
+        elif lossless_content:
+            lossless_q = 0
         if quality<lossless_q and depth>16 and "jpeg" in options and ww>=8 and wh>=8:
             #assume that we have "turbojpeg",
             #which beats everything in terms of efficiency for lossy compression:
             return "jpeg"
-        if "webp" in options and pixel_count>=16384 and ww>=2 and wh>=2 and depth in (24, 32):
+        if "webp" in options and pixel_count>=16384 and ww>=2 and wh>=2 and depth in (24, 32) and not lossless_content:
             return "webp"
         #lossless options:
         if speed==100 or (speed>=95 and pixel_count<MAX_RGB) or depth>24:
@@ -528,6 +658,9 @@ class WindowVideoSource(WindowSource):
                 return "rgb24"
             if "rgb32" in options:
                 return "rgb32"
+        if content_type=="ui" and self.rgb_lz4 and "rgb24" in options:
+            #flat areas compress very well and very quickly with lz4:
+            return "rgb24"
         if "png" in options:
             return "png"
         if "jpeg2000" in options and ww>=32 and wh>=32 and depth in (24, 32):
@@ -545,6 +678,12 @@ class WindowVideoSource(WindowSource):
             if r and r.intersects(x, y, w, h):
                 #the damage will take care of scheduling it again
                 vs.cancel_refresh_timer()
+        for stream in self.video_streams.values():
+            r = stream.rectangle
+            if r and r.intersects(x, y, w, h):
+                stream.subregion.cancel_refresh_timer()
+        self.scroll_damage_seq += 1
+        self.scroll_damage.append((self.scroll_damage_seq, x, y, w, h))
         WindowSource.do_damage(self, ww, wh, x, y, w, h, options)
 
 
@@ -554,6 +693,8 @@ class WindowVideoSource(WindowSource):
         vsr = self.video_subregion
         if vsr:
             vsr.cancel_refresh_timer()
+        for stream in self.video_streams.values():
+            stream.subregion.cancel_refresh_timer()
         self.scroll_data = None
         self.last_scroll_time = 0
         WindowSource.cancel_damage(self)
@@ -568,9 +709,12 @@ class WindowVideoSource(WindowSource):
             if vs.detection:
                 #reset the video region on full quality refresh
                 vs.reset()
+                self.clear_video_streams()
             else:
                 #keep the region, but cancel the refresh:
                 vs.cancel_refresh_timer()
+        for stream in self.video_streams.values():
+            stream.subregion.cancel_refresh_timer()
         self.scroll_data = None
         self.last_scroll_time = 0
         if self.non_video_encodings:
@@ -648,6 +792,8 @@ class WindowVideoSource(WindowSource):
         #override so we can update the subregion timers / regions tracking:
         WindowSource.remove_refresh_region(self, region)
         self.video_subregion.remove_refresh_region(region)
+        for stream in self.video_streams.values():
+            stream.subregion.remove_refresh_region(region)
 
     def add_refresh_region(self, region):
         #Note: this does not run in the UI thread!
@@ -658,20 +804,27 @@ class WindowVideoSource(WindowSource):
         if vr is None:
             #no video region, normal code path:
             return WindowSource.add_refresh_region(self, region)
-        if vr.contains_rect(region):
-            #all of it is in the video region:
-            self.video_subregion.add_video_refresh(region)
-            return 0
-        ir = vr.intersection_rect(region)
-        if ir is None:
-            #region is outside video region, normal code path:
-            return WindowSource.add_refresh_region(self, region)
-        #add intersection (rectangle in video region) to video refresh:
-        self.video_subregion.add_video_refresh(ir)
-        #add any rectangles not in the video region
+        #each video region (the video subregion and the additional video streams)
+        #handles the refresh of the rectangles within it:
+        regions = [region]
+        for vs in [self.video_subregion]+[stream.subregion for stream in self.video_streams.values()]:
+            vr = vs.rectangle
+            if not vr:
+                continue
+            outside = []
+            for r in regions:
+                ir = vr.intersection_rect(r)
+                if ir is None:
+                    outside.append(r)
+                    continue
+                #add intersection (rectangle in video region) to video refresh:
+                vs.add_video_refresh(ir)
+                outside += r.substract_rect(vr)
+            regions = outside
+        #add any rectangles not in the video regions
         #(if any: keep track if we actually added anything)
         pixels_modified = 0
-        for r in region.substract_rect(vr):
+        for r in regions:
             pixels_modified += WindowSource.add_refresh_region(self, r)
         return pixels_modified
 
@@ -737,37 +890,7 @@ class WindowVideoSource(WindowSource):
             return
         assert not self.full_frames_only
 
-        actual_vr = None
-        if vr in regions:
-            #found the video region the easy way: exact match in list
-            actual_vr = vr
-        else:
-            #find how many pixels are within the region (roughly):
-            #find all unique regions that intersect with it:
-            inter = tuple(x for x in (vr.intersection_rect(r) for r in regions) if x is not None)
-            if len(inter)>0:
-                #merge all regions into one:
-                in_region = merge_all(inter)
-                pixels_in_region = vr.width*vr.height
-                pixels_intersect = in_region.width*in_region.height
-                if pixels_intersect>=pixels_in_region*40/100:
-                    #we have at least 40% of the video region
-                    #that needs refreshing, do it:
-                    actual_vr = vr
-
-            #still no luck?
-            if actual_vr is None:
-                #try to find one that has the same dimensions:
-                same_d = tuple(r for r in regions if r.width==vr.width and r.height==vr.height)
-                if len(same_d)==1:
-                    #probably right..
-                    actual_vr = same_d[0]
-                elif len(same_d)>1:
-                    #find one that shares at least one coordinate:
-                    same_c = tuple(r for r in same_d if r.x==vr.x or r.y==vr.y)
-                    if len(same_c)==1:
-                        actual_vr = same_c[0]
-
+        actual_vr = self.find_video_region(vr, regions)
         if actual_vr is None:
             sublog("do_send_delayed_regions: video region %s not found in: %s", vr, regions)
         else:
@@ -781,16 +904,27 @@ class WindowVideoSource(WindowSource):
             video_options = options.copy()
             video_options["av-sync"] = True
             self.process_damage_region(damage_time, actual_vr.x, actual_vr.y, actual_vr.width, actual_vr.height, coding, video_options, 0)
+            regions = self.substract_video_region(regions, actual_vr)
+            if not regions:
+                return
 
-            #now substract this region from the rest:
-            trimmed = []
-            for r in regions:
-                trimmed += r.substract_rect(actual_vr)
-            if not trimmed:
-                sublog("do_send_delayed_regions: nothing left after removing video region %s", actual_vr)
+        #the additional video streams, each one using its own video encoder:
+        for stream_id, stream in self.video_streams.items():
+            sr = stream.rectangle
+            #streams don't move, so only look for the same rectangle:
+            actual_sr = self.find_video_region(sr, regions, False)
+            if actual_sr is None:
+                continue
+            ww, wh = self.window.get_dimensions()
+            if actual_sr.x+actual_sr.width>ww or actual_sr.y+actual_sr.height>wh:
+                continue
+            video_options = options.copy()
+            video_options["av-sync"] = True
+            video_options["stream"] = stream_id
+            self.process_damage_region(damage_time, actual_sr.x, actual_sr.y, actual_sr.width, actual_sr.height, coding, video_options, 0)
+            regions = self.substract_video_region(regions, actual_sr)
+            if not regions:
                 return
-            sublog("do_send_delayed_regions: subtracted %s from %s gives us %s", actual_vr, regions, trimmed)
-            regions = trimmed
 
         #merge existing damage delayed region if there is one:
         #(this codepath can fire from a video region refresh callback)
@@ -818,6 +952,54 @@ class WindowVideoSource(WindowSource):
             sublog("do_send_delayed_regions: delaying non video regions %s some more by %ims", regions, delay)
             self.expire_timer = self.timeout_add(delay, self.expire_delayed_region)
 
+    def find_video_region(self, vr, regions, same_dimensions=True):
+        """
+            Returns the rectangle we should send as video from the damaged regions given,
+            or None if the video region 'vr' does not need updating.
+            When 'same_dimensions' is set, a region with the same size is also accepted.
+        """
+        if not vr:
+            return None
+        if vr in regions:
+            #found the video region the easy way: exact match in list
+            return vr
+        #find how many pixels are within the region (roughly):
+        #find all unique regions that intersect with it:
+        inter = tuple(x for x in (vr.intersection_rect(r) for r in regions) if x is not None)
+        if len(inter)>0:
+            #merge all regions into one:
+            in_region = merge_all(inter)
+            pixels_in_region = vr.width*vr.height
+            pixels_intersect = in_region.width*in_region.height
+            if pixels_intersect>=pixels_in_region*40/100:
+                #we have at least 40% of the video region
+                #that needs refreshing, do it:
+                return vr
+        if not same_dimensions:
+            return None
+        #still no luck?
+        #try to find one that has the same dimensions:
+        same_d = tuple(r for r in regions if r.width==vr.width and r.height==vr.height)
+        if len(same_d)==1:
+            #probably right..
+            return same_d[0]
+        if len(same_d)>1:
+            #find one that shares at least one coordinate:
+            same_c = tuple(r for r in same_d if r.x==vr.x or r.y==vr.y)
+            if len(same_c)==1:
+                return same_c[0]
+        return None
+
+    def substract_video_region(self, regions, vr):
+        trimmed = []
+        for r in regions:
+            trimmed += r.substract_rect(vr)
+        if not trimmed:
+            sublog("do_send_delayed_regions: nothing left after removing video region %s", vr)
+        else:
+            sublog("do_send_delayed_regions: subtracted %s from %s gives us %s", vr, regions, trimmed)
+        return trimmed
+
     def must_encode_full_frame(self, encoding):
         return self.full_frames_only or (encoding in self.video_encodings) or not self.non_video_encodings
 
@@ -855,6 +1037,10 @@ class WindowVideoSource(WindowSource):
         if self.is_cancelled(sequence):
             image.free()
             return
+        if self.supports_scrolling:
+            #record which damage events this image includes:
+            options = options.copy()
+            options["scroll-damage-seq"] = self.scroll_damage_seq
         self.pixel_format = image.get_pixel_format()
         self.image_depth = image.get_depth()
         #image may have been clipped to the new window size during resize:
@@ -1035,6 +1221,7 @@ class WindowVideoSource(WindowSource):
                 #cannot use video subregions
                 #FIXME: small race if a refresh timer is due when we change encoding - meh
                 vs.reset()
+                self.clear_video_streams()
             else:
                 old = vs.rectangle
                 ww, wh = self.window_dimensions
@@ -1059,14 +1246,14 @@ class WindowVideoSource(WindowSource):
                     if old is None or old!=newrect:
                         refreshlog("identified new video region: %s", newrect)
                         #figure out if the new region had pending regular refreshes:
-                        subregion_needs_refresh = any(newrect.intersects_rect(x) for x in self.refresh_regions)
+                        subregion_needs_refresh = any(newrect.intersects_rect(x) for x in self.refresh_tiles)
                         if old:
                             #we don't bother substracting new and old (too complicated)
                             refreshlog("scheduling refresh of old region: %s", old)
                             #this may also schedule a refresh:
                             WindowSource.add_refresh_region(self, old)
                         WindowSource.remove_refresh_region(self, newrect)
-                        if not self.refresh_regions:
+                        if not self.refresh_tiles:
                             self.cancel_refresh_timer()
                         if subregion_needs_refresh:
                             vs.add_video_refresh(newrect)
@@ -1077,6 +1264,7 @@ class WindowVideoSource(WindowSource):
                     refreshlog("video region cleared, scheduling refresh of old region: %s", old)
                     self.add_refresh_region(old)
                     vs.cancel_refresh_timer()
+                self.update_video_streams(ww, wh)
         if force_reload:
             self.cleanup_codecs()
         self.check_pipeline_score(force_reload)
@@ -1209,7 +1397,21 @@ class WindowVideoSource(WindowSource):
             scorelog("get_video_pipeline_options%s using cached values from %ims ago", (encodings, width, height, src_format, force_refresh), 1000.0*(monotonic_time()-self.last_pipeline_time))
             return self.last_pipeline_scores
         scorelog("get_video_pipeline_options%s last params=%s, full_csc_modes=%s", (encodings, width, height, src_format, force_refresh), self.last_pipeline_params, self.full_csc_modes)
+        s = self.do_get_video_pipeline_options(encodings, width, height, src_format, self._csc_encoder, self._video_encoder)
+        if self.is_cancelled():
+            self.last_pipeline_params = None
+            self.last_pipeline_scores = ()
+        else:
+            self.last_pipeline_params = (encodings, width, height, src_format)
+            self.last_pipeline_scores = s
+        self.last_pipeline_time = monotonic_time()
+        return s
 
+    def do_get_video_pipeline_options(self, encodings, width, height, src_format, current_csce=None, current_ve=None):
+        """
+            Calculates the pipeline scores, without caching them,
+            'current_csce' and 'current_ve' are the instances we would be replacing.
+        """
         vh = self.video_helper
         if vh is None:
             return ()       #closing down
@@ -1275,7 +1477,7 @@ class WindowVideoSource(WindowSource):
                     detection = bool(vs) and vs.detection
                     score_data = get_pipeline_score(enc_in_format, csc_spec, encoder_spec, width, height, scaling,
                                                     target_q, min_q, target_s, min_s,
-                                                    self._csc_encoder, self._video_encoder,
+                                                    current_csce, current_ve,
                                                     score_delta, ffps, detection)
                     if score_data:
                         scores.append(score_data)
@@ -1295,13 +1497,6 @@ class WindowVideoSource(WindowSource):
                             add_scores("via %s (%s)" % (out_csc, actual_csc), csc_spec, out_csc)
         s = sorted(scores, key=lambda x : -x[0])
         scorelog("get_video_pipeline_options%s scores=%s", (encodings, width, height, src_format), s)
-        if self.is_cancelled():
-            self.last_pipeline_params = None
-            self.last_pipeline_scores = ()
-        else:
-            self.last_pipeline_params = (encodings, width, height, src_format)
-            self.last_pipeline_scores = s
-        self.last_pipeline_time = monotonic_time()
         return s
 
     def csc_equiv(self, csc_mode):
@@ -1503,8 +1698,10 @@ class WindowVideoSource(WindowSource):
         videolog("check_pipeline%s setting up a new pipeline as check failed - encodings=%s",
                  (encoding, width, height, src_format), encodings)
         #cleanup existing one if needed:
-        self.csc_clean(self._csc_encoder)
-        self.ve_clean(self._video_encoder)
+        self.csc_clean(self._csc_encoder, self._csc_pool_key)
+        self.ve_clean(self._video_encoder, self._video_encoder_pool_key)
+        self._csc_pool_key = None
+        self._video_encoder_pool_key = None
         #and make a new one:
         w = width & self.width_mask
         h = height & self.height_mask
@@ -1608,6 +1805,8 @@ class WindowVideoSource(WindowSource):
             #we're here because an exception occurred, cleanup before trying again:
             self.csc_clean(self._csc_encoder)
             self.ve_clean(self._video_encoder)
+            self._csc_pool_key = None
+            self._video_encoder_pool_key = None
         end = monotonic_time()
         if not self.is_cancelled():
             videolog("setup_pipeline(..) failed! took %.2fms", (end-start)*1000.0)
@@ -1638,14 +1837,19 @@ class WindowVideoSource(WindowSource):
             #so make sure it never degrades quality
             csc_speed = min(speed, 100-quality/2.0)
             csc_start = monotonic_time()
-            csce = csc_spec.make_instance()
-            csce.init_context(csc_width, csc_height, src_format,
-                                   enc_width, enc_height, enc_in_format, csc_speed)
+            csc_key = get_csc_key(csc_spec.codec_type, csc_width, csc_height, src_format,
+                                  enc_width, enc_height, enc_in_format, csc_speed)
+            csce = get_video_pool().get(csc_key)
+            if csce is None:
+                csce = csc_spec.make_instance()
+                csce.init_context(csc_width, csc_height, src_format,
+                                       enc_width, enc_height, enc_in_format, int(csc_speed))
             csc_end = monotonic_time()
             csclog("setup_pipeline: csc=%s, info=%s, setup took %.2fms",
                   csce, csce.get_info(), (csc_end-csc_start)*1000.0)
         else:
             csce = None
+            csc_key = None
             #use the encoder's mask directly since that's all we have to worry about!
             width_mask = encoder_spec.width_mask
             height_mask = encoder_spec.height_mask
@@ -1658,15 +1862,24 @@ class WindowVideoSource(WindowSource):
                 videolog("scaling is now enabled, so skipping %s", encoder_spec)
                 return False
         self._csc_encoder = csce
+        self._csc_pool_key = csc_key
         enc_start = monotonic_time()
         #FIXME: filter dst_formats to only contain formats the encoder knows about?
         dst_formats = tuple(bytestostr(x) for x in self.full_csc_modes.strlistget(encoder_spec.encoding))
-        ve = encoder_spec.make_instance()
+        video_options = self.get_video_encoder_options(encoder_spec.encoding, width, height)
         options = self.encoding_options.copy()
-        options.update(self.get_video_encoder_options(encoder_spec.encoding, width, height))
-        ve.init_context(enc_width, enc_height, enc_in_format,
-                        dst_formats, encoder_spec.encoding,
-                        quality, speed, encoder_scaling, options)
+        options.update(video_options)
+        ve_key = get_encoder_key(encoder_spec.codec_type, encoder_spec.encoding, enc_width, enc_height, enc_in_format,
+                                 dst_formats, encoder_scaling, options)
+        ve = get_video_pool().get(ve_key)
+        if ve is not None:
+            ve.set_encoding_speed(speed)
+            ve.set_encoding_quality(quality)
+        else:
+            ve = encoder_spec.make_instance()
+            ve.init_context(enc_width, enc_height, enc_in_format,
+                            dst_formats, encoder_spec.encoding,
+                            quality, speed, encoder_scaling, options)
         #record new actual limits:
         self.actual_scaling = scaling
         self.width_mask = width_mask
@@ -1678,6 +1891,7 @@ class WindowVideoSource(WindowSource):
         enc_end = monotonic_time()
         self.start_video_frame = 0
         self._video_encoder = ve
+        self._video_encoder_pool_key = ve_key
         videolog("setup_pipeline: csc=%s, video encoder=%s, info: %s, setup took %.2fms",
                 csce, ve, ve.get_info(), (enc_end-enc_start)*1000.0)
         scalinglog("setup_pipeline: scaling=%s, encoder_scaling=%s", scaling, encoder_scaling)
@@ -1727,6 +1941,22 @@ class WindowVideoSource(WindowSource):
         return packet
 
 
+    def get_scroll_damage(self, seq):
+        """
+            Returns the damage rectangles received since the last scroll data update,
+            or None if we can't tell and all the rows must be checksummed again.
+            (the damage history is updated from the UI thread, we only read a copy of it)
+        """
+        last = self.scroll_update_seq
+        self.scroll_update_seq = seq
+        if last<=0 or seq<last:
+            return None
+        history = tuple(self.scroll_damage)
+        if not history or history[0][0]>last+1:
+            #some of the damage events we need have been dropped from the history
+            return None
+        return tuple((x, y, w, h) for dseq, x, y, w, h in history if last<dseq<=seq)
+
     def encode_scrolling(self, scroll_data, image, options={}):
         start = monotonic_time()
         try:
@@ -1753,7 +1983,6 @@ class WindowVideoSource(WindowSource):
             raw_scroll = {}
             non_scroll = {0 : h}
         scrolllog(" will send scroll data=%s, non-scroll=%s", raw_scroll, non_scroll)
-        flush = len(non_scroll)
         #convert to a screen rectangle list for the client:
         scrolls = []
         for scroll, line_defs in raw_scroll.items():
@@ -1763,6 +1992,32 @@ class WindowVideoSource(WindowSource):
                 assert y+line+scroll>=0, "cannot scroll rectangle by %i lines from %i+%i" % (scroll, y, line)
                 assert y+line+scroll<=wh, "cannot scroll rectangle %i high by %i lines from %i+%i (window height is %i)" % (count, scroll, y, line, wh)
                 scrolls.append((x, y+line, w, count, 0, scroll))
+        non_scroll_rects = tuple((0, sy, w, sh) for sy, sh in non_scroll.items())
+        return self.send_scroll_and_rectangles(image, scrolls, non_scroll_rects, options, start)
+
+    def encode_motion(self, copies, repaint, image, options={}):
+        """
+            Send the blocks that have moved using the "scroll" encoding,
+            which the clients handle as a list of copy-rectangle instructions,
+            and encode the rest as rectangles.
+        """
+        start = monotonic_time()
+        try:
+            del options["av-sync"]
+        except KeyError:
+            pass
+        x, y = image.get_geometry()[:2]
+        scrolls = tuple((x+sx, y+sy, sw, sh, dx, dy) for sx, sy, sw, sh, dx, dy in copies)
+        scrolllog("encode_motion(%s, %s) copies=%s, repaint=%s", image, options, scrolls, repaint)
+        return self.send_scroll_and_rectangles(image, scrolls, repaint, options, start)
+
+    def send_scroll_and_rectangles(self, image, scrolls, rectangles, options, start):
+        """
+            The scrolls are in window coordinates,
+            the rectangles to encode are relative to the image.
+        """
+        x, y, w, h = image.get_geometry()[:4]
+        flush = len(rectangles)
         #send the scrolls if we have any
         #(zero change scrolls have been removed - so maybe there are none)
         if scrolls:
@@ -1780,15 +2035,15 @@ class WindowVideoSource(WindowSource):
             compresslog("compress: %5.1fms for %4ix%-4i pixels at %4i,%-4i for wid=%-5i using %9s as %3i rectangles  (%5iKB)           , sequence %5i, client_options=%s",
                  (end-start)*1000.0, w, h, x, y, self.wid, coding, len(scrolls), w*h*4/1024, self._damage_packet_sequence, client_options)
         #send the rest as rectangles:
-        if non_scroll:
+        if rectangles:
             speed, quality = self._current_speed, self._current_quality
             nsstart = monotonic_time()
             client_options = options.copy()
-            for sy, sh in non_scroll.items():
+            for sx, sy, sw, sh in rectangles:
                 substart = monotonic_time()
-                sub = image.get_sub_image(0, sy, w, sh)
-                encoding = self.get_best_nonvideo_encoding(w, sh, speed, quality)
-                assert encoding, "no nonvideo encoding found for %ix%i screen update" % (w, sh)
+                sub = image.get_sub_image(sx, sy, sw, sh)
+                encoding = self.get_best_nonvideo_encoding(sw, sh, speed, quality)
+                assert encoding, "no nonvideo encoding found for %ix%i screen update" % (sw, sh)
                 encode_fn = self._encoders[encoding]
                 ret = encode_fn(encoding, sub, options)
                 if not ret:
@@ -1804,17 +2059,17 @@ class WindowVideoSource(WindowSource):
                 #    from xpra.os_util import memoryview_to_bytes
                 #    from PIL import Image
                 #    im = Image.frombuffer("RGBA", (w, sh), memoryview_to_bytes(sub.get_pixels()), "raw", "BGRA", sub.get_rowstride(), 1)
-                #    filename = "./scroll-%i-%i.png" % (self._sequence, len(non_scroll)-flush)
+                #    filename = "./scroll-%i-%i.png" % (self._sequence, len(rectangles)-flush)
                 #    im.save(filename, "png")
                 #    log.info("saved scroll y=%i h=%i to %s", sy, sh, filename)
                 packet = self.make_draw_packet(sub.get_x(), sub.get_y(), outw, outh, coding, data, outstride, client_options, options)
                 self.queue_damage_packet(packet)
-                psize = w*sh*4
+                psize = sw*sh*4
                 csize = len(data)
                 compresslog("compress: %5.1fms for %4ix%-4i pixels at %4i,%-4i for wid=%-5i using %9s with ratio %5.1f%%  (%5iKB to %5iKB), sequence %5i, client_options=%s",
-                     (monotonic_time()-substart)*1000.0, w, sh, x+0, y+sy, self.wid, coding, 100.0*csize/psize, psize/1024, csize/1024, self._damage_packet_sequence, client_options)
+                     (monotonic_time()-substart)*1000.0, sw, sh, x+sx, y+sy, self.wid, coding, 100.0*csize/psize, psize/1024, csize/1024, self._damage_packet_sequence, client_options)
                 scrolllog("non-scroll encoding using %s (quality=%i, speed=%i) took %ims for %i rectangles",
-                          encoding, self._current_quality, self._current_speed, (monotonic_time()-nsstart)*1000, len(non_scroll))
+                          encoding, self._current_quality, self._current_speed, (monotonic_time()-nsstart)*1000, len(rectangles))
             else:
                 #we can't send the non-scroll areas, ouch!
                 flush = 0
@@ -1868,10 +2123,87 @@ class WindowVideoSource(WindowSource):
 
     def video_encode(self, encoding, image, options):
         try:
+            stream_id = options.get("stream")
+            if stream_id:
+                return self.video_stream_encode(stream_id, encoding, image, options)
             return self.do_video_encode(encoding, image, options)
         finally:
             self.free_image_wrapper(image)
 
+    def video_stream_encode(self, stream_id, encoding, image, options):
+        """
+            Encodes a frame for one of the additional video streams,
+            using a non-video encoding if the stream is gone or if we can't setup a pipeline for it.
+
+            Runs in the 'encode' thread.
+        """
+        stream = self.video_streams.get(stream_id)
+        if not stream or stream.closed or not self.common_video_encodings or self.image_depth not in (24, 32):
+            return self.video_fallback(image, options)
+        vh = self.video_helper
+        if vh is None:
+            return None         #shortcut when closing down
+        stream.cancel_idle_timer()
+        w, h = image.get_geometry()[2:4]
+        src_format = image.get_pixel_format()
+        if encoding=="auto":
+            encodings = self.common_video_encodings
+        else:
+            encodings = [encoding]
+        quality = max(0, min(100, self._current_quality))
+        speed = max(0, min(100, self._current_speed))
+        video_options = self.get_video_encoder_options(encoding, w, h)
+        #streams are never delayed:
+        video_options.pop("b-frames", None)
+        if not stream.check_pipeline(encodings, w, h, src_format):
+            #no need for eos: the client starts a new decoder with the first frame
+            stream.clean()
+            scores = self.do_get_video_pipeline_options(encodings, w, h, src_format)
+            if not stream.setup_pipeline(scores, w, h, src_format, quality, speed,
+                                         self.full_csc_modes, self.encoding_options, video_options):
+                if self.is_cancelled():
+                    return None
+                videolog("no video pipeline for stream %s at %ix%i", stream, w, h)
+                return self.video_fallback(image, options)
+        csce = stream.csce
+        ve = stream.ve
+        csc_image = image
+        csc = src_format
+        start = monotonic_time()
+        try:
+            if csce:
+                csc_image = csce.convert_image(image)
+                if not csc_image:
+                    raise Exception("conversion of %s to %s failed" % (image, csce.get_dst_format()))
+                csc = csce.get_dst_format()
+            ret = ve.compress_image(csc_image, quality, speed, video_options)
+        except Exception as e:
+            videolog("%s.compress_image%s", ve, (csc_image, quality, speed, video_options), exc_info=True)
+            if self.is_cancelled():
+                return None
+            videolog.error("Error: failed to encode %s video frame for stream %i:", ve.get_type(), stream_id)
+            videolog.error(" %s", e)
+            stream.clean()
+            return self.video_fallback(image, options)
+        finally:
+            if csc_image is not image:
+                self.free_image_wrapper(csc_image)
+            del csc_image
+        if ret is None:
+            return self.video_fallback(image, options)
+        data, client_options = ret
+        end = monotonic_time()
+        stream.frames += 1
+        #free the pipeline if the stream stops updating:
+        stream.schedule_idle_timer(VIDEO_TIMEOUT*1000, self.video_stream_timeout)
+        client_options["csc"] = self.csc_equiv(csc)
+        client_options["stream"] = stream_id
+        actual_encoding = ve.get_encoding()
+        videolog("video_stream_encode %s encoder: %4s %4ix%-4i result is %7i bytes, %6.1f MPixels/s, client options=%s",
+                 ve.get_type(), actual_encoding, w, h, len(data or ""),
+                 (w*h/(end-start+0.000001)/1024.0/1024.0), client_options)
+        return actual_encoding, Compressed(actual_encoding, data), client_options, w, h, 0, 24
+
     def do_video_encode(self, encoding, image, options):
         """
             This method is used by make_data_packet to encode frames using video encoders.
@@ -1924,6 +2256,7 @@ class WindowVideoSource(WindowSource):
                     if not scroll_data:
                         scroll_data = ScrollData()
                         self.scroll_data = scroll_data
+                        self.scroll_update_seq = 0
                         scrolllog("new scroll data: %s", scroll_data)
                     if not image.is_thread_safe():
                         #what we really want is to check that the frame has been frozen,
@@ -1939,7 +2272,8 @@ class WindowVideoSource(WindowSource):
                     pixels = image.get_pixels()
                     if not pixels:
                         return None
-                    scroll_data.update(pixels, x, y, w, h, stride, bpp)
+                    damage = self.get_scroll_damage(options.get("scroll-damage-seq", 0))
+                    scroll_data.update(pixels, x, y, w, h, stride, bpp, damage)
                     max_distance = min(1000, (100-self.scroll_min_percent)*h//100)
                     scroll_data.calculate(max_distance)
                     #marker telling us not to invalidate the scroll data from here on:
@@ -1952,6 +2286,19 @@ class WindowVideoSource(WindowSource):
                     #if enough scrolling is detected, use scroll encoding for this frame:
                     if match_pct>=self.scroll_min_percent:
                         return self.encode_scrolling(scroll_data, image, options)
+                    #look for blocks moving sideways or in any direction,
+                    #but only if most of the lines have changed:
+                    if self.motion_2d and scroll_data.get_changed_lines()*100>=h*self.scroll_min_percent:
+                        start = monotonic_time()
+                        motion = scroll_data.calculate_motion(max_distance)
+                        if motion:
+                            copies, repaint = motion
+                            repaint_pct = int(100*sum(rw*rh for _, _, rw, rh in repaint)/(w*h))
+                            end = monotonic_time()
+                            scrolllog("motion detection took %ims, %i copies, %i%% to repaint in %i rectangles",
+                                      (end-start)*1000, len(copies), repaint_pct, len(repaint))
+                            if 100-repaint_pct>=self.scroll_min_percent and len(copies)<MAX_MOTION_RECTS and len(repaint)<MAX_MOTION_RECTS:
+                                return self.encode_motion(copies, repaint, image, options)
                 except Exception:
                     scrolllog("do_video_encode%s scrolling detection", (encoding, image, options), exc_info=True)
                     if not self.is_cancelled():